@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+__all__ = ["BlobFile"]
+
+import collections.abc
+import mmap
+import os
+import pathlib
+
+
+class BlobFile:
+    """An append-only file of blobs, read by memory mapping.
+
+    Blobs are appended to the end of the file, and read back
+    by (offset, length) as memoryview slices of a read-only memory map
+    of the file, so reading copies nothing: the operating system
+    reads pages of the file as they are touched, and can drop them
+    again when memory is short. Opening the file costs nothing
+    until a blob is read.
+
+    The file has no index; the caller must save the offset
+    and length of each blob. Blobs that are no longer needed
+    remain in the file (as dead space), until the caller copies
+    the blobs it needs to a new file and replaces this file with it
+    (see PatternDatabase.compact_blob_file).
+
+    Not thread-safe.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        Path to the file. It is created when the first blob is appended.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self._mmap: mmap.mmap | None = None
+
+    @property
+    def size(self) -> int:
+        """The size of the file (bytes); 0 if it does not exist."""
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def append(self, data: bytes) -> int:
+        """Append a blob and sync it to storage; return its offset.
+
+        May be called from a different thread than `read`,
+        as long as calls are serialized.
+        """
+        return self.append_all([data])[0]
+
+    def append_all(
+        self, blobs: collections.abc.Iterable[bytes | memoryview]
+    ) -> list[int]:
+        """Append blobs and sync them to storage (once);
+        return their offsets.
+
+        May be called from a different thread than `read`,
+        as long as calls are serialized.
+        """
+        offsets: list[int] = []
+        with open(self.path, "ab") as f:
+            for data in blobs:
+                offsets.append(f.tell())
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return offsets
+
+    def read(self, offset: int, length: int) -> memoryview:
+        """Read a blob, as a read-only memoryview of the file.
+
+        Raises
+        ------
+        ValueError
+            If the blob is not entirely in the file.
+        """
+        end = offset + length
+        if offset < 0 or length < 0:
+            raise ValueError(f"Invalid blob {offset=}, {length=}")
+        if self._mmap is None or end > len(self._mmap):
+            # Map the whole file, including blobs appended since
+            # the previous map. Do not close the previous map:
+            # memoryviews of it may still exist; it is unmapped
+            # once they are released.
+            self._mmap = None
+            file_size = self.size
+            if end > file_size:
+                raise ValueError(
+                    f"Blob {offset=}, {length=} extends past the end "
+                    f"of {self.path} ({file_size} bytes)"
+                )
+            if file_size == 0:
+                return memoryview(b"")
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)[offset:end]
+
+    def replace(self, path: pathlib.Path) -> None:
+        """Replace the file with another file, such as a compacted copy,
+        and drop the memory map.
+
+        Existing memoryviews (of the old file) remain valid.
+        """
+        os.replace(path, self.path)
+        self._mmap = None
+
+    def close(self) -> None:
+        """Drop the memory map.
+
+        It is unmapped once all memoryviews of it are released.
+        """
+        self._mmap = None
@@ -3,6 +3,8 @@ from __future__ import annotations
 import dataclasses
 import enum
 
+from .pattern_database import PatternMetadata
+
 
 class ConnectionStateEnum(enum.IntEnum):
     """Client websocket connection state."""
@@ -57,6 +59,17 @@ class LoomConnectionState:
     reason: str = ""
 
 
+@dataclasses.dataclass
+class LoomLinkLatency:
+    """The round-trip time of the network connection to the loom
+
+    Only reported for network connections (e.g. "socket://host:port").
+    """
+
+    type: str = dataclasses.field(init=False, default="LoomLinkLatency")
+    round_trip_time: float  # seconds
+
+
 @dataclasses.dataclass
 class LoomState:
     """The state output by the loom.
@@ -85,10 +98,34 @@ class LoomState:
 
 @dataclasses.dataclass
 class PatternNames:
-    """The list of loaded patterns (including the current pattern)"""
+    """The names of the most recently used patterns, oldest first
+    (including the current pattern)
+
+    At most NUM_MENU_PATTERNS names; use the search_patterns command
+    to find other patterns.
+
+    version is incremented whenever the names change,
+    so a client can ignore names it already has.
+    """
 
     type: str = dataclasses.field(init=False, default="PatternNames")
     names: list[str]
+    version: int = 0
+
+
+@dataclasses.dataclass
+class PatternPage:
+    """One page of the results of a pattern search,
+    most recently used first.
+    """
+
+    type: str = dataclasses.field(init=False, default="PatternPage")
+    query: str
+    offset: int
+    total: int  # total number of matching patterns
+    patterns: list[PatternMetadata]
+    # Only patterns with the same warp as the current pattern?
+    same_warp: bool = False
 
 
 @dataclasses.dataclass
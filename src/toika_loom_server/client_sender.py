@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+__all__ = ["ClientSender", "ClientSenderStats"]
+
+import asyncio
+import collections
+import dataclasses
+import itertools
+import logging
+import time
+from typing import Any
+
+from fastapi import WebSocket
+
+from .loom_constants import LOG_NAME
+
+# The default maximum number of messages waiting to be sent
+DEFAULT_MAX_QUEUE_SIZE = 100
+
+# Types of messages that are superseded by a newer message of the same type.
+# Only the most recent message of each of these types is kept in the queue.
+COALESCED_TYPES = frozenset(
+    (
+        "CurrentPickNumber",
+        "JumpPickNumber",
+        "LoomConnectionState",
+        "LoomLinkLatency",
+        "LoomState",
+        "PatternNames",
+        "ReducedPattern",
+        "WeaveDirection",
+    )
+)
+
+# Types of messages that are never dropped, even if the queue is full,
+# in addition to COALESCED_TYPES (which are never dropped because
+# no later message may replace them, and the queue holds at most one
+# message of each).
+NEVER_DROPPED_TYPES = frozenset(("CommandProblem",))
+
+
+@dataclasses.dataclass
+class ClientSenderStats:
+    """Statistics for a ClientSender.
+
+    Latency is the time from queuing a message to finishing sending it.
+    """
+
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    num_sent: int = 0
+    num_coalesced: int = 0
+    num_dropped: int = 0
+    mean_latency: float = 0
+    max_latency: float = 0
+
+
+class ClientSender:
+    """Send messages to a client from a dedicated task.
+
+    Messages are queued by `send` (which never blocks) and sent
+    in order by a background task, so a slow client cannot delay
+    the caller.
+
+    Messages whose type is in COALESCED_TYPES are coalesced: queuing one
+    discards any queued message of the same type. If the queue is full,
+    the oldest queued message whose type is in neither COALESCED_TYPES
+    nor NEVER_DROPPED_TYPES is dropped; if there is no such message,
+    the queue grows.
+
+    Once the sender is closed, or has stopped because sending failed
+    (e.g. the client disconnected), messages are no longer queued.
+
+    Parameters
+    ----------
+    websocket : WebSocket
+        Connection to the client.
+    max_queue_size : int
+        The maximum number of queued messages.
+    """
+
+    def __init__(
+        self, websocket: WebSocket, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE
+    ) -> None:
+        self.log = logging.getLogger(LOG_NAME)
+        self.websocket = websocket
+        self.max_queue_size = max_queue_size
+        self.stats = ClientSenderStats()
+        # dict of key: (queue time, message dict), where key is the message
+        # type for coalesced messages, else a unique int.
+        self.queue: collections.OrderedDict[Any, tuple[float, dict[str, Any]]] = (
+            collections.OrderedDict()
+        )
+        self.queue_event = asyncio.Event()
+        self.empty_event = asyncio.Event()
+        self.empty_event.set()
+        self.message_counter = itertools.count()
+        self.closed = False
+        self.send_task = asyncio.create_task(self.send_loop())
+
+    @property
+    def is_running(self) -> bool:
+        """Is the send task running?"""
+        return not self.send_task.done()
+
+    def send(self, message: dict[str, Any]) -> bool:
+        """Queue a message to send to the client.
+
+        Return True if the message was queued, False if the sender
+        is closed.
+
+        Parameters
+        ----------
+        message : dict[str, Any]
+            The message. It must have a "type" field whose value is a string.
+        """
+        if self.closed:
+            return False
+        message_type = message["type"]
+        if message_type in COALESCED_TYPES:
+            key: Any = message_type
+            if self.queue.pop(key, None) is not None:
+                self.stats.num_coalesced += 1
+        else:
+            key = next(self.message_counter)
+        if len(self.queue) >= self.max_queue_size:
+            self._drop_oldest()
+        self.queue[key] = (time.monotonic(), message)
+        self.stats.queue_depth = len(self.queue)
+        self.stats.max_queue_depth = max(
+            self.stats.max_queue_depth, self.stats.queue_depth
+        )
+        self.empty_event.clear()
+        self.queue_event.set()
+        return True
+
+    async def close(self) -> None:
+        """Stop sending messages. Queued messages are discarded."""
+        self.send_task.cancel()
+        self._discard_queue()
+
+    async def flush(self, timeout: float) -> None:
+        """Wait for queued messages to be sent, or for the timeout to expire.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time to wait (seconds).
+        """
+        try:
+            async with asyncio.timeout(timeout):
+                await self.empty_event.wait()
+        except TimeoutError:
+            pass
+
+    async def send_loop(self) -> None:
+        """Send queued messages."""
+        try:
+            while True:
+                if not self.queue:
+                    self.empty_event.set()
+                    self.queue_event.clear()
+                    await self.queue_event.wait()
+                    continue
+                _, (queue_time, message) = self.queue.popitem(last=False)
+                self.stats.queue_depth = len(self.queue)
+                await self.websocket.send_json(message)
+                latency = time.monotonic() - queue_time
+                self.stats.num_sent += 1
+                self.stats.mean_latency += (
+                    latency - self.stats.mean_latency
+                ) / self.stats.num_sent
+                self.stats.max_latency = max(self.stats.max_latency, latency)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.log.info(f"ClientSender: stop sending to client: {e!r}")
+        finally:
+            self._discard_queue()
+
+    def _discard_queue(self) -> None:
+        """Mark the sender closed and discard queued messages."""
+        self.closed = True
+        self.queue.clear()
+        self.stats.queue_depth = 0
+        self.empty_event.set()
+
+    def _drop_oldest(self) -> None:
+        """Drop the oldest queued message that may be dropped, if any."""
+        for key, (_, message) in self.queue.items():
+            if (
+                message["type"] not in COALESCED_TYPES
+                and message["type"] not in NEVER_DROPPED_TYPES
+            ):
+                del self.queue[key]
+                self.stats.num_dropped += 1
+                self.log.warning(
+                    f"ClientSender: queue full; dropped {message['type']} message"
+                )
+                return
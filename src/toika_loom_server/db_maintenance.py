@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+__all__ = [
+    "DEFAULT_IDLE_TIME",
+    "DEFAULT_MAINTENANCE_INTERVAL",
+    "MAINTENANCE_TASKS",
+    "DatabaseMaintenance",
+]
+
+import asyncio
+import collections.abc
+import logging
+import time
+from typing import Any
+
+from .loom_constants import LOG_NAME
+from .pattern_database import PatternDatabase
+from .pick_latency import LatencyHistogram
+
+# Default time the looms must be idle before maintenance runs (seconds)
+DEFAULT_IDLE_TIME = 60
+
+# Default interval between maintenance cycles (seconds)
+DEFAULT_MAINTENANCE_INTERVAL = 60 * 60
+
+# Default interval between checks of whether the looms are idle (seconds)
+DEFAULT_IDLE_POLL_INTERVAL = 5
+
+# Maximum number of free pages to return to the file system per slice
+VACUUM_PAGES_PER_SLICE = 100
+
+# Maximum number of patterns to delete per slice, to meet the size budget
+PRUNE_PATTERNS_PER_SLICE = 10
+
+# Maintenance tasks, in the order they are run in each cycle:
+# * prune: delete the least recently used patterns until the database
+#   is within its size budget (if it has one, and it can be met).
+# * compact: reclaim the space of deleted patterns in the blob file,
+#   if much of it is unused; this copies bodies into the database,
+#   so it comes before vacuum.
+# * vacuum: return free pages to the file system.
+# * checkpoint: copy the write-ahead log into the database.
+# * optimize: update the query planner's statistics, if needed.
+# * quick_check: check the integrity of the database.
+MAINTENANCE_TASKS = (
+    "prune",
+    "compact",
+    "vacuum",
+    "checkpoint",
+    "optimize",
+    "quick_check",
+)
+
+
+class DatabaseMaintenance:
+    """Maintain a pattern database in the background, while the looms
+    are idle.
+
+    Every interval seconds, run each of MAINTENANCE_TASKS,
+    in small slices. Before each slice, wait until the looms have been
+    idle for at least idle_time, so maintenance does not compete
+    with weaving. Each slice holds the database connection briefly
+    (typically a few milliseconds, though compacting the blob file
+    holds it while it copies the bodies in use), so it can at most
+    delay saving a pick number; picks are sent from memory,
+    without the database.
+
+    The integrity check cannot be split into slices, so it is run
+    on a separate connection and abandoned as soon as a loom becomes
+    active; it is retried in the next cycle.
+
+    The time taken by each slice is recorded in a histogram per task.
+
+    Must be constructed and used in the event loop that runs the database.
+
+    Parameters
+    ----------
+    pattern_db : PatternDatabase
+        The pattern database. It must be open while maintenance runs.
+    is_idle : collections.abc.Callable[[float], bool]
+        Function that returns True if the looms have been idle
+        for at least the specified time (seconds).
+        It is also called in a different thread, during the integrity check.
+    max_db_bytes : int
+        Size budget of the stored patterns (bytes; see
+        PatternDatabase.get_size); 0 for no limit. The least recently
+        used patterns (for any loom) are deleted to meet it, though
+        the two most recent patterns for each loom are always kept;
+        if those do not fit, nothing is deleted and a warning is logged.
+    interval : float
+        Interval between maintenance cycles (seconds).
+    idle_time : float
+        How long the looms must be idle before a slice runs (seconds).
+    idle_poll_interval : float
+        Interval between checks of whether the looms are idle (seconds).
+    """
+
+    def __init__(
+        self,
+        pattern_db: PatternDatabase,
+        is_idle: collections.abc.Callable[[float], bool],
+        max_db_bytes: int = 0,
+        interval: float = DEFAULT_MAINTENANCE_INTERVAL,
+        idle_time: float = DEFAULT_IDLE_TIME,
+        idle_poll_interval: float = DEFAULT_IDLE_POLL_INTERVAL,
+    ) -> None:
+        if interval <= 0:
+            raise ValueError(f"{interval=} must be positive")
+        self.log = logging.getLogger(LOG_NAME)
+        self.pattern_db = pattern_db
+        self.is_idle = is_idle
+        self.max_db_bytes = max_db_bytes
+        self.interval = interval
+        self.idle_time = idle_time
+        self.idle_poll_interval = idle_poll_interval
+        self.slice_durations = {task: LatencyHistogram() for task in MAINTENANCE_TASKS}
+        self.num_cycles = 0
+        self.num_patterns_pruned = 0
+        self.num_checks_abandoned = 0
+        # Result of the last completed integrity check; None if none
+        self.check_result: str | None = None
+        # Size of the stored patterns and of the database's files
+        # at the end of the last cycle (bytes)
+        self.db_bytes: int | None = None
+        self.db_disk_bytes: int | None = None
+        self.stopped = False
+        self.maintenance_task: asyncio.Future = asyncio.Future()
+
+    def start(self) -> None:
+        """Start (or restart) maintenance."""
+        self.maintenance_task.cancel()
+        self.stopped = False
+        self.maintenance_task = asyncio.create_task(self.maintenance_loop())
+
+    def stop(self) -> None:
+        """Stop maintenance, abandoning any integrity check."""
+        self.stopped = True
+        self.maintenance_task.cancel()
+
+    async def maintenance_loop(self) -> None:
+        while True:
+            try:
+                await self.run_cycle()
+            except Exception as e:
+                self.log.exception(f"DatabaseMaintenance: cycle failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    async def run_cycle(self) -> None:
+        """Run one maintenance cycle: each task, in slices,
+        waiting for the looms to be idle before each slice.
+        """
+        if self.max_db_bytes > 0:
+            await self.prune()
+
+        await self.run_slice("compact", self.pattern_db.compact_blob_file)
+
+        num_free_pages = None
+        while True:
+            prev_num_free_pages = num_free_pages
+            num_free_pages = await self.run_slice(
+                "vacuum",
+                self.pattern_db.incremental_vacuum,
+                max_pages=VACUUM_PAGES_PER_SLICE,
+            )
+            # Stop if there is no progress, e.g. if auto-vacuum is disabled
+            if num_free_pages == 0 or num_free_pages == prev_num_free_pages:
+                break
+
+        await self.run_slice("checkpoint", self.pattern_db.checkpoint)
+        await self.run_slice("optimize", self.pattern_db.optimize)
+
+        check_result = await self.run_slice(
+            "quick_check",
+            self.pattern_db.quick_check,
+            should_stop=lambda: self.stopped or not self.is_idle(self.idle_time),
+        )
+        if check_result is None:
+            self.num_checks_abandoned += 1
+        else:
+            if check_result != "ok":
+                self.log.error(
+                    "DatabaseMaintenance: the pattern database is damaged: "
+                    f"{check_result}"
+                )
+            self.check_result = check_result
+
+        self.db_bytes = await self.pattern_db.get_size()
+        self.db_disk_bytes = self.pattern_db.get_disk_size()
+        self.num_cycles += 1
+
+    async def prune(self) -> None:
+        """Delete the least recently used patterns, in slices,
+        until the stored patterns are within the size budget,
+        unless deleting patterns cannot meet it.
+        """
+        if await self.pattern_db.get_size() <= self.max_db_bytes:
+            return
+        min_size = await self.run_slice("prune", self.pattern_db.get_min_size)
+        if min_size > self.max_db_bytes:
+            self.log.warning(
+                "DatabaseMaintenance: deleting patterns cannot meet "
+                f"the size budget of {self.max_db_bytes} bytes; "
+                f"the patterns that are always kept need {min_size} bytes"
+            )
+            return
+        while True:
+            num_pruned = await self.run_slice(
+                "prune",
+                self.pattern_db.prune_to_size,
+                max_bytes=self.max_db_bytes,
+                max_patterns=PRUNE_PATTERNS_PER_SLICE,
+            )
+            if num_pruned == 0:
+                break
+            self.num_patterns_pruned += num_pruned
+
+    async def run_slice(
+        self,
+        task: str,
+        func: collections.abc.Callable[..., collections.abc.Awaitable[Any]],
+        **kwargs: Any,
+    ) -> Any:
+        """Wait until the looms are idle, then run and time one slice
+        of a maintenance task, and return its result.
+
+        Parameters
+        ----------
+        task : str
+            The task: one of MAINTENANCE_TASKS.
+        func : collections.abc.Callable[..., collections.abc.Awaitable[Any]]
+            Async function that runs the slice.
+        **kwargs : Any
+            Keyword arguments for func.
+        """
+        await self.wait_for_idle()
+        start_time = time.perf_counter()
+        result = await func(**kwargs)
+        self.slice_durations[task].record(time.perf_counter() - start_time)
+        return result
+
+    async def wait_for_idle(self) -> None:
+        """Wait until the looms have been idle for at least idle_time."""
+        while not self.is_idle(self.idle_time):
+            await asyncio.sleep(self.idle_poll_interval)
+
+    def get_stats(self) -> dict[str, Any]:
+        """Get statistics, as a dict that can be encoded as json."""
+        return dict(
+            num_cycles=self.num_cycles,
+            num_patterns_pruned=self.num_patterns_pruned,
+            num_checks_abandoned=self.num_checks_abandoned,
+            check_result=self.check_result,
+            db_bytes=self.db_bytes,
+            db_disk_bytes=self.db_disk_bytes,
+            max_db_bytes=self.max_db_bytes,
+            slice_durations={
+                task: histogram.as_dict()
+                for task, histogram in self.slice_durations.items()
+            },
+        )
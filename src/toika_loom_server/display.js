@@ -3,6 +3,10 @@ const TranslationDict = {}
 
 const MaxFiles = 10
 
+// Delay after the user stops typing in the pattern search box
+// before searching (msec)
+const SearchDelay = 300
+
 const MinBlockSize = 11
 const MaxBlockSize = 41
 // Display gap on left and right edges of warp and top and bottom edges of weft
@@ -110,8 +114,20 @@ class LoomClient {
         this.loomConnectionState = ConnectionStateEnum.disconnected
         this.loomConnectionStateReason = ""
         this.loomState = null
+        this.loomRoundTripTime = null
         this.jumpPickNumber = null
         this.jumpRepeatNumber = null
+        // The version of the pattern names in the pattern menu
+        this.patternNamesVersion = null
+        // The current pattern search query ("" if not searching),
+        // whether to only show patterns with the same warp
+        // as the current pattern,
+        // the number of matching patterns, and the number shown
+        this.searchQuery = ""
+        this.searchSameWarp = false
+        this.searchTotal = 0
+        this.numSearchResults = 0
+        this.searchTimer = null
         // this.init()
     }
 
@@ -184,6 +200,15 @@ class LoomClient {
 
         var patternMenu = document.getElementById("pattern_menu")
         patternMenu.addEventListener("change", this.handlePatternMenu.bind(this))
+
+        var patternSearchElt = document.getElementById("pattern_search")
+        patternSearchElt.addEventListener("input", this.handlePatternSearchInput.bind(this))
+
+        var patternSearchSameWarpElt = document.getElementById("pattern_search_same_warp")
+        patternSearchSameWarpElt.addEventListener("change", this.searchPatterns.bind(this))
+
+        var patternSearchMoreElt = document.getElementById("pattern_search_more")
+        patternSearchMoreElt.addEventListener("click", this.handlePatternSearchMore.bind(this))
     }
 
     /*
@@ -216,6 +241,10 @@ class LoomClient {
             this.loomConnectionState = ConnectionStateTranslationDict[datadict.state]
             this.loomConnectionStateReason = datadict.reason
             this.displayLoomState()
+        } else if (datadict.type == "LoomLinkLatency") {
+            resetCommandProblemMessage = false
+            this.loomRoundTripTime = datadict.round_trip_time
+            this.displayLoomState()
         } else if (datadict.type == "LoomState") {
             resetCommandProblemMessage = false
             this.loomState = datadict
@@ -225,7 +254,14 @@ class LoomClient {
             this.displayCurrentPattern()
             var patternMenu = document.getElementById("pattern_menu")
             patternMenu.value = this.currentPattern.name
+            if (this.searchSameWarp) {
+                // The results depend on the current pattern
+                this.searchPatterns()
+            }
+        } else if (datadict.type == "PatternNames" && datadict.version == this.patternNamesVersion) {
+            // The pattern menu already has these names
         } else if (datadict.type == "PatternNames") {
+            this.patternNamesVersion = datadict.version
             /*
             Why this code is so odd:
             • The <hr> separator is not part of option list, and there is no good way
@@ -269,6 +305,9 @@ class LoomClient {
                 menuOptions.remove(patternNames.length)
             }
             patternMenu.value = currentName
+        } else if (datadict.type == "PatternPage") {
+            resetCommandProblemMessage = false
+            this.displayPatternPage(datadict)
         } else if (datadict.type == "CommandProblem") {
             resetCommandProblemMessage = false
             var color = SeverityColors[datadict.severity]
@@ -289,6 +328,37 @@ class LoomClient {
         }
     }
 
+    /*
+    Display a page of pattern search results.
+
+    Each result is a button that selects the pattern.
+    Ignore pages for an out of date query.
+    */
+    displayPatternPage(datadict) {
+        if (datadict.query != this.searchQuery || datadict.same_warp != this.searchSameWarp) {
+            return
+        }
+        var resultsElt = document.getElementById("pattern_search_results")
+        if (datadict.offset == 0) {
+            resultsElt.replaceChildren()
+            this.numSearchResults = 0
+        } else if (datadict.offset != this.numSearchResults) {
+            return
+        }
+        for (const item of datadict.patterns) {
+            var button = document.createElement("button")
+            button.type = "button"
+            button.className = "pattern-search-result"
+            button.textContent = `${item.name} (${item.num_shafts} ${t("shafts")}, ${item.num_picks} ${t("picks")})`
+            button.addEventListener("click", this.handlePatternSearchResult.bind(this, item.name))
+            resultsElt.appendChild(button)
+        }
+        this.numSearchResults += datadict.patterns.length
+        this.searchTotal = datadict.total
+        var patternSearchMoreElt = document.getElementById("pattern_search_more")
+        patternSearchMoreElt.style.display = this.numSearchResults < this.searchTotal ? "inline" : "none"
+    }
+
     // Display the weave direction -- the value of the global "weaveForward" 
     displayDirection() {
         var weaveDirectionElt = document.getElementById("weave_direction")
@@ -325,6 +395,10 @@ class LoomClient {
                 }
             }
         }
+        if ((this.loomRoundTripTime != null) && (this.loomConnectionState == ConnectionStateEnum.connected)) {
+            // Round-trip time of a network connection to the loom
+            text = text + " (" + Math.round(this.loomRoundTripTime * 1000) + " ms)"
+        }
         var statusElt = document.getElementById("status")
         statusElt.textContent = text
         statusElt.style.color = text_color
@@ -533,6 +607,72 @@ class LoomClient {
         await this.sendCommand(command)
     }
 
+    /*
+    Handle typing in the pattern search box.
+
+    Search once the user stops typing for SearchDelay msec;
+    a blank search box clears the results.
+    */
+    async handlePatternSearchInput(event) {
+        clearTimeout(this.searchTimer)
+        this.searchTimer = setTimeout(this.searchPatterns.bind(this), SearchDelay)
+    }
+
+    /*
+    Handle the pattern_search_more button: fetch the next page of results.
+    */
+    async handlePatternSearchMore(event) {
+        var command = {
+            "type": "search_patterns",
+            "query": this.searchQuery,
+            "same_warp": this.searchSameWarp,
+            "offset": this.numSearchResults,
+        }
+        await this.sendCommand(command)
+    }
+
+    /*
+    Handle clicking a pattern search result: select the pattern
+    and clear the search.
+    */
+    async handlePatternSearchResult(name, event) {
+        var patternSearchElt = document.getElementById("pattern_search")
+        patternSearchElt.value = ""
+        await this.searchPatterns()
+        var command = { "type": "select_pattern", "name": name }
+        await this.sendCommand(command)
+    }
+
+    /*
+    Search for patterns matching the contents of the pattern search box
+    (and, if the "same warp" box is checked, that have the same warp
+    as the current pattern).
+
+    Send the "search_patterns" command, or clear the results if blank
+    and the "same warp" box is not checked.
+    */
+    async searchPatterns() {
+        var patternSearchElt = document.getElementById("pattern_search")
+        var patternSearchSameWarpElt = document.getElementById("pattern_search_same_warp")
+        this.searchQuery = patternSearchElt.value.trim()
+        this.searchSameWarp = patternSearchSameWarpElt.checked
+        this.numSearchResults = 0
+        if (this.searchQuery == "" && !this.searchSameWarp) {
+            var resultsElt = document.getElementById("pattern_search_results")
+            resultsElt.replaceChildren()
+            var patternSearchMoreElt = document.getElementById("pattern_search_more")
+            patternSearchMoreElt.style.display = "none"
+            return
+        }
+        var command = {
+            "type": "search_patterns",
+            "query": this.searchQuery,
+            "same_warp": this.searchSameWarp,
+            "offset": 0,
+        }
+        await this.sendCommand(command)
+    }
+
     /*
     Handle pattern files dropped on drop area (likely the whole page)
     */
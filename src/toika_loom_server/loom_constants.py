@@ -1,4 +1,11 @@
-__all__ = ["BAUD_RATE", "LOG_NAME", "TERMINATOR"]
+__all__ = [
+    "BAUD_RATE",
+    "LOG_NAME",
+    "MOCK_PORT_NAME",
+    "RECONNECT_MAX_DELAY",
+    "RECONNECT_MIN_DELAY",
+    "TERMINATOR",
+]
 
 # baud rate of loom's FTDI serial port
 BAUD_RATE = 9600
@@ -7,5 +14,15 @@ BAUD_RATE = 9600
 # This value is from https://stackoverflow.com/a/77007723
 LOG_NAME = "uvicorn.error"
 
+# Serial port name that specifies a mock loom
+MOCK_PORT_NAME = "mock"
+
+# Delay before the first attempt to reconnect to the loom,
+# after losing the connection (seconds). The delay doubles
+# after each failed attempt, up to RECONNECT_MAX_DELAY,
+# and each delay is randomly shortened by up to half (jitter).
+RECONNECT_MIN_DELAY = 0.2
+RECONNECT_MAX_DELAY = 30
+
 # terminator bytes for commands and replies
 TERMINATOR = b"\r"
@@ -0,0 +1,641 @@
+from __future__ import annotations
+
+__all__ = [
+    "DEFAULT_DRIVER_SOCKET_PATH",
+    "DRIVER_PORT_PREFIX",
+    "DriverClient",
+    "LoomDriver",
+    "get_driver_socket_path",
+    "run_toika_loom_driver",
+]
+
+import argparse
+import asyncio
+import base64
+import collections.abc
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import random
+import tempfile
+from types import TracebackType
+from typing import Any, Type
+
+from .client_replies import JumpPickNumber, MessageSeverityEnum
+from .loom_constants import LOG_NAME, RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY
+from .loom_protocol import LoomProtocol, open_loom_connection
+from .mock_loom import MockLoom
+from .pattern_codec import decode_pattern, encode_pattern
+from .pick_pipeline import PickPipeline, PreparedPick
+from .reduced_pattern import ReducedPattern
+
+
+def _get_default_socket_path() -> pathlib.Path:
+    """Get a per-user default path for the loom driver socket:
+    in the user's runtime directory, if there is one,
+    else in the temporary directory, named for the user.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return pathlib.Path(runtime_dir) / "toika_loom_driver.sock"
+    return pathlib.Path(tempfile.gettempdir()) / f"toika_loom_driver-{os.getuid()}.sock"
+
+
+DEFAULT_DRIVER_SOCKET_PATH = _get_default_socket_path()
+
+# LoomServer serial port name that specifies a loom driver:
+# "driver" (use DEFAULT_DRIVER_SOCKET_PATH) or "driver:socket_path".
+DRIVER_PORT_PREFIX = "driver"
+
+# Maximum time to wait for the loom driver's initial state (seconds)
+DRIVER_STATE_TIMEOUT = 5
+
+# Maximum length of a message (one line) on the driver socket (bytes).
+# A set_pattern message holds a whole pattern, so it can be large.
+MAX_MESSAGE_LEN = 256 * 1024 * 1024
+
+
+def get_driver_socket_path(serial_port: str) -> pathlib.Path | None:
+    """Get the loom driver socket path from a LoomServer serial port name.
+
+    Return None if the serial port name does not specify a loom driver.
+    """
+    if serial_port == DRIVER_PORT_PREFIX:
+        return DEFAULT_DRIVER_SOCKET_PATH
+    if serial_port.startswith(DRIVER_PORT_PREFIX + ":"):
+        return pathlib.Path(serial_port[len(DRIVER_PORT_PREFIX) + 1 :])
+    return None
+
+
+def encode_message(message: dict[str, Any]) -> bytes:
+    """Encode a message as one line of compact json."""
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+def prepared_pick_from_dict(message: dict[str, Any]) -> PreparedPick:
+    """Construct a PreparedPick from a "pick" message."""
+    return PreparedPick(
+        pattern_name=message["pattern_name"],
+        pick_number=message["pick_number"],
+        repeat_number=message["repeat_number"],
+        cmdbytes=bytes.fromhex(message["cmdbytes"]),
+        is_jump=message["is_jump"],
+    )
+
+
+class LoomDriver:
+    """Own the connection to the loom, on behalf of a web server.
+
+    The driver keeps the current pattern, pick pipeline and weave
+    direction, and sends picks to the loom, whether or not a web server
+    is connected. So the web server can be restarted (or be absent)
+    without interrupting weaving. If the connection to the loom is lost,
+    the driver reconnects on its own, with jittered exponential backoff
+    (see LoomServer.reconnect_loop).
+
+    The web server (a LoomServer with serial port "driver[:socket_path]")
+    connects over a Unix domain socket, which only the user running
+    the driver may use. Only one web server may be connected at a time;
+    the most recent connection to send a message wins.
+
+    Messages in both directions are lines of compact json,
+    each with a "type" field.
+
+    Messages from the web server:
+
+    * connect_loom: connect to the loom (if not connected),
+      then reply with state.
+    * set_pattern(pattern): set the pattern (encoded by encode_pattern,
+      then base64), including the current pick and repeat numbers.
+    * set_jump_pick(pick_number, repeat_number): set the jump pick.
+    * set_weave_forward(forward): set the weave direction.
+    * command(data): send data (a hex string, including the terminator)
+      to the loom.
+
+    Messages to the web server:
+
+    * state(loom_connected, pattern_name, pick_number, repeat_number,
+      jump_pick_number, jump_repeat_number, weave_forward)
+    * pick(pattern_name, pick_number, repeat_number, cmdbytes, is_jump):
+      a pick that was sent to the loom.
+    * problem(message, severity): a problem, e.g. an invalid loom reply.
+    * loom_connection_lost(reason): the connection to the loom was lost.
+
+    Parameters
+    ----------
+    serial_port : str
+        The name of the serial port, e.g. "/dev/tty0".
+        If the name is "mock" then use a mock loom.
+    socket_path : pathlib.Path
+        Path of the Unix domain socket on which to listen for a web server.
+    verbose : bool
+        If True, log diagnostic information.
+    """
+
+    def __init__(
+        self,
+        serial_port: str,
+        socket_path: pathlib.Path = DEFAULT_DRIVER_SOCKET_PATH,
+        verbose: bool = False,
+    ) -> None:
+        self.log = logging.getLogger(LOG_NAME)
+        self.serial_port = serial_port
+        self.socket_path = socket_path
+        self.verbose = verbose
+        self.pick_pipeline = PickPipeline()
+        self.weave_forward = True
+        self.loom_protocol: LoomProtocol | None = None
+        self.mock_loom: MockLoom | None = None
+        self.server: asyncio.Server | None = None
+        self.client_writer: asyncio.StreamWriter | None = None
+        # Serializes connecting to the loom, which is done by
+        # reconnect_loop and when asked by the web server.
+        self.connect_lock = asyncio.Lock()
+        self.reconnect_event = asyncio.Event()
+        self.reconnect_task: asyncio.Future = asyncio.Future()
+        self.done_task: asyncio.Future = asyncio.Future()
+
+    @classmethod
+    async def amain(
+        cls,
+        serial_port: str,
+        socket_path: pathlib.Path = DEFAULT_DRIVER_SOCKET_PATH,
+        verbose: bool = False,
+    ) -> None:
+        async with cls(
+            serial_port=serial_port, socket_path=socket_path, verbose=verbose
+        ) as driver:
+            await driver.done_task
+
+    @property
+    def loom_connected(self) -> bool:
+        """Return True if connected to the loom."""
+        return self.loom_protocol is not None and self.loom_protocol.is_connected
+
+    async def start(self) -> None:
+        """Connect to the loom and start listening for a web server.
+
+        Raises
+        ------
+        RuntimeError
+            If another loom driver is listening on socket_path.
+        """
+        await self.check_no_other_driver()
+        self.reconnect_task = asyncio.create_task(self.reconnect_loop())
+        try:
+            await self.connect_to_loom()
+        except Exception as e:
+            # Keep trying, e.g. until the loom is turned on
+            self.log.warning(f"LoomDriver: could not connect to the loom: {e!r}")
+            self.reconnect_event.set()
+        self.socket_path.unlink(missing_ok=True)
+        self.server = await asyncio.start_unix_server(
+            self.handle_client, path=self.socket_path, limit=MAX_MESSAGE_LEN
+        )
+        # Only this user may drive the loom
+        os.chmod(self.socket_path, 0o600)
+
+    async def check_no_other_driver(self) -> None:
+        """Check that no other loom driver is listening on socket_path.
+
+        Raises
+        ------
+        RuntimeError
+            If another loom driver is listening.
+        """
+        try:
+            _, writer = await asyncio.open_unix_connection(path=self.socket_path)
+        except OSError:
+            # No socket, or a stale socket left by a driver that is gone
+            return
+        # A connection that sends nothing does not disturb the other driver
+        writer.close()
+        raise RuntimeError(
+            f"Another loom driver is already listening on {self.socket_path}"
+        )
+
+    async def close(self) -> None:
+        """Stop listening, and disconnect from the web server and loom."""
+        self.reconnect_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            self.socket_path.unlink(missing_ok=True)
+        if self.client_writer is not None:
+            self.client_writer.close()
+        protocol = self.loom_protocol
+        self.loom_protocol = None
+        if protocol is not None:
+            protocol.close()
+        if self.mock_loom is not None:
+            await self.mock_loom.close()
+            self.mock_loom = None
+        if not self.done_task.done():
+            self.done_task.set_result(None)
+
+    async def connect_to_loom(self) -> None:
+        """Connect to the loom, if not already connected."""
+        async with self.connect_lock:
+            if self.loom_connected:
+                return
+            if self.mock_loom is not None:
+                await self.mock_loom.close()
+                self.mock_loom = None
+            self.loom_protocol, self.mock_loom = await open_loom_connection(
+                serial_port=self.serial_port,
+                protocol_factory=self.create_loom_protocol,
+                verbose=self.verbose,
+            )
+
+    def create_loom_protocol(self) -> LoomProtocol:
+        """Create a LoomProtocol that calls back to this driver."""
+        return LoomProtocol(
+            reply_callback=self.handle_loom_reply,
+            connection_lost_callback=self.handle_loom_connection_lost,
+        )
+
+    def get_state(self) -> dict[str, Any]:
+        """Get a state message."""
+        pattern = self.pick_pipeline.pattern
+        jump_pick = self.pick_pipeline.jump_pick
+        return dict(
+            type="state",
+            loom_connected=self.loom_connected,
+            pattern_name=None if pattern is None else pattern.name,
+            pick_number=None if pattern is None else pattern.pick_number,
+            repeat_number=None if pattern is None else pattern.repeat_number,
+            jump_pick_number=jump_pick.pick_number,
+            jump_repeat_number=jump_pick.repeat_number,
+            weave_forward=self.weave_forward,
+        )
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handle a connection from a web server.
+
+        The connection replaces the current one (if any) when it sends
+        its first message, so merely connecting (e.g. to check whether
+        a driver is running) does not disturb the current web server.
+        """
+        try:
+            line = await reader.readline()
+            if line:
+                if self.client_writer is not None:
+                    self.log.info(
+                        "LoomDriver: a new web server connected; closing the old one"
+                    )
+                    self.client_writer.close()
+                self.client_writer = writer
+            while line:
+                await self.handle_message(json.loads(line))
+                line = await reader.readline()
+        except Exception as e:
+            self.log.exception(f"LoomDriver: web server connection failed: {e!r}")
+        finally:
+            if self.client_writer is writer:
+                self.client_writer = None
+            writer.close()
+
+    def handle_loom_connection_lost(self, exc: Exception | None) -> None:
+        """Handle loss of the connection to the loom."""
+        if self.loom_protocol is None or not self.loom_protocol.lost:
+            return
+        self.loom_protocol = None
+        self.log.warning(f"LoomDriver: lost the connection to the loom: {exc!r}")
+        self.send_to_client(
+            dict(type="loom_connection_lost", reason="" if exc is None else str(exc))
+        )
+        self.reconnect_event.set()
+
+    async def reconnect_loop(self) -> None:
+        """Reconnect to the loom whenever the connection is lost.
+
+        Retry with jittered exponential backoff until connected.
+        The pick pipeline is kept, so weaving resumes where it left off.
+        """
+        while True:
+            await self.reconnect_event.wait()
+            self.reconnect_event.clear()
+            delay = RECONNECT_MIN_DELAY
+            while not self.loom_connected:
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+                try:
+                    await self.connect_to_loom()
+                except Exception as e:
+                    self.log.warning(
+                        f"LoomDriver: could not reconnect to the loom: {e!r}"
+                    )
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            self.log.info("LoomDriver: reconnected to the loom")
+
+    def handle_loom_reply(self, reply: bytes) -> bytes | None:
+        """Handle a reply from the loom; see LoomServer.handle_loom_reply."""
+        if self.verbose:
+            self.log.info(f"LoomDriver: read loom reply: {reply!r}")
+        if reply not in (b"1", b"2"):
+            message = f"invalid loom reply {reply!r}: must be b'1' or b'2'"
+            self.log.warning(f"LoomDriver: {message}")
+            self.send_to_client(
+                dict(
+                    type="problem",
+                    message=message,
+                    severity=MessageSeverityEnum.WARNING,
+                )
+            )
+            return None
+        prepared_pick = self.pick_pipeline.advance(weave_forward=self.weave_forward)
+        if prepared_pick is None:
+            return None
+        pick_message = dataclasses.asdict(prepared_pick)
+        pick_message["cmdbytes"] = prepared_pick.cmdbytes.hex()
+        self.send_to_client(dict(type="pick", **pick_message))
+        return prepared_pick.cmdbytes
+
+    async def handle_message(self, message: dict[str, Any]) -> None:
+        """Handle one message from the web server."""
+        if self.verbose:
+            message_str = str(message)
+            if len(message_str) > 120:
+                message_str = message_str[0:120] + "..."
+            self.log.info(f"LoomDriver: read message {message_str}")
+        match message["type"]:
+            case "connect_loom":
+                try:
+                    await self.connect_to_loom()
+                except Exception as e:
+                    self.log.warning(
+                        f"LoomDriver: could not connect to the loom: {e!r}"
+                    )
+                    self.send_to_client(
+                        dict(type="loom_connection_lost", reason=str(e))
+                    )
+                self.send_to_client(self.get_state())
+            case "set_pattern":
+                pattern = decode_pattern(base64.b64decode(message["pattern"]))
+                self.pick_pipeline.set_pattern(pattern)
+            case "set_jump_pick":
+                self.pick_pipeline.set_jump_pick(
+                    JumpPickNumber(
+                        pick_number=message["pick_number"],
+                        repeat_number=message["repeat_number"],
+                    )
+                )
+            case "set_weave_forward":
+                self.weave_forward = message["forward"]
+            case "command":
+                try:
+                    if self.loom_protocol is None:
+                        raise RuntimeError("Cannot write to the loom: no connection.")
+                    await self.loom_protocol.write_and_drain(
+                        bytes.fromhex(message["data"])
+                    )
+                except Exception as e:
+                    self.send_to_client(
+                        dict(
+                            type="problem",
+                            message=f"loom command failed: {e!r}",
+                            severity=MessageSeverityEnum.ERROR,
+                        )
+                    )
+            case _:
+                self.log.warning(f"LoomDriver: ignoring unknown message {message!r}")
+
+    def send_to_client(self, message: dict[str, Any]) -> None:
+        """Send a message to the web server, if connected.
+
+        Does not wait for the data to be sent, so a slow (or missing)
+        web server never delays the loom.
+        """
+        if self.client_writer is None or self.client_writer.is_closing():
+            return
+        self.client_writer.write(encode_message(message))
+
+    async def __aenter__(self) -> LoomDriver:
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        type: Type[BaseException] | None,
+        value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        await self.close()
+
+
+class DriverClient:
+    """A LoomServer's connection to a LoomDriver.
+
+    Supports the parts of the LoomProtocol interface used by LoomServer
+    (is_connected, lost, close and write_and_drain), so it can stand in
+    for a LoomProtocol. The connection counts as lost if either
+    the connection to the driver or the driver's connection to the loom
+    is lost.
+
+    Parameters
+    ----------
+    socket_path : pathlib.Path
+        Path of the loom driver's Unix domain socket.
+    pick_callback : collections.abc.Callable[[PreparedPick], None]
+        Function to call for each pick the driver sent to the loom.
+    problem_callback : collections.abc.Callable
+        Function to call to report a problem, with signature
+        (message: str, severity: MessageSeverityEnum) -> None.
+    connection_lost_callback : collections.abc.Callable
+        Function to call when the connection is lost or closed,
+        with signature (exc: Exception | None) -> None.
+    """
+
+    def __init__(
+        self,
+        socket_path: pathlib.Path,
+        pick_callback: collections.abc.Callable[[PreparedPick], None],
+        problem_callback: collections.abc.Callable[[str, MessageSeverityEnum], None],
+        connection_lost_callback: collections.abc.Callable[[Exception | None], None],
+    ) -> None:
+        self.log = logging.getLogger(LOG_NAME)
+        self.socket_path = socket_path
+        self.pick_callback = pick_callback
+        self.problem_callback = problem_callback
+        self.connection_lost_callback = connection_lost_callback
+        self.writer: asyncio.StreamWriter | None = None
+        self.lost = False
+        self.state: dict[str, Any] = {}
+        self.read_task: asyncio.Future = asyncio.Future()
+
+    @property
+    def is_connected(self) -> bool:
+        """Return True if connected to the loom (via the driver)."""
+        return (
+            self.writer is not None
+            and not self.lost
+            and not self.writer.is_closing()
+            and self.state.get("loom_connected", False)
+        )
+
+    async def connect(self) -> None:
+        """Connect to the driver, ask it to connect to the loom,
+        and read its state into self.state.
+
+        Raises
+        ------
+        RuntimeError
+            If the driver cannot connect to the loom.
+        TimeoutError
+            If the driver does not reply in time.
+
+        If connecting fails, the connection to the driver is closed.
+        """
+        reader, writer = await asyncio.open_unix_connection(
+            path=self.socket_path, limit=MAX_MESSAGE_LEN
+        )
+        self.writer = writer
+        try:
+            self.send(dict(type="connect_loom"))
+            async with asyncio.timeout(DRIVER_STATE_TIMEOUT):
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        raise RuntimeError("The loom driver closed the connection")
+                    message = json.loads(line)
+                    if message["type"] == "state":
+                        self.state = message
+                        break
+                    elif message["type"] == "loom_connection_lost":
+                        raise RuntimeError(
+                            f"The loom driver could not connect to the loom: "
+                            f"{message['reason']}"
+                        )
+        except BaseException:
+            self.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+            raise
+        self.read_task = asyncio.create_task(self.read_loop(reader))
+
+    def close(self) -> None:
+        """Close the connection to the driver. A no-op if already closed.
+
+        This does not affect the driver's connection to the loom.
+        """
+        self.lost = True
+        if self.writer is not None:
+            self.writer.close()
+
+    async def read_loop(self, reader: asyncio.StreamReader) -> None:
+        """Read and handle messages from the driver."""
+        exc: Exception | None = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    exc = ConnectionError("The loom driver closed the connection")
+                    break
+                message = json.loads(line)
+                match message["type"]:
+                    case "pick":
+                        self.pick_callback(prepared_pick_from_dict(message))
+                    case "problem":
+                        self.problem_callback(
+                            message["message"],
+                            MessageSeverityEnum(message["severity"]),
+                        )
+                    case "state":
+                        self.state = message
+                    case "loom_connection_lost":
+                        if message["reason"]:
+                            exc = ConnectionError(message["reason"])
+                        break
+                    case _:
+                        self.log.warning(
+                            f"DriverClient: ignoring unknown message {message!r}"
+                        )
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            exc = e
+        if self.lost:
+            # Closed by self.close
+            return
+        self.close()
+        self.connection_lost_callback(exc)
+
+    def send(self, message: dict[str, Any]) -> None:
+        """Send a message to the driver."""
+        if self.writer is None or self.writer.is_closing():
+            raise RuntimeError("Not connected to the loom driver")
+        self.writer.write(encode_message(message))
+
+    def send_jump_pick(self, jump_pick: JumpPickNumber) -> None:
+        """Send the jump pick to the driver."""
+        self.send(
+            dict(
+                type="set_jump_pick",
+                pick_number=jump_pick.pick_number,
+                repeat_number=jump_pick.repeat_number,
+            )
+        )
+
+    def send_pattern(self, pattern: ReducedPattern) -> None:
+        """Send the pattern, including pick and repeat numbers,
+        to the driver.
+        """
+        encoded_pattern = base64.b64encode(encode_pattern(pattern)).decode()
+        self.send(dict(type="set_pattern", pattern=encoded_pattern))
+
+    def send_weave_forward(self, weave_forward: bool) -> None:
+        """Send the weave direction to the driver."""
+        self.send(dict(type="set_weave_forward", forward=weave_forward))
+
+    async def write_and_drain(self, data: bytes) -> None:
+        """Ask the driver to write data to the loom.
+
+        Parameters
+        ----------
+        data : bytes
+            The data to write, including the terminator.
+        """
+        self.send(dict(type="command", data=data.hex()))
+        assert self.writer is not None  # make mypy happy
+        await self.writer.drain()
+
+
+def create_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Loom driver: own the connection to the loom, "
+        "so the web server (run_toika_loom driver) can restart without "
+        "interrupting weaving."
+    )
+    parser.add_argument(
+        "serial_port",
+        help="Serial port connected to the loom, "
+        "typically of the form /dev/tty... "
+        "Specify 'mock' to run a mock (simulated) loom",
+    )
+    parser.add_argument(
+        "--socket-path",
+        default=DEFAULT_DRIVER_SOCKET_PATH,
+        type=pathlib.Path,
+        help="Path of the Unix domain socket for the web server.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="print diagnostic information to stdout",
+    )
+    return parser
+
+
+def run_toika_loom_driver() -> None:
+    parser = create_argument_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(LoomDriver.amain(**vars(args)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+__all__ = ["LoomProtocol", "open_loom_connection"]
+
+import asyncio
+import collections.abc
+import time
+
+from serial_asyncio import create_serial_connection  # type: ignore
+
+from .loom_constants import BAUD_RATE, MOCK_PORT_NAME, TERMINATOR
+from .mock_loom import MockLoom
+from .network_serial import (
+    DEFAULT_WRITE_TIMEOUT,
+    RFC2217_URL_PREFIX,
+    SOCKET_URL_PREFIX,
+    get_round_trip_time,
+    open_rfc2217_connection,
+    open_socket_connection,
+)
+from .pick_latency import PickLatencyRecorder
+
+# Interval at which to check whether a pick command has been sent on,
+# if the transport has buffered it without pausing the protocol (seconds)
+DRAIN_POLL_INTERVAL = 0.001
+
+
+class LoomProtocol(asyncio.Protocol):
+    """Low-level connection to the loom.
+
+    Replies from the loom are parsed as they arrive, in `data_received`,
+    and passed to a callback, without involving a coroutine.
+    The callback may return data to send to the loom in response,
+    which is written at once. If that data is not sent on within
+    write_timeout, the connection is aborted, as for `write_and_drain`.
+
+    The transport's write buffer high-water mark is set to 0 (if the
+    transport supports it), so the transport pauses the protocol
+    whenever it cannot send data on at once, e.g. because the loom
+    or the network has stalled. Otherwise a socket or serial transport
+    would buffer 64 kB of commands before pausing.
+
+    Parameters
+    ----------
+    reply_callback : collections.abc.Callable[[bytes], bytes | None]
+        Function to call with each reply from the loom,
+        stripped of the terminator and surrounding whitespace.
+        If it returns data, that data is written to the loom.
+        The data must include the terminator.
+    connection_lost_callback : collections.abc.Callable
+        Function to call when the connection is lost or closed,
+        with signature (exc: Exception | None) -> None. The argument
+        is the exception, if any (see asyncio.BaseProtocol.connection_lost).
+    write_timeout : float
+        Maximum time for `write_and_drain` to wait until it is OK
+        to write more data, and for a response to a reply
+        to be sent on (seconds).
+    latency_recorder : PickLatencyRecorder | None
+        If not None, record the latency of each stage of responding
+        to a reply, and the number of bytes read and written.
+        Only replies the callback responds to (picks) are timed.
+    """
+
+    def __init__(
+        self,
+        reply_callback: collections.abc.Callable[[bytes], bytes | None],
+        connection_lost_callback: collections.abc.Callable[[Exception | None], None],
+        write_timeout: float = DEFAULT_WRITE_TIMEOUT,
+        latency_recorder: PickLatencyRecorder | None = None,
+    ) -> None:
+        self.reply_callback = reply_callback
+        self.connection_lost_callback = connection_lost_callback
+        self.write_timeout = write_timeout
+        self.latency_recorder = latency_recorder
+        # (read time, write time) of a pick command waiting to be sent on
+        self.pending_drain: tuple[float, float] | None = None
+        self.transport: asyncio.Transport | None = None
+        self.buffer = bytearray()
+        self.lost = False
+        # Cleared while the transport asks us to pause writing.
+        self.can_write_event = asyncio.Event()
+        self.can_write_event.set()
+        # Timer that aborts the connection if a response to a reply
+        # is not sent on in time
+        self.write_timer: asyncio.TimerHandle | None = None
+        # Why the connection was aborted, if it was
+        self.write_error: Exception | None = None
+
+    @property
+    def is_connected(self) -> bool:
+        """Return True if connected to the loom."""
+        return (
+            self.transport is not None
+            and not self.lost
+            and not self.transport.is_closing()
+        )
+
+    @property
+    def round_trip_time(self) -> float | None:
+        """The round-trip time of the network connection to the loom
+        (seconds), or None if not known, e.g. for a local serial port.
+        """
+        return get_round_trip_time(self.transport)
+
+    def abort(self, exc: Exception) -> None:
+        """Close the connection at once, discarding unsent data,
+        e.g. because the link has stalled (which would stop `close`
+        from finishing). A no-op if already closed.
+
+        Parameters
+        ----------
+        exc : Exception
+            The reason, which is passed to connection_lost_callback.
+        """
+        if self.transport is None or self.lost:
+            return
+        self.write_error = exc
+        self.transport.abort()
+
+    def close(self) -> None:
+        """Close the connection. A no-op if already closed."""
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert isinstance(transport, asyncio.Transport)
+        self.transport = transport
+        try:
+            transport.set_write_buffer_limits(high=0)
+        except NotImplementedError:
+            # E.g. ThreadedSerialTransport, which pauses on every write
+            pass
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.lost = True
+        self._cancel_write_timer()
+        # Release any writers waiting in drain
+        self.can_write_event.set()
+        self.connection_lost_callback(exc if exc is not None else self.write_error)
+
+    def data_received(self, data: bytes) -> None:
+        read_time = 0.0
+        if self.latency_recorder is not None:
+            read_time = time.perf_counter()
+            self.latency_recorder.record_bytes_read(len(data))
+
+        # Fast path: the data is exactly one reply
+        if not self.buffer and data.find(TERMINATOR) == len(data) - len(TERMINATOR):
+            self._handle_reply(data[: -len(TERMINATOR)].strip(), read_time)
+            return
+
+        self.buffer += data
+        while True:
+            index = self.buffer.find(TERMINATOR)
+            if index < 0:
+                break
+            reply = bytes(self.buffer[:index]).strip()
+            del self.buffer[: index + len(TERMINATOR)]
+            self._handle_reply(reply, read_time)
+
+    async def drain(self) -> None:
+        """Wait until it is OK to write more data."""
+        await self.can_write_event.wait()
+
+    async def write_and_drain(self, data: bytes) -> None:
+        """Write data to the loom, then wait until it is OK to write more.
+
+        Parameters
+        ----------
+        data : bytes
+            The data to write, including the terminator.
+
+        Raises
+        ------
+        TimeoutError
+            If it is not OK to write more data within self.write_timeout,
+            in which case the connection is aborted.
+        """
+        self.write(data)
+        try:
+            async with asyncio.timeout(self.write_timeout):
+                await self.drain()
+        except TimeoutError:
+            exc = self._make_write_timeout_error()
+            self.abort(exc)
+            raise exc from None
+
+    def pause_writing(self) -> None:
+        self.can_write_event.clear()
+
+    def resume_writing(self) -> None:
+        self.can_write_event.set()
+        self._cancel_write_timer()
+        self._check_drained()
+
+    def write(self, data: bytes) -> None:
+        """Write data to the loom.
+
+        Parameters
+        ----------
+        data : bytes
+            The data to write, including the terminator.
+
+        Raises
+        ------
+        RuntimeError
+            If not connected.
+        """
+        if not self.is_connected:
+            raise RuntimeError("Cannot write to the loom: no connection.")
+        assert self.transport is not None  # make mypy happy
+        self.transport.write(data)
+        if self.latency_recorder is not None:
+            self.latency_recorder.record_bytes_written(len(data))
+
+    def write_if_idle(self, data: bytes) -> bool:
+        """Write low-priority data to the loom, if nothing else is waiting
+        to be written. Return True if the data was written.
+
+        Parameters
+        ----------
+        data : bytes
+            The data to write, including the terminator.
+        """
+        if (
+            not self.is_connected
+            or not self.can_write_event.is_set()
+            or self.transport is None
+            or self.transport.get_write_buffer_size() > 0
+        ):
+            return False
+        self.transport.write(data)
+        if self.latency_recorder is not None:
+            self.latency_recorder.record_bytes_written(len(data))
+        return True
+
+    def _cancel_write_timer(self) -> None:
+        if self.write_timer is not None:
+            self.write_timer.cancel()
+            self.write_timer = None
+
+    def _handle_write_timeout(self) -> None:
+        """Abort the connection, because a response to a reply
+        was not sent on within write_timeout.
+        """
+        self.write_timer = None
+        if not self.can_write_event.is_set():
+            self.abort(self._make_write_timeout_error())
+
+    def _make_write_timeout_error(self) -> TimeoutError:
+        return TimeoutError(
+            f"Writing to the loom took longer than {self.write_timeout} seconds"
+        )
+
+    def _start_write_timer(self) -> None:
+        """Start timing a response to a reply, if it was not sent on
+        at once. Stopped by resume_writing.
+        """
+        if self.write_timer is None and not self.can_write_event.is_set():
+            self.write_timer = asyncio.get_running_loop().call_later(
+                self.write_timeout, self._handle_write_timeout
+            )
+
+    def _check_drained(self) -> None:
+        """Record the drain and total latency of a pick command,
+        if it has been sent on.
+        """
+        if self.pending_drain is None or self.latency_recorder is None:
+            return
+        if self.lost or self.transport is None:
+            self.pending_drain = None
+            return
+        if self.transport.get_write_buffer_size() > 0:
+            # If paused, resume_writing calls this method again
+            if self.can_write_event.is_set():
+                asyncio.get_running_loop().call_later(
+                    DRAIN_POLL_INTERVAL, self._check_drained
+                )
+            return
+        drained_time = time.perf_counter()
+        read_time, written_time = self.pending_drain
+        self.pending_drain = None
+        self.latency_recorder.record("drain", drained_time - written_time)
+        self.latency_recorder.record("total", drained_time - read_time)
+
+    def _handle_reply(self, reply: bytes, read_time: float) -> None:
+        if self.latency_recorder is None:
+            response = self.reply_callback(reply)
+            if response is not None and self.is_connected:
+                assert self.transport is not None  # make mypy happy
+                self.transport.write(response)
+                self._start_write_timer()
+            return
+
+        decoded_time = time.perf_counter()
+        response = self.reply_callback(reply)
+        if response is None or not self.is_connected:
+            return
+        assert self.transport is not None  # make mypy happy
+        looked_up_time = time.perf_counter()
+        self.transport.write(response)
+        written_time = time.perf_counter()
+        self._start_write_timer()
+        recorder = self.latency_recorder
+        recorder.record_bytes_written(len(response), is_pick=True)
+        recorder.record("decode", decoded_time - read_time)
+        recorder.record("lookup", looked_up_time - decoded_time)
+        recorder.record("write", written_time - looked_up_time)
+        self.pending_drain = (read_time, written_time)
+        self._check_drained()
+
+
+async def open_loom_connection(
+    serial_port: str,
+    protocol_factory: collections.abc.Callable[[], LoomProtocol],
+    verbose: bool,
+) -> tuple[LoomProtocol, MockLoom | None]:
+    """Open a connection to the loom.
+
+    Parameters
+    ----------
+    serial_port : str
+        The name of the serial port, e.g. "/dev/tty0".
+        If the name is "mock" then use a new mock loom.
+        If the name starts with "socket://" or "rfc2217://" then
+        connect over the network, e.g. to a serial device server.
+    protocol_factory : collections.abc.Callable[[], LoomProtocol]
+        Function that returns a new LoomProtocol.
+    verbose : bool
+        If True, the mock loom (if any) logs diagnostic information.
+
+    Returns (protocol, mock_loom), where mock_loom is None
+    unless serial_port is "mock".
+    """
+    if serial_port == MOCK_PORT_NAME:
+        mock_loom = MockLoom(verbose=verbose)
+        _, protocol = await mock_loom.open_client_transport(protocol_factory)
+        return protocol, mock_loom
+    if serial_port.startswith(SOCKET_URL_PREFIX):
+        _, protocol = await open_socket_connection(serial_port, protocol_factory)
+        return protocol, None
+    if serial_port.startswith(RFC2217_URL_PREFIX):
+        _, protocol = await open_rfc2217_connection(serial_port, protocol_factory)
+        return protocol, None
+    _, protocol = await create_serial_connection(
+        asyncio.get_running_loop(),
+        protocol_factory,
+        url=serial_port,
+        baudrate=BAUD_RATE,
+    )
+    return protocol, None
@@ -3,35 +3,85 @@ from __future__ import annotations
 __all__ = ["LoomServer", "DEFAULT_DATABASE_PATH"]
 
 import asyncio
+import collections.abc
 import dataclasses
 import enum
-import io
 import json
 import logging
 import pathlib
+import random
 import tempfile
+import time
+from functools import partial
 from types import SimpleNamespace, TracebackType
 from typing import Any, Type
 
-from dtx_to_wif import read_dtx, read_wif
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.websockets import WebSocketState
-from serial_asyncio import open_serial_connection  # type: ignore
 
 from . import client_replies
 from .client_replies import MessageSeverityEnum
-from .loom_constants import BAUD_RATE, LOG_NAME, TERMINATOR
+from .client_sender import ClientSender
+from .loom_constants import (
+    LOG_NAME,
+    RECONNECT_MAX_DELAY,
+    RECONNECT_MIN_DELAY,
+    TERMINATOR,
+)
+from .loom_driver import DriverClient, get_driver_socket_path
+from .loom_protocol import LoomProtocol, open_loom_connection
+from .loom_thread import LoomThread
 from .mock_loom import MockLoom
-from .mock_streams import StreamReaderType, StreamWriterType
-from .pattern_database import PatternDatabase
-from .reduced_pattern import Pick, ReducedPattern, reduced_pattern_from_pattern_data
-
-# The maximum number of patterns that can be in the history
+from .network_serial import DEFAULT_WRITE_TIMEOUT
+from .pattern_database import (
+    DEFAULT_PAGE_SIZE,
+    PatternDatabase,
+    PatternMetadata,
+    delete_database_files,
+    get_upload_hash,
+)
+from .pattern_parser import (
+    DEFAULT_MAX_PARSE_JOBS,
+    DEFAULT_PARSE_TIMEOUT,
+    SUPPORTED_SUFFIXES,
+    PatternParser,
+)
+from .pick_latency import PickLatencyRecorder
+from .pick_pipeline import PickPipeline, PreparedPick
+from .reduced_pattern import ReducedPattern
+from .status_poller import (
+    STATUS_QUERY,
+    STATUS_REPLY_PREFIX,
+    StatusPoller,
+    parse_status_reply,
+)
+
+# Default maximum number of patterns in the pattern database (per loom)
 MAX_PATTERNS = 25
 
-DEFAULT_DATABASE_PATH = pathlib.Path(tempfile.gettempdir()) / "pattern_database.sqlite"
+# The number of most recently used patterns reported in PatternNames
+NUM_MENU_PATTERNS = 25
+
+# Maximum number of patterns in one page of search results
+MAX_SEARCH_PAGE_SIZE = 100
+
+# Interval between measurements of the round-trip time
+# of a network connection to the loom (seconds)
+LINK_LATENCY_INTERVAL = 2
 
-MOCK_PORT_NAME = "mock"
+# The number of round-trip time measurements to keep, for statistics
+NUM_LINK_LATENCIES = 100
+
+# The number of time-to-recover measurements to keep, for statistics
+NUM_RECOVERY_TIMES = 100
+
+# Default bounds on unsaved picks: the pick number is saved
+# once this much time has passed since the oldest unsaved pick (seconds),
+# or once this many picks are unsaved, whichever comes first.
+DEFAULT_PERSIST_INTERVAL = 5
+DEFAULT_PERSIST_PICKS = 10
+
+DEFAULT_DATABASE_PATH = pathlib.Path(tempfile.gettempdir()) / "pattern_database.sqlite"
 
 
 class CloseCode(enum.IntEnum):
@@ -61,6 +111,10 @@ class LoomServer:
     serial_port : str
         The name of the serial port, e.g. "/dev/tty0".
         If the name is "mock" then use a mock loom.
+        If the name starts with "socket://" or "rfc2217://" then
+        connect over the network, e.g. to a serial device server.
+        If the name is "driver" or "driver:socket_path" then connect
+        to a loom driver (see LoomDriver) at the default or specified path.
     translation_dict : dict[str, str]
         Translation dict.
     reset_db : bool
@@ -71,6 +125,47 @@ class LoomServer:
     db_path : pathlib.Path
         Path to pattern database.
         Intended for unit tests, to avoid stomping on the real database.
+    loom_thread : bool
+        If True, communicate with the loom using an event loop
+        in a dedicated thread, so that responses to the loom are not
+        delayed by work in the main event loop.
+        Ignored if using a loom driver.
+    write_timeout : float
+        Maximum time to write a command to the loom (seconds).
+    status_poll_interval : float
+        Interval between queries of the loom's state while weaving
+        (seconds); the interval grows while the loom is idle.
+        If 0 then do not query the loom's state.
+        Ignored if using a loom driver.
+    pattern_db : PatternDatabase | None
+        The pattern database, e.g. one shared with other looms
+        (see PatternDatabase.for_loom). If None then create one
+        using db_path (and reset_db).
+    persist_interval : float
+        Maximum time a pick may go unsaved (seconds).
+    persist_picks : int
+        Maximum number of unsaved picks. If 1 (or less),
+        or if persist_interval is 0, save every pick.
+    max_patterns : int
+        Maximum number of patterns to keep in the database;
+        if 0 then no limit.
+    max_pattern_bytes : int
+        Maximum total size of the patterns in the database
+        (bytes, as encoded); if 0 then no limit.
+    max_pattern_age : float
+        Maximum time since a pattern was last used (seconds);
+        if 0 then no limit.
+
+    Notes
+    -----
+    The current pick number is kept in memory and saved to the database
+    behind the weaver (write-behind), to spare the SD card: only the
+    latest pick number for each pattern is saved, once persist_picks
+    picks are unsaved or persist_interval has passed since the oldest
+    unsaved pick. Pick numbers are also saved when a pattern is selected
+    and when the server is closed. So a power failure loses fewer than
+    persist_picks picks, and none older than persist_interval
+    (plus the time to write to the database).
     """
 
     def __init__(
@@ -80,87 +175,241 @@ class LoomServer:
         reset_db: bool,
         verbose: bool,
         db_path: pathlib.Path = DEFAULT_DATABASE_PATH,
+        loom_thread: bool = False,
+        write_timeout: float = DEFAULT_WRITE_TIMEOUT,
+        status_poll_interval: float = 0,
+        pattern_db: PatternDatabase | None = None,
+        persist_interval: float = DEFAULT_PERSIST_INTERVAL,
+        persist_picks: int = DEFAULT_PERSIST_PICKS,
+        max_patterns: int = MAX_PATTERNS,
+        max_pattern_bytes: int = 0,
+        max_pattern_age: float = 0,
+        pattern_parser: PatternParser | None = None,
+        max_parse_jobs: int = DEFAULT_MAX_PARSE_JOBS,
+        parse_timeout: float = DEFAULT_PARSE_TIMEOUT,
     ) -> None:
         self.log = logging.getLogger(LOG_NAME)
         if verbose:
             self.log.info(
-                f"LoomServer({serial_port=!r}, {reset_db=!r}, {verbose=!r}, {db_path=!r})"
+                f"LoomServer({serial_port=!r}, {reset_db=!r}, {verbose=!r}, "
+                f"{db_path=!r}, {loom_thread=!r}, {write_timeout=!r}, "
+                f"{status_poll_interval=!r}, {persist_interval=!r}, "
+                f"{persist_picks=!r}, {max_patterns=!r}, {max_pattern_bytes=!r}, "
+                f"{max_pattern_age=!r}, {max_parse_jobs=!r}, {parse_timeout=!r})"
             )
         self.serial_port = serial_port
         self.translation_dict = translation_dict
+        self.write_timeout = write_timeout
+        self.status_poll_interval = status_poll_interval
+        self.persist_interval = persist_interval
+        self.persist_picks_threshold = persist_picks
+        self.max_patterns = max_patterns
+        self.max_pattern_bytes = max_pattern_bytes
+        self.max_pattern_age = max_pattern_age
         self.websocket: WebSocket | None = None
-        self.pattern_db = PatternDatabase(db_path)
+        self.client_sender: ClientSender | None = None
         self.verbose = verbose
         self.db_path = db_path
-        if reset_db:
-            db_path.unlink(missing_ok=True)
+        if pattern_db is None:
+            if reset_db:
+                delete_database_files(db_path)
+            pattern_db = PatternDatabase(db_path)
+        self.pattern_db = pattern_db
+        # Close the pattern parser only if this server created it
+        self.owns_pattern_parser = pattern_parser is None
+        if pattern_parser is None:
+            pattern_parser = PatternParser(
+                max_jobs=max_parse_jobs, timeout=parse_timeout
+            )
+        self.pattern_parser = pattern_parser
         self.loom_connecting = False
         self.loom_disconnecting = False
         self.client_connected = False
         self.mock_loom: MockLoom | None = None
-        self.loom_reader: StreamReaderType | None = None
-        self.loom_writer: StreamWriterType | None = None
+        # The status poller runs in the loom event loop;
+        # the latest loom state is kept in the web loop.
+        self.status_poller: StatusPoller | None = None
+        self.loom_state: client_replies.LoomState | None = None
+        self.loom_protocol: LoomProtocol | DriverClient | None = None
+        self.driver_socket_path = get_driver_socket_path(serial_port)
+        if self.driver_socket_path is not None:
+            loom_thread = False
+        self.loom_thread: LoomThread | None = LoomThread() if loom_thread else None
+        # The event loop that handles the client; set by start.
+        self.web_loop: asyncio.AbstractEventLoop | None = None
         self.read_client_task: asyncio.Future = asyncio.Future()
-        self.read_loom_task: asyncio.Future = asyncio.Future()
         self.done_task: asyncio.Future = asyncio.Future()
-        self.current_pattern: ReducedPattern | None = None
-        self.jump_pick = client_replies.JumpPickNumber(
-            pick_number=None, repeat_number=None
+        self.report_picks_task: asyncio.Future = asyncio.Future()
+        self.persist_picks_task: asyncio.Future = asyncio.Future()
+        self.link_latency_task: asyncio.Future = asyncio.Future()
+        self.reconnect_task: asyncio.Future = asyncio.Future()
+        # Set when the connection to the loom is lost, to reconnect
+        self.reconnect_event = asyncio.Event()
+        # Monotonic time at which the loss of the connection
+        # to the loom was detected; None if connected.
+        self.loom_lost_time: float | None = None
+        # Monotonic time of the last pick request or client command
+        self.last_activity_time = time.monotonic()
+        self.num_loom_losses = 0
+        self.num_loom_recoveries = 0
+        self.num_reconnect_attempts = 0
+        # Times from detecting loss of the connection to the loom
+        # to being connected again (seconds)
+        self.recovery_times: collections.deque[float] = collections.deque(
+            maxlen=NUM_RECOVERY_TIMES
         )
+        # Recent round-trip times of a network connection to the loom
+        self.link_latencies: collections.deque[float] = collections.deque(
+            maxlen=NUM_LINK_LATENCIES
+        )
+        # Latency of responding to pick requests, and serial line use
+        self.pick_latency = PickLatencyRecorder()
+        self.current_pattern: ReducedPattern | None = None
+        # The names of the most recently used patterns,
+        # their version (see PatternDatabase.names_version),
+        # and the PatternNames reply for them, as a dict;
+        # all updated by report_pattern_names.
+        self.pattern_names: list[str] = []
+        self.pattern_names_version: int | None = None
+        self.pattern_names_reply: dict[str, Any] = {}
+        # The version of the pattern names sent to the client;
+        # None if not sent.
+        self.client_names_version: int | None = None
+        self.pick_pipeline = PickPipeline()
+        # Follow-up stages for picks sent to the loom:
+        # picks to report to the client, and the latest
+        # (pick_number, repeat_number) to save, by pattern name.
+        self.picks_to_report: asyncio.Queue[PreparedPick] = asyncio.Queue()
+        self.picks_to_persist: dict[str, tuple[int, int]] = {}
+        # Set when a pick is queued to be saved,
+        # and when it is time to save queued picks.
+        self.persist_picks_event = asyncio.Event()
+        self.persist_picks_now_event = asyncio.Event()
+        # Statistics for saving pick numbers
+        self.num_unsaved_picks = 0
+        self.num_picks_queued = 0
+        self.num_pick_writes = 0
+        # Statistics for uploaded pattern files: the number parsed,
+        # and the number added without parsing (uploaded before)
+        self.num_uploads_parsed = 0
+        self.num_uploads_reused = 0
+        # Uploads are handled by background tasks, so that the client
+        # can send other commands while a file is being parsed.
+        # upload_task is the most recent upload, which waits for the one
+        # before it; select_task is a deferred select_pattern command.
+        # Both are cancelled when the client disconnects.
+        self.upload_task: asyncio.Future = asyncio.Future()
+        self.upload_task.set_result(None)
+        self.upload_tasks: set[asyncio.Future] = set()
+        self.select_task: asyncio.Future = self.upload_task
         self.weave_forward = True
+        self.background_tasks: set[asyncio.Task] = set()
         self.loom_error_flag = False
         self.command_dispatch_table = dict(
             clear_pattern_names=self.cmd_clear_pattern_names,
             file=self.cmd_file,
             jump_to_pick=self.cmd_jump_to_pick,
+            search_patterns=self.cmd_search_patterns,
             select_pattern=self.cmd_select_pattern,
             weave_direction=self.cmd_weave_direction,
             oobcommand=self.cmd_oobcommand,
         )
 
     async def start(self) -> None:
+        self.web_loop = asyncio.get_running_loop()
         await self.pattern_db.init()
+        self.report_picks_task = asyncio.create_task(self.report_picks_loop())
+        self.persist_picks_task = asyncio.create_task(self.persist_picks_loop())
+        self.link_latency_task = asyncio.create_task(self.report_link_latency_loop())
+        self.reconnect_task = asyncio.create_task(self.reconnect_loop())
         await self.clear_jump_pick()
         # Restore current pattern, if any
-        names = await self.pattern_db.get_pattern_names()
+        names = await self.pattern_db.get_pattern_names(max_names=1)
         if len(names) > 0:
             await self.select_pattern(names[-1])
-        await self.connect_to_loom()
+        try:
+            await self.connect_to_loom()
+        except Exception as e:
+            # Keep trying, e.g. until the loom is turned on
+            self.log.error(f"LoomServer: could not connect to the loom: {e!r}")
+            self.loom_lost_time = time.monotonic()
+            self.reconnect_event.set()
 
-    async def close(
-        self, stop_read_loom: bool = True, stop_read_client: bool = True
-    ) -> None:
+    async def close(self, stop_read_client: bool = True) -> None:
         """Disconnect from client and loom and stop all tasks."""
-        if self.loom_writer is not None:
-            if stop_read_loom:
-                self.read_loom_task.cancel()
-            if stop_read_client:
-                self.read_client_task.cancel()
-            self.loom_writer.close()
-        if self.mock_loom is not None:
-            await self.mock_loom.close()
+        if stop_read_client:
+            self.read_client_task.cancel()
+        protocol = self.loom_protocol
+        self.loom_protocol = None
+        await self.run_in_loom_loop(self.close_loom_connection(protocol))
+        if self.loom_thread is not None:
+            self.loom_thread.close()
+        if self.client_sender is not None:
+            await self.client_sender.close()
+        self.report_picks_task.cancel()
+        self.persist_picks_task.cancel()
+        self.link_latency_task.cancel()
+        self.reconnect_task.cancel()
+        self.cancel_uploads()
+        if self.owns_pattern_parser:
+            self.pattern_parser.close()
+        await self.persist_picks()
+        await self.pattern_db.close()
         if not self.done_task.done():
             self.done_task.set_result(None)
 
-    async def add_pattern(self, pattern: ReducedPattern) -> None:
+    async def add_pattern(
+        self, pattern: ReducedPattern, upload_hash: str | None = None
+    ) -> None:
         """Add a pattern to pattern database.
 
-        Also purge the MAX_PATTERNS oldest entries (excluding
-        the current pattern, if any) and report the new list
+        Also purge the least recently used patterns, as needed
+        to meet max_patterns, max_pattern_bytes and max_pattern_age
+        (but never the current pattern), and report the new list
         of pattern names to the client.
+
+        A pattern with the same name is replaced, and any unsaved
+        pick number for it is discarded.
+
+        Parameters
+        ----------
+        pattern : ReducedPattern
+            The pattern to add.
+        upload_hash : str | None
+            The hash of the file the pattern was parsed from, if any;
+            see PatternDatabase.add_pattern.
         """
-        await self.pattern_db.add_pattern(pattern=pattern, max_entries=MAX_PATTERNS)
+        self.discard_pick_persistence(pattern.name)
+        await self.pattern_db.add_pattern(
+            pattern=pattern,
+            max_entries=self.max_patterns,
+            max_bytes=self.max_pattern_bytes,
+            max_age=self.max_pattern_age,
+            upload_hash=upload_hash,
+        )
         await self.report_pattern_names()
 
+    def is_idle(self, idle_time: float) -> bool:
+        """Return True if there have been no pick requests from the loom
+        or commands from the client for at least idle_time (seconds),
+        and all pick numbers have been saved.
+
+        May be called from any thread.
+        """
+        return (
+            not self.picks_to_persist
+            and time.monotonic() - self.last_activity_time >= idle_time
+        )
+
+    @property
+    def jump_pick(self) -> client_replies.JumpPickNumber:
+        """The pending jump, if any."""
+        return self.pick_pipeline.jump_pick
+
     @property
     def loom_connected(self) -> bool:
         """Return True if connected to the loom."""
-        return not (
-            self.loom_writer is None
-            or self.loom_reader is None
-            or self.loom_writer.is_closing()
-            or self.loom_reader.at_eof()
-        )
+        return self.loom_protocol is not None and self.loom_protocol.is_connected
 
     async def close_websocket(
         self, ws: WebSocket, code: CloseCode = CloseCode.NORMAL, reason: str = ""
@@ -182,19 +431,20 @@ class LoomServer:
         """
         if self.loom_connected:
             await self.disconnect_from_loom()
+        self.loom_state = None
         try:
             self.loom_connecting = True
             await self.report_loom_connection_state()
-            if self.serial_port == MOCK_PORT_NAME:
-                self.mock_loom = MockLoom(verbose=self.verbose)
-                self.loom_reader, self.loom_writer = (
-                    await self.mock_loom.open_client_connection()
-                )
-            else:
-                self.loom_reader, self.loom_writer = await open_serial_connection(
-                    url=self.serial_port, baudrate=BAUD_RATE
-                )
+            self.loom_protocol = await self.run_in_loom_loop(
+                self.open_loom_connection()
+            )
+            if self.driver_client is not None:
+                await self.adopt_driver_state()
             self.loom_connecting = False
+            if self.loom_lost_time is not None:
+                self.recovery_times.append(time.monotonic() - self.loom_lost_time)
+                self.num_loom_recoveries += 1
+                self.loom_lost_time = None
             await self.report_loom_connection_state()
         except Exception as e:
             self.loom_connecting = False
@@ -203,7 +453,153 @@ class LoomServer:
         finally:
             self.loom_connecting = False
 
-        self.read_loom_task = asyncio.create_task(self.read_loom_loop())
+    async def adopt_driver_state(self) -> None:
+        """Adopt the state of the loom driver, after connecting to it.
+
+        The driver is the authority on the current pick, pending jump
+        and weave direction, since it may have been weaving while
+        this server was not running. But if the driver's pattern is not
+        in the pattern database, the driver gets this server's pattern
+        (and jump, if any) instead.
+        """
+        assert self.driver_client is not None  # make mypy happy
+        state = self.driver_client.state
+        self.weave_forward = state["weave_forward"]
+        await self.report_weave_direction()
+        pattern_name = state["pattern_name"]
+        if pattern_name is not None and pattern_name in (
+            await self.pattern_db.get_pattern_names()
+        ):
+            await self.persist_picks()
+            await self.pattern_db.update_pick_number(
+                pattern_name=pattern_name,
+                pick_number=state["pick_number"],
+                repeat_number=state["repeat_number"],
+            )
+            # This sends the pattern (with the driver's pick) to the driver,
+            # which clears the driver's jump; it is restored below.
+            await self.select_pattern(pattern_name)
+        elif self.current_pattern is not None:
+            self.driver_client.send_pattern(self.current_pattern)
+            self.driver_client.send_jump_pick(self.jump_pick)
+            return
+        jump_pick = client_replies.JumpPickNumber(
+            pick_number=state["jump_pick_number"],
+            repeat_number=state["jump_repeat_number"],
+        )
+        self.pick_pipeline.set_jump_pick(jump_pick)
+        self.driver_client.send_jump_pick(jump_pick)
+        await self.report_jump_pick_number()
+
+    def call_in_web_loop(
+        self, callback: collections.abc.Callable[..., Any], *args
+    ) -> None:
+        """Call a function in the web (client) event loop.
+
+        If using a loom thread, the function is called soon (using the
+        web loop's thread-safe queue), else it is called immediately.
+        For use by code handling the loom.
+        """
+        if self.loom_thread is None:
+            callback(*args)
+        else:
+            assert self.web_loop is not None
+            self.web_loop.call_soon_threadsafe(callback, *args)
+
+    async def close_loom_connection(
+        self, protocol: LoomProtocol | DriverClient | None
+    ) -> None:
+        """Close a connection to the loom and the mock loom, if any.
+
+        Runs in the loom event loop (see run_in_loom_loop).
+        """
+        if self.status_poller is not None:
+            self.status_poller.stop()
+            self.status_poller = None
+        if protocol is not None:
+            protocol.close()
+        if self.mock_loom is not None:
+            await self.mock_loom.close()
+            self.mock_loom = None
+
+    def create_loom_protocol(self) -> LoomProtocol:
+        """Create a LoomProtocol that calls back to this server."""
+        return LoomProtocol(
+            reply_callback=self.handle_loom_reply,
+            connection_lost_callback=partial(
+                self.call_in_web_loop, self.handle_loom_connection_lost
+            ),
+            write_timeout=self.write_timeout,
+            latency_recorder=self.pick_latency,
+        )
+
+    @property
+    def driver_client(self) -> DriverClient | None:
+        """The connection to the loom driver, if using one and connected."""
+        if isinstance(self.loom_protocol, DriverClient):
+            return self.loom_protocol
+        return None
+
+    def handle_driver_pick(self, prepared_pick: PreparedPick) -> None:
+        """Handle a pick that the loom driver sent to the loom."""
+        self.pick_pipeline.apply_pick(prepared_pick)
+        self.handle_pick_sent(prepared_pick)
+
+    def handle_driver_problem(
+        self, message: str, severity: MessageSeverityEnum
+    ) -> None:
+        """Report a problem reported by the loom driver."""
+        self.log.warning(f"LoomServer: loom driver reported: {message}")
+        self.start_background_task(
+            self.report_command_problem(message=message, severity=severity)
+        )
+
+    async def open_loom_connection(self) -> LoomProtocol | DriverClient:
+        """Open a connection to the loom and return the protocol.
+
+        Runs in the loom event loop (see run_in_loom_loop).
+        """
+        if self.driver_socket_path is not None:
+            driver_client = DriverClient(
+                socket_path=self.driver_socket_path,
+                pick_callback=self.handle_driver_pick,
+                problem_callback=self.handle_driver_problem,
+                connection_lost_callback=self.handle_loom_connection_lost,
+            )
+            await driver_client.connect()
+            return driver_client
+        protocol, self.mock_loom = await open_loom_connection(
+            serial_port=self.serial_port,
+            protocol_factory=self.create_loom_protocol,
+            verbose=self.verbose,
+        )
+        if self.status_poll_interval > 0:
+            self.start_status_poller(protocol)
+        return protocol
+
+    def start_status_poller(self, protocol: LoomProtocol) -> None:
+        """Start polling the loom's state, replacing any existing poller.
+
+        Runs in the loom event loop.
+        """
+        if self.status_poller is not None:
+            self.status_poller.stop()
+        self.status_poller = StatusPoller(
+            write_query=partial(protocol.write_if_idle, STATUS_QUERY),
+            state_callback=partial(self.call_in_web_loop, self.handle_loom_state),
+            min_interval=self.status_poll_interval,
+        )
+        self.status_poller.start()
+
+    async def run_in_loom_loop(self, coro: collections.abc.Coroutine) -> Any:
+        """Run a coroutine in the loom event loop and return the result.
+
+        The loom event loop is the loom thread's loop,
+        if using a loom thread, else the current loop.
+        """
+        if self.loom_thread is None:
+            return await coro
+        return await self.loom_thread.run(coro)
 
     async def run_client(self, websocket: WebSocket) -> None:
         """Run a client connection, closing any existing connection.
@@ -222,6 +618,8 @@ class LoomServer:
             await self.disconnect_client()
         await websocket.accept()
         self.websocket = websocket
+        self.client_sender = ClientSender(websocket)
+        self.client_names_version = None
         self.read_client_task = asyncio.create_task(self.read_client_loop())
         if not self.loom_connected:
             try:
@@ -237,6 +635,9 @@ class LoomServer:
 
     async def disconnect_client(self, cancel_read_client_loop: bool = True) -> None:
         self.read_client_task.cancel()
+        if self.client_sender is not None:
+            await self.client_sender.close()
+            self.client_sender = None
         websocket = self.websocket
         self.websocket = None
         if websocket is not None:
@@ -254,19 +655,17 @@ class LoomServer:
         self.loom_disconnecting = True
         await self.report_loom_connection_state()
         try:
-            if self.loom_writer is not None:
-                self.loom_writer.close()
-                self.loom_reader = None
-                self.loom_writer = None
-            self.mock_loom = None
+            protocol = self.loom_protocol
+            self.loom_protocol = None
+            await self.run_in_loom_loop(self.close_loom_connection(protocol))
         finally:
             self.loom_disconnecting = False
             await self.report_loom_connection_state()
 
-    async def command_pick(self, pick: Pick) -> None:
-        """Send a shaft_word to the loom"""
-        shaft_word = sum(1 << i for i, isup in enumerate(pick.are_shafts_up) if isup)
-        await self.command_loom_bytes(shaft_word.to_bytes(length=4, byteorder="big"))
+    def cancel_uploads(self) -> None:
+        """Cancel uploads that are in progress, and deferred selections."""
+        for task in self.upload_tasks:
+            task.cancel()
 
     async def clear_jump_pick(self, force_output=False):
         """Clear self.jump_pick and report value if changed or force_output
@@ -276,12 +675,10 @@ class LoomServer:
         force_output : bool
             If True then report JumpPickNumber, even if it has not changed.
         """
-        null_jump_pick = client_replies.JumpPickNumber(
-            pick_number=None, repeat_number=None
-        )
-        do_report = force_output or self.jump_pick != null_jump_pick
-        self.jump_pick = null_jump_pick
-        if do_report:
+        did_clear = self.pick_pipeline.clear_jump_pick()
+        if did_clear and self.driver_client is not None:
+            self.driver_client.send_jump_pick(self.jump_pick)
+        if did_clear or force_output:
             await self.report_jump_pick_number()
 
     async def command_loom(self, cmd: str) -> None:
@@ -304,28 +701,29 @@ class LoomServer:
             The command to send, without a terminator.
             (This method will append the terminator).
         """
-        if self.loom_writer is None or self.loom_writer.is_closing():
-            raise RuntimeError("Cannot write to the loom: no connection.")
-        if self.verbose:
-            self.log.info(
-                f"LoomServer: sending command to loom: {cmdbytes + TERMINATOR!r}"
-            )
-        self.loom_writer.write(cmdbytes + TERMINATOR)
-        await self.loom_writer.drain()
+        await self.write_to_loom(cmdbytes + TERMINATOR)
 
-    def increment_pick_number(self) -> int:
-        """Increment pick_number in the specified direction.
+    async def write_to_loom(self, data: bytes) -> None:
+        """Write terminated data to the loom
 
-        Increment repeat_number as well, if appropriate.
-
-        Return the new pick number. This will be 0 if repeat_number changed,
-        or if unweaving and repeat_number would be decremented to 0.
+        Parameters
+        ----------
+        data : bytes
+            The data to write, including the terminator.
         """
-        if self.current_pattern is None:
-            return 0
-        return self.current_pattern.increment_pick_number(
-            weave_forward=self.weave_forward
-        )
+        if self.loom_protocol is None:
+            raise RuntimeError("Cannot write to the loom: no connection.")
+        if self.verbose:
+            self.log.info(f"LoomServer: sending command to loom: {data!r}")
+        protocol = self.loom_protocol
+        try:
+            await self.run_in_loom_loop(protocol.write_and_drain(data))
+        except TimeoutError:
+            # The link is stalled; treat it as lost, so reconnect_loop
+            # starts over with a new connection.
+            self.log.error("LoomServer: timed out writing to the loom; closing")
+            await self.run_in_loom_loop(self.close_loom_connection(protocol))
+            raise
 
     async def cmd_clear_pattern_names(self, command: SimpleNamespace) -> None:
         # Clear the pattern database
@@ -337,32 +735,18 @@ class LoomServer:
             await self.report_pattern_names()
 
     async def cmd_file(self, command: SimpleNamespace) -> None:
-        filename = command.name
-        try:
-            if self.verbose:
-                self.log.info(
-                    f"LoomServer: read weaving pattern {filename!r}: data={command.data[0:40]!r}...",
-                )
-            if filename.lower().endswith(".dtx"):
-                with io.StringIO(command.data) as dtx_file:
-                    pattern_data = read_dtx(dtx_file)
-            elif filename.lower().endswith(".wif"):
-                with io.StringIO(command.data) as wif_file:
-                    pattern_data = read_wif(wif_file)
-            else:
-                raise CommandError(
-                    f"Cannot load pattern {filename!r}: unsupported file type"
-                )
-            pattern = reduced_pattern_from_pattern_data(
-                name=command.name, data=pattern_data
-            )
-            await self.add_pattern(pattern)
-
-        except Exception as e:
-            await self.report_command_problem(
-                message=f"Failed to read pattern {filename!r}: {e!r}",
-                severity=MessageSeverityEnum.WARNING,
+        # Parse the file in the background, but add patterns
+        # in the order they were uploaded.
+        upload_task = asyncio.create_task(
+            self.upload_pattern(
+                filename=command.name,
+                data=command.data,
+                previous_upload_task=self.upload_task,
             )
+        )
+        self.upload_task = upload_task
+        self.upload_tasks.add(upload_task)
+        upload_task.add_done_callback(self.upload_tasks.discard)
 
     async def cmd_jump_to_pick(self, command: SimpleNamespace) -> None:
         if self.current_pattern is None:
@@ -381,21 +765,67 @@ class LoomServer:
                     + f" {command.pick_number} > {max_pick_number}"
                 )
 
-        self.jump_pick = client_replies.JumpPickNumber(
-            pick_number=command.pick_number,
-            repeat_number=command.repeat_number,
+        self.pick_pipeline.set_jump_pick(
+            client_replies.JumpPickNumber(
+                pick_number=command.pick_number,
+                repeat_number=command.repeat_number,
+            )
         )
+        if self.driver_client is not None:
+            self.driver_client.send_jump_pick(self.jump_pick)
         await self.report_jump_pick_number()
 
+    async def cmd_search_patterns(self, command: SimpleNamespace) -> None:
+        query = getattr(command, "query", "")
+        offset = max(getattr(command, "offset", 0), 0)
+        limit = min(
+            max(getattr(command, "limit", DEFAULT_PAGE_SIZE), 1), MAX_SEARCH_PAGE_SIZE
+        )
+        # Only patterns with the same warp as the current pattern?
+        # If there is no current pattern, nothing matches.
+        same_warp = bool(getattr(command, "same_warp", False))
+        same_warp_as = ""
+        if same_warp and self.current_pattern is not None:
+            same_warp_as = self.current_pattern.name
+        total = 0
+        patterns: list[PatternMetadata] = []
+        if same_warp_as or not same_warp:
+            try:
+                total, patterns = await self.pattern_db.search_patterns(
+                    query=query, offset=offset, limit=limit, same_warp_as=same_warp_as
+                )
+            except ValueError as e:
+                raise CommandError(str(e))
+        await self.reply_to_client(
+            client_replies.PatternPage(
+                query=query,
+                offset=offset,
+                total=total,
+                patterns=patterns,
+                same_warp=same_warp,
+            )
+        )
+
     async def cmd_select_pattern(self, command: SimpleNamespace) -> None:
         name = command.name
+        if not self.upload_task.done() or not self.select_task.done():
+            # The pattern may not have been added yet
+            self.select_task = asyncio.create_task(
+                self.select_after_uploads(
+                    name=name, wait_for=[self.upload_task, self.select_task]
+                )
+            )
+            self.upload_tasks.add(self.select_task)
+            self.select_task.add_done_callback(self.upload_tasks.discard)
+            return
         if self.current_pattern is not None and self.current_pattern.name == name:
             return
         await self.select_pattern(name)
-        await self.clear_jump_pick()
 
     async def cmd_weave_direction(self, command: SimpleNamespace) -> None:
         self.weave_forward = command.forward
+        if self.driver_client is not None:
+            self.driver_client.send_weave_forward(self.weave_forward)
         await self.report_weave_direction()
 
     async def cmd_oobcommand(self, command: SimpleNamespace) -> None:
@@ -408,17 +838,26 @@ class LoomServer:
         try:
             self.client_connected = True
             await self.report_loom_connection_state()
+            await self.report_loom_state()
             await self.report_pattern_names()
             await self.report_weave_direction()
             await self.clear_jump_pick(force_output=True)
             await self.report_current_pattern()
             await self.report_current_pick_number()
-            if not self.loom_connected:
-                await self.connect_to_loom()
+            if not self.loom_connected and not self.loom_connecting:
+                try:
+                    await self.connect_to_loom()
+                except Exception as e:
+                    # connect_to_loom reported the problem;
+                    # reconnect_loop keeps trying.
+                    self.log.warning(
+                        f"LoomServer: could not connect to the loom: {e!r}"
+                    )
             while self.client_connected:
                 assert self.websocket is not None
                 try:
                     data = await self.websocket.receive_json()
+                    self.last_activity_time = time.monotonic()
                 except json.JSONDecodeError:
                     self.log.info(
                         "LoomServer: ignoring invalid command: not json-encoded"
@@ -481,86 +920,302 @@ class LoomServer:
                 message="Client read loop failed; try refreshing",
                 severity=MessageSeverityEnum.ERROR,
             )
+            if self.client_sender is not None:
+                await self.client_sender.flush(timeout=0.1)
             self.client_connected = False
             if self.websocket is not None:
                 await self.close_websocket(
                     self.websocket, code=CloseCode.ERROR, reason=repr(e)
                 )
+        finally:
+            self.cancel_uploads()
 
-    async def read_loom_loop(self) -> None:
-        """Read and process replies from the loom."""
-        try:
-            if self.loom_reader is None:
-                raise RuntimeError("No loom reader")
-            while True:
-                reply_bytes = await self.loom_reader.readuntil(TERMINATOR)
-                if self.verbose:
-                    self.log.info(f"LoomServer: read loom reply: {reply_bytes!r}")
-                if not reply_bytes:
-                    self.log.warning("Reader closed; quit read_loom_loop")
-                    return
-                reply = reply_bytes.decode().strip()
-                # The only possible replies from the loom are:
-                # "1": request next forward pick
-                # "2": request next backward pick
-                # TODO: allow the user to choose whether to use the loom's
-                # commanded direction (respect the "reverse" button)
-                # or the software's commanded direction.
-                # For now only the software works.
-                if reply not in {"1", "2"}:
-                    message = f"invalid loom reply {reply!r}: must be '1' or '2'"
-                    self.log.warning(f"LoomServer: {message}")
-                    await self.report_command_problem(
-                        message=message,
-                        severity=MessageSeverityEnum.WARNING,
-                    )
+    def handle_loom_connection_lost(self, exc: Exception | None) -> None:
+        """Handle loss of the connection to the loom.
+
+        Called (in the web loop) by self.loom_protocol; a no-op
+        if the connection was closed by disconnect_from_loom or replaced.
+        """
+        if self.loom_protocol is None or not self.loom_protocol.lost:
+            return
+        self.loom_protocol = None
+        if exc is None:
+            self.log.warning("LoomServer: the loom closed the connection")
+            reason = ""
+        else:
+            message = f"Lost the connection to the loom: {exc!r}"
+            self.log.error(f"LoomServer: {message}")
+            reason = str(exc)
+            self.start_background_task(
+                self.report_command_problem(
+                    message=message,
+                    severity=MessageSeverityEnum.ERROR,
+                )
+            )
+        self.start_background_task(self.report_loom_connection_state(reason=reason))
+        self.loom_lost_time = time.monotonic()
+        self.num_loom_losses += 1
+        self.reconnect_event.set()
+
+    async def reconnect_loop(self) -> None:
+        """Reconnect to the loom whenever the connection is lost.
+
+        Retry with jittered exponential backoff until connected.
+        The pick pipeline (pattern, pick and jump) is kept by this server,
+        so weaving resumes where it left off.
+        """
+        while True:
+            await self.reconnect_event.wait()
+            self.reconnect_event.clear()
+            delay = RECONNECT_MIN_DELAY
+            while not self.loom_connected:
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+                if self.loom_connected or self.loom_connecting:
+                    # A client connected (and connected to the loom)
                     continue
+                self.num_reconnect_attempts += 1
+                try:
+                    await self.connect_to_loom()
+                except Exception as e:
+                    self.log.warning(
+                        f"LoomServer: could not reconnect to the loom: {e!r}"
+                    )
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            self.log.info("LoomServer: reconnected to the loom")
 
-                if self.current_pattern is not None:
-                    # Command a new pick, if there is one.
-                    if self.jump_pick.pick_number is not None:
-                        new_pick_number = self.jump_pick.pick_number
-                        self.current_pattern.set_current_pick_number(new_pick_number)
-                    else:
-                        new_pick_number = self.increment_pick_number()
-                    if self.jump_pick.repeat_number is not None:
-                        self.current_pattern.repeat_number = (
-                            self.jump_pick.repeat_number
-                        )
-                    pick = self.current_pattern.get_current_pick()
-                    await self.command_pick(pick)
-                    await self.clear_jump_pick()
-                    await self.report_current_pick_number()
+    def handle_loom_reply(self, reply: bytes) -> bytes | None:
+        """Handle a reply from the loom.
 
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            message = f"Server stopped listening to the loom: {e!r}"
-            self.log.exception(f"LoomServer: {message}")
-            await self.report_command_problem(
+        Called by self.loom_protocol for each reply,
+        without the terminator. Return the command to send
+        to the loom in response, if any.
+
+        This runs in the loom event loop; everything but
+        choosing the next pick is done in the web loop.
+        """
+        if self.verbose:
+            self.log.info(f"LoomServer: read loom reply: {reply!r}")
+        # The possible replies from the loom are:
+        # b"1": request next forward pick
+        # b"2": request next backward pick
+        # b"=s" + state word in hex: reply to STATUS_QUERY
+        if reply.startswith(STATUS_REPLY_PREFIX):
+            state_word = parse_status_reply(reply)
+            if state_word is None:
+                self.call_in_web_loop(self.report_invalid_loom_reply, reply)
+            elif self.status_poller is not None:
+                self.status_poller.handle_state_word(state_word)
+            return None
+        # TODO: allow the user to choose whether to use the loom's
+        # commanded direction (respect the "reverse" button)
+        # or the software's commanded direction.
+        # For now only the software works.
+        if reply not in (b"1", b"2"):
+            self.call_in_web_loop(self.report_invalid_loom_reply, reply)
+            return None
+        self.last_activity_time = time.monotonic()
+        if self.status_poller is not None:
+            self.status_poller.note_activity()
+
+        # Command the next pick, if there is one. Send it first;
+        # the client and database are updated by follow-up tasks.
+        prepared_pick = self.pick_pipeline.advance(weave_forward=self.weave_forward)
+        if prepared_pick is None:
+            return None
+        if self.verbose:
+            self.log.info(
+                f"LoomServer: sending command to loom: {prepared_pick.cmdbytes!r}"
+            )
+        self.call_in_web_loop(self.handle_pick_sent, prepared_pick)
+        return prepared_pick.cmdbytes
+
+    def handle_loom_state(self, loom_state: client_replies.LoomState) -> None:
+        """Record and report a changed loom state."""
+        self.loom_state = loom_state
+        self.start_background_task(self.report_loom_state())
+
+    def handle_pick_sent(self, prepared_pick: PreparedPick) -> None:
+        """Queue follow-up work for a pick that was sent to the loom."""
+        self.picks_to_report.put_nowait(prepared_pick)
+        self.queue_pick_persistence(
+            pattern_name=prepared_pick.pattern_name,
+            pick_number=prepared_pick.pick_number,
+            repeat_number=prepared_pick.repeat_number,
+        )
+
+    def report_invalid_loom_reply(self, reply: bytes) -> None:
+        """Log and report an invalid reply from the loom."""
+        message = f"invalid loom reply {reply!r}"
+        self.log.warning(f"LoomServer: {message}")
+        self.start_background_task(
+            self.report_command_problem(
                 message=message,
-                severity=MessageSeverityEnum.ERROR,
+                severity=MessageSeverityEnum.WARNING,
             )
-            await self.disconnect_from_loom()
+        )
+
+    async def persist_picks(self) -> None:
+        """Save all pending pick numbers to the database."""
+        self.num_unsaved_picks = 0
+        while self.picks_to_persist:
+            pattern_name, (pick_number, repeat_number) = next(
+                iter(self.picks_to_persist.items())
+            )
+            try:
+                self.num_pick_writes += 1
+                await self.pattern_db.update_pick_number(
+                    pattern_name=pattern_name,
+                    pick_number=pick_number,
+                    repeat_number=repeat_number,
+                )
+            except Exception as e:
+                self.log.exception(
+                    f"LoomServer: failed to save pick number for {pattern_name!r}: {e!r}"
+                )
+            # Only discard the entry if it was not updated while writing.
+            if self.picks_to_persist.get(pattern_name) == (pick_number, repeat_number):
+                del self.picks_to_persist[pattern_name]
+
+    async def persist_picks_loop(self) -> None:
+        """Save pick numbers queued by queue_pick_persistence,
+        once persist_interval has passed since the oldest unsaved pick,
+        or sooner if enough picks are unsaved.
+        """
+        while True:
+            await self.persist_picks_event.wait()
+            try:
+                async with asyncio.timeout(self.persist_interval):
+                    await self.persist_picks_now_event.wait()
+            except TimeoutError:
+                pass
+            self.persist_picks_event.clear()
+            self.persist_picks_now_event.clear()
+            await self.persist_picks()
+
+    def discard_pick_persistence(self, pattern_name: str) -> None:
+        """Discard the unsaved pick number (if any) for a pattern,
+        e.g. because the pattern is being replaced by a new one
+        with the same name, whose pick number must not be overwritten.
+        """
+        self.picks_to_persist.pop(pattern_name, None)
+
+    def queue_pick_persistence(
+        self, pattern_name: str, pick_number: int, repeat_number: int
+    ) -> None:
+        """Queue a pick number to be saved by persist_picks_loop.
+
+        Only the most recent pick number for each pattern is saved.
+        """
+        self.picks_to_persist.pop(pattern_name, None)
+        self.picks_to_persist[pattern_name] = (pick_number, repeat_number)
+        self.num_picks_queued += 1
+        self.num_unsaved_picks += 1
+        self.persist_picks_event.set()
+        if self.num_unsaved_picks >= self.persist_picks_threshold:
+            self.persist_picks_now_event.set()
+
+    async def report_picks_loop(self) -> None:
+        """Report picks sent to the loom to the client.
+
+        Picks of a pattern other than the current pattern are not reported:
+        they were sent before the pattern was selected, and reporting them
+        would overwrite the current pick reported by select_pattern.
+        """
+        while True:
+            prepared_pick = await self.picks_to_report.get()
+            if (
+                self.current_pattern is None
+                or prepared_pick.pattern_name != self.current_pattern.name
+            ):
+                continue
+            try:
+                if prepared_pick.is_jump:
+                    await self.report_jump_pick_number()
+                reply = client_replies.CurrentPickNumber(
+                    pick_number=prepared_pick.pick_number,
+                    repeat_number=prepared_pick.repeat_number,
+                )
+                await self.reply_to_client(reply)
+            except Exception as e:
+                self.log.exception(f"LoomServer: failed to report pick: {e!r}")
+
+    async def report_link_latency_loop(self) -> None:
+        """Measure and report the round-trip time of a network connection
+        to the loom, if connected over the network.
+        """
+        while True:
+            await asyncio.sleep(LINK_LATENCY_INTERVAL)
+            if not isinstance(self.loom_protocol, LoomProtocol):
+                continue
+            round_trip_time = self.loom_protocol.round_trip_time
+            if round_trip_time is None:
+                continue
+            self.link_latencies.append(round_trip_time)
+            await self.reply_to_client(
+                client_replies.LoomLinkLatency(round_trip_time=round_trip_time)
+            )
+
+    def get_stats(self) -> dict[str, Any]:
+        """Get runtime statistics, as a dict that can be encoded as json."""
+        link_latencies = self.link_latencies
+        recovery_times = self.recovery_times
+        return dict(
+            client_sender=(
+                None
+                if self.client_sender is None
+                else dataclasses.asdict(self.client_sender.stats)
+            ),
+            link_round_trip_time=(
+                dict(
+                    last=link_latencies[-1],
+                    min=min(link_latencies),
+                    mean=sum(link_latencies) / len(link_latencies),
+                    max=max(link_latencies),
+                    num_measurements=len(link_latencies),
+                )
+                if link_latencies
+                else None
+            ),
+            loom_reconnect=dict(
+                num_losses=self.num_loom_losses,
+                num_attempts=self.num_reconnect_attempts,
+                num_recoveries=self.num_loom_recoveries,
+                last_time_to_recover=recovery_times[-1] if recovery_times else None,
+                mean_time_to_recover=(
+                    sum(recovery_times) / len(recovery_times)
+                    if recovery_times
+                    else None
+                ),
+                max_time_to_recover=max(recovery_times) if recovery_times else None,
+            ),
+            pattern_cache=dataclasses.asdict(self.pattern_db.cache.stats),
+            pick_latency=self.pick_latency.as_dict(),
+            pick_persistence=dict(
+                num_picks=self.num_picks_queued,
+                num_writes=self.num_pick_writes,
+                num_unsaved_picks=self.num_unsaved_picks,
+            ),
+            pattern_parser=self.pattern_parser.get_stats(),
+            uploads=dict(
+                num_parsed=self.num_uploads_parsed,
+                num_reused=self.num_uploads_reused,
+            ),
+        )
 
     async def reply_to_client(self, reply: Any) -> None:
         """Send a reply to the client.
 
+        The reply is queued and sent by self.client_sender,
+        so this does not wait for the client.
+
         Parameters
         ----------
         reply : dataclasses.dataclass
             The reply as a dataclass. It should have a "type" field
             whose value is a string.
         """
-        if self.client_connected:
-            assert self.websocket is not None
-            reply_dict = dataclasses.asdict(reply)
-            if self.verbose:
-                reply_str = str(reply_dict)
-                if len(reply_str) > 120:
-                    reply_str = reply_str[0:120] + "..."
-                self.log.info(f"LoomServer: reply to client: {reply_str}")
-            await self.websocket.send_json(reply_dict)
+        if self.client_connected and self.client_sender is not None:
+            self.reply_dict_to_client(dataclasses.asdict(reply))
         else:
             if self.verbose:
                 reply_str = str(reply)
@@ -570,6 +1225,21 @@ class LoomServer:
                     f"LoomServer: do not send reply {reply_str}; not connected"
                 )
 
+    def reply_dict_to_client(self, reply_dict: dict[str, Any]) -> bool:
+        """Send a reply that is already a dict to the client, if connected.
+
+        The dict is queued as is, so it must not be changed afterwards.
+        Return True if the reply was queued.
+        """
+        if not self.client_connected or self.client_sender is None:
+            return False
+        if self.verbose:
+            reply_str = str(reply_dict)
+            if len(reply_str) > 120:
+                reply_str = reply_str[0:120] + "..."
+            self.log.info(f"LoomServer: reply to client: {reply_str}")
+        return self.client_sender.send(reply_dict)
+
     async def report_command_problem(self, message: str, severity: MessageSeverityEnum):
         """Report a CommandProblem to the client."""
         reply = client_replies.CommandProblem(message=message, severity=severity)
@@ -593,21 +1263,35 @@ class LoomServer:
         reply = client_replies.LoomConnectionState(state=state, reason=reason)
         await self.reply_to_client(reply)
 
+    async def report_loom_state(self) -> None:
+        """Report LoomState to the client, if known."""
+        if self.loom_state is not None:
+            await self.reply_to_client(self.loom_state)
+
     async def report_pattern_names(self) -> None:
-        """Report PatternNames to the client."""
-        names = await self.pattern_db.get_pattern_names()
-        reply = client_replies.PatternNames(names=names)
-        await self.reply_to_client(reply)
+        """Report PatternNames to the client, unless it already has them.
+
+        The names are only read again (usually from the pattern database's
+        cache), and the reply built again, if the names have changed.
+        """
+        version = self.pattern_db.names_version
+        if version != self.pattern_names_version:
+            self.pattern_names = await self.pattern_db.get_pattern_names(
+                max_names=NUM_MENU_PATTERNS
+            )
+            self.pattern_names_reply = dataclasses.asdict(
+                client_replies.PatternNames(names=self.pattern_names, version=version)
+            )
+            self.pattern_names_version = version
+        if version == self.client_names_version:
+            return
+        if self.reply_dict_to_client(self.pattern_names_reply):
+            self.client_names_version = version
 
     async def report_current_pick_number(self) -> None:
         """Report CurrentPickNumber to the client."""
         if self.current_pattern is None:
             return
-        await self.pattern_db.update_pick_number(
-            pattern_name=self.current_pattern.name,
-            pick_number=self.current_pattern.pick_number,
-            repeat_number=self.current_pattern.repeat_number,
-        )
         reply = client_replies.CurrentPickNumber(
             pick_number=self.current_pattern.pick_number,
             repeat_number=self.current_pattern.repeat_number,
@@ -623,14 +1307,122 @@ class LoomServer:
         client_reply = client_replies.WeaveDirection(forward=self.weave_forward)
         await self.reply_to_client(client_reply)
 
+    def start_background_task(self, coro: collections.abc.Coroutine) -> None:
+        """Run a coroutine in a task, holding a reference until it is done.
+
+        For use by callbacks that cannot await.
+        """
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def select_after_uploads(
+        self, name: str, wait_for: list[asyncio.Future]
+    ) -> None:
+        """Select a pattern once the specified uploads (and deferred
+        selections) are done, and report any problem to the client.
+        """
+        await asyncio.wait(wait_for)
+        try:
+            if self.current_pattern is not None and self.current_pattern.name == name:
+                return
+            await self.select_pattern(name)
+        except CommandError as e:
+            await self.report_command_problem(
+                message=str(e),
+                severity=MessageSeverityEnum.ERROR,
+            )
+        except Exception as e:
+            message = f"select_pattern {name!r} unexpectedly failed: {e!r}"
+            self.log.exception(f"LoomServer: {message}")
+            await self.report_command_problem(
+                message=message,
+                severity=MessageSeverityEnum.ERROR,
+            )
+
     async def select_pattern(self, name: str) -> None:
+        """Select a pattern, and clear the jump pick, if any.
+
+        Also update the pattern's timestamp in the database,
+        to make it the most recent pattern.
+        """
+        # Save pending pick numbers first, so the pattern is up to date.
+        await self.persist_picks()
         try:
             pattern = await self.pattern_db.get_pattern(name)
         except LookupError:
             raise CommandError(f"select_pattern failed: no such pattern: {name}")
+        await self.pattern_db.update_pick_number(
+            pattern_name=pattern.name,
+            pick_number=pattern.pick_number,
+            repeat_number=pattern.repeat_number,
+        )
         self.current_pattern = pattern
+        jump_pick_cleared = self.pick_pipeline.set_pattern(pattern)
+        # Discard unreported picks: the current pick is reported below
+        while not self.picks_to_report.empty():
+            self.picks_to_report.get_nowait()
+        if self.driver_client is not None:
+            self.driver_client.send_pattern(pattern)
         await self.report_current_pattern()
         await self.report_current_pick_number()
+        if jump_pick_cleared:
+            await self.report_jump_pick_number()
+        # A pattern found by searching may not be in the pattern menu
+        if name not in self.pattern_names:
+            await self.report_pattern_names()
+
+    async def upload_pattern(
+        self, filename: str, data: str, previous_upload_task: asyncio.Future
+    ) -> None:
+        """Add a pattern from an uploaded file, and report any problem
+        to the client.
+
+        The file is parsed in a separate process (see PatternParser),
+        unless it was uploaded before.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file, which is also the name of the pattern.
+        data : str
+            The contents of the file.
+        previous_upload_task : asyncio.Future
+            The previous upload. Wait for it to finish before adding
+            the pattern, so patterns are added in the order uploaded.
+        """
+        try:
+            await asyncio.wait([previous_upload_task])
+            if self.verbose:
+                self.log.info(
+                    f"LoomServer: read weaving pattern {filename!r}: data={data[0:40]!r}...",
+                )
+            # A file that was uploaded before need not be parsed again
+            upload_hash = get_upload_hash(filename, data)
+            self.discard_pick_persistence(filename)
+            if await self.pattern_db.add_uploaded_pattern(
+                pattern_name=filename,
+                upload_hash=upload_hash,
+                max_entries=self.max_patterns,
+                max_bytes=self.max_pattern_bytes,
+                max_age=self.max_pattern_age,
+            ):
+                self.num_uploads_reused += 1
+                await self.report_pattern_names()
+                return
+            if not filename.lower().endswith(SUPPORTED_SUFFIXES):
+                raise CommandError(
+                    f"Cannot load pattern {filename!r}: unsupported file type"
+                )
+            pattern = await self.pattern_parser.parse(filename=filename, data=data)
+            self.num_uploads_parsed += 1
+            await self.add_pattern(pattern, upload_hash=upload_hash)
+
+        except Exception as e:
+            await self.report_command_problem(
+                message=f"Failed to read pattern {filename!r}: {e!r}",
+                severity=MessageSeverityEnum.WARNING,
+            )
 
     def t(self, phrase: str) -> str:
         """Translate a phrase, if possible."""
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+__all__ = ["LoomThread"]
+
+import asyncio
+import collections.abc
+import logging
+import threading
+from typing import Any, TypeVar
+
+from .loom_constants import LOG_NAME
+
+T = TypeVar("T")
+
+# Maximum time to wait for the thread to stop (seconds)
+STOP_TIMEOUT = 2
+
+
+class LoomThread:
+    """An event loop running in a dedicated thread, for loom I/O.
+
+    This isolates communication with the loom from everything else
+    in the web server's event loop (HTTP, websockets, database access,
+    pattern parsing).
+
+    Code running in the thread talks to the web server's event loop
+    using that loop's call_soon_threadsafe, and vice-versa.
+
+    Parameters
+    ----------
+    name : str
+        Name of the thread.
+    """
+
+    def __init__(self, name: str = "loom_io") -> None:
+        self.log = logging.getLogger(LOG_NAME)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    @property
+    def is_running(self) -> bool:
+        """Is the thread running?"""
+        return self.thread.is_alive()
+
+    def call_soon(self, callback: collections.abc.Callable[..., Any], *args) -> None:
+        """Call a function in the thread's event loop.
+
+        Safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def run(self, coro: collections.abc.Coroutine[Any, Any, T]) -> T:
+        """Run a coroutine in the thread's event loop and return the result.
+
+        Call from a different event loop.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return await asyncio.wrap_future(future)
+
+    def close(self) -> None:
+        """Cancel all tasks, stop the event loop, and wait for the thread."""
+        if not self.is_running:
+            return
+        self.loop.call_soon_threadsafe(self._stop)
+        self.thread.join(timeout=STOP_TIMEOUT)
+        if self.thread.is_alive():
+            self.log.warning("LoomThread: thread did not stop in time")
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            # Let cancelled tasks finish
+            tasks = asyncio.all_tasks(self.loop)
+            if tasks:
+                self.loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True)
+                )
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        finally:
+            self.loop.close()
+
+    def _stop(self) -> None:
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+        self.loop.stop()
@@ -4,22 +4,51 @@ import json
 import locale
 import logging
 import pathlib
-from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+import re
+import shutil
+import tempfile
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncGenerator
 
 import uvicorn
-from fastapi import FastAPI, WebSocket
-from fastapi.responses import HTMLResponse, Response
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketException, status
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
+from .db_maintenance import DEFAULT_MAINTENANCE_INTERVAL, DatabaseMaintenance
 from .loom_constants import LOG_NAME
-from .loom_server import DEFAULT_DATABASE_PATH, LoomServer
+from .loom_server import (
+    DEFAULT_DATABASE_PATH,
+    DEFAULT_PERSIST_INTERVAL,
+    DEFAULT_PERSIST_PICKS,
+    MAX_PATTERNS,
+    LoomServer,
+)
+from .network_serial import DEFAULT_WRITE_TIMEOUT
+from .pattern_database import BODY_STORES, PatternDatabase, delete_database_files
+from .pattern_export import EXPORT_FORMATS, export_patterns
+from .pattern_parser import DEFAULT_MAX_PARSE_JOBS, DEFAULT_PARSE_TIMEOUT, PatternParser
 
 PKG_FILES = importlib.resources.files("toika_loom_server")
 LOCALE_FILES = PKG_FILES.joinpath("locales")
 
 # Avoid warnings about no event loop in unit tests
-# by constructing when the server starts
+# by constructing when the server starts.
+# loom_server is the first (often the only) loom;
+# loom_servers contains all looms, by loom ID.
 loom_server: LoomServer | None = None
+loom_servers: dict[str, LoomServer] = {}
+# Maintenance of the pattern database (shared by all looms);
+# None if disabled.
+db_maintenance: DatabaseMaintenance | None = None
+
+# Loom ID used if a serial port is specified without one
+DEFAULT_LOOM_ID = ""
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Regex for "loom_id=serial_port"
+LOOM_PORT_REGEX = re.compile(r"([A-Za-z0-9_-]+)=(.+)")
 
 translation_dict: dict[str, str] = {}
 
@@ -28,9 +57,16 @@ def create_argument_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "serial_port",
+        nargs="+",
         help="Serial port connected to the loom, "
         "typically of the form /dev/tty... "
-        "Specify 'mock' to run a mock (simulated) loom",
+        "Specify 'socket://host:port' or 'rfc2217://host:port' "
+        "to connect over the network, e.g. to a serial device server. "
+        "Specify 'mock' to run a mock (simulated) loom. "
+        "Specify 'driver' or 'driver:socket_path' to use a loom driver "
+        "(see run_toika_loom_driver). "
+        "To run several looms, specify loom_id=serial_port for each; "
+        "loom loom_id is then served at /loom/loom_id/",
     )
     parser.add_argument(
         "-r",
@@ -44,6 +80,101 @@ def create_argument_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="print diagnostic information to stdout",
     )
+    parser.add_argument(
+        "--loom-thread",
+        action="store_true",
+        help="communicate with the loom using a dedicated thread, "
+        "so that other work cannot delay responses to the loom",
+    )
+    parser.add_argument(
+        "--write-timeout",
+        default=DEFAULT_WRITE_TIMEOUT,
+        type=float,
+        help="maximum time to write a command to the loom (seconds)",
+    )
+    parser.add_argument(
+        "--status-poll-interval",
+        default=0,
+        type=float,
+        help="interval between queries of the loom's state while weaving "
+        "(seconds); the interval grows while the loom is idle. "
+        "0 (the default) disables status queries.",
+    )
+    parser.add_argument(
+        "--persist-interval",
+        default=DEFAULT_PERSIST_INTERVAL,
+        type=float,
+        help="maximum time before the current pick number is saved "
+        "to the pattern database (seconds); 0 saves every pick",
+    )
+    parser.add_argument(
+        "--persist-picks",
+        default=DEFAULT_PERSIST_PICKS,
+        type=int,
+        help="maximum number of picks woven before the current pick number "
+        "is saved to the pattern database; "
+        "fewer picks than this are lost if the power fails",
+    )
+    parser.add_argument(
+        "--max-patterns",
+        default=MAX_PATTERNS,
+        type=int,
+        help="maximum number of patterns to keep in the pattern database "
+        "(per loom); the least recently used patterns are purged. "
+        "0 for no limit.",
+    )
+    parser.add_argument(
+        "--max-pattern-bytes",
+        default=0,
+        type=int,
+        help="maximum total size of the patterns in the pattern database "
+        "(bytes, per loom); 0 (the default) for no limit.",
+    )
+    parser.add_argument(
+        "--max-pattern-age",
+        default=0,
+        type=float,
+        help="purge patterns that have not been used for this long (days); "
+        "0 (the default) for no limit.",
+    )
+    parser.add_argument(
+        "--pattern-store",
+        default="sqlite",
+        choices=BODY_STORES,
+        help="where to store new patterns: in the pattern database (sqlite), "
+        "or in a memory-mapped file next to it (mmap), which is faster "
+        "for large libraries.",
+    )
+    parser.add_argument(
+        "--max-db-bytes",
+        default=0,
+        type=int,
+        help="maximum size of the stored patterns (bytes, for all looms), "
+        "in the database file and the mmap pattern store, but not the write-ahead log; "
+        "the least recently used patterns are purged while the looms are idle. "
+        "0 (the default) for no limit.",
+    )
+    parser.add_argument(
+        "--maintenance-interval",
+        default=DEFAULT_MAINTENANCE_INTERVAL,
+        type=float,
+        help="interval between maintenance of the pattern database (seconds), "
+        "which only runs while the looms are idle. 0 disables maintenance.",
+    )
+    parser.add_argument(
+        "--max-parse-jobs",
+        default=DEFAULT_MAX_PARSE_JOBS,
+        type=int,
+        help="maximum number of uploaded pattern files to parse at the same time "
+        "(for all looms); each is parsed in a separate process.",
+    )
+    parser.add_argument(
+        "--parse-timeout",
+        default=DEFAULT_PARSE_TIMEOUT,
+        type=float,
+        help="maximum time to parse an uploaded pattern file (seconds); "
+        "0 for no limit.",
+    )
     parser.add_argument(
         "--db-path",
         default=DEFAULT_DATABASE_PATH,
@@ -57,15 +188,59 @@ def create_argument_parser() -> argparse.ArgumentParser:
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, FastAPI]:
     global loom_server
+    global db_maintenance
     global translation_dict
     translation_dict = get_translation_dict()
     parser = create_argument_parser()
     args = parser.parse_args()
+    kwargs = vars(args)
+    loom_ports = parse_loom_ports(kwargs.pop("serial_port"))
+    kwargs["max_pattern_age"] *= SECONDS_PER_DAY
+    max_db_bytes = kwargs.pop("max_db_bytes")
+    maintenance_interval = kwargs.pop("maintenance_interval")
+    if args.reset_db:
+        delete_database_files(args.db_path)
+    pattern_db = PatternDatabase(args.db_path, body_store=kwargs.pop("pattern_store"))
+    # Limit the number of parse jobs for all looms together
+    pattern_parser = PatternParser(
+        max_jobs=kwargs.pop("max_parse_jobs"), timeout=kwargs.pop("parse_timeout")
+    )
+    # Isolate each loom's serial I/O in its own thread
+    if len(loom_ports) > 1:
+        kwargs["loom_thread"] = True
 
-    async with LoomServer(
-        **vars(args), translation_dict=translation_dict
-    ) as loom_server:
-        yield
+    async with AsyncExitStack() as stack:
+        # Close the parser after the loom servers, which use it
+        stack.callback(pattern_parser.close)
+        for loom_id, serial_port in loom_ports.items():
+            loom_servers[loom_id] = await stack.enter_async_context(
+                LoomServer(
+                    serial_port=serial_port,
+                    **kwargs,
+                    translation_dict=translation_dict,
+                    pattern_db=pattern_db.for_loom(loom_id),
+                    pattern_parser=pattern_parser,
+                )
+            )
+        loom_server = next(iter(loom_servers.values()))
+        if maintenance_interval > 0:
+            db_maintenance = DatabaseMaintenance(
+                pattern_db=loom_server.pattern_db,
+                is_idle=lambda idle_time: all(
+                    server.is_idle(idle_time) for server in loom_servers.values()
+                ),
+                max_db_bytes=max_db_bytes,
+                interval=maintenance_interval,
+            )
+            db_maintenance.start()
+        try:
+            yield
+        finally:
+            if db_maintenance is not None:
+                db_maintenance.stop()
+                db_maintenance = None
+            loom_servers.clear()
+            loom_server = None
 
 
 app = FastAPI(lifespan=lifespan)
@@ -73,6 +248,47 @@ app = FastAPI(lifespan=lifespan)
 log = logging.getLogger(LOG_NAME)
 
 
+def parse_loom_ports(serial_ports: list[str]) -> dict[str, str]:
+    """Parse serial port arguments into a dict of loom ID: serial port.
+
+    Each argument is loom_id=serial_port or (for at most one loom)
+    serial_port, in which case the loom ID is DEFAULT_LOOM_ID.
+
+    Raises
+    ------
+    ValueError
+        If a loom ID is repeated.
+    """
+    loom_ports: dict[str, str] = {}
+    for arg in serial_ports:
+        match = LOOM_PORT_REGEX.fullmatch(arg)
+        if match is None:
+            loom_id, serial_port = DEFAULT_LOOM_ID, arg
+        else:
+            loom_id, serial_port = match.groups()
+        if loom_id in loom_ports:
+            raise ValueError(f"Loom ID {loom_id!r} specified more than once")
+        loom_ports[loom_id] = serial_port
+    return loom_ports
+
+
+def get_loom_server(loom_id: str) -> LoomServer:
+    """Get the LoomServer for a loom ID.
+
+    Raises
+    ------
+    fastapi.HTTPException
+        If there is no such loom.
+    """
+    loom_server = loom_servers.get(loom_id)
+    if loom_server is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No loom with ID {loom_id!r}",
+        )
+    return loom_server
+
+
 def get_translation_dict() -> dict[str, str]:
     """Get the translation dict for the current locale"""
     # Read a dict of key: None and turn into a dict of key: key
@@ -105,6 +321,17 @@ def get_translation_dict() -> dict[str, str]:
 
 @app.get("/")
 async def get() -> HTMLResponse:
+    assert loom_server is not None
+    return get_display(loom_server)
+
+
+@app.get("/loom/{loom_id}/")
+async def get_loom(loom_id: str) -> HTMLResponse:
+    return get_display(get_loom_server(loom_id))
+
+
+def get_display(loom_server: LoomServer) -> HTMLResponse:
+    """Get the display page for a loom."""
     global translation_dict
 
     display_html_template = PKG_FILES.joinpath("display.html_template").read_text()
@@ -117,7 +344,6 @@ async def get() -> HTMLResponse:
     )
     display_js = display_js.replace("const TranslationDict = {}", js_translation_str)
 
-    assert loom_server is not None
     is_mock = loom_server.mock_loom is not None
     display_debug_controls = "block" if is_mock else "none"
 
@@ -137,6 +363,87 @@ async def favicon():
     return Response(content=bindata, media_type="image/x-icon")
 
 
+@app.get("/stats")
+async def get_stats() -> dict[str, Any]:
+    """Get runtime statistics, e.g. to see if the client is a bottleneck."""
+    assert loom_server is not None
+    return get_stats_dict(loom_server)
+
+
+@app.get("/loom/{loom_id}/stats")
+async def get_loom_stats(loom_id: str) -> dict[str, Any]:
+    """Get runtime statistics for one loom."""
+    return get_stats_dict(get_loom_server(loom_id))
+
+
+def get_stats_dict(loom_server: LoomServer) -> dict[str, Any]:
+    """Get runtime statistics for a loom,
+    including maintenance of the pattern database (None if disabled).
+    """
+    stats = loom_server.get_stats()
+    stats["db_maintenance"] = (
+        None if db_maintenance is None else db_maintenance.get_stats()
+    )
+    return stats
+
+
+@app.get("/backup")
+async def get_backup() -> FileResponse:
+    """Get a backup of the pattern database (for all looms),
+    made while the server is running.
+    """
+    assert loom_server is not None
+    backup_dir = pathlib.Path(tempfile.mkdtemp())
+    backup_path = backup_dir / "toika_loom_patterns.sqlite"
+    try:
+        await loom_server.pattern_db.backup(backup_path)
+    except BaseException:
+        shutil.rmtree(backup_dir)
+        raise
+    return FileResponse(
+        backup_path,
+        filename=backup_path.name,
+        media_type="application/vnd.sqlite3",
+        background=BackgroundTask(shutil.rmtree, backup_dir),
+    )
+
+
+@app.get("/export")
+async def get_export(format: str = "wif") -> StreamingResponse:
+    """Export all patterns as a zip file."""
+    assert loom_server is not None
+    return get_export_response(loom_server, format=format)
+
+
+@app.get("/loom/{loom_id}/export")
+async def get_loom_export(loom_id: str, format: str = "wif") -> StreamingResponse:
+    """Export all patterns for one loom as a zip file."""
+    return get_export_response(get_loom_server(loom_id), format=format)
+
+
+def get_export_response(loom_server: LoomServer, format: str) -> StreamingResponse:
+    """Get a streaming response that exports a loom's patterns.
+
+    Raises
+    ------
+    fastapi.HTTPException
+        If format is not one of EXPORT_FORMATS.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown format {format!r}; must be one of {EXPORT_FORMATS}",
+        )
+    filename = "toika_loom_patterns"
+    if loom_server.pattern_db.loom_id:
+        filename += f"_{loom_server.pattern_db.loom_id}"
+    return StreamingResponse(
+        export_patterns(loom_server.pattern_db, format=format),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.zip"'},
+    )
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket) -> None:
     global loom_server
@@ -144,6 +451,16 @@ async def websocket_endpoint(websocket: WebSocket) -> None:
     await loom_server.run_client(websocket=websocket)
 
 
+@app.websocket("/loom/{loom_id}/ws")
+async def loom_websocket_endpoint(websocket: WebSocket, loom_id: str) -> None:
+    loom_server = loom_servers.get(loom_id)
+    if loom_server is None:
+        raise WebSocketException(
+            code=status.WS_1008_POLICY_VIOLATION, reason=f"No loom with ID {loom_id!r}"
+        )
+    await loom_server.run_client(websocket=websocket)
+
+
 def run_toika_loom() -> None:
     # Handle the help argument and also catch parsing errors right away
     parser = create_argument_parser()
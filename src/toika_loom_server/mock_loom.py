@@ -1,11 +1,12 @@
 from __future__ import annotations
 
-__all__ = ["MockLoom"]
+__all__ = ["MockLoom", "MockLoomTransport"]
 
 import asyncio
+import collections.abc
 import logging
 from types import TracebackType
-from typing import Type
+from typing import Type, TypeVar
 
 from .loom_constants import LOG_NAME, TERMINATOR
 from .mock_streams import (
@@ -15,10 +16,71 @@ from .mock_streams import (
     StreamWriterType,
     open_mock_connection,
 )
+from .status_poller import STATUS_QUERY, STATUS_REPLY_PREFIX
 
 SHAFT_MOTION_DURATION: float = 1  # seconds for shafts to move
 DIRECTION_NAMES = {True: "weave", False: "unweave"}
 
+ProtocolT = TypeVar("ProtocolT", bound=asyncio.Protocol)
+
+
+class MockLoomTransport(asyncio.Transport):
+    """Transport for a protocol-level connection to a MockLoom.
+
+    Create using MockLoom.open_client_transport.
+
+    Parameters
+    ----------
+    loom : MockLoom
+        The mock loom.
+    protocol : asyncio.Protocol
+        The client's protocol, which receives replies from the loom.
+    """
+
+    def __init__(self, loom: MockLoom, protocol: asyncio.Protocol) -> None:
+        super().__init__()
+        self.loom = loom
+        self.protocol = protocol
+        self.closing = False
+        self.buffer = bytearray()
+
+    def abort(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.closing:
+            return
+        self.closing = True
+        asyncio.get_running_loop().call_soon(self.protocol.connection_lost, None)
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self.protocol
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def write(self, data: bytes | bytearray | memoryview) -> None:
+        """Send terminated commands to the loom."""
+        if self.closing:
+            return
+        self.buffer += data
+        while True:
+            index = self.buffer.find(TERMINATOR)
+            if index < 0:
+                break
+            cmdbytes = bytes(self.buffer[: index + len(TERMINATOR)])
+            del self.buffer[: index + len(TERMINATOR)]
+            self.loom.transport_commands.put_nowait(cmdbytes)
+
+    def deliver_reply(self, data: bytes) -> None:
+        """Deliver terminated reply data from the loom to the protocol."""
+        if self.closing:
+            return
+        asyncio.get_running_loop().call_soon(self.protocol.data_received, data)
+
 
 class MockLoom:
     """Simulate a Toika ES dobby loom.
@@ -28,12 +90,19 @@ class MockLoom:
     verbose : bool
         If True, log diagnostic information.
 
-    The user controls this loom by:
+    The user controls this loom using streams, by:
 
-    * Call command_reader.create_writer() to create a command writer.
-    * Call reply_writer.create_reader() to create a reply reader.
+    * Call open_client_connection() to create a reply reader
+      and a command writer.
     * Read replies from the reply reader.
     * Write commands to the command writer.
+
+    Or using a protocol, by:
+
+    * Call open_client_transport(protocol_factory), the analog
+      of asyncio's loop.create_connection.
+    * Replies are delivered to the protocol's data_received method.
+    * Write commands using the transport.
     """
 
     def __init__(self, verbose: bool = True) -> None:
@@ -42,9 +111,15 @@ class MockLoom:
         self.weave_forward = True
         self.reply_writer: StreamWriterType | None = None
         self.command_reader: StreamReaderType | None = None
+        self.client_transport: MockLoomTransport | None = None
+        self.transport_commands: asyncio.Queue[bytes] = asyncio.Queue()
+        self.handle_transport_commands_task: asyncio.Future = asyncio.Future()
         self.done_task: asyncio.Future = asyncio.Future()
         self.shaft_word = 0
         self.pick_wanted = False
+        self.error = False
+        self.shafts_moving = False
+        self.shafts_moving_handle: asyncio.TimerHandle | None = None
         self.start_task = asyncio.create_task(self.start())
         self.command_event = asyncio.Event()
 
@@ -56,6 +131,11 @@ class MockLoom:
 
     async def close(self, cancel_read_commands_task=True) -> None:
         self.read_commands_task.cancel()
+        self.handle_transport_commands_task.cancel()
+        if self.shafts_moving_handle is not None:
+            self.shafts_moving_handle.cancel()
+        if self.client_transport is not None:
+            self.client_transport.close()
         if self.reply_writer is not None:
             self.reply_writer.close()
             await self.reply_writer.wait_closed()
@@ -80,12 +160,35 @@ class MockLoom:
                 f"Bug: {self.command_reader=} and {self.reply_writer=} must both be mock streams"
             )
 
+    async def open_client_transport(
+        self, protocol_factory: collections.abc.Callable[[], ProtocolT]
+    ) -> tuple[MockLoomTransport, ProtocolT]:
+        """Open a protocol-level connection to the loom.
+
+        The analog of asyncio's loop.create_connection.
+        Only one such connection is supported.
+
+        Returns (transport, protocol).
+        """
+        await self.start_task
+        if self.client_transport is not None:
+            raise RuntimeError("A client transport is already open")
+        protocol = protocol_factory()
+        self.client_transport = MockLoomTransport(loom=self, protocol=protocol)
+        protocol.connection_made(self.client_transport)
+        self.handle_transport_commands_task = asyncio.create_task(
+            self.handle_transport_commands_loop()
+        )
+        return self.client_transport, protocol
+
     @classmethod
     async def amain(cls, verbose: bool = True) -> None:
         loom = cls(verbose=verbose)
         await loom.done_task
 
     def connected(self) -> bool:
+        if self.client_transport is not None:
+            return not self.client_transport.is_closing()
         return (
             self.command_reader is not None
             and self.reply_writer is not None
@@ -94,6 +197,7 @@ class MockLoom:
         )
 
     async def handle_commands_loop(self) -> None:
+        """Handle commands written to the command stream."""
         try:
             while self.connected():
                 assert self.command_reader is not None  # make mypy happy
@@ -101,54 +205,100 @@ class MockLoom:
                 if not cmdbytes:
                     # Connection has closed
                     asyncio.create_task(self.close())
-                self.command_event.set()
-                if len(cmdbytes) == 5:
-                    # cmdbytes should be a 32 bit int
-                    # specifying which shafts to raise
-                    if not self.pick_wanted:
-                        # Ignore the command unless a pick is wanted
-                        continue
-
-                    self.shaft_word = int.from_bytes(cmdbytes[0:4], byteorder="big")
-                    self.pick_wanted = False
-                    if self.verbose:
-                        self.log.info(f"MockLoom: raise shafts {self.shaft_word:08x}")
-                elif len(cmdbytes) == 3 and cmdbytes[0:1] == b"#":
-                    # Out of band command specific to the mock loom.
-                    cmdstr = cmdbytes.decode()
-                    match cmdstr[1].lower():
-                        case "c":
-                            if self.verbose:
-                                self.log.info("MockLoom: oob close command")
-                            asyncio.create_task(self.close())
-                            return
-                        case "d":
-                            self.weave_forward = not self.weave_forward
-                            if self.verbose:
-                                self.log.info(
-                                    "MockLoom: oob toggle weave direction: "
-                                    f"{DIRECTION_NAMES[self.weave_forward]}"
-                                )
-                        case "n":
-                            if self.verbose:
-                                self.log.info("MockLoom: oob request next pick")
-                            self.pick_wanted = True
-                            await self.request_next_pick()
-                        case _:
-                            self.log.warning(
-                                f"MockLoom: unrecognized oob command: {cmdstr!r}"
-                            )
-                else:
-                    self.log.warning(f"MockLoom: unrecognized command: {cmdbytes!r}")
+                    return
+                await self.handle_command(cmdbytes)
         except Exception:
             self.log.exception("MockLoom: handle_command_loop failed; giving up")
             await self.close(cancel_read_commands_task=False)
 
+    async def handle_transport_commands_loop(self) -> None:
+        """Handle commands written to the client transport."""
+        try:
+            while self.connected():
+                cmdbytes = await self.transport_commands.get()
+                await self.handle_command(cmdbytes)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.log.exception(
+                "MockLoom: handle_transport_commands_loop failed; giving up"
+            )
+            asyncio.create_task(self.close())
+
+    async def handle_command(self, cmdbytes: bytes) -> None:
+        """Handle one command, including the terminator."""
+        self.command_event.set()
+        if len(cmdbytes) == 5:
+            # cmdbytes should be a 32 bit int
+            # specifying which shafts to raise
+            if not self.pick_wanted:
+                # Ignore the command unless a pick is wanted
+                return
+
+            self.shaft_word = int.from_bytes(cmdbytes[0:4], byteorder="big")
+            self.pick_wanted = False
+            self.shafts_moving = True
+            if self.shafts_moving_handle is not None:
+                self.shafts_moving_handle.cancel()
+            self.shafts_moving_handle = asyncio.get_running_loop().call_later(
+                SHAFT_MOTION_DURATION, self.end_shaft_motion
+            )
+            if self.verbose:
+                self.log.info(f"MockLoom: raise shafts {self.shaft_word:08x}")
+        elif cmdbytes == STATUS_QUERY:
+            await self.reply(f"{STATUS_REPLY_PREFIX.decode()}{self.state_word:x}")
+        elif len(cmdbytes) == 3 and cmdbytes[0:1] == b"#":
+            # Out of band command specific to the mock loom.
+            cmdstr = cmdbytes.decode()
+            match cmdstr[1].lower():
+                case "c":
+                    if self.verbose:
+                        self.log.info("MockLoom: oob close command")
+                    asyncio.create_task(self.close())
+                case "d":
+                    self.weave_forward = not self.weave_forward
+                    if self.verbose:
+                        self.log.info(
+                            "MockLoom: oob toggle weave direction: "
+                            f"{DIRECTION_NAMES[self.weave_forward]}"
+                        )
+                case "e":
+                    self.error = not self.error
+                    if self.verbose:
+                        self.log.info(f"MockLoom: oob toggle error: {self.error}")
+                case "n":
+                    if self.verbose:
+                        self.log.info("MockLoom: oob request next pick")
+                    self.pick_wanted = True
+                    await self.request_next_pick()
+                case _:
+                    self.log.warning(f"MockLoom: unrecognized oob command: {cmdstr!r}")
+        else:
+            self.log.warning(f"MockLoom: unrecognized command: {cmdbytes!r}")
+
+    def end_shaft_motion(self) -> None:
+        self.shafts_moving = False
+        self.shafts_moving_handle = None
+
+    @property
+    def state_word(self) -> int:
+        """The state word reported in reply to STATUS_QUERY.
+
+        See client_replies.LoomState.from_state_word.
+        """
+        return (
+            (0x00 if self.shafts_moving else 0x01)
+            | (0x04 if self.pick_wanted else 0x00)
+            | (0x08 if self.error else 0x00)
+        )
+
     async def reply(self, reply: str) -> None:
         """Issue the specified reply, which should not be terminated"""
         if self.verbose:
             self.log.info(f"MockLoom: send reply {reply!r}")
-        if self.connected():
+        if self.client_transport is not None:
+            self.client_transport.deliver_reply(reply.encode() + TERMINATOR)
+        elif self.connected():
             assert self.reply_writer is not None
             self.reply_writer.write(reply.encode() + TERMINATOR)
             await self.reply_writer.drain()
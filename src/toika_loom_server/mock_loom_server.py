@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+__all__ = ["DEFAULT_MOCK_LOOM_PORT", "MockLoomServer", "run_mock_loom_server"]
+
+import argparse
+import asyncio
+import logging
+import socket
+from types import TracebackType
+from typing import Type
+
+from .loom_constants import LOG_NAME
+from .mock_loom import MockLoom, MockLoomTransport
+
+DEFAULT_MOCK_LOOM_PORT = 7400
+
+
+class _ReplyForwarder(asyncio.Protocol):
+    """Protocol for a MockLoom client transport
+    that forwards loom replies to a network client.
+    """
+
+    def __init__(self, network_transport: asyncio.Transport) -> None:
+        self.network_transport = network_transport
+
+    def data_received(self, data: bytes) -> None:
+        if not self.network_transport.is_closing():
+            self.network_transport.write(data)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.network_transport.close()
+
+
+class _MockLoomConnection(asyncio.Protocol):
+    """Protocol for one network client of a MockLoomServer.
+
+    Commands from the client are written to a new MockLoom,
+    and the loom's replies are written back to the client.
+    """
+
+    def __init__(self, server: MockLoomServer) -> None:
+        self.server = server
+        self.log = logging.getLogger(LOG_NAME)
+        self.mock_loom: MockLoom | None = None
+        self.loom_transport: MockLoomTransport | None = None
+        # Commands received before the mock loom is ready
+        self.pending_data = bytearray()
+        self.start_task: asyncio.Future = asyncio.Future()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert isinstance(transport, asyncio.Transport)
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.start_task = asyncio.create_task(self.start(transport))
+
+    async def start(self, transport: asyncio.Transport) -> None:
+        self.mock_loom = MockLoom(verbose=self.server.verbose)
+        self.server.mock_looms.append(self.mock_loom)
+        self.loom_transport, _ = await self.mock_loom.open_client_transport(
+            lambda: _ReplyForwarder(transport)
+        )
+        if self.pending_data:
+            self.loom_transport.write(bytes(self.pending_data))
+            self.pending_data.clear()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.start_task.cancel()
+        if self.mock_loom is not None:
+            self.server.mock_looms.remove(self.mock_loom)
+            asyncio.create_task(self.mock_loom.close())
+
+    def data_received(self, data: bytes) -> None:
+        if self.loom_transport is None:
+            self.pending_data += data
+        else:
+            self.loom_transport.write(data)
+
+
+class MockLoomServer:
+    """A TCP server that provides a mock loom for each connection.
+
+    A stand-in for a serial device server connected to a real loom,
+    so the cost of the network hop can be measured
+    (use serial port "socket://host:port").
+
+    Parameters
+    ----------
+    host : str | None
+        Host (interface) on which to listen.
+    port : int
+        Port on which to listen; 0 to pick a free port.
+    verbose : bool
+        If True, the mock looms log diagnostic information.
+    """
+
+    def __init__(
+        self,
+        host: str | None = "127.0.0.1",
+        port: int = DEFAULT_MOCK_LOOM_PORT,
+        verbose: bool = False,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.server: asyncio.Server | None = None
+        self.mock_looms: list[MockLoom] = []
+
+    @property
+    def url(self) -> str:
+        """The serial port url for a LoomServer."""
+        return f"socket://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self.server = await asyncio.get_running_loop().create_server(
+            lambda: _MockLoomConnection(self), host=self.host, port=self.port
+        )
+        # Report the actual port, in case port=0
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        for mock_loom in self.mock_looms:
+            await mock_loom.close()
+
+    async def __aenter__(self) -> MockLoomServer:
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        type: Type[BaseException] | None,
+        value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        await self.close()
+
+
+def create_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Serve a mock loom over TCP, for testing network connections."
+    )
+    parser.add_argument(
+        "--host",
+        default="",
+        help="Host (interface) on which to listen; default: all interfaces.",
+    )
+    parser.add_argument(
+        "--port",
+        default=DEFAULT_MOCK_LOOM_PORT,
+        type=int,
+        help="Port on which to listen.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="print diagnostic information to stdout",
+    )
+    return parser
+
+
+async def amain(host: str, port: int, verbose: bool) -> None:
+    async with MockLoomServer(host=host or None, port=port, verbose=verbose) as server:
+        assert server.server is not None  # make mypy happy
+        await server.server.serve_forever()
+
+
+def run_mock_loom_server() -> None:
+    parser = create_argument_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(amain(**vars(args)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+__all__ = [
+    "DEFAULT_WRITE_TIMEOUT",
+    "RFC2217_URL_PREFIX",
+    "SOCKET_URL_PREFIX",
+    "ThreadedSerialTransport",
+    "get_round_trip_time",
+    "is_network_port",
+    "open_rfc2217_connection",
+    "open_socket_connection",
+    "parse_socket_url",
+]
+
+import asyncio
+import collections.abc
+import logging
+import queue
+import socket
+import struct
+import threading
+import urllib.parse
+from typing import Any, TypeVar
+
+import serial  # type: ignore
+
+from .loom_constants import BAUD_RATE, LOG_NAME
+
+# Serial port name prefixes for network connections to the loom,
+# e.g. via a serial device server:
+# "socket://host:port" is a raw TCP connection
+# "rfc2217://host:port" uses the telnet com port control option (RFC 2217)
+SOCKET_URL_PREFIX = "socket://"
+RFC2217_URL_PREFIX = "rfc2217://"
+
+# Default maximum time to write a command to the loom (seconds)
+DEFAULT_WRITE_TIMEOUT = 2
+
+# Maximum time a serial read blocks, so the reader thread can notice
+# that the transport was closed (seconds)
+READ_POLL_INTERVAL = 0.1
+
+# Offset and format of the tcpi_rtt and tcpi_rttvar fields
+# of Linux's struct tcp_info (microseconds)
+_TCP_INFO_RTT_OFFSET = 68
+_TCP_INFO_RTT_FORMAT = "II"
+_TCP_INFO_LEN = 104
+
+ProtocolT = TypeVar("ProtocolT", bound=asyncio.Protocol)
+
+
+def is_network_port(serial_port: str) -> bool:
+    """Return True if the serial port name is a network URL."""
+    return serial_port.startswith((SOCKET_URL_PREFIX, RFC2217_URL_PREFIX))
+
+
+def parse_socket_url(url: str) -> tuple[str, int]:
+    """Parse a "socket://host:port" or "rfc2217://host:port" url.
+
+    Query parameters (as used by pyserial) are ignored.
+    Returns (host, port).
+
+    Raises
+    ------
+    ValueError
+        If the url is not a network url or has no port.
+    """
+    if not is_network_port(url):
+        raise ValueError(
+            f"{url=!r} must start with {SOCKET_URL_PREFIX!r} "
+            f"or {RFC2217_URL_PREFIX!r}"
+        )
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.hostname is None or parsed.port is None:
+        raise ValueError(f"{url=!r} must specify host and port")
+    return parsed.hostname, parsed.port
+
+
+def get_round_trip_time(transport: asyncio.BaseTransport | None) -> float | None:
+    """Get the smoothed round-trip time of a transport's TCP connection.
+
+    The value is measured continuously by the kernel from TCP
+    acknowledgements, so it needs no cooperation from the loom.
+
+    Returns the round-trip time in seconds, or None if not known:
+    the transport is not a TCP connection, or the operating system
+    does not report TCP_INFO (it is Linux-specific).
+    """
+    if transport is None or not hasattr(socket, "TCP_INFO"):
+        return None
+    sock = transport.get_extra_info("socket")
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return None
+    try:
+        tcp_info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO_LEN)
+    except OSError:
+        return None
+    if len(tcp_info) < _TCP_INFO_RTT_OFFSET + struct.calcsize(_TCP_INFO_RTT_FORMAT):
+        return None
+    rtt_us, _ = struct.unpack_from(_TCP_INFO_RTT_FORMAT, tcp_info, _TCP_INFO_RTT_OFFSET)
+    return rtt_us / 1e6
+
+
+async def open_socket_connection(
+    url: str,
+    protocol_factory: collections.abc.Callable[[], ProtocolT],
+) -> tuple[asyncio.Transport, ProtocolT]:
+    """Open a raw TCP connection to a "socket://host:port" url.
+
+    Disables Nagle's algorithm (TCP_NODELAY), since commands
+    to the loom are tiny and must not be delayed.
+
+    Returns (transport, protocol).
+    """
+    host, port = parse_socket_url(url)
+    transport, protocol = await asyncio.get_running_loop().create_connection(
+        protocol_factory, host=host, port=port
+    )
+    sock = transport.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return transport, protocol
+
+
+async def open_rfc2217_connection(
+    url: str,
+    protocol_factory: collections.abc.Callable[[], ProtocolT],
+) -> tuple[ThreadedSerialTransport, ProtocolT]:
+    """Open a connection to an "rfc2217://host:port" url.
+
+    pyserial's RFC 2217 client does blocking I/O (and cannot be used
+    with serial_asyncio), so run it using a ThreadedSerialTransport.
+    pyserial sets TCP_NODELAY on the connection.
+
+    Returns (transport, protocol).
+    """
+    loop = asyncio.get_running_loop()
+    serial_instance = await loop.run_in_executor(
+        None,
+        lambda: serial.serial_for_url(
+            url, baudrate=BAUD_RATE, timeout=READ_POLL_INTERVAL
+        ),
+    )
+    protocol = protocol_factory()
+    transport = ThreadedSerialTransport(
+        loop=loop,
+        serial_instance=serial_instance,
+        protocol=protocol,
+    )
+    return transport, protocol
+
+
+class ThreadedSerialTransport(asyncio.Transport):
+    """Transport for a blocking pyserial instance, using threads.
+
+    One thread reads data and delivers it to the protocol
+    (in the event loop), another writes queued data.
+
+    Writing pauses the protocol (see asyncio.Protocol.pause_writing)
+    until the data has been written, so the protocol can wait
+    for each write to finish, e.g. with a timeout
+    (pyserial's RFC 2217 client does not support write timeouts).
+
+    Parameters
+    ----------
+    loop : asyncio.AbstractEventLoop
+        The event loop in which to call the protocol.
+    serial_instance : serial.SerialBase
+        An open serial instance, with a read timeout.
+    protocol : asyncio.Protocol
+        The protocol.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        serial_instance: Any,
+        protocol: asyncio.Protocol,
+    ) -> None:
+        super().__init__()
+        self.log = logging.getLogger(LOG_NAME)
+        self.loop = loop
+        self.serial = serial_instance
+        self.protocol = protocol
+        self.closing = False
+        self.write_queue: queue.SimpleQueue[bytes | None] = queue.SimpleQueue()
+        self.num_bytes_to_write = 0
+        self.num_bytes_lock = threading.Lock()
+        self.protocol.connection_made(self)
+        self.read_thread = threading.Thread(
+            target=self._read_loop, name="serial_read", daemon=True
+        )
+        self.write_thread = threading.Thread(
+            target=self._write_loop, name="serial_write", daemon=True
+        )
+        self.read_thread.start()
+        self.write_thread.start()
+
+    def abort(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._close(exc=None)
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        if name == "serial":
+            return self.serial
+        if name == "socket":
+            # pyserial's RFC 2217 and socket instances have a _socket
+            return getattr(self.serial, "_socket", default)
+        return default
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self.protocol
+
+    def get_write_buffer_size(self) -> int:
+        return self.num_bytes_to_write
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def write(self, data: bytes | bytearray | memoryview) -> None:
+        if self.closing:
+            return
+        with self.num_bytes_lock:
+            pause = self.num_bytes_to_write == 0
+            self.num_bytes_to_write += len(data)
+        if pause:
+            self.protocol.pause_writing()
+        self.write_queue.put(bytes(data))
+
+    def _close(self, exc: Exception | None) -> None:
+        """Close the transport; call in the event loop."""
+        if self.closing:
+            return
+        self.closing = True
+        self.write_queue.put(None)
+        self.loop.call_soon(self._call_connection_lost, exc)
+
+    def _call_connection_lost(self, exc: Exception | None) -> None:
+        try:
+            self.protocol.connection_lost(exc)
+        finally:
+            # The read thread exits within READ_POLL_INTERVAL
+            # and the write thread on reading None.
+            self.serial.close()
+
+    def _read_loop(self) -> None:
+        """Read data and deliver it to the protocol."""
+        try:
+            while not self.closing:
+                data = self.serial.read(self.serial.in_waiting or 1)
+                if data:
+                    self.loop.call_soon_threadsafe(self._deliver_data, data)
+        except Exception as e:
+            if not self.closing:
+                self.loop.call_soon_threadsafe(self._close, e)
+
+    def _deliver_data(self, data: bytes) -> None:
+        if not self.closing:
+            self.protocol.data_received(data)
+
+    def _resume_writing(self) -> None:
+        if not self.closing:
+            self.protocol.resume_writing()
+
+    def _write_loop(self) -> None:
+        """Write queued data; a None item stops the loop."""
+        try:
+            while True:
+                data = self.write_queue.get()
+                if data is None:
+                    return
+                self.serial.write(data)
+                self.serial.flush()
+                with self.num_bytes_lock:
+                    self.num_bytes_to_write -= len(data)
+                    resume = self.num_bytes_to_write == 0
+                if resume:
+                    self.loop.call_soon_threadsafe(self._resume_writing)
+        except Exception as e:
+            if not self.closing:
+                self.loop.call_soon_threadsafe(self._close, e)
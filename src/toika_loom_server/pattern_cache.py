@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+__all__ = [
+    "DEFAULT_PATTERN_CACHE_SIZE",
+    "PatternCache",
+    "PatternCacheStats",
+    "approximate_pattern_size",
+]
+
+import collections
+import copy
+import dataclasses
+
+from .reduced_pattern import ReducedPattern
+
+# Default maximum approximate size of the cached patterns (bytes)
+DEFAULT_PATTERN_CACHE_SIZE = 32_000_000
+
+# Approximate memory used by one Pick, excluding its shaft list;
+# includes the pick's entries in shaft_word_table and pick_colors.
+_PICK_OVERHEAD = 200
+# Approximate memory per shaft in a Pick's shaft list
+_SHAFT_SIZE = 8
+# Approximate memory per entry of warp_colors, threading and color_table
+_LIST_ITEM_SIZE = 36
+
+
+def approximate_pattern_size(pattern: ReducedPattern) -> int:
+    """Approximate the memory used by a decoded pattern (bytes)."""
+    num_shafts = len(pattern.pick0.are_shafts_up)
+    num_list_items = (
+        len(pattern.warp_colors) + len(pattern.threading) + len(pattern.color_table)
+    )
+    return (len(pattern.picks) + 1) * (
+        _PICK_OVERHEAD + _SHAFT_SIZE * num_shafts
+    ) + num_list_items * _LIST_ITEM_SIZE
+
+
+@dataclasses.dataclass
+class PatternCacheStats:
+    """Statistics for a PatternCache."""
+
+    num_hits: int = 0
+    num_misses: int = 0
+    num_evictions: int = 0
+    num_patterns: int = 0
+    size: int = 0
+
+
+class PatternCache:
+    """Least-recently-used cache of decoded patterns.
+
+    Entries are keyed by the content hash of the encoded pattern
+    (see PatternDatabase), so an entry can never be stale,
+    and patterns with the same content share one entry,
+    even if they have different names or are used by different looms.
+
+    The least-recently-used patterns are evicted to keep the total
+    approximate size (see approximate_pattern_size) within max_size.
+    A pattern larger than max_size is not cached.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum approximate size of the cached patterns (bytes).
+        0 disables the cache.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_PATTERN_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.stats = PatternCacheStats()
+        # Dict of key: (pattern, size)
+        self._entries: collections.OrderedDict[str, tuple[ReducedPattern, int]] = (
+            collections.OrderedDict()
+        )
+
+    def get(self, key: str) -> ReducedPattern | None:
+        """Get a copy of a cached pattern, or None if not cached.
+
+        The copy is shallow: the caller may change its name,
+        pick_number and repeat_number, but must not change its other fields.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.num_misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.num_hits += 1
+        return copy.copy(entry[0])
+
+    def put(self, key: str, pattern: ReducedPattern) -> None:
+        """Add a pattern to the cache, replacing any existing entry for key.
+
+        The cache keeps a shallow copy of the pattern,
+        so the caller must not change the pattern's fields
+        (other than name, pick_number and repeat_number).
+        """
+        self.invalidate(key)
+        size = approximate_pattern_size(pattern)
+        if size > self.max_size:
+            return
+        self._entries[key] = (copy.copy(pattern), size)
+        self.stats.size += size
+        while self.stats.size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.stats.size -= evicted_size
+            self.stats.num_evictions += 1
+        self.stats.num_patterns = len(self._entries)
+
+    def invalidate(self, key: str) -> None:
+        """Remove the entry for key, if any."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.stats.size -= entry[1]
+            self.stats.num_patterns = len(self._entries)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        self._entries.clear()
+        self.stats.size = 0
+        self.stats.num_patterns = 0
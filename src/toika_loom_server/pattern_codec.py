@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+__all__ = [
+    "FORMAT_VERSION",
+    "MAGIC",
+    "decode_pattern",
+    "decode_warp",
+    "encode_pattern",
+    "encode_warp",
+    "is_encoded_pattern",
+]
+
+import zlib
+
+from .reduced_pattern import Pick, ReducedPattern
+
+# Compact binary encoding of a ReducedPattern, for the pattern database.
+#
+# The header is MAGIC, then a version byte and a flags byte.
+# The rest (zlib-compressed if FLAG_COMPRESSED is set) is:
+#
+# * name: string
+# * color_table: count, then each color as a string
+# * warp_colors: count, then each color index
+# * threading: count, then each shaft index
+# * pick_number, repeat_number
+# * num_shafts (the maximum length of are_shafts_up)
+# * number of picks, excluding pick0
+# * if FLAG_RAGGED is set: the length of are_shafts_up
+#   for pick0, then for each pick
+# * pick colors: pick0, then each pick
+# * shaft rows: pick0, then each pick; each is the shaft word
+#   as a little-endian int of (num_shafts + 7) // 8 bytes
+#
+# Counts and lengths are unsigned varints (LEB128). Other integers,
+# including color indices, are zigzag-encoded signed varints.
+# Strings are a length, followed by that many bytes of UTF-8.
+MAGIC = b"TKP"
+FORMAT_VERSION = 1
+
+# Flags
+FLAG_COMPRESSED = 0x01
+# are_shafts_up has different lengths in different picks
+FLAG_RAGGED = 0x02
+
+# Only compress data that is at least this long (bytes)
+MIN_COMPRESS_LEN = 64
+
+_HEADER_LEN = len(MAGIC) + 2
+
+
+def is_encoded_pattern(data: bytes | memoryview) -> bool:
+    """Return True if data looks like a pattern encoded by encode_pattern."""
+    return len(data) >= _HEADER_LEN and data[: len(MAGIC)] == MAGIC
+
+
+def encode_pattern(pattern: ReducedPattern, compress: bool = True) -> bytes:
+    """Encode a pattern in the compact binary format.
+
+    Parameters
+    ----------
+    pattern : ReducedPattern
+        The pattern to encode.
+    compress : bool
+        Compress the data with zlib, if that makes it smaller?
+    """
+    all_picks = [pattern.pick0] + pattern.picks
+    shaft_lengths = [len(pick.are_shafts_up) for pick in all_picks]
+    num_shafts = max(shaft_lengths)
+    flags = 0
+    if any(length != num_shafts for length in shaft_lengths):
+        flags |= FLAG_RAGGED
+
+    body = bytearray()
+    _write_str(body, pattern.name)
+    _write_uint(body, len(pattern.color_table))
+    for color in pattern.color_table:
+        _write_str(body, color)
+    for int_list in (pattern.warp_colors, pattern.threading):
+        _write_uint(body, len(int_list))
+        for value in int_list:
+            _write_int(body, value)
+    _write_int(body, pattern.pick_number)
+    _write_int(body, pattern.repeat_number)
+    _write_uint(body, num_shafts)
+    _write_uint(body, len(pattern.picks))
+    if flags & FLAG_RAGGED:
+        for length in shaft_lengths:
+            _write_uint(body, length)
+    for pick in all_picks:
+        _write_int(body, pick.color)
+    row_len = (num_shafts + 7) // 8
+    for pick in all_picks:
+        body += pick.shaft_word.to_bytes(length=row_len, byteorder="little")
+
+    if compress and len(body) >= MIN_COMPRESS_LEN:
+        compressed_body = zlib.compress(body)
+        if len(compressed_body) < len(body):
+            flags |= FLAG_COMPRESSED
+            body = bytearray(compressed_body)
+    return MAGIC + bytes((FORMAT_VERSION, flags)) + body
+
+
+def decode_pattern(data: bytes | memoryview) -> ReducedPattern:
+    """Decode a pattern encoded by encode_pattern.
+
+    If the data is a memoryview of uncompressed data,
+    it is decoded in place, without copying it.
+
+    Raises
+    ------
+    ValueError
+        If the data is not a valid encoded pattern,
+        or has an unsupported version.
+    """
+    if not is_encoded_pattern(data):
+        raise ValueError("Not an encoded pattern")
+    version, flags = data[len(MAGIC) : _HEADER_LEN]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported pattern format {version=}")
+    body = data[_HEADER_LEN:]
+    if flags & FLAG_COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise ValueError(f"Cannot decompress pattern: {e}")
+    try:
+        return _decode_body(body, flags)
+    except IndexError:
+        raise ValueError("Encoded pattern is truncated")
+
+
+def encode_warp(threading: list[int], warp_colors: list[int]) -> bytes:
+    """Encode the warp of a pattern: its threading and warp colors.
+
+    The encoding is canonical (equal warps have equal encodings),
+    so it can be hashed to find patterns with the same warp.
+    It has no header: it is threading, then warp_colors,
+    each as a count followed by the values.
+    """
+    data = bytearray()
+    for int_list in (threading, warp_colors):
+        _write_uint(data, len(int_list))
+        for value in int_list:
+            _write_int(data, value)
+    return bytes(data)
+
+
+def decode_warp(data: bytes) -> tuple[list[int], list[int]]:
+    """Decode a warp encoded by encode_warp.
+
+    Returns
+    -------
+    threading, warp_colors : tuple[list[int], list[int]]
+        The threading and warp colors.
+
+    Raises
+    ------
+    ValueError
+        If the data is truncated.
+    """
+    reader = _Reader(data)
+    try:
+        threading = [reader.read_int() for _ in range(reader.read_uint())]
+        warp_colors = [reader.read_int() for _ in range(reader.read_uint())]
+    except IndexError:
+        raise ValueError("Encoded warp is truncated")
+    return threading, warp_colors
+
+
+def _decode_body(body: bytes | memoryview, flags: int) -> ReducedPattern:
+    reader = _Reader(body)
+    name = reader.read_str()
+    color_table = [reader.read_str() for _ in range(reader.read_uint())]
+    warp_colors = [reader.read_int() for _ in range(reader.read_uint())]
+    threading = [reader.read_int() for _ in range(reader.read_uint())]
+    pick_number = reader.read_int()
+    repeat_number = reader.read_int()
+    num_shafts = reader.read_uint()
+    num_all_picks = reader.read_uint() + 1
+    if flags & FLAG_RAGGED:
+        shaft_lengths = [reader.read_uint() for _ in range(num_all_picks)]
+    else:
+        shaft_lengths = [num_shafts] * num_all_picks
+    colors = [reader.read_int() for _ in range(num_all_picks)]
+    row_len = (num_shafts + 7) // 8
+    rows = reader.read_bytes(row_len * num_all_picks)
+    # Lists of shaft states, cached by (shaft_word, length):
+    # patterns have few distinct rows. Each Pick gets its own copy.
+    are_shafts_up_cache: dict[tuple[int, int], list[bool]] = {}
+    all_picks = []
+    for i, (color, length) in enumerate(zip(colors, shaft_lengths)):
+        shaft_word = int.from_bytes(
+            rows[i * row_len : (i + 1) * row_len], byteorder="little"
+        )
+        are_shafts_up = are_shafts_up_cache.get((shaft_word, length))
+        if are_shafts_up is None:
+            are_shafts_up = [bool(shaft_word & (1 << j)) for j in range(length)]
+            are_shafts_up_cache[(shaft_word, length)] = are_shafts_up
+        all_picks.append(Pick(color=color, are_shafts_up=are_shafts_up.copy()))
+    return ReducedPattern(
+        name=name,
+        color_table=color_table,
+        warp_colors=warp_colors,
+        threading=threading,
+        picks=all_picks[1:],
+        pick0=all_picks[0],
+        pick_number=pick_number,
+        repeat_number=repeat_number,
+    )
+
+
+def _write_uint(buffer: bytearray, value: int) -> None:
+    """Append an unsigned varint."""
+    if value < 0:
+        raise ValueError(f"{value=} must be >= 0")
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _write_int(buffer: bytearray, value: int) -> None:
+    """Append a zigzag-encoded signed varint."""
+    _write_uint(buffer, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _write_str(buffer: bytearray, value: str) -> None:
+    encoded = value.encode()
+    _write_uint(buffer, len(encoded))
+    buffer += encoded
+
+
+class _Reader:
+    """Read values written by the _write_x functions.
+
+    Reading past the end raises IndexError.
+    """
+
+    def __init__(self, data: bytes | memoryview) -> None:
+        self.data = data
+        self.pos = 0
+
+    def read_bytes(self, num_bytes: int) -> bytes | memoryview:
+        end = self.pos + num_bytes
+        if end > len(self.data):
+            raise IndexError("read past end of data")
+        result = self.data[self.pos : end]
+        self.pos = end
+        return result
+
+    def read_uint(self) -> int:
+        result = 0
+        shift = 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read_int(self) -> int:
+        value = self.read_uint()
+        return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+    def read_str(self) -> str:
+        return str(self.read_bytes(self.read_uint()), "utf-8")
@@ -1,131 +1,1624 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import collections.abc
+import contextlib
+import copy
 import dataclasses
+import hashlib
 import json
+import logging
 import pathlib
+import sqlite3
 import time
+from types import TracebackType
+from typing import Type
 
 import aiosqlite
 
-from .reduced_pattern import ReducedPattern
+from .blob_file import BlobFile
+from .loom_constants import LOG_NAME
+from .pattern_cache import DEFAULT_PATTERN_CACHE_SIZE, PatternCache
+from .pattern_codec import (
+    FORMAT_VERSION,
+    decode_pattern,
+    decode_warp,
+    encode_pattern,
+    encode_warp,
+)
+from .reduced_pattern import PARSER_VERSION, ReducedPattern
 
+# Pragmas for the database connection: write-ahead logging lets readers
+# proceed during a write, and with WAL, synchronous=normal only syncs
+# at checkpoints, which is much faster on an SD card and still safe
+# against corruption (a power loss may lose the last few transactions).
+# Incremental auto-vacuum lets DatabaseMaintenance return free pages
+# to the file system a few at a time; it only takes effect if set
+# before the database is written (see _migrate_to_v8 for older databases),
+# so it must be first.
+CONNECTION_PRAGMAS = (
+    "pragma auto_vacuum = incremental",
+    "pragma journal_mode = wal",
+    "pragma synchronous = normal",
+    "pragma cache_size = -8000",
+    "pragma temp_store = memory",
+    "pragma busy_timeout = 5000",
+)
 
-class PatternDatabase:
-    FIELDS_STR = ", ".join(
-        (
-            "id integer primary key",
-            "pattern_name text",
-            "pattern_json text",
-            "pick_number integer",
-            "repeat_number integer",
-            "timestamp_sec real",
+# Maximum number of prepared statements for sqlite3 to cache
+NUM_CACHED_STATEMENTS = 64
+
+
+# Places to store new pattern bodies: "sqlite" stores them in the
+# database, and "mmap" appends them to a memory-mapped blob file
+# (see get_blob_path); either can read bodies stored by the other.
+BODY_STORES = ("sqlite", "mmap")
+
+
+def get_blob_path(dbpath: pathlib.Path) -> pathlib.Path:
+    """Get the path of the blob file for the "mmap" body store."""
+    return pathlib.Path(f"{dbpath}-blobs")
+
+
+def get_compacted_blob_path(dbpath: pathlib.Path) -> pathlib.Path:
+    """Get the path of the new blob file written by compact_blob_file."""
+    return pathlib.Path(f"{dbpath}-blobs.compact")
+
+
+# Number of SQLite virtual machine instructions between checks
+# of whether to stop quick_check_database
+QUICK_CHECK_PROGRESS_STEPS = 10_000
+
+# Patterns that prune_to_size may delete: all but the two most
+# recently used patterns for each loom
+DELETABLE_PATTERNS_STR = (
+    "select id, loom_id, content_hash, timestamp_sec from "
+    "(select id, loom_id, content_hash, timestamp_sec, row_number() "
+    "over (partition by loom_id order by timestamp_sec desc, id desc) "
+    "as row_num from patterns) where row_num > 2"
+)
+
+# Maximum number of rows of each index for `pragma optimize` to sample,
+# which bounds the time it takes
+OPTIMIZE_ANALYSIS_LIMIT = 400
+
+# Maximum number of database pages for backup_database to copy
+# in one step. Each step holds the source database's read lock
+# (which, with write-ahead logging, does not block writers).
+BACKUP_PAGES_PER_STEP = 256
+
+
+def delete_database_files(dbpath: pathlib.Path) -> None:
+    """Delete a database file, its write-ahead log files,
+    and its blob files, if present.
+    """
+    for suffix in ("", "-wal", "-shm", "-blobs", "-blobs.compact"):
+        pathlib.Path(f"{dbpath}{suffix}").unlink(missing_ok=True)
+
+
+def backup_database(
+    dbpath: pathlib.Path,
+    backup_path: pathlib.Path,
+    pages_per_step: int = BACKUP_PAGES_PER_STEP,
+) -> None:
+    """Write a consistent copy of a pattern database to a new file,
+    while it is in use.
+
+    Use SQLite's incremental backup API, copying at most pages_per_step
+    pages per step, from a snapshot of the database: a read transaction
+    is held for the whole backup, so writes by other connections
+    neither block the backup nor restart it. Pattern bodies in the blob
+    file (see BODY_STORES) are copied into the backup, so the backup
+    is a single, self-contained database file that can be used
+    with either body store.
+
+    This function blocks, but releases the GIL while copying,
+    so it is intended to be run in a thread (see PatternDatabase.backup).
+    The backup is written to a temporary file, which then replaces
+    backup_path, so backup_path is never left incomplete.
+
+    Parameters
+    ----------
+    dbpath : pathlib.Path
+        Path to the database file.
+    backup_path : pathlib.Path
+        Path to the backup file.
+    pages_per_step : int
+        Maximum number of pages to copy in one step.
+    """
+    temp_path = pathlib.Path(f"{backup_path}.tmp")
+    temp_path.unlink(missing_ok=True)
+    blob_file = BlobFile(get_blob_path(dbpath))
+    source = sqlite3.connect(dbpath, isolation_level=None)
+    try:
+        source.execute("begin")
+        source.execute("select count(*) from sqlite_master").fetchone()
+        target = sqlite3.connect(temp_path)
+        try:
+            source.backup(target, pages=pages_per_step)
+            rows = target.execute(
+                "select content_hash, blob_offset, blob_length from pattern_bodies "
+                "where blob_offset is not null"
+            ).fetchall()
+            for content_hash, blob_offset, blob_length in rows:
+                body = decode_pattern(
+                    blob_file.read(offset=blob_offset, length=blob_length)
+                )
+                target.execute(
+                    "update pattern_bodies set pattern_data = ?, "
+                    "blob_offset = null, blob_length = null where content_hash = ?",
+                    (encode_pattern(body), content_hash),
+                )
+            target.commit()
+            # Make the backup a single file
+            target.execute("pragma journal_mode = delete")
+        finally:
+            target.close()
+    finally:
+        blob_file.close()
+        source.close()
+    temp_path.replace(backup_path)
+
+
+def quick_check_database(
+    dbpath: pathlib.Path,
+    should_stop: collections.abc.Callable[[], bool],
+    progress_steps: int = QUICK_CHECK_PROGRESS_STEPS,
+) -> str | None:
+    """Check the integrity of a pattern database, while it is in use.
+
+    Run `pragma quick_check` on a separate connection, which reads
+    a snapshot of the database (with write-ahead logging, this does not
+    block writers). The check cannot be done in parts, so instead
+    should_stop is called every progress_steps SQLite instructions,
+    and the check is abandoned as soon as it returns True.
+
+    This function blocks, but releases the GIL while checking,
+    so it is intended to be run in a thread (see PatternDatabase.quick_check).
+
+    Parameters
+    ----------
+    dbpath : pathlib.Path
+        Path to the database file.
+    should_stop : collections.abc.Callable[[], bool]
+        Function that returns True if the check should be abandoned.
+        It is called in the thread that runs the check.
+    progress_steps : int
+        Number of SQLite instructions between calls to should_stop.
+
+    Returns
+    -------
+    result : str | None
+        "ok" if no problems were found, else a description
+        of the problems, one per line; None if the check was abandoned.
+    """
+    connection = sqlite3.connect(dbpath)
+    try:
+        connection.set_progress_handler(should_stop, progress_steps)
+        try:
+            rows = connection.execute("pragma quick_check").fetchall()
+        except sqlite3.OperationalError as e:
+            if "interrupted" not in str(e):
+                raise
+            return None
+    finally:
+        connection.close()
+    return "\n".join(row[0] for row in rows)
+
+
+# Fields of the patterns table. Each row is a named reference
+# to a pattern body in the pattern_bodies table (see BODY_STRS),
+# by content_hash. num_picks through content_hash are metadata
+# of the body, so listings need not read the body; warp_hash
+# identifies the warp (see WARP_STRS).
+# Databases written by older versions also have a pattern_data column
+# (and perhaps a pattern_json column), which are no longer used.
+FIELDS_STR = ", ".join(
+    (
+        "id integer primary key",
+        "pattern_name text",
+        "pick_number integer",
+        "repeat_number integer",
+        "timestamp_sec real",
+        "loom_id text not null default ''",
+        "num_picks integer",
+        "num_shafts integer",
+        "num_ends integer",
+        "warp_hash text",
+        "data_size integer",
+        "content_hash text",
+    )
+)
+
+# Indexes of the patterns table: one for lookup by name,
+# and a covering index for listing and pruning by age.
+INDEX_STRS = (
+    "create index if not exists patterns_by_name on patterns (loom_id, pattern_name)",
+    "create index if not exists patterns_by_time "
+    "on patterns (loom_id, timestamp_sec, id, pattern_name)",
+)
+
+# Content-addressed storage of patterns: pattern_bodies holds
+# each distinct encoded pattern (with a blank name) once, by its hash,
+# either in pattern_data or (if blob_offset is not null) in the blob file,
+# in which case pattern_data is empty. If warp_hash is not null,
+# the body was encoded without its threading and warp colors,
+# which are stored in the warps table. upload_hashes maps the hash
+# of each uploaded pattern file to the hash of its pattern body,
+# so a file that was uploaded before need not be parsed again.
+# A trigger deletes a body, and the uploads that produced it,
+# when the last pattern that uses it is deleted (a body in the blob file
+# leaves dead space there).
+BODY_STRS = (
+    "create table if not exists pattern_bodies "
+    "(content_hash text primary key, pattern_data blob not null, "
+    "blob_offset integer, blob_length integer, warp_hash text)",
+    "create table if not exists upload_hashes "
+    "(upload_hash text primary key, content_hash text not null)",
+    "create index if not exists upload_hashes_by_content "
+    "on upload_hashes (content_hash)",
+    "create index if not exists patterns_by_hash on patterns (content_hash)",
+    "create trigger if not exists pattern_bodies_delete after delete on patterns "
+    "when not exists (select 1 from patterns where content_hash = old.content_hash) "
+    "begin "
+    "delete from pattern_bodies where content_hash = old.content_hash; "
+    "delete from upload_hashes where content_hash = old.content_hash; "
+    "end",
+)
+
+# Warps (threading and warp colors, encoded by encode_warp),
+# by warp_hash: the SHA-256 hash of the encoded warp. Patterns with
+# the same warp_hash can be woven on the same warp, e.g. different
+# treadlings for one threading, and the index finds them quickly.
+# Each distinct warp is stored once, and is deleted by a trigger
+# when the last body that uses it is deleted.
+WARP_STRS = (
+    "create table if not exists warps "
+    "(warp_hash text primary key, warp_data blob not null)",
+    "create index if not exists patterns_by_warp "
+    "on patterns (loom_id, warp_hash, timestamp_sec, id)",
+    "create index if not exists pattern_bodies_by_warp on pattern_bodies (warp_hash)",
+    "create trigger if not exists warps_delete after delete on pattern_bodies "
+    "when old.warp_hash is not null and not exists "
+    "(select 1 from pattern_bodies where warp_hash = old.warp_hash) "
+    "begin delete from warps where warp_hash = old.warp_hash; end",
+)
+
+# Metadata fields, in the order returned by get_metadata
+METADATA_FIELDS = (
+    "num_picks",
+    "num_shafts",
+    "num_ends",
+    "warp_hash",
+    "data_size",
+    "content_hash",
+)
+
+# Columns for the fields of PatternMetadata, from table alias "p"
+METADATA_COLUMNS_STR = ", ".join(
+    f"p.{name}" for name in ("pattern_name",) + METADATA_FIELDS + ("timestamp_sec",)
+)
+
+# Full-text index of pattern names (an external-content FTS5 table),
+# and triggers that keep it up to date. Updates that do not change
+# the name (such as saving the pick number) do not touch the index.
+SEARCH_INDEX_STRS = (
+    "create virtual table patterns_fts "
+    "using fts5(pattern_name, content='patterns', content_rowid='id')",
+    "create trigger patterns_fts_insert after insert on patterns begin "
+    "insert into patterns_fts (rowid, pattern_name) "
+    "values (new.id, new.pattern_name); end",
+    "create trigger patterns_fts_delete after delete on patterns begin "
+    "insert into patterns_fts (patterns_fts, rowid, pattern_name) "
+    "values ('delete', old.id, old.pattern_name); end",
+    "create trigger patterns_fts_update after update of pattern_name on patterns begin "
+    "insert into patterns_fts (patterns_fts, rowid, pattern_name) "
+    "values ('delete', old.id, old.pattern_name); "
+    "insert into patterns_fts (rowid, pattern_name) "
+    "values (new.id, new.pattern_name); end",
+)
+
+# Value of `pragma auto_vacuum` for incremental auto-vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Search terms of the form key:value select patterns by metadata,
+# e.g. "shafts:8"; this is the metadata field for each key.
+SEARCH_FILTER_FIELDS = dict(picks="num_picks", shafts="num_shafts", ends="num_ends")
+
+# Default number of patterns returned by search_patterns
+DEFAULT_PAGE_SIZE = 20
+
+
+@dataclasses.dataclass
+class PatternMetadata:
+    """Information about a pattern in the database.
+
+    Parameters
+    ----------
+    name : str
+        The name of the pattern.
+    num_picks : int
+        The number of picks (not counting pick 0).
+    num_shafts : int
+        The number of shafts.
+    num_ends : int
+        The number of warp ends.
+    warp_hash : str
+        SHA-256 hash of the encoded warp (threading and warp colors),
+        as hex; patterns with the same warp_hash share a warp.
+    data_size : int
+        The size of the encoded pattern (bytes).
+    content_hash : str
+        SHA-256 hash of the encoded pattern, as hex.
+    timestamp_sec : float
+        When the pattern was last used, in unix seconds.
+    """
+
+    name: str
+    num_picks: int
+    num_shafts: int
+    num_ends: int
+    warp_hash: str
+    data_size: int
+    content_hash: str
+    timestamp_sec: float
+
+
+def get_warp_hash(threading: list[int], warp_colors: list[int]) -> str:
+    """Get the warp_hash of a pattern's warp, as hex."""
+    return hashlib.sha256(encode_warp(threading, warp_colors)).hexdigest()
+
+
+def get_metadata(
+    pattern: ReducedPattern, pattern_data: bytes
+) -> tuple[int, int, int, str, int, str]:
+    """Get the values of METADATA_FIELDS for a pattern.
+
+    Parameters
+    ----------
+    pattern : ReducedPattern
+        The pattern.
+    pattern_data : bytes
+        The pattern, encoded with encode_pattern.
+    """
+    return (
+        len(pattern.picks),
+        max(len(pick.are_shafts_up) for pick in [pattern.pick0] + pattern.picks),
+        len(pattern.threading),
+        get_warp_hash(pattern.threading, pattern.warp_colors),
+        len(pattern_data),
+        hashlib.sha256(pattern_data).hexdigest(),
+    )
+
+
+def encode_pattern_body(
+    pattern: ReducedPattern, compress: bool = True, strip_warp: bool = False
+) -> tuple[bytes, tuple[int, int, int, str, int, str]]:
+    """Encode a pattern body, for content-addressed storage.
+
+    The body is the pattern with a blank name, pick_number 0
+    and repeat_number 1, so it only depends on the content.
+
+    Parameters
+    ----------
+    pattern : ReducedPattern
+        The pattern.
+    compress : bool
+        Compress the encoded body (if that makes it smaller)?
+        The metadata is the same either way: that of the
+        compressed encoding, which is the canonical form.
+    strip_warp : bool
+        Encode the body without its threading and warp colors,
+        to be stored separately (see WARP_STRS)?
+        The metadata is the same either way.
+
+    Returns
+    -------
+    pattern_data, metadata : tuple[bytes, tuple[int, int, int, str, int, str]]
+        The encoded body, and the values of METADATA_FIELDS
+        (the last of which is the content hash).
+    """
+    body = copy.copy(pattern)
+    body.name = ""
+    body.pick_number = 0
+    body.repeat_number = 1
+    pattern_data = encode_pattern(body)
+    metadata = get_metadata(body, pattern_data)
+    if strip_warp:
+        body.threading = []
+        body.warp_colors = []
+    if strip_warp or not compress:
+        pattern_data = encode_pattern(body, compress=compress)
+    return pattern_data, metadata
+
+
+def decode_pattern_body(
+    pattern_data: bytes | memoryview, warp_data: bytes | None
+) -> ReducedPattern:
+    """Decode a pattern body encoded by encode_pattern_body.
+
+    Parameters
+    ----------
+    pattern_data : bytes | memoryview
+        The encoded body.
+    warp_data : bytes | None
+        The encoded warp (see encode_warp), if the body
+        was encoded with strip_warp true, else None.
+    """
+    pattern = decode_pattern(pattern_data)
+    if warp_data is not None:
+        pattern.threading, pattern.warp_colors = decode_warp(warp_data)
+    return pattern
+
+
+def get_upload_hash(filename: str, data: str) -> str:
+    """Get the hash of an uploaded pattern file, for add_uploaded_pattern.
+
+    The hash depends on the file's contents and type (suffix),
+    but not its name, and on PARSER_VERSION and the pattern_codec
+    FORMAT_VERSION, so that the file is parsed again if either changes.
+    """
+    hasher = hashlib.sha256()
+    versions = f"{PARSER_VERSION}.{FORMAT_VERSION}"
+    for item in (versions, pathlib.PurePath(filename).suffix.lower(), data):
+        hasher.update(item.encode())
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+async def _get_pragma(db: aiosqlite.Connection, name: str) -> int:
+    """Get the value of an integer-valued pragma."""
+    async with db.execute(f"pragma {name}") as cursor:
+        row = await cursor.fetchone()
+    assert row is not None  # make mypy happy
+    return row[0]
+
+
+async def _get_column_names(
+    db: aiosqlite.Connection, table: str = "patterns"
+) -> list[str]:
+    async with db.execute(f"pragma table_info({table})") as cursor:
+        return [row[1] for row in await cursor.fetchall()]
+
+
+async def _migrate_to_v1(db: aiosqlite.Connection) -> None:
+    """Add the loom_id column, for multiple looms."""
+    if "loom_id" not in await _get_column_names(db):
+        await db.execute(
+            "alter table patterns add column loom_id text not null default ''"
+        )
+
+
+async def _migrate_to_v2(db: aiosqlite.Connection) -> None:
+    """Convert patterns saved as JSON to the binary format.
+
+    Delete (and log) saved patterns that cannot be converted,
+    such as patterns with more than MAX_SHAFTS shafts,
+    rather than fail to open the database.
+    """
+    column_names = await _get_column_names(db)
+    if "pattern_data" not in column_names:
+        await db.execute("alter table patterns add column pattern_data blob")
+    if "pattern_json" not in column_names:
+        return
+    async with db.execute(
+        "select id, pattern_json from patterns "
+        "where pattern_data is null and pattern_json is not null"
+    ) as cursor:
+        rows = await cursor.fetchall()
+    updates: list[tuple[bytes, int]] = []
+    bad_ids: list[tuple[int]] = []
+    for id, pattern_json in rows:
+        try:
+            pattern = ReducedPattern.from_dict(json.loads(pattern_json))
+        except Exception as e:
+            logging.getLogger(LOG_NAME).warning(
+                f"Deleting saved pattern {id=} that cannot be converted: {e!r}"
+            )
+            bad_ids.append((id,))
+        else:
+            updates.append((encode_pattern(pattern), id))
+    await db.executemany(
+        "update patterns set pattern_data = ?, pattern_json = null where id = ?",
+        updates,
+    )
+    await db.executemany("delete from patterns where id = ?", bad_ids)
+
+
+async def _migrate_to_v3(db: aiosqlite.Connection) -> None:
+    """Add metadata columns and indexes."""
+    column_names = await _get_column_names(db)
+    for field in FIELDS_STR.split(", "):
+        name = field.split()[0]
+        if name in METADATA_FIELDS and name not in column_names:
+            await db.execute(f"alter table patterns add column {field}")
+    async with db.execute(
+        "select id, pattern_data from patterns where content_hash is null"
+    ) as cursor:
+        rows = await cursor.fetchall()
+    await db.executemany(
+        "update patterns set "
+        + ", ".join(f"{name} = ?" for name in METADATA_FIELDS)
+        + " where id = ?",
+        [
+            get_metadata(decode_pattern(pattern_data), pattern_data) + (id,)
+            for id, pattern_data in rows
+        ],
+    )
+    for index_str in INDEX_STRS:
+        await db.execute(index_str)
+
+
+async def _migrate_to_v4(db: aiosqlite.Connection) -> None:
+    """Add the full-text index of pattern names, if supported.
+
+    If this sqlite3 was built without FTS5, skip the index;
+    search_patterns then falls back to a slower substring search.
+    """
+    try:
+        for index_str in SEARCH_INDEX_STRS:
+            await db.execute(index_str)
+    except sqlite3.OperationalError as e:
+        if "fts5" not in str(e):
+            raise
+        return
+    await db.execute("insert into patterns_fts (patterns_fts) values ('rebuild')")
+
+
+async def _migrate_to_v5(db: aiosqlite.Connection) -> None:
+    """Move pattern data to content-addressed pattern bodies."""
+    for body_str in BODY_STRS:
+        await db.execute(body_str)
+    async with db.execute(
+        "select id, pattern_data from patterns where pattern_data is not null"
+    ) as cursor:
+        rows = await cursor.fetchall()
+    bodies = {
+        id: encode_pattern_body(decode_pattern(pattern_data))
+        for id, pattern_data in rows
+    }
+    await db.executemany(
+        "insert or ignore into pattern_bodies (content_hash, pattern_data) "
+        "values (?, ?)",
+        [(metadata[-1], pattern_data) for pattern_data, metadata in bodies.values()],
+    )
+    await db.executemany(
+        "update patterns set data_size = ?, content_hash = ?, pattern_data = null "
+        "where id = ?",
+        [(metadata[-2], metadata[-1], id) for id, (_, metadata) in bodies.items()],
+    )
+
+
+async def _migrate_to_v6(db: aiosqlite.Connection) -> None:
+    """Add the location of pattern bodies in the blob file."""
+    column_names = await _get_column_names(db, table="pattern_bodies")
+    for name in ("blob_offset", "blob_length"):
+        if name not in column_names:
+            await db.execute(f"alter table pattern_bodies add column {name} integer")
+
+
+async def _migrate_to_v7(db: aiosqlite.Connection) -> None:
+    """Add warp hashes, the warps table and its index."""
+    if "warp_hash" not in await _get_column_names(db):
+        await db.execute("alter table patterns add column warp_hash text")
+    if "warp_hash" not in await _get_column_names(db, table="pattern_bodies"):
+        await db.execute("alter table pattern_bodies add column warp_hash text")
+    for warp_str in WARP_STRS:
+        await db.execute(warp_str)
+
+    # Existing bodies keep their warps; compute their warp hashes
+    async with db.execute("pragma database_list") as cursor:
+        db_file = {row[1]: row[2] for row in await cursor.fetchall()}["main"]
+    blob_file = BlobFile(get_blob_path(pathlib.Path(db_file)))
+    async with db.execute(
+        "select content_hash, pattern_data, blob_offset, blob_length "
+        "from pattern_bodies where content_hash in "
+        "(select content_hash from patterns where warp_hash is null)"
+    ) as cursor:
+        rows = await cursor.fetchall()
+    updates = []
+    for content_hash, pattern_data, blob_offset, blob_length in rows:
+        if blob_offset is not None:
+            pattern_data = blob_file.read(offset=blob_offset, length=blob_length)
+        pattern = decode_pattern(pattern_data)
+        updates.append(
+            (get_warp_hash(pattern.threading, pattern.warp_colors), content_hash)
         )
+    blob_file.close()
+    await db.executemany(
+        "update patterns set warp_hash = ? where content_hash = ?", updates
     )
 
-    def __init__(self, dbpath: pathlib.Path) -> None:
+
+async def _migrate_to_v8(db: aiosqlite.Connection) -> None:
+    """Enable incremental auto-vacuum.
+
+    This needs a full vacuum, which rewrites the database file,
+    and cannot be done in a transaction, so commit first.
+    """
+    if await _get_pragma(db, "auto_vacuum") == AUTO_VACUUM_INCREMENTAL:
+        return
+    await db.commit()
+    await db.execute("pragma auto_vacuum = incremental")
+    await db.execute("vacuum")
+
+
+# Schema migrations: MIGRATIONS[i] upgrades the schema
+# from version i to i + 1. Databases written before versioning
+# have version 0, though some have some of the later changes,
+# so each migration must tolerate changes that are already present.
+MIGRATIONS: tuple[
+    collections.abc.Callable[[aiosqlite.Connection], collections.abc.Awaitable[None]],
+    ...,
+] = (
+    _migrate_to_v1,
+    _migrate_to_v2,
+    _migrate_to_v3,
+    _migrate_to_v4,
+    _migrate_to_v5,
+    _migrate_to_v6,
+    _migrate_to_v7,
+    _migrate_to_v8,
+)
+
+# The current schema version, saved as the database's user_version
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def upgrade_schema(db: aiosqlite.Connection) -> None:
+    """Create the patterns table, or upgrade it to SCHEMA_VERSION,
+    and commit.
+
+    Raises
+    ------
+    RuntimeError
+        If the database was written by a newer version of this software.
+    """
+    version = await _get_pragma(db, "user_version")
+    async with db.execute(
+        "select 1 from sqlite_master where type = 'table' and name = 'patterns'"
+    ) as cursor:
+        table_exists = await cursor.fetchone() is not None
+
+    if not table_exists:
+        await db.execute(f"create table patterns ({FIELDS_STR})")
+        for index_str in INDEX_STRS + BODY_STRS + WARP_STRS:
+            await db.execute(index_str)
+        await _migrate_to_v4(db)
+    elif version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"The pattern database has schema version {version}, "
+            f"but this software only supports version {SCHEMA_VERSION} or older; "
+            "upgrade toika_loom_server or reset the database"
+        )
+    else:
+        for migration in MIGRATIONS[version:]:
+            await migration(db)
+    # pragma does not support parameters
+    await db.execute(f"pragma user_version = {SCHEMA_VERSION:d}")
+    await db.commit()
+
+
+class _SharedConnection:
+    """A database connection, pattern cache and blob file
+    shared by PatternDatabase views.
+
+    The lock serializes transactions, since they share the connection.
+    blob_file_lock is held by operations that read the blob file
+    without the connection (backups) and by blob file compaction,
+    which must not run at the same time.
+    """
+
+    def __init__(
+        self, cache_size: int, body_store: str, blob_path: pathlib.Path
+    ) -> None:
+        self.connection: aiosqlite.Connection | None = None
+        self.lock = asyncio.Lock()
+        self.num_users = 0
+        self.cache = PatternCache(max_size=cache_size)
+        self.body_store = body_store
+        self.blob_file = BlobFile(blob_path)
+        self.blob_file_lock = asyncio.Lock()
+        # Does the database have the full-text index of pattern names?
+        self.has_search_index = False
+        # Results of get_pattern_names, by (loom_id, max_names),
+        # which are updated or discarded when the patterns change,
+        # and the version of each loom's names (see names_version).
+        self.names_cache: dict[tuple[str, int], list[str]] = {}
+        self.names_versions: collections.Counter[str] = collections.Counter()
+
+
+class PatternDatabase:
+    """Database of patterns for one loom.
+
+    Several looms may share one database file; each loom only sees
+    its own patterns. Use `for_loom` to get the database for another loom.
+    All such views share one long-lived connection, which is opened
+    by the first call to `init` and closed by the matching last
+    call to `close`.
+
+    The names of the most recently used patterns are cached
+    (see get_pattern_names), and the cache is updated by each change
+    to the patterns, so listing them rarely needs the database.
+    `names_version` tells whether they may have changed.
+
+    Pattern bodies are content-addressed: patterns with the same content
+    (for any loom, under any name) share one stored body.
+    Decoded bodies are cached (also shared by all views),
+    so switching between patterns does not need to decode them.
+
+    New bodies are stored in the database, or, if body_store is "mmap",
+    appended (uncompressed) to an append-only blob file next to it,
+    which is memory-mapped: opening a large library then costs
+    nothing until a pattern is read, and a pattern is decoded
+    in place, without reading it into memory first.
+    Bodies already stored either way remain readable
+    if body_store is changed.
+
+    Parameters
+    ----------
+    dbpath : pathlib.Path
+        Path to the database file.
+    loom_id : str
+        ID of the loom whose patterns this database holds.
+        The default of "" is the only loom of a single-loom server.
+    cache_size : int
+        Maximum approximate size of cached decoded patterns (bytes).
+        0 disables the cache.
+    body_store : str
+        Where to store new pattern bodies: one of BODY_STORES.
+
+    Raises
+    ------
+    ValueError
+        If body_store is not one of BODY_STORES.
+    """
+
+    FIELDS_STR = FIELDS_STR
+
+    def __init__(
+        self,
+        dbpath: pathlib.Path,
+        loom_id: str = "",
+        cache_size: int = DEFAULT_PATTERN_CACHE_SIZE,
+        body_store: str = "sqlite",
+    ) -> None:
+        if body_store not in BODY_STORES:
+            raise ValueError(f"{body_store=} must be one of {BODY_STORES}")
         self.dbpath = dbpath
+        self.loom_id = loom_id
+        self._shared = _SharedConnection(
+            cache_size=cache_size,
+            body_store=body_store,
+            blob_path=get_blob_path(dbpath),
+        )
+
+    def for_loom(self, loom_id: str) -> PatternDatabase:
+        """Get a database for the specified loom, sharing this database."""
+        db = copy.copy(self)
+        db.loom_id = loom_id
+        return db
+
+    @property
+    def cache(self) -> PatternCache:
+        """The cache of decoded patterns."""
+        return self._shared.cache
+
+    @property
+    def names_version(self) -> int:
+        """The version of this loom's pattern names: a number that
+        is incremented whenever the names, or their order, may have changed.
+        """
+        return self._shared.names_versions[self.loom_id]
+
+    @property
+    def is_open(self) -> bool:
+        """Is the connection open?"""
+        return self._shared.connection is not None
 
     async def init(self) -> None:
-        async with aiosqlite.connect(self.dbpath) as db:
-            await db.execute(f"create table if not exists patterns ({self.FIELDS_STR})")
-            await db.commit()
+        """Open the connection, if not already open,
+        and create or upgrade the schema.
+
+        Each call must be matched by a call to `close`.
+
+        Raises
+        ------
+        RuntimeError
+            If the database was written by a newer version of this software.
+        """
+        async with self._shared.lock:
+            self._shared.num_users += 1
+            if self._shared.connection is not None:
+                return
+            db = await aiosqlite.connect(
+                self.dbpath, cached_statements=NUM_CACHED_STATEMENTS
+            )
+            try:
+                for pragma in CONNECTION_PRAGMAS:
+                    await db.execute(pragma)
+                await upgrade_schema(db)
+                await self._finish_blob_compaction(db)
+                async with db.execute(
+                    "select 1 from sqlite_master where name = 'patterns_fts'"
+                ) as cursor:
+                    self._shared.has_search_index = await cursor.fetchone() is not None
+            except BaseException:
+                self._shared.num_users -= 1
+                await db.close()
+                raise
+            self._shared.connection = db
+
+    async def close(self) -> None:
+        """Close the connection, if this is the last user.
+
+        A no-op if the connection is not open.
+        """
+        async with self._shared.lock:
+            if self._shared.connection is None:
+                return
+            self._shared.num_users -= 1
+            if self._shared.num_users > 0:
+                return
+            db = self._shared.connection
+            self._shared.connection = None
+            self._shared.blob_file.close()
+            self._shared.names_cache.clear()
+            await db.close()
+
+    @contextlib.asynccontextmanager
+    async def _connect(self) -> collections.abc.AsyncIterator[aiosqlite.Connection]:
+        """Lock and return the connection.
+
+        If the body raises, roll back any uncommitted changes.
+
+        Raises
+        ------
+        RuntimeError
+            If the connection is not open.
+        """
+        async with self._shared.lock:
+            db = self._shared.connection
+            if db is None:
+                raise RuntimeError("The pattern database is not open; call init")
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
 
     async def add_pattern(
         self,
         pattern: ReducedPattern,
         max_entries: int = 0,
+        max_bytes: int = 0,
+        max_age: float = 0,
+        upload_hash: str | None = None,
     ) -> None:
         """Add a new pattern to the database.
 
         Add the specified pattern to the database, overwriting
         any existing pattern by that name (with a new id number,
-        so the new pattern is the most recent).
-        Prune excess patterns and return the resulting pattern names.
+        so the new pattern is the most recent),
+        and prune excess patterns, in a single transaction.
+        The pattern body is stored only once, however many patterns
+        (for any loom) have the same content.
+
+        Pruning removes the least recently used patterns (for this loom)
+        until all the limits are met, but always keeps the two most
+        recent patterns: the new one and the previous one,
+        which is likely to be the current pattern.
 
         Parameters
         ----------
         pattern : ReducedPattern
             The pattern to add. The pick_number and repeat_number are ignored.
-        max_patterns : int
+        max_entries : int
             Maximum number of patterns to keep; if 0 then no limit.
-            If there are more than this many patterns in the database,
-            the oldest are purged. If keep_name is not None then its
-            timestamp is set to a bit later than now.
-            and a value of 1 is silently changed to 2,
-            so the most recent pattern (which is the current pattern)
-            and the new one are both kept.
+        max_bytes : int
+            Maximum total size of the encoded patterns (bytes),
+            counting a body once for each pattern that uses it;
+            if 0 then no limit.
+        max_age : float
+            Maximum time since a pattern was last used (seconds);
+            if 0 then no limit.
+        upload_hash : str | None
+            The hash of the file the pattern was parsed from
+            (see get_upload_hash), if any, so that `add_uploaded_pattern`
+            can add the pattern again without parsing the file.
         """
-
-        pattern_json = json.dumps(dataclasses.asdict(pattern))
+        use_blob_file = self._shared.body_store == "mmap"
+        # Store blobs uncompressed, so they can be decoded in place.
+        # Encode in a thread: it takes a while for a large pattern.
+        pattern_data, metadata = await asyncio.to_thread(
+            encode_pattern_body, pattern, compress=not use_blob_file, strip_warp=True
+        )
+        warp_hash = metadata[-3]
+        content_hash = metadata[-1]
         current_time = time.time()
-        async with aiosqlite.connect(self.dbpath) as db:
+        async with self._connect() as db:
             await db.execute(
-                "delete from patterns where pattern_name = ?", (pattern.name,)
+                "insert or ignore into warps (warp_hash, warp_data) values (?, ?)",
+                (warp_hash, encode_warp(pattern.threading, pattern.warp_colors)),
             )
-            # If limiting the number of entries, make sure to allow
-            # at least two, to save the most recent pattern,
-            # since it is likely to be the current pattern.
-            if max_entries > 0:
-                max_entries = max(max_entries, 2)
-            await db.execute(
-                "insert into patterns "
-                "(pattern_name, pattern_json, pick_number, repeat_number, timestamp_sec) "
-                "values (?, ?, ?, ?, ?)",
-                (pattern.name, pattern_json, 0, 1, current_time),
+            if use_blob_file:
+                await self._append_blob(db, content_hash, pattern_data, warp_hash)
+            else:
+                await db.execute(
+                    "insert or ignore into pattern_bodies "
+                    "(content_hash, pattern_data, warp_hash) values (?, ?, ?)",
+                    (content_hash, pattern_data, warp_hash),
+                )
+            if upload_hash is not None:
+                await db.execute(
+                    "insert or replace into upload_hashes (upload_hash, content_hash) "
+                    "values (?, ?)",
+                    (upload_hash, content_hash),
+                )
+            cursor = await db.execute(
+                "insert into patterns (pattern_name, pick_number, repeat_number, "
+                f"timestamp_sec, loom_id, {', '.join(METADATA_FIELDS)}) "
+                f"values (?, 0, 1, ?, ?, {', '.join('?' * len(METADATA_FIELDS))})",
+                (pattern.name, current_time, self.loom_id) + metadata,
+            )
+            assert cursor.lastrowid is not None  # make mypy happy
+            num_pruned = await self._replace_and_prune(
+                db,
+                pattern_name=pattern.name,
+                row_id=cursor.lastrowid,
+                current_time=current_time,
+                max_entries=max_entries,
+                max_bytes=max_bytes,
+                max_age=max_age,
             )
             await db.commit()
+            self._name_used(pattern.name, num_pruned=num_pruned)
 
-            pattern_names = await self.get_pattern_names()
-            names_to_delete = pattern_names[0:-max_entries]
+    async def add_uploaded_pattern(
+        self,
+        pattern_name: str,
+        upload_hash: str,
+        max_entries: int = 0,
+        max_bytes: int = 0,
+        max_age: float = 0,
+    ) -> bool:
+        """Add a pattern from a file that was uploaded before,
+        without parsing the file.
 
-            if len(names_to_delete) > 0:
-                # Purge old patterns
-                for pattern_name in names_to_delete:
-                    await db.execute(
-                        "delete from patterns where pattern_name = ?", (pattern_name,)
-                    )
-                await db.commit()
+        If the database has a pattern that was parsed from a file
+        with the specified upload_hash, then add a pattern with the same
+        content (for this loom) by the specified name, as `add_pattern` does
+        (and with the same pruning), and return True.
+        Otherwise do nothing and return False; the caller must parse
+        the file and call `add_pattern`.
+
+        Parameters
+        ----------
+        pattern_name : str
+            The name of the pattern.
+        upload_hash : str
+            The hash of the uploaded file; see get_upload_hash.
+        max_entries, max_bytes, max_age
+            Limits for pruning; see add_pattern.
+        """
+        current_time = time.time()
+        async with self._connect() as db:
+            cursor = await db.execute(
+                "insert into patterns (pattern_name, pick_number, repeat_number, "
+                f"timestamp_sec, loom_id, {', '.join(METADATA_FIELDS)}) "
+                "select ?, 0, 1, ?, ?, "
+                + ", ".join(f"p.{name}" for name in METADATA_FIELDS)
+                + " from upload_hashes u join patterns p "
+                "on p.content_hash = u.content_hash where u.upload_hash = ? limit 1",
+                (pattern_name, current_time, self.loom_id, upload_hash),
+            )
+            if cursor.rowcount < 1:
+                return False
+            assert cursor.lastrowid is not None  # make mypy happy
+            num_pruned = await self._replace_and_prune(
+                db,
+                pattern_name=pattern_name,
+                row_id=cursor.lastrowid,
+                current_time=current_time,
+                max_entries=max_entries,
+                max_bytes=max_bytes,
+                max_age=max_age,
+            )
+            await db.commit()
+            self._name_used(pattern_name, num_pruned=num_pruned)
+        return True
+
+    async def _append_blob(
+        self,
+        db: aiosqlite.Connection,
+        content_hash: str,
+        pattern_data: bytes,
+        warp_hash: str,
+    ) -> None:
+        """Append a pattern body to the blob file, if not already stored,
+        and add it to pattern_bodies, without committing.
+
+        The blob is synced to storage before it is added,
+        so a committed body is never missing from the blob file.
+        """
+        async with db.execute(
+            "select 1 from pattern_bodies where content_hash = ?", (content_hash,)
+        ) as cursor:
+            if await cursor.fetchone() is not None:
+                return
+        offset = await asyncio.to_thread(self._shared.blob_file.append, pattern_data)
+        await db.execute(
+            "insert into pattern_bodies "
+            "(content_hash, pattern_data, blob_offset, blob_length, warp_hash) "
+            "values (?, x'', ?, ?, ?)",
+            (content_hash, offset, len(pattern_data), warp_hash),
+        )
+
+    async def compact_blob_file(self, min_dead_fraction: float = 0.5) -> int:
+        """Reclaim the space of deleted pattern bodies in the blob file
+        (for all looms), if at least min_dead_fraction of it is unused.
+
+        Copy the bodies in use to a new file, in order (so they are
+        packed), update their offsets, then replace the blob file
+        with the new file. If the server stops between the last two
+        steps, `init` finishes the job (see _finish_blob_compaction).
+        This holds the connection while copying.
+
+        Returns
+        -------
+        num_bytes : int
+            The number of bytes by which the blob file shrank.
+        """
+        blob_file = self._shared.blob_file
+        compacted_file = BlobFile(get_compacted_blob_path(self.dbpath))
+        async with self._shared.blob_file_lock, self._connect() as db:
+            old_size = blob_file.size
+            async with db.execute(
+                "select content_hash, blob_offset, blob_length "
+                "from pattern_bodies where blob_offset is not null "
+                "order by blob_offset"
+            ) as cursor:
+                rows = list(await cursor.fetchall())
+            live_size = sum(blob_length for _, _, blob_length in rows)
+            if old_size == 0 or old_size - live_size < old_size * min_dead_fraction:
+                return 0
+
+            def write_compacted_file() -> list[int]:
+                compacted_file.path.unlink(missing_ok=True)
+                return compacted_file.append_all(
+                    blob_file.read(offset=blob_offset, length=blob_length)
+                    for _, blob_offset, blob_length in rows
+                )
+
+            offsets = await asyncio.to_thread(write_compacted_file)
+            await db.executemany(
+                "update pattern_bodies set blob_offset = ? where content_hash = ?",
+                [
+                    (offset, content_hash)
+                    for offset, (content_hash, _, _) in zip(offsets, rows)
+                ],
+            )
+            await db.commit()
+            blob_file.replace(compacted_file.path)
+        return old_size - live_size
+
+    async def _finish_blob_compaction(self, db: aiosqlite.Connection) -> None:
+        """Finish or abandon a compaction of the blob file that was
+        interrupted, if any (see `compact_blob_file`).
+
+        If the offsets of the bodies in the database are packed,
+        and end at the end of the compacted file, the offsets were
+        updated, so replace the blob file with the compacted file.
+        Otherwise the compacted file is not in use; delete it.
+        """
+        compacted_path = get_compacted_blob_path(self.dbpath)
+        if not compacted_path.exists():
+            return
+        async with db.execute(
+            "select blob_offset, blob_length from pattern_bodies "
+            "where blob_offset is not null order by blob_offset"
+        ) as cursor:
+            rows = await cursor.fetchall()
+        end = 0
+        for blob_offset, blob_length in rows:
+            if blob_offset != end:
+                break
+            end += blob_length
+        else:
+            if end == compacted_path.stat().st_size:
+                self._shared.blob_file.replace(compacted_path)
+                return
+        compacted_path.unlink()
+
+    async def _replace_and_prune(
+        self,
+        db: aiosqlite.Connection,
+        pattern_name: str,
+        row_id: int,
+        current_time: float,
+        max_entries: int,
+        max_bytes: int,
+        max_age: float,
+    ) -> int:
+        """Delete older patterns named pattern_name, other than row_id,
+        and prune excess patterns, without committing.
+
+        Add the new row before deleting the old one, so a body
+        that both use is not deleted.
+
+        Returns
+        -------
+        num_pruned : int
+            The number of patterns pruned.
+        """
+        await db.execute(
+            "delete from patterns where pattern_name = ? and loom_id = ? and id != ?",
+            (pattern_name, self.loom_id, row_id),
+        )
+        num_pruned = 0
+        if max_entries > 0:
+            cursor = await db.execute(
+                "delete from patterns where loom_id = ? and id not in "
+                "(select id from patterns where loom_id = ? "
+                "order by timestamp_sec desc, id desc limit ?)",
+                (self.loom_id, self.loom_id, max(max_entries, 2)),
+            )
+            num_pruned += cursor.rowcount
+        if max_bytes > 0:
+            cursor = await db.execute(
+                "delete from patterns where id in "
+                "(select id from (select id, row_number() over win as row_num, "
+                "sum(data_size) over win as total_size "
+                "from patterns where loom_id = ? "
+                "window win as (order by timestamp_sec desc, id desc)) "
+                "where row_num > 2 and total_size > ?)",
+                (self.loom_id, max_bytes),
+            )
+            num_pruned += cursor.rowcount
+        if max_age > 0:
+            cursor = await db.execute(
+                "delete from patterns where loom_id = ? and timestamp_sec < ? "
+                "and id not in (select id from patterns where loom_id = ? "
+                "order by timestamp_sec desc, id desc limit 2)",
+                (self.loom_id, current_time - max_age, self.loom_id),
+            )
+            num_pruned += cursor.rowcount
+        return num_pruned
+
+    def _name_used(self, pattern_name: str, num_pruned: int = 0) -> None:
+        """Update the cached names for a pattern (of this loom)
+        that was just added or used, so is now the most recent,
+        and for num_pruned patterns that were deleted.
+
+        Call after committing, while holding the lock.
+        """
+        if num_pruned > 0:
+            # The cache does not know which patterns were deleted
+            self._invalidate_names(self.loom_id)
+            return
+        cached_names = [
+            (max_names, names)
+            for (loom_id, max_names), names in self._shared.names_cache.items()
+            if loom_id == self.loom_id
+        ]
+        # If nothing is cached, the names may have changed
+        changed = not cached_names
+        for max_names, names in cached_names:
+            if names[-1:] == [pattern_name]:
+                continue
+            if pattern_name in names:
+                names.remove(pattern_name)
+            names.append(pattern_name)
+            del names[:-max_names]
+            changed = True
+        if changed:
+            self._shared.names_versions[self.loom_id] += 1
+
+    def _invalidate_names(self, loom_id: str) -> None:
+        """Discard the cached names for a loom, and increment
+        the version of its names.
+
+        Call after committing, while holding the lock.
+        """
+        for key in [key for key in self._shared.names_cache if key[0] == loom_id]:
+            del self._shared.names_cache[key]
+        self._shared.names_versions[loom_id] += 1
 
     async def clear_database(self) -> None:
-        """Remove all patterns from the database."""
-        async with aiosqlite.connect(self.dbpath) as db:
-            await db.execute("delete from patterns")
+        """Remove all patterns (for this loom) from the database."""
+        async with self._connect() as db:
+            await db.execute("delete from patterns where loom_id = ?", (self.loom_id,))
             await db.commit()
+            self._invalidate_names(self.loom_id)
 
     async def get_pattern(self, pattern_name: str) -> ReducedPattern:
-        async with aiosqlite.connect(self.dbpath) as db:
-            db.row_factory = aiosqlite.Row
+        """Get a pattern, from the cache if possible.
+
+        Raises
+        ------
+        LookupError
+            If the pattern is not in the database.
+        """
+        async with self._connect() as db:
             async with db.execute(
-                "select * from patterns where pattern_name = ?", (pattern_name,)
+                "select content_hash, pick_number, repeat_number from patterns "
+                "where pattern_name = ? and loom_id = ?",
+                (pattern_name, self.loom_id),
             ) as cursor:
                 row = await cursor.fetchone()
-        if row is None:
-            raise LookupError(f"{pattern_name} not found")
-        pattern_dict = json.loads(row["pattern_json"])
-        pattern = ReducedPattern.from_dict(pattern_dict)
-        pattern.pick_number = row["pick_number"]
-        pattern.repeat_number = row["repeat_number"]
+            if row is None:
+                raise LookupError(f"{pattern_name} not found")
+            content_hash, pick_number, repeat_number = row
+            pattern = self.cache.get(content_hash)
+            if pattern is None:
+                body = await self._read_body(db, content_hash)
+                assert body is not None  # make mypy happy
+                pattern = decode_pattern_body(*body)
+                self.cache.put(content_hash, pattern=pattern)
+        pattern.name = pattern_name
+        pattern.pick_number = pick_number
+        pattern.repeat_number = repeat_number
         return pattern
 
-    async def get_pattern_names(self) -> list[str]:
-        async with aiosqlite.connect(self.dbpath) as db:
+    async def iter_patterns(self) -> collections.abc.AsyncIterator[ReducedPattern]:
+        """Iterate over the patterns (for this loom), oldest first
+        (the same order as get_pattern_names).
+
+        Patterns are read and decoded one at a time, bypassing the cache,
+        and are decoded in a thread, so iterating over a large library
+        neither uses much memory nor blocks the event loop.
+        Patterns deleted during iteration are skipped.
+        """
+        for pattern_name in await self.get_pattern_names():
+            async with self._connect() as db:
+                async with db.execute(
+                    "select content_hash, pick_number, repeat_number from patterns "
+                    "where pattern_name = ? and loom_id = ?",
+                    (pattern_name, self.loom_id),
+                ) as cursor:
+                    row = await cursor.fetchone()
+                if row is None:
+                    continue
+                content_hash, pick_number, repeat_number = row
+                body = await self._read_body(db, content_hash)
+            if body is None:
+                continue
+            pattern = await asyncio.to_thread(decode_pattern_body, *body)
+            pattern.name = pattern_name
+            pattern.pick_number = pick_number
+            pattern.repeat_number = repeat_number
+            yield pattern
+
+    async def _read_body(
+        self, db: aiosqlite.Connection, content_hash: str
+    ) -> tuple[bytes | memoryview, bytes | None] | None:
+        """Read an encoded pattern body and its warp, if stored separately,
+        or return None if not found.
+
+        Returns
+        -------
+        pattern_data, warp_data : tuple[bytes | memoryview, bytes | None]
+            The arguments for decode_pattern_body. pattern_data is
+            a memoryview of the blob file, if the body is stored there.
+        """
+        async with db.execute(
+            "select b.pattern_data, b.blob_offset, b.blob_length, w.warp_data "
+            "from pattern_bodies b left join warps w on w.warp_hash = b.warp_hash "
+            "where b.content_hash = ?",
+            (content_hash,),
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        pattern_data, blob_offset, blob_length, warp_data = row
+        if blob_offset is not None:
+            pattern_data = self._shared.blob_file.read(
+                offset=blob_offset, length=blob_length
+            )
+        return pattern_data, warp_data
+
+    async def backup(
+        self, backup_path: pathlib.Path, pages_per_step: int = BACKUP_PAGES_PER_STEP
+    ) -> None:
+        """Write a consistent copy of the database (for all looms)
+        to a new file, without blocking the event loop
+        or this database's connection.
+
+        See backup_database for details.
+        """
+        async with self._shared.blob_file_lock:
+            await asyncio.to_thread(
+                backup_database,
+                dbpath=self.dbpath,
+                backup_path=backup_path,
+                pages_per_step=pages_per_step,
+            )
+
+    async def quick_check(
+        self, should_stop: collections.abc.Callable[[], bool]
+    ) -> str | None:
+        """Check the integrity of the database (for all looms),
+        without blocking the event loop or this database's connection.
+
+        See quick_check_database for details.
+        """
+        return await asyncio.to_thread(
+            quick_check_database, dbpath=self.dbpath, should_stop=should_stop
+        )
+
+    async def get_size(self) -> int:
+        """Get the size of the stored patterns (bytes), for all looms:
+        the pages of the database file in use, plus the pattern bodies
+        in the blob file that are in use.
+
+        This is the size that deleting patterns reduces. It excludes
+        free pages (see `incremental_vacuum`), dead space in the blob
+        file (see `compact_blob_file`), and the write-ahead log;
+        see `get_disk_size` for the size of the files.
+        """
+        async with self._connect() as db:
+            return await self._get_size(db)
+
+    async def _get_size(self, db: aiosqlite.Connection) -> int:
+        page_count = await _get_pragma(db, "page_count")
+        freelist_count = await _get_pragma(db, "freelist_count")
+        page_size = await _get_pragma(db, "page_size")
+        async with db.execute(
+            "select coalesce(sum(blob_length), 0) from pattern_bodies "
+            "where blob_offset is not null"
+        ) as cursor:
+            row = await cursor.fetchone()
+        assert row is not None  # make mypy happy
+        return (page_count - freelist_count) * page_size + row[0]
+
+    def get_disk_size(self) -> int:
+        """Get the total size of the database's files (bytes),
+        for all looms: the database file, its write-ahead log,
+        and the blob file.
+        """
+        total = 0
+        for suffix in ("", "-wal", "-blobs"):
+            try:
+                total += pathlib.Path(f"{self.dbpath}{suffix}").stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    async def incremental_vacuum(self, max_pages: int) -> int:
+        """Return up to max_pages free pages to the file system,
+        shrinking the database file.
+
+        Returns
+        -------
+        num_free_pages : int
+            The number of free pages that remain.
+        """
+        async with self._connect() as db:
+            # execute would only run the first step, which frees one page
+            await db.executescript(f"pragma incremental_vacuum({max_pages:d})")
+            return await _get_pragma(db, "freelist_count")
+
+    async def checkpoint(self) -> None:
+        """Copy as much of the write-ahead log into the database file
+        as can be done without waiting for readers.
+        """
+        async with self._connect() as db:
+            async with db.execute("pragma wal_checkpoint(passive)") as cursor:
+                await cursor.fetchall()
+
+    async def optimize(self) -> None:
+        """Update the statistics the query planner uses, if needed."""
+        async with self._connect() as db:
+            await db.execute(f"pragma analysis_limit = {OPTIMIZE_ANALYSIS_LIMIT:d}")
+            await db.execute("pragma optimize")
+
+    async def get_min_size(self) -> int:
+        """Get the size of the patterns (see `get_size`) that would
+        remain if `prune_to_size` deleted every pattern it may.
+
+        Find out by deleting those patterns in a transaction
+        that is then rolled back, since deleting a pattern frees
+        an amount of space that is hard to predict.
+        """
+        async with self._connect() as db:
+            try:
+                await db.execute(
+                    "delete from patterns where id in "
+                    f"(select id from ({DELETABLE_PATTERNS_STR}))"
+                )
+                return await self._get_size(db)
+            finally:
+                await db.rollback()
+
+    async def prune_to_size(self, max_bytes: int, max_patterns: int) -> int:
+        """Delete up to max_patterns of the least recently used patterns
+        (for all looms), if the size of the patterns (see `get_size`)
+        is larger than max_bytes.
+
+        Always keep the two most recent patterns for each loom,
+        as `add_pattern` does. Deleting a pattern only frees space
+        if no other pattern has the same content. Use `get_min_size`
+        to find out whether max_bytes can be met at all.
+
+        Returns
+        -------
+        num_deleted : int
+            The number of patterns deleted.
+        """
+        async with self._connect() as db:
+            if await self._get_size(db) <= max_bytes:
+                return 0
             async with db.execute(
-                "select pattern_name from patterns order by timestamp_sec asc, id asc"
+                "select id, loom_id from "
+                f"({DELETABLE_PATTERNS_STR}) order by timestamp_sec, id limit ?",
+                (max_patterns,),
+            ) as cursor:
+                rows = list(await cursor.fetchall())
+            await db.executemany(
+                "delete from patterns where id = ?", [(id,) for id, _ in rows]
+            )
+            await db.commit()
+            for loom_id in {loom_id for _, loom_id in rows}:
+                self._invalidate_names(loom_id)
+        return len(rows)
+
+    async def get_pattern_names(self, max_names: int = 0) -> list[str]:
+        """Get the names of the most recently used patterns, oldest first.
+
+        If max_names > 0, the names are cached, so getting them again
+        does not use the database, until the patterns change in a way
+        that the cache cannot follow (e.g. if patterns are pruned).
+
+        Parameters
+        ----------
+        max_names : int
+            Maximum number of names to return; if 0 then no limit.
+        """
+        names = self._shared.names_cache.get((self.loom_id, max_names))
+        if names is not None:
+            return names.copy()
+        async with self._connect() as db:
+            async with db.execute(
+                "select pattern_name from "
+                "(select pattern_name, timestamp_sec, id from patterns "
+                "where loom_id = ? order by timestamp_sec desc, id desc limit ?) "
+                "order by timestamp_sec asc, id asc",
+                (self.loom_id, max_names if max_names > 0 else -1),
+            ) as cursor:
+                rows = await cursor.fetchall()
+            names = [row[0] for row in rows]
+            if max_names > 0:
+                self._shared.names_cache[(self.loom_id, max_names)] = names.copy()
+        return names
+
+    async def get_pattern_metadata(self) -> list[PatternMetadata]:
+        """Get metadata for all patterns, oldest first
+        (the same order as get_pattern_names).
+        """
+        async with self._connect() as db:
+            async with db.execute(
+                f"select {METADATA_COLUMNS_STR} from patterns p "
+                "where loom_id = ? order by timestamp_sec asc, id asc",
+                (self.loom_id,),
             ) as cursor:
                 rows = await cursor.fetchall()
+        return [PatternMetadata(*row) for row in rows]
 
-        return [row[0] for row in rows]
+    async def search_patterns(
+        self,
+        query: str = "",
+        offset: int = 0,
+        limit: int = DEFAULT_PAGE_SIZE,
+        same_warp_as: str = "",
+    ) -> tuple[int, list[PatternMetadata]]:
+        """Search for patterns, most recently used first.
+
+        Parameters
+        ----------
+        query : str
+            Whitespace-separated search terms; a pattern must match all
+            of them. A term of the form key:value, where key is one of
+            SEARCH_FILTER_FIELDS and value is an integer, matches patterns
+            with that metadata value, e.g. "shafts:8". Other terms match
+            words in the pattern name that start with the term
+            (case-insensitive), e.g. "twi" matches "Rosy twill.wif".
+            Blank matches all patterns.
+        offset : int
+            Number of matching patterns to skip.
+        limit : int
+            Maximum number of patterns to return.
+        same_warp_as : str
+            If not blank, only match other patterns that have
+            the same warp (threading and warp colors) as this pattern,
+            e.g. other treadlings for the current pattern.
+            If there is no such pattern, nothing matches.
+
+        Returns
+        -------
+        total, metadata_list : tuple[int, list[PatternMetadata]]
+            The total number of matching patterns,
+            and metadata for the requested page of them.
+
+        Raises
+        ------
+        ValueError
+            If a key:value term has an unknown key or a non-integer value.
+        """
+        where_strs = ["p.loom_id = ?"]
+        where_args: list[str | int] = [self.loom_id]
+        words = []
+        for term in query.split():
+            key, sep, value = term.partition(":")
+            if not sep:
+                words.append(term)
+                continue
+            field = SEARCH_FILTER_FIELDS.get(key.lower())
+            if field is None or not value.isdigit():
+                raise ValueError(
+                    f"Invalid search term {term!r}: must be key:integer "
+                    f"with key one of {sorted(SEARCH_FILTER_FIELDS)}"
+                )
+            where_strs.append(f"p.{field} = ?")
+            where_args.append(int(value))
+        if same_warp_as:
+            where_strs += [
+                "p.warp_hash = (select warp_hash from patterns "
+                "where loom_id = ? and pattern_name = ?)",
+                "p.pattern_name != ?",
+            ]
+            where_args += [self.loom_id, same_warp_as, same_warp_as]
+
+        if words:
+            if self._shared.has_search_index:
+                # Quote each word (so punctuation is not FTS syntax)
+                # and make it a prefix query. Use a subquery, so the
+                # full-text query runs once, rather than once per row.
+                where_strs.append(
+                    "p.id in (select rowid from patterns_fts where patterns_fts match ?)"
+                )
+                where_args.append(
+                    " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+                )
+            else:
+                # No full-text index; match substrings instead.
+                for word in words:
+                    where_strs.append("p.pattern_name like ? escape '\\'")
+                    escaped_word = (
+                        word.replace("\\", "\\\\")
+                        .replace("%", "\\%")
+                        .replace("_", "\\_")
+                    )
+                    where_args.append(f"%{escaped_word}%")
+        sql_tail = f"from patterns p where {' and '.join(where_strs)}"
+
+        async with self._connect() as db:
+            async with db.execute(f"select count(*) {sql_tail}", where_args) as cursor:
+                row = await cursor.fetchone()
+            assert row is not None  # make mypy happy
+            total = row[0]
+            async with db.execute(
+                f"select {METADATA_COLUMNS_STR} "
+                f"{sql_tail} order by p.timestamp_sec desc, p.id desc limit ? offset ?",
+                where_args + [limit, offset],
+            ) as cursor:
+                rows = await cursor.fetchall()
+        return total, [PatternMetadata(*row) for row in rows]
 
     async def update_pick_number(
         self, pattern_name: str, pick_number: int, repeat_number: int
     ) -> None:
         """Update the pick and repeat numbers for the specified pattern."""
-        async with aiosqlite.connect(self.dbpath) as db:
-            await db.execute(
+        async with self._connect() as db:
+            cursor = await db.execute(
                 "update patterns "
-                "set pick_number = ?, repeat_number = ?, timestamp_sec = ?"
-                "where pattern_name = ?",
-                (pick_number, repeat_number, time.time(), pattern_name),
+                "set pick_number = ?, repeat_number = ?, timestamp_sec = ? "
+                "where pattern_name = ? and loom_id = ?",
+                (pick_number, repeat_number, time.time(), pattern_name, self.loom_id),
             )
             await db.commit()
+            if cursor.rowcount > 0:
+                self._name_used(pattern_name)
 
     async def set_timestamp(self, pattern_name: str, timestamp: float) -> None:
         """Set the timestamp for the specified pattern.
@@ -137,12 +1630,27 @@ class PatternDatabase:
         timestamp : float
             Timestamp in unix seconds, e.g. from time.time()
         """
-        async with aiosqlite.connect(self.dbpath) as db:
+        async with self._connect() as db:
             await db.execute(
-                "update patterns set timestamp_sec = ? where pattern_name = ?",
-                (timestamp, pattern_name),
+                "update patterns set timestamp_sec = ? "
+                "where pattern_name = ? and loom_id = ?",
+                (timestamp, pattern_name, self.loom_id),
             )
             await db.commit()
+            # The timestamp may be any time, so the order is unknown
+            self._invalidate_names(self.loom_id)
+
+    async def __aenter__(self) -> PatternDatabase:
+        await self.init()
+        return self
+
+    async def __aexit__(
+        self,
+        type: Type[BaseException] | None,
+        value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        await self.close()
 
 
 async def create_pattern_database(dbpath: pathlib.Path) -> PatternDatabase:
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+__all__ = ["EXPORT_FORMATS", "NATIVE_SUFFIX", "export_patterns"]
+
+import asyncio
+import collections.abc
+import io
+import pathlib
+import typing
+import zipfile
+
+import dtx_to_wif
+
+from .pattern_codec import encode_pattern
+from .pattern_database import PatternDatabase
+from .reduced_pattern import ReducedPattern, pattern_data_from_reduced_pattern
+
+# Formats for exported patterns:
+# * wif: a WIF file, which any weaving software can read.
+# * native: the pattern database's own compact encoding
+#   (see pattern_codec), including the pick and repeat numbers.
+EXPORT_FORMATS = ("wif", "native")
+
+# File name suffix of patterns exported in the native format
+NATIVE_SUFFIX = ".tkp"
+
+
+async def export_patterns(
+    pattern_db: PatternDatabase, format: str = "wif"
+) -> collections.abc.AsyncIterator[bytes]:
+    """Export all patterns (for one loom) as a zip file,
+    yielding the zip file in chunks, e.g. for a streaming HTTP response.
+
+    Patterns are read, converted and compressed one at a time,
+    and each is yielded as soon as it is written, so the export
+    never holds more than one pattern in memory.
+    Conversion and compression run in a thread,
+    so they do not block the event loop.
+
+    Parameters
+    ----------
+    pattern_db : PatternDatabase
+        The pattern database; it must be open.
+    format : str
+        The format of the exported patterns: one of EXPORT_FORMATS.
+
+    Raises
+    ------
+    ValueError
+        If format is not one of EXPORT_FORMATS.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"{format=} must be one of {EXPORT_FORMATS}")
+    buffer = _ChunkBuffer()
+    zip_file = zipfile.ZipFile(typing.cast(typing.IO[bytes], buffer), mode="w")
+    used_filenames: set[str] = set()
+    async for pattern in pattern_db.iter_patterns():
+        filename = _get_filename(pattern.name, format, used_filenames)
+        await asyncio.to_thread(_write_pattern, zip_file, filename, pattern, format)
+        yield buffer.take()
+    await asyncio.to_thread(zip_file.close)
+    yield buffer.take()
+
+
+def _get_filename(pattern_name: str, format: str, used_filenames: set[str]) -> str:
+    """Get a unique file name for an exported pattern,
+    and add it to used_filenames.
+    """
+    suffix = ".wif" if format == "wif" else NATIVE_SUFFIX
+    stem = pathlib.PurePosixPath(pattern_name.replace("\\", "/")).stem or "pattern"
+    filename = stem + suffix
+    copy_number = 1
+    while filename in used_filenames:
+        copy_number += 1
+        filename = f"{stem} ({copy_number}){suffix}"
+    used_filenames.add(filename)
+    return filename
+
+
+def _write_pattern(
+    zip_file: zipfile.ZipFile, filename: str, pattern: ReducedPattern, format: str
+) -> None:
+    """Write one pattern to the zip file."""
+    if format == "wif":
+        wif_file = io.StringIO()
+        dtx_to_wif.write_wif(wif_file, pattern_data_from_reduced_pattern(pattern))
+        zip_file.writestr(
+            filename, wif_file.getvalue(), compress_type=zipfile.ZIP_DEFLATED
+        )
+    else:
+        # The encoding is already compressed
+        zip_file.writestr(
+            filename, encode_pattern(pattern), compress_type=zipfile.ZIP_STORED
+        )
+
+
+class _ChunkBuffer:
+    """A write-only file that holds what is written until it is taken.
+
+    It cannot seek or tell, so zipfile writes a streamable zip file.
+    """
+
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        """Return and forget everything written so far."""
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
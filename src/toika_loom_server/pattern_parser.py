@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+__all__ = [
+    "DEFAULT_MAX_PARSE_JOBS",
+    "DEFAULT_PARSE_TIMEOUT",
+    "SUPPORTED_SUFFIXES",
+    "PatternParser",
+    "parse_pattern_file",
+]
+
+import asyncio
+import io
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import signal
+import time
+from typing import Any
+
+from dtx_to_wif import read_dtx, read_wif
+
+from .pattern_codec import decode_pattern, encode_pattern
+from .pick_latency import LatencyHistogram
+from .reduced_pattern import ReducedPattern, reduced_pattern_from_pattern_data
+
+# Default maximum number of pattern files parsed at the same time
+DEFAULT_MAX_PARSE_JOBS = 2
+
+# Default maximum time to parse a pattern file (seconds)
+DEFAULT_PARSE_TIMEOUT = 60
+
+# Suffixes of the pattern files that can be parsed (lowercase)
+SUPPORTED_SUFFIXES = (".dtx", ".wif")
+
+
+def parse_pattern_file(filename: str, data: str) -> ReducedPattern:
+    """Parse the contents of a pattern file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file, which is also the name of the pattern.
+        The suffix (one of SUPPORTED_SUFFIXES) specifies the format.
+    data : str
+        The contents of the file.
+
+    Raises
+    ------
+    ValueError
+        If the file type is not supported.
+    """
+    if filename.lower().endswith(".dtx"):
+        with io.StringIO(data) as dtx_file:
+            pattern_data = read_dtx(dtx_file)
+    elif filename.lower().endswith(".wif"):
+        with io.StringIO(data) as wif_file:
+            pattern_data = read_wif(wif_file)
+    else:
+        raise ValueError(f"Cannot load pattern {filename!r}: unsupported file type")
+    return reduced_pattern_from_pattern_data(name=filename, data=pattern_data)
+
+
+class PatternParser:
+    """Parse pattern files in separate processes, so that parsing
+    a large file does not hold up the event loop (or the loom).
+
+    Each file is parsed by a worker process, which is started
+    the first time it is needed and reused for later files.
+    At most max_jobs files are parsed at the same time;
+    other calls to `parse` wait their turn.
+    If parsing times out or is cancelled, the worker is killed.
+
+    Must be used in one event loop.
+
+    Parameters
+    ----------
+    max_jobs : int
+        Maximum number of files to parse at the same time,
+        which is also the maximum number of worker processes.
+    timeout : float
+        Maximum time to parse a file (seconds); 0 for no limit.
+        This does not include time spent waiting for a worker.
+    """
+
+    def __init__(
+        self,
+        max_jobs: int = DEFAULT_MAX_PARSE_JOBS,
+        timeout: float = DEFAULT_PARSE_TIMEOUT,
+    ) -> None:
+        if max_jobs < 1:
+            raise ValueError(f"{max_jobs=} must be positive")
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        # Do not fork: the server has other threads (e.g. the loom thread)
+        self.context = multiprocessing.get_context("spawn")
+        self.job_semaphore = asyncio.Semaphore(max_jobs)
+        self.idle_workers: list[_Worker] = []
+        self.busy_workers: set[_Worker] = set()
+        self.parse_durations = LatencyHistogram()
+        self.num_jobs_running = 0
+        self.num_timeouts = 0
+        self.num_cancelled = 0
+
+    async def parse(self, filename: str, data: str) -> ReducedPattern:
+        """Parse a pattern file in a worker process.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file, which is also the name of the pattern;
+            see parse_pattern_file.
+        data : str
+            The contents of the file.
+
+        Raises
+        ------
+        TimeoutError
+            If parsing took longer than the timeout.
+        Exception
+            Whatever parse_pattern_file raised, if possible,
+            else RuntimeError, e.g. if the worker process died.
+        """
+        async with self.job_semaphore:
+            worker = self.idle_workers.pop() if self.idle_workers else None
+            if worker is None:
+                worker = await asyncio.to_thread(_Worker, self.context)
+            self.busy_workers.add(worker)
+            self.num_jobs_running += 1
+            worker_ok = False
+            start_time = time.perf_counter()
+            try:
+                async with asyncio.timeout(self.timeout or None):
+                    succeeded, result = await asyncio.to_thread(
+                        worker.parse, filename, data
+                    )
+                worker_ok = True
+            except TimeoutError:
+                self.num_timeouts += 1
+                raise TimeoutError(
+                    f"Parsing {filename!r} took longer than {self.timeout} seconds"
+                ) from None
+            except asyncio.CancelledError:
+                self.num_cancelled += 1
+                raise
+            finally:
+                self.num_jobs_running -= 1
+                self.busy_workers.discard(worker)
+                if worker_ok:
+                    self.idle_workers.append(worker)
+                else:
+                    worker.kill()
+            self.parse_durations.record(time.perf_counter() - start_time)
+        if not succeeded:
+            raise result
+        # Decode in a thread: decoding is pure Python, so it lets
+        # the event loop run, whereas unpickling a pattern would not.
+        return await asyncio.to_thread(decode_pattern, result)
+
+    def close(self) -> None:
+        """Kill all worker processes.
+
+        Parsing that is in progress fails with RuntimeError.
+        """
+        for worker in self.idle_workers:
+            worker.kill(close_connection=True)
+        for worker in self.busy_workers:
+            worker.kill()
+        self.idle_workers = []
+
+    def get_stats(self) -> dict[str, Any]:
+        """Get statistics, as a dict that can be encoded as json."""
+        return dict(
+            num_workers=len(self.idle_workers) + len(self.busy_workers),
+            num_jobs_running=self.num_jobs_running,
+            num_timeouts=self.num_timeouts,
+            num_cancelled=self.num_cancelled,
+            parse_durations=self.parse_durations.as_dict(),
+        )
+
+
+class _Worker:
+    """A worker process that parses pattern files, one at a time.
+
+    The blocking methods are meant to be called in a thread.
+    """
+
+    def __init__(self, context: multiprocessing.context.SpawnContext) -> None:
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_run_worker,
+            args=(child_connection,),
+            name="pattern_parser",
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+
+    def parse(self, filename: str, data: str) -> tuple[bool, Any]:
+        """Parse a pattern file and return (succeeded, result).
+
+        The result is the pattern, encoded with encode_pattern
+        (which is much quicker to transfer than a pickled pattern),
+        if parsing succeeded, else the exception that parsing raised.
+        Blocks until the worker replies.
+        """
+        try:
+            self.connection.send((filename, data))
+            return self.connection.recv()
+        except (EOFError, OSError):
+            # Close the connection here, rather than in kill,
+            # so it is not closed while a thread is using it.
+            self.connection.close()
+            raise RuntimeError("The pattern parser process died") from None
+
+    def kill(self, close_connection: bool = False) -> None:
+        """Kill the worker process.
+
+        A thread that is waiting for a reply gets RuntimeError.
+
+        Parameters
+        ----------
+        close_connection : bool
+            Also close the connection? Only do this if no thread
+            is using it.
+        """
+        self.process.kill()
+        if close_connection:
+            self.connection.close()
+
+
+def _run_worker(connection: multiprocessing.connection.Connection) -> None:
+    """Parse pattern files received from the connection, until it closes.
+
+    Runs in the worker process.
+    """
+    # Let the server handle ^C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            filename, data = connection.recv()
+        except EOFError:
+            return
+        try:
+            pattern = parse_pattern_file(filename, data)
+        except Exception as e:
+            error = e
+            try:
+                pickle.loads(pickle.dumps(error))
+            except Exception:
+                # The server could not unpickle the exception
+                error = RuntimeError(repr(e))
+            connection.send((False, error))
+        else:
+            connection.send((True, encode_pattern(pattern, compress=False)))
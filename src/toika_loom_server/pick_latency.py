@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+__all__ = [
+    "BITS_PER_BYTE",
+    "LATENCY_BUCKET_BOUNDS",
+    "PICK_STAGES",
+    "LatencyHistogram",
+    "PickLatencyRecorder",
+]
+
+import bisect
+import threading
+import time
+from typing import Any
+
+from .loom_constants import BAUD_RATE
+
+# Upper bounds of the latency histogram buckets (seconds):
+# 1, 2, 5 per decade, from 1 µs to 10 s. Longer latencies
+# go into an overflow bucket.
+LATENCY_BUCKET_BOUNDS = tuple(
+    mantissa * 10.0**exponent for exponent in range(-6, 1) for mantissa in (1, 2, 5)
+) + (10.0,)
+
+# Bits sent over the serial line per byte: 8 data bits,
+# plus a start bit and a stop bit.
+BITS_PER_BYTE = 10
+
+# Stages of handling a pick request from the loom, in order:
+# * decode: split the reply from the data read from the loom.
+# * lookup: choose the pick and look up its shaft word.
+# * write: hand the command to the transport.
+# * drain: wait until the transport has sent the command on.
+# * total: from reading the data to finishing the drain.
+PICK_STAGES = ("decode", "lookup", "write", "drain", "total")
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of latencies.
+
+    Recording a latency is a binary search of the buckets,
+    so it is cheap enough to do for every pick.
+    Percentiles are reported as the upper bound of the bucket
+    that contains them (but no more than the maximum latency).
+
+    Not thread-safe; see PickLatencyRecorder.
+    """
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKET_BOUNDS) + 1)
+        self.num_values = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, latency: float) -> None:
+        """Record a latency (seconds)."""
+        self.counts[bisect.bisect_left(LATENCY_BUCKET_BOUNDS, latency)] += 1
+        self.num_values += 1
+        self.sum += latency
+        if latency > self.max:
+            self.max = latency
+
+    def percentile(self, percent: float) -> float | None:
+        """Get the specified percentile (seconds), or None if no data.
+
+        Parameters
+        ----------
+        percent : float
+            The percentile, in the range [0, 100].
+        """
+        if self.num_values == 0:
+            return None
+        # Number of values at or below the percentile (at least 1)
+        num_needed = max(percent / 100 * self.num_values, 1)
+        cumulative_count = 0
+        for bound, count in zip(LATENCY_BUCKET_BOUNDS, self.counts):
+            cumulative_count += count
+            if cumulative_count >= num_needed:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> dict[str, Any]:
+        """Get a summary, as a dict that can be encoded as json."""
+        return dict(
+            num_values=self.num_values,
+            mean=self.sum / self.num_values if self.num_values else None,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+            max=self.max if self.num_values else None,
+        )
+
+
+class PickLatencyRecorder:
+    """Record how long it takes to respond to pick requests from the loom,
+    and how busy the serial line is.
+
+    There is one histogram for each stage in PICK_STAGES.
+    Latencies are measured with time.perf_counter (a monotonic clock).
+
+    Serial line utilization is the fraction of the line's capacity
+    (at BAUD_RATE) used in each direction since the recorder was created
+    or reset. Compare pick_wire_time (the time to transmit a pick command)
+    to the total latency, to see whether the weaver is waiting
+    on the software or on the serial line.
+
+    Values are recorded by the thread that talks to the loom
+    and may be read by any thread.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear all data."""
+        with self.lock:
+            self.histograms = {stage: LatencyHistogram() for stage in PICK_STAGES}
+            self.num_bytes_read = 0
+            self.num_bytes_written = 0
+            self.pick_command_len = 0
+            self.start_time = time.perf_counter()
+
+    def record(self, stage: str, latency: float) -> None:
+        """Record the latency of one stage of handling a pick (seconds)."""
+        with self.lock:
+            self.histograms[stage].record(latency)
+
+    def record_bytes_read(self, num_bytes: int) -> None:
+        """Record bytes read from the loom."""
+        with self.lock:
+            self.num_bytes_read += num_bytes
+
+    def record_bytes_written(self, num_bytes: int, is_pick: bool = False) -> None:
+        """Record bytes written to the loom.
+
+        Parameters
+        ----------
+        num_bytes : int
+            The number of bytes written.
+        is_pick : bool
+            True if the bytes are a pick command.
+        """
+        with self.lock:
+            self.num_bytes_written += num_bytes
+            if is_pick:
+                self.pick_command_len = num_bytes
+
+    def as_dict(self) -> dict[str, Any]:
+        """Get a summary, as a dict that can be encoded as json."""
+        with self.lock:
+            duration = time.perf_counter() - self.start_time
+            line_capacity = duration * BAUD_RATE / BITS_PER_BYTE
+            return dict(
+                stages={
+                    stage: histogram.as_dict()
+                    for stage, histogram in self.histograms.items()
+                },
+                serial=dict(
+                    baud_rate=BAUD_RATE,
+                    duration=duration,
+                    num_bytes_read=self.num_bytes_read,
+                    num_bytes_written=self.num_bytes_written,
+                    read_utilization=self.num_bytes_read / line_capacity,
+                    write_utilization=self.num_bytes_written / line_capacity,
+                    pick_wire_time=(
+                        self.pick_command_len * BITS_PER_BYTE / BAUD_RATE
+                        if self.pick_command_len
+                        else None
+                    ),
+                ),
+            )
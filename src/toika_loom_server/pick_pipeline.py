@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+__all__ = ["PickPipeline", "PreparedPick"]
+
+import dataclasses
+import threading
+
+from .client_replies import JumpPickNumber
+from .loom_constants import TERMINATOR
+from .reduced_pattern import ReducedPattern
+
+
+def null_jump_pick() -> JumpPickNumber:
+    """Return a JumpPickNumber that specifies no jump."""
+    return JumpPickNumber(pick_number=None, repeat_number=None)
+
+
+@dataclasses.dataclass(frozen=True)
+class PreparedPick:
+    """A pick that is ready to be sent to the loom.
+
+    Parameters
+    ----------
+    pattern_name : str
+        The name of the pattern.
+    pick_number : int
+        The pick number.
+    repeat_number : int
+        The repeat number.
+    cmdbytes : bytes
+        The shaft word command for the loom, including the terminator.
+    is_jump : bool
+        True if this pick is the result of a pending jump,
+        in which case sending it clears the jump.
+    """
+
+    pattern_name: str
+    pick_number: int
+    repeat_number: int
+    cmdbytes: bytes
+    is_jump: bool
+
+
+class PickPipeline:
+    """Keep the next forward and backward picks ready to send to the loom.
+
+    The prepared picks take any pending jump into account. They are
+    recomputed whenever the pattern, the jump, or the current pick changes,
+    so that responding to a pick request from the loom is a dict lookup.
+
+    The current pick and repeat numbers are stored in the pattern.
+
+    The methods are thread-safe, so the loom can be handled
+    by a different thread than the client.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.pattern: ReducedPattern | None = None
+        self.jump_pick = null_jump_pick()
+        self.next_picks: dict[bool, PreparedPick] = {}
+
+    def advance(self, weave_forward: bool) -> PreparedPick | None:
+        """Advance to the prepared pick in the specified direction.
+
+        Update the pattern's pick and repeat numbers, clear the jump
+        (if the pick is the result of a jump), and prepare the next picks.
+
+        Return the prepared pick, or None if there is no pattern.
+        """
+        with self.lock:
+            prepared_pick = self.next_picks.get(weave_forward)
+            if prepared_pick is None or self.pattern is None:
+                return None
+            self.pattern.pick_number = prepared_pick.pick_number
+            self.pattern.repeat_number = prepared_pick.repeat_number
+            if prepared_pick.is_jump:
+                self.jump_pick = null_jump_pick()
+            self.prepare()
+            return prepared_pick
+
+    def apply_pick(self, prepared_pick: PreparedPick) -> None:
+        """Apply a pick that was sent to the loom by a different pipeline.
+
+        Used to mirror a pipeline that runs elsewhere (e.g. in a loom driver
+        process). Ignored if the pick is for a different pattern.
+        """
+        with self.lock:
+            if self.pattern is None or self.pattern.name != prepared_pick.pattern_name:
+                return
+            self.pattern.pick_number = prepared_pick.pick_number
+            self.pattern.repeat_number = prepared_pick.repeat_number
+            if prepared_pick.is_jump:
+                self.jump_pick = null_jump_pick()
+            self.prepare()
+
+    def clear_jump_pick(self) -> bool:
+        """Clear the jump pick.
+
+        Return True if there was a jump pick to clear.
+        """
+        with self.lock:
+            if self.jump_pick == null_jump_pick():
+                return False
+            self.set_jump_pick(null_jump_pick())
+            return True
+
+    def prepare(self) -> None:
+        """Prepare the next forward and backward picks."""
+        with self.lock:
+            if self.pattern is None:
+                self.next_picks = {}
+            else:
+                self.next_picks = {
+                    weave_forward: self._prepare_pick(
+                        pattern=self.pattern, weave_forward=weave_forward
+                    )
+                    for weave_forward in (True, False)
+                }
+
+    def set_jump_pick(self, jump_pick: JumpPickNumber) -> None:
+        """Set the jump pick and prepare the next picks."""
+        with self.lock:
+            self.jump_pick = jump_pick
+            self.prepare()
+
+    def set_pattern(self, pattern: ReducedPattern | None) -> bool:
+        """Set the pattern, clear the jump pick, and prepare the next picks.
+
+        Return True if there was a jump pick to clear.
+        """
+        with self.lock:
+            had_jump_pick = self.jump_pick != null_jump_pick()
+            self.pattern = pattern
+            self.jump_pick = null_jump_pick()
+            self.prepare()
+            return had_jump_pick
+
+    def _prepare_pick(
+        self, pattern: ReducedPattern, weave_forward: bool
+    ) -> PreparedPick:
+        if self.jump_pick.pick_number is not None:
+            pick_number = self.jump_pick.pick_number
+            repeat_number = pattern.repeat_number
+        else:
+            pick_number, repeat_number = pattern.compute_next_pick_number(
+                weave_forward=weave_forward
+            )
+        if self.jump_pick.repeat_number is not None:
+            repeat_number = self.jump_pick.repeat_number
+        return PreparedPick(
+            pattern_name=pattern.name,
+            pick_number=pick_number,
+            repeat_number=repeat_number,
+            cmdbytes=pattern.get_shaft_bytes(pick_number) + TERMINATOR,
+            is_jump=self.jump_pick != null_jump_pick(),
+        )
@@ -1,19 +1,47 @@
 from __future__ import annotations
 
 __all__ = [
+    "HAVE_NUMPY",
+    "MAX_SHAFTS",
+    "PARSER_VERSION",
     "Pick",
     "ReducedPattern",
+    "pattern_data_from_reduced_pattern",
     "reduced_pattern_from_pattern_data",
     "read_full_pattern",
 ]
 
+import array
 import copy
 import dataclasses
+import itertools
 import pathlib
 from typing import Any
 
 import dtx_to_wif
 
+try:
+    import numpy as np
+
+    HAVE_NUMPY = True
+except ImportError:
+    # NumPy is optional; it speeds up reduced_pattern_from_pattern_data
+    HAVE_NUMPY = False
+
+# The maximum number of shafts the loom supports;
+# the shaft word sent to the loom is a 32 bit int.
+MAX_SHAFTS = 32
+
+# The version of the code that reads pattern files and reduces them.
+# Increment it whenever a change (e.g. to read_full_pattern or
+# reduced_pattern_from_pattern_data) may change the result of reading
+# a file, so that cached results of uploads (see get_upload_hash
+# in pattern_database) are not reused.
+PARSER_VERSION = 1
+
+# Number of bytes in an encoded shaft word
+SHAFT_WORD_LEN = 4
+
 
 def pop_and_check_type_field(typename: str, datadict: dict[str, Any]) -> None:
     typestr = datadict.pop("type", typename)
@@ -44,6 +72,11 @@ class Pick:
         pop_and_check_type_field("Pick", datadict)
         return cls(**datadict)
 
+    @property
+    def shaft_word(self) -> int:
+        """The shafts to raise, as a bit mask; bit 0 is shaft 1."""
+        return sum(1 << i for i, isup in enumerate(self.are_shafts_up) if isup)
+
 
 @dataclasses.dataclass
 class ReducedPattern:
@@ -54,6 +87,19 @@ class ReducedPattern:
 
     Picks are accessed by pick number, which is 1-based.
     0 indicates that nothing has been woven.
+
+    On construction the picks are compiled into two compact tables,
+    both indexed by pick number (so index 0 is pick0):
+
+    * shaft_word_table: the shaft words, encoded as the 4-byte
+      big-endian values the loom expects, concatenated.
+    * pick_colors: the weft color index of each pick.
+
+    These are plain attributes rather than fields, so they are not
+    part of the dict representation, nor of equality comparisons.
+    If the caller already has shaft_word_table, it can pass it as
+    compiled_shaft_words, to save computing it again; it must match
+    the picks (which implies they have at most MAX_SHAFTS shafts).
     """
 
     type: str = dataclasses.field(init=False, default="ReducedPattern")
@@ -65,6 +111,7 @@ class ReducedPattern:
     pick0: Pick
     pick_number: int = 0
     repeat_number: int = 1
+    compiled_shaft_words: dataclasses.InitVar[bytes | None] = None
 
     @classmethod
     def from_dict(cls, datadict: dict[str, Any]) -> ReducedPattern:
@@ -79,6 +126,23 @@ class ReducedPattern:
         datadict["pick0"] = Pick.from_dict(datadict["pick0"])
         return cls(**datadict)
 
+    def __post_init__(self, compiled_shaft_words: bytes | None) -> None:
+        all_picks = [self.pick0] + self.picks
+        if compiled_shaft_words is not None:
+            self.shaft_word_table = compiled_shaft_words
+        else:
+            num_shafts = max(len(pick.are_shafts_up) for pick in all_picks)
+            if num_shafts > MAX_SHAFTS:
+                raise ValueError(
+                    f"Pattern {self.name!r} has {num_shafts} shafts; "
+                    f"the loom supports at most {MAX_SHAFTS}"
+                )
+            self.shaft_word_table = b"".join(
+                pick.shaft_word.to_bytes(length=SHAFT_WORD_LEN, byteorder="big")
+                for pick in all_picks
+            )
+        self.pick_colors = array.array("i", (pick.color for pick in all_picks))
+
     def increment_pick_number(self, weave_forward: bool) -> int:
         """Increment pick_number in the specified direction.
 
@@ -86,19 +150,31 @@ class ReducedPattern:
 
         Return the new pick number.
         """
+        self.pick_number, self.repeat_number = self.compute_next_pick_number(
+            weave_forward=weave_forward
+        )
+        return self.pick_number
+
+    def compute_next_pick_number(self, weave_forward: bool) -> tuple[int, int]:
+        """Compute the next pick in the specified direction.
+
+        Unlike increment_pick_number, this does not change the pattern.
+
+        Return the next (pick_number, repeat_number).
+        """
         if self.pick_number < 0 or self.pick_number > len(self.picks):
             raise RuntimeError(
                 f"Bug: {self.pick_number=} out of range [0, {len(self.picks)}"
             )
         next_pick_number = self.pick_number + (1 if weave_forward else -1)
+        next_repeat_number = self.repeat_number
         if next_pick_number < 0:
-            self.repeat_number -= 1
+            next_repeat_number -= 1
             next_pick_number = len(self.picks)
         elif next_pick_number > len(self.picks):
-            self.repeat_number += 1
+            next_repeat_number += 1
             next_pick_number = 0
-        self.pick_number = next_pick_number
-        return next_pick_number
+        return next_pick_number, next_repeat_number
 
     def get_current_pick(self) -> Pick:
         """Get the current pick.
@@ -116,6 +192,28 @@ class ReducedPattern:
         else:
             return self.picks[pick_number - 1]
 
+    def get_shaft_bytes(self, pick_number: int) -> bytes:
+        """Get the encoded shaft word for the specified pick.
+
+        Parameters
+        ----------
+        pick_number : int
+            The pick number; 0 for pick0.
+
+        Raises
+        ------
+        IndexError
+            If pick_number < 0 or > len(self.picks)
+        """
+        if pick_number < 0 or pick_number > len(self.picks):
+            raise IndexError(f"{pick_number=} < 0 or > {len(self.picks)}")
+        start = pick_number * SHAFT_WORD_LEN
+        return self.shaft_word_table[start : start + SHAFT_WORD_LEN]
+
+    def get_current_shaft_bytes(self) -> bytes:
+        """Get the encoded shaft word for the current pick."""
+        return self.get_shaft_bytes(self.pick_number)
+
     def set_current_pick_number(self, pick_number: int) -> None:
         """Set pick_number.
 
@@ -142,7 +240,7 @@ def _smallest_shaft(shafts: set[int]) -> int:
 
 
 def reduced_pattern_from_pattern_data(
-    name: str, data: dtx_to_wif.PatternData
+    name: str, data: dtx_to_wif.PatternData, use_numpy: bool | None = None
 ) -> ReducedPattern:
     """Convert a dtx_to_wif.PatternData to a ReducedPattern.
 
@@ -153,13 +251,27 @@ def reduced_pattern_from_pattern_data(
         in PatternData).
     data : dtx_to_wif.PatternData
         The pattern read by dtx_to_wif.
+    use_numpy : bool | None
+        Use NumPy to compute which shafts are up in each pick?
+        If None, use it if it is installed (see HAVE_NUMPY);
+        True requires NumPy. The result is the same either way,
+        but NumPy is much faster for large patterns.
 
     The result is simpler and smaller, and can be sent to easily
     encoded and sent to javascript.
 
     Note that all input (PatternData) indices are 1-based
     and all output (ReducedPattern) indices are 0-based.
+
+    Raises
+    ------
+    ImportError
+        If use_numpy is True and NumPy is not installed.
     """
+    if use_numpy is None:
+        use_numpy = HAVE_NUMPY
+    elif use_numpy and not HAVE_NUMPY:
+        raise ImportError("use_numpy=True, but NumPy is not installed")
     if data.color_table:
         # Note: PatternData promises to have color_range
         # if color_table is present.
@@ -198,50 +310,230 @@ def reduced_pattern_from_pattern_data(
         data.weft_colors.get(weft, default_weft_color) - 1 for weft in wefts_from1
     ]
 
+    threading = [
+        _smallest_shaft(data.threading.get(warp, {0})) - 1 for warp in warps_from1
+    ]
+    shaft_word_table: bytes | None = None
+    if use_numpy:
+        are_shafts_up_list, shaft_word_table = _compute_shafts_up_with_numpy(
+            data=data, num_wefts=num_wefts
+        )
+    else:
+        are_shafts_up_list = _compute_shafts_up(data=data, num_wefts=num_wefts)
+    num_shafts = len(are_shafts_up_list[0])
+    # Note: Pick's fields are color, are_shafts_up
+    picks = list(map(Pick, weft_colors, are_shafts_up_list))
+
+    result = ReducedPattern(
+        color_table=color_strs,
+        name=name,
+        warp_colors=warp_colors,
+        threading=threading,
+        picks=picks,
+        pick0=Pick(are_shafts_up=[False] * num_shafts, color=default_weft_color),
+        compiled_shaft_words=shaft_word_table,
+    )
+    return result
+
+
+def _compute_shafts_up(
+    data: dtx_to_wif.PatternData, num_wefts: int
+) -> list[list[bool]]:
+    """Compute are_shafts_up for each pick of a pattern.
+
+    Parameters
+    ----------
+    data : dtx_to_wif.PatternData
+        The pattern read by dtx_to_wif.
+    num_wefts : int
+        The number of picks.
+
+    Raises
+    ------
+    RuntimeError
+        If no shafts are raised in any pick.
+    """
+    wefts_from1 = range(1, num_wefts + 1)
     if data.liftplan:
-        shaft_sets = list(data.liftplan.get(weft, {}) - {0} for weft in wefts_from1)  # type: ignore
+        shaft_sets = [data.liftplan.get(weft, set()) - {0} for weft in wefts_from1]
     else:
         shaft_sets = []
         for weft in wefts_from1:
-            treadle_set = data.treadling.get(weft, {}) - {0}  # type: ignore
+            treadle_set = data.treadling.get(weft, set()) - {0}
             shaft_sets.append(
-                set.union(*(data.tieup[treadle] for treadle in treadle_set)) - {0}
+                set().union(
+                    *(data.tieup.get(treadle, set()) for treadle in treadle_set)
+                )
+                - {0}
             )
-    if len(shaft_sets) != len(weft_colors):
-        raise RuntimeError(
-            f"{len(shaft_sets)=} != {len(weft_colors)=}\n{shaft_sets=}\n{weft_colors=}"
-        )
     try:
         num_shafts = max(max(shaft_set) for shaft_set in shaft_sets if shaft_set)
     except (ValueError, TypeError):
         raise RuntimeError("No shafts are raised")
-    threading = [
-        _smallest_shaft(data.threading.get(warp, {0})) - 1 for warp in warps_from1
-    ]
     shafts_from1 = list(range(1, num_shafts + 1))
     if data.is_rising_shed:
-        are_shafts_up_list = [
+        return [
             [shaft in shaft_set for shaft in shafts_from1] for shaft_set in shaft_sets
         ]
     else:
-        are_shafts_up_list = [
+        return [
             [shaft not in shaft_set for shaft in shafts_from1]
             for shaft_set in shaft_sets
         ]
-    picks = [
-        Pick(are_shafts_up=are_shafts_up, color=weft_color)
-        for are_shafts_up, weft_color in zip(are_shafts_up_list, weft_colors)
-    ]
 
-    result = ReducedPattern(
-        color_table=color_strs,
-        name=name,
-        warp_colors=warp_colors,
-        threading=threading,
-        picks=picks,
-        pick0=Pick(are_shafts_up=[False] * num_shafts, color=default_weft_color),
+
+def _compute_shafts_up_with_numpy(
+    data: dtx_to_wif.PatternData, num_wefts: int
+) -> tuple[list[list[bool]], bytes | None]:
+    """Compute are_shafts_up for each pick of a pattern, using NumPy.
+
+    The result is the same as _compute_shafts_up, but the work
+    is done on boolean matrices: the liftplan, or the treadling
+    times the tieup.
+
+    Parameters
+    ----------
+    data : dtx_to_wif.PatternData
+        The pattern read by dtx_to_wif.
+    num_wefts : int
+        The number of picks.
+
+    Returns
+    -------
+    are_shafts_up_list : list[list[bool]]
+        are_shafts_up for each pick.
+    shaft_word_table : bytes | None
+        shaft_word_table (see ReducedPattern), or None if there are
+        more than MAX_SHAFTS shafts.
+
+    Raises
+    ------
+    RuntimeError
+        If no shafts are raised in any pick.
+    """
+    # Index 0 means "none" (no treadle or no shaft), so drop it
+    if data.liftplan:
+        is_up = _to_matrix(data.liftplan, num_rows=num_wefts)[1:, 1:]
+    else:
+        is_treadled = _to_matrix(data.treadling, num_rows=num_wefts)[1:, 1:]
+        tieup = _to_matrix(data.tieup, num_rows=is_treadled.shape[1])[1:, 1:]
+        # Count the treadles that raise each shaft. Multiply as float32,
+        # which is much faster than bool and exact for these counts.
+        is_up = (is_treadled.astype(np.float32) @ tieup.astype(np.float32)) > 0
+    raised_shaft_indices = np.flatnonzero(is_up.any(axis=0))
+    if len(raised_shaft_indices) == 0:
+        raise RuntimeError("No shafts are raised")
+    num_shafts = int(raised_shaft_indices[-1]) + 1
+    is_up = is_up[:, :num_shafts]
+    if not data.is_rising_shed:
+        is_up = ~is_up
+
+    if num_shafts > MAX_SHAFTS:
+        # ReducedPattern rejects the pattern
+        return is_up.tolist(), None
+
+    # Pack the shafts of each pick into a shaft word
+    packed_shafts = np.zeros((num_wefts, SHAFT_WORD_LEN), dtype=np.uint8)
+    packed_shafts[:, : (num_shafts + 7) // 8] = np.packbits(
+        is_up, axis=1, bitorder="little"
+    )
+    shaft_words = packed_shafts.view("<u4")[:, 0]
+    shaft_word_table = np.concatenate(([0], shaft_words)).astype(">u4").tobytes()
+    return is_up.tolist(), shaft_word_table
+
+
+def _to_matrix(value_sets: dict[int, set[int]], num_rows: int) -> np.ndarray:
+    """Convert a dict of row: set of column indices to a boolean matrix.
+
+    Parameters
+    ----------
+    value_sets : dict[int, set[int]]
+        Dict of row index: set of column indices (both >= 0),
+        for example a liftplan: weft: set of shafts.
+        Rows greater than num_rows are ignored.
+    num_rows : int
+        The maximum row index; the matrix has num_rows + 1 rows
+        (row 0 is included, and missing rows are all False).
+        It has enough columns for the largest column index.
+    """
+    row_sets = list(
+        map(value_sets.get, range(num_rows + 1), itertools.repeat((), num_rows + 1))
+    )
+    lengths = np.fromiter(map(len, row_sets), dtype=np.intp, count=len(row_sets))
+    columns = np.fromiter(
+        itertools.chain.from_iterable(row_sets),
+        dtype=np.intp,
+        count=int(lengths.sum()),
+    )
+    matrix = np.zeros((len(row_sets), columns.max(initial=0) + 1), dtype=bool)
+    matrix[np.repeat(np.arange(len(row_sets)), lengths), columns] = True
+    return matrix
+
+
+def pattern_data_from_reduced_pattern(
+    pattern: ReducedPattern,
+) -> dtx_to_wif.PatternData:
+    """Convert a ReducedPattern to a dtx_to_wif.PatternData,
+    e.g. to write it as a WIF file.
+
+    The result has a liftplan (rather than a tieup and treadling)
+    and is a rising shed pattern. Reducing it again
+    with reduced_pattern_from_pattern_data gives back the pattern
+    (apart from pick_number and repeat_number), as long as
+    the pattern was reduced from a PatternData in the first place.
+
+    Raises
+    ------
+    ValueError
+        If a color in the color table is not of the form "#rrggbb".
+    """
+    color_table: dict[int, tuple[int, int, int]] = {}
+    for i, color_str in enumerate(pattern.color_table):
+        if len(color_str) != 7 or not color_str.startswith("#"):
+            raise ValueError(f"Cannot convert color {color_str!r} to r,g,b")
+        color_table[i + 1] = (
+            int(color_str[1:3], 16),
+            int(color_str[3:5], 16),
+            int(color_str[5:7], 16),
+        )
+    # Note that all output (PatternData) indices are 1-based,
+    # and 0 is used for "no shaft"
+    num_shafts = max(
+        len(pick.are_shafts_up) for pick in [pattern.pick0] + pattern.picks
+    )
+    return dtx_to_wif.PatternData(
+        name=pattern.name,
+        threading={
+            warp: {shaft + 1} for warp, shaft in enumerate(pattern.threading, start=1)
+        },
+        tieup={},
+        treadling={},
+        liftplan={
+            weft: {
+                shaft
+                for shaft, is_up in enumerate(pick.are_shafts_up, start=1)
+                if is_up
+            }
+            or {0}
+            for weft, pick in enumerate(pattern.picks, start=1)
+        },
+        color_table=color_table,
+        color_range=(0, 255),
+        warp=dtx_to_wif.WarpWeftData(
+            threads=len(pattern.threading), color=(pattern.warp_colors or [0])[0] + 1
+        ),
+        weft=dtx_to_wif.WarpWeftData(
+            threads=len(pattern.picks), color=pattern.pick0.color
+        ),
+        warp_colors={
+            warp: color + 1 for warp, color in enumerate(pattern.warp_colors, start=1)
+        },
+        weft_colors={
+            weft: pick.color + 1 for weft, pick in enumerate(pattern.picks, start=1)
+        },
+        num_shafts=num_shafts,
+        source_program="toika_loom_server",
     )
-    return result
 
 
 def read_full_pattern(path: pathlib.Path) -> dtx_to_wif.PatternData:
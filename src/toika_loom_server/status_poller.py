@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+__all__ = [
+    "DEFAULT_MAX_POLL_INTERVAL",
+    "STATUS_QUERY",
+    "STATUS_REPLY_PREFIX",
+    "StatusPoller",
+    "parse_status_reply",
+]
+
+import asyncio
+import collections.abc
+
+from .client_replies import LoomState
+from .loom_constants import TERMINATOR
+
+# Command that asks the loom for its state, and the prefix of the reply,
+# which is followed by the state word in hex, e.g. b"=s5".
+STATUS_QUERY = b"=s" + TERMINATOR
+STATUS_REPLY_PREFIX = b"=s"
+
+# Default maximum poll interval, which is used when the loom is idle
+# (seconds)
+DEFAULT_MAX_POLL_INTERVAL = 60
+
+
+def parse_status_reply(reply: bytes) -> int | None:
+    """Parse a status reply (without terminator).
+
+    Return the state word, or None if reply is not a valid status reply.
+    """
+    if not reply.startswith(STATUS_REPLY_PREFIX):
+        return None
+    try:
+        return int(reply[len(STATUS_REPLY_PREFIX) :], 16)
+    except ValueError:
+        return None
+
+
+class StatusPoller:
+    """Poll the loom's state, adapting the rate to weaving activity.
+
+    The poll interval starts at min_interval. Each poll with no activity
+    (picks or state changes) since the previous poll doubles the interval,
+    up to max_interval, so an idle loom is rarely polled. Any activity
+    resets the interval to min_interval.
+
+    Polling never delays a pick: `write_query` should only write the query
+    if nothing else is waiting to be written, and return False otherwise,
+    in which case the poll is skipped. Picks are written as soon as
+    the loom asks for them, so the query can delay a pick by at most
+    the time to transmit the query itself.
+
+    Must be constructed and used in the event loop
+    that communicates with the loom.
+
+    Parameters
+    ----------
+    write_query : collections.abc.Callable[[], bool]
+        Function that writes STATUS_QUERY to the loom, if idle.
+        Returns True if the query was written.
+    state_callback : collections.abc.Callable[[LoomState], None]
+        Function to call with the new state, when the state changes.
+    min_interval : float
+        Poll interval when weaving (seconds). Must be positive.
+    max_interval : float
+        Poll interval when idle (seconds). Must be >= min_interval.
+    """
+
+    def __init__(
+        self,
+        write_query: collections.abc.Callable[[], bool],
+        state_callback: collections.abc.Callable[[LoomState], None],
+        min_interval: float,
+        max_interval: float = DEFAULT_MAX_POLL_INTERVAL,
+    ) -> None:
+        if min_interval <= 0:
+            raise ValueError(f"{min_interval=} must be positive")
+        if max_interval < min_interval:
+            raise ValueError(f"{max_interval=} must be >= {min_interval=}")
+        self.write_query = write_query
+        self.state_callback = state_callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.state_word: int | None = None
+        self.num_polls = 0
+        self.active = False
+        self.activity_event = asyncio.Event()
+        self.poll_task: asyncio.Future = asyncio.Future()
+
+    def start(self) -> None:
+        """Start (or restart) polling."""
+        self.poll_task.cancel()
+        self.state_word = None
+        self.interval = self.min_interval
+        self.poll_task = asyncio.create_task(self.poll_loop())
+
+    def stop(self) -> None:
+        """Stop polling."""
+        self.poll_task.cancel()
+
+    def handle_state_word(self, state_word: int) -> None:
+        """Handle a state word read from the loom.
+
+        Call state_callback if the state word changed.
+        """
+        if state_word == self.state_word:
+            return
+        self.state_word = state_word
+        self.note_activity()
+        self.state_callback(LoomState.from_state_word(state_word))
+
+    def note_activity(self) -> None:
+        """Note weaving activity, e.g. a pick request.
+
+        Resets the poll interval to min_interval.
+        """
+        self.active = True
+        if self.interval > self.min_interval:
+            self.interval = self.min_interval
+            # Wake poll_loop to shorten the current wait
+            self.activity_event.set()
+
+    async def poll_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        # Poll at once, to learn the initial state
+        last_poll_time = loop.time() - self.interval
+        while True:
+            self.activity_event.clear()
+            try:
+                async with asyncio.timeout_at(last_poll_time + self.interval):
+                    await self.activity_event.wait()
+                # The interval was shortened; wait again.
+                continue
+            except TimeoutError:
+                pass
+            last_poll_time = loop.time()
+            if self.write_query():
+                self.num_polls += 1
+            if self.active:
+                self.active = False
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
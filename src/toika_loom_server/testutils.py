@@ -1,8 +1,9 @@
-__all__ = ["create_test_client"]
+__all__ = ["create_test_client", "read_initial_replies"]
 
 import collections.abc
 import contextlib
 import pathlib
+import random
 import sys
 import tempfile
 from types import SimpleNamespace
@@ -34,6 +35,11 @@ def create_test_client(
     db_path: pathlib.Path | str | None = None,
     expected_pattern_names: collections.abc.Iterable[str] = (),
     expected_current_pattern: ReducedPattern | None = None,
+    loom_thread: bool = False,
+    serial_port: str = "mock",
+    status_poll_interval: float = 0,
+    extra_serial_ports: collections.abc.Iterable[str] = (),
+    loom_id: str | None = None,
 ) -> collections.abc.Generator[tuple[TestClient, WebSocketType], None]:
     """Create a test server, client, websocket. Return (client, websocket).
 
@@ -56,12 +62,27 @@ def create_test_client(
     expected_current_pattern : ReducedPattern | None
         Expected_current_pattern. Specify if and only if db_path is not None
         and you expect the database to contain any patterns.
+    loom_thread : bool
+        Specify argument --loom-thread?
+    serial_port : str
+        Serial port argument, e.g. "driver:socket_path" to use a loom driver.
+    status_poll_interval : float
+        --status-poll-interval argument value. If nonzero then
+        LoomState messages are ignored while reading the initial state.
+    extra_serial_ports : collections.abc.Iterable[str]
+        Additional serial port arguments, e.g. "b=mock", to run several looms.
+    loom_id : str | None
+        ID of the loom to connect the websocket to; if None then use "/ws".
     """
     expected_pattern_names = list(expected_pattern_names)
     with tempfile.NamedTemporaryFile() as f:
-        argv = ["testutils", "mock", "--verbose"]
+        argv = ["testutils", serial_port, *extra_serial_ports, "--verbose"]
         if reset_db:
             argv.append("--reset-db")
+        if loom_thread:
+            argv.append("--loom-thread")
+        if status_poll_interval:
+            argv += ["--status-poll-interval", str(status_poll_interval)]
         if db_path is None:
             argv += ["--db-path", f.name]
         else:
@@ -69,77 +90,169 @@ def create_test_client(
         sys.argv = argv
 
         with TestClient(main.app) as client:
-            with client.websocket_connect("/ws") as websocket:
+            ws_path = "/ws" if loom_id is None else f"/loom/{loom_id}/ws"
+            with client.websocket_connect(ws_path) as websocket:
 
                 if read_initial_state:
-                    seen_types: set[str] = set()
-                    expected_types = {
-                        "JumpPickNumber",
-                        "LoomConnectionState",
-                        "PatternNames",
-                        "WeaveDirection",
-                    }
-                    if expected_current_pattern:
-                        expected_types |= {"ReducedPattern", "CurrentPickNumber"}
-                    good_connection_states = {
-                        ConnectionStateEnum.CONNECTING,
-                        ConnectionStateEnum.CONNECTED,
-                    }
-                    while True:
-                        reply_dict = receive_dict(websocket)
-                        reply = SimpleNamespace(**reply_dict)
-                        match reply.type:
-                            case "LoomConnectionState":
-                                if reply.state not in good_connection_states:
-                                    raise AssertionError(
-                                        f"Unexpected state in {reply=}; "
-                                        f"should be in {good_connection_states}"
-                                    )
-                                elif reply.state != ConnectionStateEnum.CONNECTED:
-                                    continue
-                            case "PatternNames":
-                                assert reply.names == expected_pattern_names
-                            case "ReducedPattern":
-                                if not expected_pattern_names:
-                                    raise AssertionError(
-                                        f"Unexpected message type {reply.type} "
-                                        "because expected_current_pattern is None"
-                                    )
-
-                                assert reply.name == expected_pattern_names[-1]
-                            case "CurrentPickNumber":
-                                assert expected_current_pattern is not None
-                                assert (
-                                    reply.pick_number
-                                    == expected_current_pattern.pick_number
-                                )
-                                assert (
-                                    reply.repeat_number
-                                    == expected_current_pattern.repeat_number
-                                )
-                            case "JumpPickNumber":
-                                assert reply.pick_number is None
-                                assert reply.repeat_number is None
-                            case "WeaveDirection":
-                                assert reply.forward
-                            case _:
-                                raise AssertionError(
-                                    f"Unexpected message type {reply.type}"
-                                )
-                        seen_types.add(reply.type)
-                        if seen_types == expected_types:
-                            break
+                    read_initial_replies(
+                        websocket=websocket,
+                        expected_pattern_names=expected_pattern_names,
+                        expected_current_pattern=expected_current_pattern,
+                        status_poll_interval=status_poll_interval,
+                    )
 
                 expected_names: list[str] = []
                 for path in upload_patterns:
                     expected_names.append(path.name)
                     upload_pattern(websocket, path)
                     reply_dict = receive_dict(websocket)
-                    assert reply_dict == dict(type="PatternNames", names=expected_names)
+                    assert reply_dict["type"] == "PatternNames"
+                    assert reply_dict["names"] == expected_names
 
                 yield (client, websocket)
 
 
+def read_initial_replies(
+    websocket: WebSocketType,
+    expected_pattern_names: list[str],
+    expected_current_pattern: ReducedPattern | None,
+    status_poll_interval: float = 0,
+) -> None:
+    """Read and check the replies sent when a client connects.
+
+    Parameters
+    ----------
+    websocket : WebSocketType
+        Newly connected websocket.
+    expected_pattern_names : list[str]
+        Expected pattern names.
+    expected_current_pattern : ReducedPattern | None
+        Expected current pattern, if any.
+    status_poll_interval : float
+        If nonzero then ignore LoomState messages.
+    """
+    seen_types: set[str] = set()
+    expected_types = {
+        "JumpPickNumber",
+        "LoomConnectionState",
+        "PatternNames",
+        "WeaveDirection",
+    }
+    if expected_current_pattern:
+        expected_types |= {"ReducedPattern", "CurrentPickNumber"}
+    good_connection_states = {
+        ConnectionStateEnum.CONNECTING,
+        ConnectionStateEnum.CONNECTED,
+    }
+    while True:
+        reply_dict = receive_dict(websocket)
+        reply = SimpleNamespace(**reply_dict)
+        match reply.type:
+            case "LoomConnectionState":
+                if reply.state not in good_connection_states:
+                    raise AssertionError(
+                        f"Unexpected state in {reply=}; "
+                        f"should be in {good_connection_states}"
+                    )
+                elif reply.state != ConnectionStateEnum.CONNECTED:
+                    continue
+            case "PatternNames":
+                assert reply.names == expected_pattern_names
+            case "ReducedPattern":
+                if not expected_pattern_names:
+                    raise AssertionError(
+                        f"Unexpected message type {reply.type} "
+                        "because expected_current_pattern is None"
+                    )
+
+                assert reply.name == expected_pattern_names[-1]
+            case "CurrentPickNumber":
+                assert expected_current_pattern is not None
+                assert reply.pick_number == expected_current_pattern.pick_number
+                assert reply.repeat_number == expected_current_pattern.repeat_number
+            case "JumpPickNumber":
+                assert reply.pick_number is None
+                assert reply.repeat_number is None
+            case "WeaveDirection":
+                assert reply.forward
+            case "LoomState" if status_poll_interval:
+                continue
+            case _:
+                raise AssertionError(f"Unexpected message type {reply.type}")
+        seen_types.add(reply.type)
+        if seen_types == expected_types:
+            break
+
+
+def create_liftplan_wif(
+    num_picks: int, num_shafts: int = 24, num_ends: int = 1000, seed: int = 0
+) -> str:
+    """Create a WIF file for a random liftplan, e.g. to test large patterns.
+
+    Each shaft is lifted in half the picks, at random,
+    so the file is roughly num_picks * num_shafts * 1.6 bytes long.
+
+    Parameters
+    ----------
+    num_picks : int
+        The number of picks.
+    num_shafts : int
+        The number of shafts.
+    num_ends : int
+        The number of warp threads.
+    seed : int
+        Seed for the random shaft lifts.
+    """
+    rng = random.Random(seed)
+    lines = [
+        "[WIF]",
+        "Version=1.1",
+        "Date=April 20, 1997",
+        "Developers=wif@mhsoft.com",
+        "Source Program=toika_loom_server testutils",
+        "",
+        "[CONTENTS]",
+        "COLOR PALETTE=true",
+        "WEAVING=true",
+        "WARP=true",
+        "WEFT=true",
+        "COLOR TABLE=true",
+        "THREADING=true",
+        "LIFTPLAN=true",
+        "",
+        "[WEAVING]",
+        "Rising Shed=true",
+        f"Treadles={num_shafts}",
+        f"Shafts={num_shafts}",
+        "",
+        "[WARP]",
+        f"Threads={num_ends}",
+        "Color=1",
+        "",
+        "[WEFT]",
+        f"Threads={num_picks}",
+        "Color=2",
+        "",
+        "[COLOR TABLE]",
+        "1=255,255,255",
+        "2=255,0,0",
+        "",
+        "[COLOR PALETTE]",
+        "Range=0,255",
+        "Entries=2",
+        "",
+        "[THREADING]",
+    ]
+    lines += [f"{end}={(end - 1) % num_shafts + 1}" for end in range(1, num_ends + 1)]
+    lines += ["", "[LIFTPLAN]"]
+    for pick in range(1, num_picks + 1):
+        shafts = [
+            str(shaft) for shaft in range(1, num_shafts + 1) if rng.random() < 0.5
+        ]
+        lines.append(f"{pick}={','.join(shafts or ['1'])}")
+    return "\n".join(lines) + "\n"
+
+
 def upload_pattern(websocket: WebSocketType, filepath: pathlib.Path) -> None:
     with open(filepath, "r") as f:
         data = f.read()
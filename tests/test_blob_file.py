@@ -0,0 +1,74 @@
+import pathlib
+import tempfile
+
+import pytest
+
+from toika_loom_server.blob_file import BlobFile
+
+
+def test_append_and_read() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = pathlib.Path(tempdir) / "blobs"
+        blob_file = BlobFile(path)
+        assert blob_file.size == 0
+        assert not path.exists()
+        assert blob_file.read(offset=0, length=0) == b""
+
+        blobs = [b"first blob", b"", b"\x00\xff" * 1000]
+        offsets = [blob_file.append(blob) for blob in blobs]
+        assert offsets == [0, 10, 10]
+        assert blob_file.size == sum(len(blob) for blob in blobs)
+        views = [
+            blob_file.read(offset=offset, length=len(blob))
+            for offset, blob in zip(offsets, blobs)
+        ]
+        for view, blob in zip(views, blobs):
+            assert isinstance(view, memoryview)
+            assert view.readonly
+            assert view == blob
+
+        # Blobs appended after the file is mapped can be read,
+        # and older views remain valid
+        offset = blob_file.append(b"later blob")
+        assert blob_file.read(offset=offset, length=10) == b"later blob"
+        assert views[0] == blobs[0]
+
+        # Another BlobFile sees the same blobs
+        assert BlobFile(path).read(offset=offsets[2], length=2000) == blobs[2]
+
+        blob_file.close()
+        assert views[2] == blobs[2]
+        assert blob_file.read(offset=0, length=10) == blobs[0]
+
+
+def test_read_out_of_range() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        blob_file = BlobFile(pathlib.Path(tempdir) / "blobs")
+        with pytest.raises(ValueError):
+            blob_file.read(offset=0, length=1)
+        blob_file.append(b"abc")
+        for offset, length in ((0, 4), (3, 1), (-1, 1), (0, -1)):
+            with pytest.raises(ValueError):
+                blob_file.read(offset=offset, length=length)
+        assert blob_file.read(offset=3, length=0) == b""
+
+
+def test_append_all_and_replace() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = pathlib.Path(tempdir) / "blobs"
+        blob_file = BlobFile(path)
+        blobs = [b"first blob", b"", b"third"]
+        offsets = blob_file.append_all(blobs)
+        assert offsets == [0, 10, 10]
+        assert blob_file.append_all([]) == []
+        view = blob_file.read(offset=0, length=10)
+
+        # Copy a blob (from a memoryview) to a new file, and replace
+        # the file with it; existing views remain valid
+        new_blob_file = BlobFile(pathlib.Path(tempdir) / "new_blobs")
+        assert new_blob_file.append_all([blob_file.read(offset=10, length=5)]) == [0]
+        blob_file.replace(new_blob_file.path)
+        assert not new_blob_file.path.exists()
+        assert blob_file.size == 5
+        assert view == blobs[0]
+        assert blob_file.read(offset=0, length=5) == b"third"
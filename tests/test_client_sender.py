@@ -0,0 +1,133 @@
+import asyncio
+from typing import Any
+
+from toika_loom_server.client_sender import ClientSender
+
+
+class ClosedWebSocket:
+    """A fake websocket whose send_json fails, as if the client is gone."""
+
+    async def send_json(self, data: dict[str, Any]) -> None:
+        raise RuntimeError("websocket is closed")
+
+
+class SlowWebSocket:
+    """A fake websocket whose send_json waits until allowed to proceed."""
+
+    def __init__(self) -> None:
+        self.sent: list[dict[str, Any]] = []
+        self.allow_send = asyncio.Event()
+
+    async def send_json(self, data: dict[str, Any]) -> None:
+        await self.allow_send.wait()
+        self.sent.append(data)
+
+
+def pick_message(pick_number: int) -> dict[str, Any]:
+    return dict(type="CurrentPickNumber", pick_number=pick_number, repeat_number=1)
+
+
+def problem_message(i: int) -> dict[str, Any]:
+    return dict(type="CommandProblem", message=f"problem {i}", severity=2)
+
+
+async def test_coalesce() -> None:
+    websocket = SlowWebSocket()
+    sender = ClientSender(websocket)  # type: ignore[arg-type]
+    try:
+        # The first message is taken by the send task before it blocks.
+        sender.send(pick_message(0))
+        await asyncio.sleep(0)
+        for pick_number in range(1, 5):
+            sender.send(pick_message(pick_number))
+            sender.send(problem_message(pick_number))
+        sender.send(dict(type="WeaveDirection", forward=False))
+        assert sender.stats.queue_depth == 6
+        assert sender.stats.num_coalesced == 3
+
+        websocket.allow_send.set()
+        await sender.flush(timeout=1)
+        # Each coalesced message is sent at the position of the latest one.
+        assert websocket.sent == [pick_message(0)] + [
+            problem_message(i) for i in range(1, 4)
+        ] + [
+            pick_message(4),
+            problem_message(4),
+            dict(type="WeaveDirection", forward=False),
+        ]
+        assert sender.stats.num_sent == 7
+        assert sender.stats.queue_depth == 0
+        assert sender.stats.max_queue_depth == 6
+        assert sender.stats.num_dropped == 0
+        assert sender.stats.max_latency >= sender.stats.mean_latency > 0
+    finally:
+        await sender.close()
+
+
+def page_message(i: int) -> dict[str, Any]:
+    return dict(type="PatternPage", names=[f"pattern {i}"])
+
+
+async def test_queue_full() -> None:
+    websocket = SlowWebSocket()
+    sender = ClientSender(websocket, max_queue_size=3)  # type: ignore[arg-type]
+    try:
+        sender.send(problem_message(0))
+        await asyncio.sleep(0)
+        sender.send(page_message(1))
+        sender.send(pick_message(1))
+        sender.send(problem_message(1))
+        # The queue is full, so the oldest droppable message is dropped
+        sender.send(dict(type="WeaveDirection", forward=True))
+        assert sender.stats.num_dropped == 1
+        # Coalesced and problem messages are never dropped
+        sender.send(page_message(2))
+        sender.send(dict(type="JumpPickNumber", pick_number=None, repeat_number=None))
+        for i in range(2, 4):
+            sender.send(problem_message(i))
+        assert sender.stats.num_dropped == 2
+        assert sender.stats.queue_depth == 6
+
+        websocket.allow_send.set()
+        await sender.flush(timeout=1)
+        assert websocket.sent == [
+            problem_message(0),
+            pick_message(1),
+            problem_message(1),
+            dict(type="WeaveDirection", forward=True),
+            dict(type="JumpPickNumber", pick_number=None, repeat_number=None),
+            problem_message(2),
+            problem_message(3),
+        ]
+    finally:
+        await sender.close()
+
+
+async def test_close() -> None:
+    websocket = SlowWebSocket()
+    sender = ClientSender(websocket)  # type: ignore[arg-type]
+    assert sender.is_running
+    sender.send(pick_message(1))
+    await sender.close()
+    await asyncio.sleep(0)
+    assert not sender.is_running
+    assert sender.stats.queue_depth == 0
+    assert not sender.send(problem_message(1))
+    assert sender.stats.queue_depth == 0
+
+
+async def test_send_fails() -> None:
+    sender = ClientSender(ClosedWebSocket())  # type: ignore[arg-type]
+    try:
+        assert sender.send(problem_message(0))
+        await sender.flush(timeout=1)
+        await asyncio.sleep(0)
+        assert not sender.is_running
+        # Nothing is queued once the send task has stopped
+        for i in range(1, 5):
+            assert not sender.send(problem_message(i))
+            assert not sender.send(pick_message(i))
+        assert sender.stats.queue_depth == 0
+        assert not sender.queue
+    finally:
+        await sender.close()
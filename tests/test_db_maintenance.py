@@ -0,0 +1,159 @@
+import asyncio
+import copy
+import pathlib
+import tempfile
+
+import pytest
+
+from toika_loom_server import db_maintenance
+from toika_loom_server.db_maintenance import MAINTENANCE_TASKS, DatabaseMaintenance
+from toika_loom_server.pattern_database import (
+    BODY_STORES,
+    PatternDatabase,
+    get_blob_path,
+)
+from toika_loom_server.reduced_pattern import (
+    ReducedPattern,
+    read_full_pattern,
+    reduced_pattern_from_pattern_data,
+)
+
+datadir = pathlib.Path(__file__).parent / "data"
+
+
+def make_patterns(num_patterns: int) -> list[ReducedPattern]:
+    """Make patterns with different content."""
+    path = next(iter(datadir.glob("*.wif")))
+    base_pattern = reduced_pattern_from_pattern_data(
+        name=path.name, data=read_full_pattern(path)
+    )
+    patterns = []
+    for i in range(num_patterns):
+        pattern = copy.copy(base_pattern)
+        pattern.name = f"pattern {i}"
+        pattern.color_table = base_pattern.color_table + [f"color {i}"] * 100
+        patterns.append(pattern)
+    return patterns
+
+
+async def test_run_cycle(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(db_maintenance, "VACUUM_PAGES_PER_SLICE", 2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            for pattern in make_patterns(100):
+                await db.add_pattern(pattern)
+            await db.clear_database()
+            file_size = dbpath.stat().st_size
+
+            maintenance = DatabaseMaintenance(
+                pattern_db=db, is_idle=lambda idle_time: True
+            )
+            await maintenance.run_cycle()
+            stats = maintenance.get_stats()
+            assert stats["num_cycles"] == 1
+            assert stats["check_result"] == "ok"
+            assert stats["num_checks_abandoned"] == 0
+            assert stats["db_bytes"] == await db.get_size()
+            assert stats["db_disk_bytes"] == db.get_disk_size()
+            assert set(stats["slice_durations"]) == set(MAINTENANCE_TASKS)
+            # There is no size budget, so nothing to prune
+            assert stats["slice_durations"]["prune"]["num_values"] == 0
+            # Free pages are returned in several slices
+            assert stats["slice_durations"]["vacuum"]["num_values"] > 1
+            for task in ("compact", "checkpoint", "optimize", "quick_check"):
+                assert stats["slice_durations"][task]["num_values"] == 1
+            assert await db.incremental_vacuum(max_pages=1) == 0
+            assert dbpath.stat().st_size < file_size
+
+
+@pytest.mark.parametrize("body_store", BODY_STORES)
+async def test_size_budget(body_store: str, caplog: pytest.LogCaptureFixture) -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath, body_store=body_store) as db:
+            patterns = make_patterns(50)
+            for pattern in patterns:
+                await db.add_pattern(pattern)
+            full_size = await db.get_size()
+            blob_path = get_blob_path(dbpath)
+            full_blob_size = blob_path.stat().st_size if body_store == "mmap" else 0
+            min_size = await db.get_min_size()
+
+            # The two most recent patterns are always kept, so a budget
+            # they do not fit in is not pursued
+            maintenance = DatabaseMaintenance(
+                pattern_db=db, is_idle=lambda idle_time: True, max_db_bytes=1
+            )
+            await maintenance.run_cycle()
+            assert len(await db.get_pattern_names()) == 50
+            assert maintenance.get_stats()["num_patterns_pruned"] == 0
+            assert "cannot meet the size budget" in caplog.text
+
+            max_db_bytes = (full_size + min_size) // 2
+            maintenance = DatabaseMaintenance(
+                pattern_db=db,
+                is_idle=lambda idle_time: True,
+                max_db_bytes=max_db_bytes,
+            )
+            await maintenance.run_cycle()
+            # The least recently used patterns are deleted
+            names = await db.get_pattern_names()
+            assert 2 < len(names) < 50
+            assert names == [pattern.name for pattern in patterns[-len(names) :]]
+            stats = maintenance.get_stats()
+            assert stats["num_patterns_pruned"] == 50 - len(names)
+            assert stats["slice_durations"]["prune"]["num_values"] > 1
+            assert stats["db_bytes"] <= max_db_bytes
+            assert stats["db_disk_bytes"] == db.get_disk_size()
+            if body_store == "mmap":
+                # The deleted patterns' space in the blob file is reclaimed
+                assert stats["slice_durations"]["compact"]["num_values"] == 1
+                assert blob_path.stat().st_size < full_blob_size
+            for pattern in patterns[-len(names) :]:
+                assert await db.get_pattern(pattern.name) == pattern
+
+
+async def test_wait_for_idle() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            idle_times: list[float] = []
+            is_idle = False
+
+            def get_is_idle(idle_time: float) -> bool:
+                idle_times.append(idle_time)
+                return is_idle
+
+            with pytest.raises(ValueError):
+                DatabaseMaintenance(pattern_db=db, is_idle=get_is_idle, interval=0)
+            maintenance = DatabaseMaintenance(
+                pattern_db=db,
+                is_idle=get_is_idle,
+                interval=0.05,
+                idle_time=30,
+                idle_poll_interval=0.01,
+            )
+            maintenance.start()
+            try:
+                # Nothing runs while the loom is active
+                await asyncio.sleep(0.05)
+                assert len(idle_times) > 1
+                assert set(idle_times) == {30}
+                assert maintenance.num_cycles == 0
+                for histogram in maintenance.slice_durations.values():
+                    assert histogram.num_values == 0
+
+                # Cycles run when the loom is idle
+                is_idle = True
+                await asyncio.sleep(0.2)
+                assert maintenance.num_cycles > 1
+
+                # Cycles stop running when the loom is active
+                is_idle = False
+                await asyncio.sleep(0.1)
+                num_cycles = maintenance.num_cycles
+                await asyncio.sleep(0.1)
+                assert maintenance.num_cycles == num_cycles
+            finally:
+                maintenance.stop()
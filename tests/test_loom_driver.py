@@ -0,0 +1,250 @@
+import asyncio
+import dataclasses
+import json
+import pathlib
+import random
+import socket
+import stat
+import tempfile
+
+import pytest
+
+from toika_loom_server import loom_driver
+from toika_loom_server.client_replies import JumpPickNumber, MessageSeverityEnum
+from toika_loom_server.loom_driver import (
+    DEFAULT_DRIVER_SOCKET_PATH,
+    DriverClient,
+    LoomDriver,
+    get_driver_socket_path,
+)
+from toika_loom_server.pick_pipeline import PreparedPick
+from toika_loom_server.reduced_pattern import (
+    Pick,
+    ReducedPattern,
+    read_full_pattern,
+    reduced_pattern_from_pattern_data,
+)
+
+datadir = pathlib.Path(__file__).parent / "data"
+
+
+def read_reduced_pattern(path: pathlib.Path) -> ReducedPattern:
+    full_pattern = read_full_pattern(path)
+    return reduced_pattern_from_pattern_data(name=path.name, data=full_pattern)
+
+
+class DriverClientRecorder:
+    """Create a DriverClient and record what it reports."""
+
+    def __init__(self, socket_path: pathlib.Path) -> None:
+        self.picks: asyncio.Queue[PreparedPick] = asyncio.Queue()
+        self.problems: list[tuple[str, MessageSeverityEnum]] = []
+        self.connection_lost: list[Exception | None] = []
+        self.client = DriverClient(
+            socket_path=socket_path,
+            pick_callback=self.picks.put_nowait,
+            problem_callback=self.handle_problem,
+            connection_lost_callback=self.connection_lost.append,
+        )
+
+    def handle_problem(self, message: str, severity: MessageSeverityEnum) -> None:
+        self.problems.append((message, severity))
+
+
+def test_get_driver_socket_path() -> None:
+    assert get_driver_socket_path("mock") is None
+    assert get_driver_socket_path("/dev/tty0") is None
+    assert get_driver_socket_path("driver") == DEFAULT_DRIVER_SOCKET_PATH
+    assert get_driver_socket_path("driver:/tmp/foo.sock") == pathlib.Path(
+        "/tmp/foo.sock"
+    )
+
+
+async def test_weave_without_web_server() -> None:
+    pattern = read_reduced_pattern(next(datadir.glob("*.wif")))
+    with tempfile.TemporaryDirectory() as tempdir:
+        socket_path = pathlib.Path(tempdir) / "driver.sock"
+        async with LoomDriver(serial_port="mock", socket_path=socket_path) as driver:
+            assert driver.loom_connected
+            assert driver.mock_loom is not None
+
+            recorder = DriverClientRecorder(socket_path=socket_path)
+            await recorder.client.connect()
+            assert recorder.client.is_connected
+            assert recorder.client.state["pattern_name"] is None
+            assert recorder.client.state["weave_forward"]
+
+            recorder.client.send_pattern(pattern)
+            recorder.client.send_jump_pick(
+                JumpPickNumber(pick_number=3, repeat_number=None)
+            )
+            # Wait for the driver to read the messages
+            await asyncio.sleep(0.05)
+            await driver.mock_loom.request_next_pick()
+            async with asyncio.timeout(1):
+                prepared_pick = await recorder.picks.get()
+            assert prepared_pick.pattern_name == pattern.name
+            assert prepared_pick.pick_number == 3
+            assert prepared_pick.is_jump
+            assert prepared_pick.cmdbytes[:-1] == pattern.get_shaft_bytes(3)
+
+            # The driver keeps weaving after the web server disconnects
+            recorder.client.close()
+            await asyncio.sleep(0.05)
+            assert recorder.connection_lost == []
+            for _ in range(2):
+                await driver.mock_loom.request_next_pick()
+                await asyncio.sleep(0.01)
+            assert driver.pick_pipeline.pattern is not None
+            assert driver.pick_pipeline.pattern.pick_number == 5
+
+            # A new web server gets the driver's state
+            recorder = DriverClientRecorder(socket_path=socket_path)
+            await recorder.client.connect()
+            assert recorder.client.state["pattern_name"] == pattern.name
+            assert recorder.client.state["pick_number"] == 5
+            assert recorder.client.state["repeat_number"] == 1
+
+            # An invalid loom reply is reported as a problem
+            await driver.mock_loom.reply("3")
+            await asyncio.sleep(0.05)
+            assert len(recorder.problems) == 1
+            assert recorder.problems[0][1] == MessageSeverityEnum.WARNING
+            assert recorder.picks.empty()
+
+        # Closing the driver closes the connection to the web server
+        await asyncio.sleep(0.05)
+        assert len(recorder.connection_lost) == 1
+        assert not recorder.client.is_connected
+
+
+async def test_reconnect_to_loom() -> None:
+    pattern = read_reduced_pattern(next(datadir.glob("*.wif")))
+    with tempfile.TemporaryDirectory() as tempdir:
+        socket_path = pathlib.Path(tempdir) / "driver.sock"
+        async with LoomDriver(serial_port="mock", socket_path=socket_path) as driver:
+            driver.pick_pipeline.set_pattern(pattern)
+            old_mock_loom = driver.mock_loom
+            assert driver.loom_protocol is not None
+            assert old_mock_loom is not None
+
+            # Lose the connection to the loom, with no web server connected;
+            # the driver should reconnect on its own.
+            driver.loom_protocol.close()
+            await asyncio.sleep(0)
+            assert not driver.loom_connected
+            async with asyncio.timeout(2):
+                while not driver.loom_connected:
+                    await asyncio.sleep(0.01)
+            assert driver.mock_loom is not None
+            assert driver.mock_loom is not old_mock_loom
+
+            # Weaving resumes where it left off
+            await driver.mock_loom.request_next_pick()
+            await asyncio.sleep(0.05)
+            assert driver.pick_pipeline.pattern is not None
+            assert driver.pick_pipeline.pattern.pick_number == 1
+
+
+async def test_connect_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(loom_driver, "DRIVER_STATE_TIMEOUT", 0.1)
+    # A "driver" that reads messages, but never replies
+    eof_event = asyncio.Event()
+
+    async def handle_client(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        while await reader.readline():
+            pass
+        eof_event.set()
+        writer.close()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        socket_path = pathlib.Path(tempdir) / "driver.sock"
+        server = await asyncio.start_unix_server(handle_client, path=socket_path)
+        try:
+            recorder = DriverClientRecorder(socket_path=socket_path)
+            with pytest.raises(TimeoutError):
+                await recorder.client.connect()
+            assert not recorder.client.is_connected
+            # The connection to the driver was closed
+            assert recorder.client.writer is not None
+            assert recorder.client.writer.is_closing()
+            async with asyncio.timeout(1):
+                await eof_event.wait()
+        finally:
+            server.close()
+
+
+def create_large_pattern(num_picks: int, num_shafts: int) -> ReducedPattern:
+    rng = random.Random(0)
+
+    def random_pick() -> Pick:
+        return Pick(
+            color=rng.randrange(2),
+            are_shafts_up=[rng.random() < 0.5 for _ in range(num_shafts)],
+        )
+
+    return ReducedPattern(
+        name="large.wif",
+        color_table=["#ffffff", "#000000"],
+        warp_colors=[0] * 200,
+        threading=[i % num_shafts for i in range(200)],
+        picks=[random_pick() for _ in range(num_picks)],
+        pick0=Pick(color=0, are_shafts_up=[False] * num_shafts),
+        pick_number=100,
+    )
+
+
+async def test_large_pattern() -> None:
+    pattern = create_large_pattern(num_picks=20000, num_shafts=24)
+    # Much too long for a stream with the default limit (64 kB)
+    assert len(json.dumps(dataclasses.asdict(pattern))) > 1000 * 1024
+    with tempfile.TemporaryDirectory() as tempdir:
+        socket_path = pathlib.Path(tempdir) / "driver.sock"
+        async with LoomDriver(serial_port="mock", socket_path=socket_path) as driver:
+            recorder = DriverClientRecorder(socket_path=socket_path)
+            await recorder.client.connect()
+            recorder.client.send_pattern(pattern)
+            async with asyncio.timeout(5):
+                while driver.pick_pipeline.pattern is None:
+                    await asyncio.sleep(0.01)
+            assert driver.pick_pipeline.pattern == pattern
+            assert recorder.client.is_connected
+
+            assert driver.mock_loom is not None
+            await driver.mock_loom.request_next_pick()
+            async with asyncio.timeout(1):
+                prepared_pick = await recorder.picks.get()
+            assert prepared_pick.pick_number == 101
+            assert prepared_pick.cmdbytes[:-1] == pattern.get_shaft_bytes(101)
+
+
+async def test_socket_access() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        socket_path = pathlib.Path(tempdir) / "driver.sock"
+        async with LoomDriver(serial_port="mock", socket_path=socket_path):
+            # Only the user running the driver may connect
+            assert stat.S_IMODE(socket_path.stat().st_mode) == 0o600
+
+            recorder = DriverClientRecorder(socket_path=socket_path)
+            await recorder.client.connect()
+
+            # A second driver refuses to take over the socket,
+            # without disturbing the connected web server
+            with pytest.raises(RuntimeError):
+                await LoomDriver(serial_port="mock", socket_path=socket_path).start()
+            await asyncio.sleep(0.05)
+            assert socket_path.exists()
+            assert recorder.client.is_connected
+            assert recorder.connection_lost == []
+        assert not socket_path.exists()
+
+        # A stale socket (whose driver is gone) is replaced
+        with socket.socket(socket.AF_UNIX) as stale_socket:
+            stale_socket.bind(str(socket_path))
+        assert socket_path.exists()
+        async with LoomDriver(serial_port="mock", socket_path=socket_path):
+            recorder = DriverClientRecorder(socket_path=socket_path)
+            await recorder.client.connect()
+            assert recorder.client.is_connected
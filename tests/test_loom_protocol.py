@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+
+from toika_loom_server.loom_constants import TERMINATOR
+from toika_loom_server.loom_protocol import LoomProtocol
+from toika_loom_server.mock_loom import MockLoom
+from toika_loom_server.pick_latency import PICK_STAGES, PickLatencyRecorder
+
+
+class RecordingTransport(asyncio.Transport):
+    """Minimal transport that records written data."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.written: list[bytes] = []
+        self.closing = False
+        self.write_buffer_size = 0
+
+    def abort(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.closing = True
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def get_write_buffer_size(self) -> int:
+        return self.write_buffer_size
+
+    def write(self, data) -> None:
+        self.written.append(bytes(data))
+
+
+def create_protocol() -> tuple[LoomProtocol, list[bytes], list[Exception | None]]:
+    replies: list[bytes] = []
+    lost: list[Exception | None] = []
+    protocol = LoomProtocol(
+        reply_callback=replies.append, connection_lost_callback=lost.append
+    )
+    return protocol, replies, lost
+
+
+async def test_data_received() -> None:
+    protocol, replies, lost = create_protocol()
+    transport = RecordingTransport()
+    protocol.connection_made(transport)
+    assert protocol.is_connected
+
+    # One reply per chunk (the usual case)
+    for reply in (b"1", b"2", b"1"):
+        protocol.data_received(reply + TERMINATOR)
+    assert replies == [b"1", b"2", b"1"]
+    replies.clear()
+
+    # Several replies in one chunk, and replies split across chunks
+    protocol.data_received(b"2" + TERMINATOR + b"1" + TERMINATOR + b"=s")
+    assert replies == [b"2", b"1"]
+    protocol.data_received(b"01")
+    assert replies == [b"2", b"1"]
+    protocol.data_received(TERMINATOR + b" 2 " + TERMINATOR)
+    assert replies == [b"2", b"1", b"=s01", b"2"]
+
+    protocol.write(b"#n" + TERMINATOR)
+    assert transport.written == [b"#n" + TERMINATOR]
+    await protocol.drain()
+
+    exc = RuntimeError("device vanished")
+    protocol.connection_lost(exc)
+    assert lost == [exc]
+    assert not protocol.is_connected
+    with pytest.raises(RuntimeError):
+        protocol.write(b"#n" + TERMINATOR)
+
+
+async def test_drain() -> None:
+    protocol, replies, lost = create_protocol()
+    protocol.connection_made(RecordingTransport())
+    protocol.pause_writing()
+    drain_task = asyncio.create_task(protocol.drain())
+    await asyncio.sleep(0.01)
+    assert not drain_task.done()
+    protocol.resume_writing()
+    async with asyncio.timeout(1):
+        await drain_task
+
+    # write_and_drain times out if writing stays paused
+    protocol.write_timeout = 0.01
+    protocol.pause_writing()
+    with pytest.raises(TimeoutError):
+        await protocol.write_and_drain(b"#n" + TERMINATOR)
+
+
+async def test_latency_recorder() -> None:
+    recorder = PickLatencyRecorder()
+    pick_command = b"\x00\x00\x00\x05" + TERMINATOR
+    protocol = LoomProtocol(
+        reply_callback=lambda reply: pick_command if reply == b"1" else None,
+        connection_lost_callback=lambda exc: None,
+        latency_recorder=recorder,
+    )
+    transport = RecordingTransport()
+    protocol.connection_made(transport)
+
+    # A pick that is sent on at once
+    protocol.data_received(b"1" + TERMINATOR)
+    assert transport.written == [pick_command]
+    stats = recorder.as_dict()
+    for stage in PICK_STAGES:
+        assert stats["stages"][stage]["num_values"] == 1
+    assert stats["serial"]["num_bytes_read"] == 2
+    assert stats["serial"]["num_bytes_written"] == len(pick_command)
+    assert stats["serial"]["pick_wire_time"] == pytest.approx(5 * 10 / 9600)
+
+    # Replies that are not answered are not timed
+    protocol.data_received(b"=s1" + TERMINATOR)
+    assert recorder.as_dict()["stages"]["total"]["num_values"] == 1
+
+    # A pick that the transport buffers is timed until it is sent on,
+    # whether or not the transport pauses the protocol
+    for pause in (False, True):
+        recorder.reset()
+        transport.write_buffer_size = len(pick_command)
+        protocol.data_received(b"1" + TERMINATOR)
+        if pause:
+            protocol.pause_writing()
+        await asyncio.sleep(0.01)
+        assert recorder.as_dict()["stages"]["drain"]["num_values"] == 0
+        transport.write_buffer_size = 0
+        if pause:
+            protocol.resume_writing()
+        else:
+            await asyncio.sleep(0.01)
+        stats = recorder.as_dict()
+        assert stats["stages"]["drain"]["num_values"] == 1
+        assert stats["stages"]["drain"]["max"] >= 0.01
+
+
+async def test_mock_loom_transport() -> None:
+    async with MockLoom(verbose=True) as loom:
+        replies: asyncio.Queue[bytes] = asyncio.Queue()
+        lost: list[Exception | None] = []
+        transport, protocol = await loom.open_client_transport(
+            lambda: LoomProtocol(
+                reply_callback=replies.put_nowait, connection_lost_callback=lost.append
+            )
+        )
+        assert protocol.is_connected
+        for shaft_word in (0x0, 0x5, 0xFFFFFFFF):
+            protocol.write(b"#n" + TERMINATOR)
+            async with asyncio.timeout(1):
+                reply = await replies.get()
+            assert reply == b"1"
+            loom.command_event.clear()
+            protocol.write(shaft_word.to_bytes(length=4, byteorder="big") + TERMINATOR)
+            async with asyncio.timeout(1):
+                await loom.command_event.wait()
+            assert loom.shaft_word == shaft_word
+
+        # Out of band close command closes the transport
+        protocol.write(b"#c" + TERMINATOR)
+        async with asyncio.timeout(1):
+            await loom.done_task
+        await asyncio.sleep(0)
+        assert transport.is_closing()
+        assert lost == [None]
+        assert not protocol.is_connected
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+
+from toika_loom_server.loom_thread import LoomThread
+
+
+async def test_run_and_close() -> None:
+    loom_thread = LoomThread()
+    try:
+        assert loom_thread.is_running
+
+        async def get_thread_and_loop() -> (
+            tuple[threading.Thread, asyncio.AbstractEventLoop]
+        ):
+            await asyncio.sleep(0)
+            return threading.current_thread(), asyncio.get_running_loop()
+
+        thread, loop = await loom_thread.run(get_thread_and_loop())
+        assert thread is loom_thread.thread
+        assert loop is loom_thread.loop
+        assert loop is not asyncio.get_running_loop()
+
+        # call_soon runs the callback in the thread
+        called_event = asyncio.Event()
+        called_threads: list[threading.Thread] = []
+        web_loop = asyncio.get_running_loop()
+
+        def callback(value: int) -> None:
+            called_threads.append(threading.current_thread())
+            web_loop.call_soon_threadsafe(called_event.set)
+
+        loom_thread.call_soon(callback, 5)
+        async with asyncio.timeout(1):
+            await called_event.wait()
+        assert called_threads == [loom_thread.thread]
+
+        # Tasks still running in the thread are cancelled by close
+        async def sleep_forever() -> None:
+            await asyncio.sleep(1000)
+
+        loom_thread.call_soon(loom_thread.loop.create_task, sleep_forever())
+    finally:
+        loom_thread.close()
+    assert not loom_thread.is_running
+    assert loom_thread.loop.is_closed()
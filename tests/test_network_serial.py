@@ -0,0 +1,184 @@
+import asyncio
+import socket
+
+import pytest
+import serial  # type: ignore
+
+from toika_loom_server.loom_constants import TERMINATOR
+from toika_loom_server.loom_protocol import LoomProtocol, open_loom_connection
+from toika_loom_server.mock_loom_server import MockLoomServer
+from toika_loom_server.network_serial import (
+    ThreadedSerialTransport,
+    get_round_trip_time,
+    is_network_port,
+    parse_socket_url,
+)
+
+
+class RecordingProtocol(asyncio.Protocol):
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.data_event = asyncio.Event()
+        self.paused = False
+        self.lost_future: asyncio.Future = asyncio.Future()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.lost_future.set_result(exc)
+
+    def data_received(self, data: bytes) -> None:
+        self.data += data
+        self.data_event.set()
+
+    def pause_writing(self) -> None:
+        self.paused = True
+
+    def resume_writing(self) -> None:
+        self.paused = False
+
+
+def test_parse_socket_url() -> None:
+    assert is_network_port("socket://localhost:7400")
+    assert is_network_port("rfc2217://10.0.0.5:2217?logging=debug")
+    assert not is_network_port("/dev/tty0")
+    assert not is_network_port("mock")
+    assert parse_socket_url("socket://localhost:7400") == ("localhost", 7400)
+    assert parse_socket_url("rfc2217://10.0.0.5:2217?logging=debug") == (
+        "10.0.0.5",
+        2217,
+    )
+    for bad_url in ("/dev/tty0", "socket://localhost", "loop://"):
+        with pytest.raises(ValueError):
+            parse_socket_url(bad_url)
+
+
+async def test_socket_connection() -> None:
+    replies: list[bytes] = []
+    reply_event = asyncio.Event()
+
+    def reply_callback(reply: bytes) -> bytes | None:
+        replies.append(reply)
+        reply_event.set()
+        # Respond to a pick request with a shaft word
+        return (0x1234).to_bytes(length=4, byteorder="big") + TERMINATOR
+
+    async with MockLoomServer(port=0) as server:
+        protocol, mock_loom = await open_loom_connection(
+            serial_port=server.url,
+            protocol_factory=lambda: LoomProtocol(
+                reply_callback=reply_callback,
+                connection_lost_callback=lambda exc: None,
+            ),
+            verbose=False,
+        )
+        try:
+            assert mock_loom is None
+            assert protocol.is_connected
+            assert protocol.transport is not None
+            sock = protocol.transport.get_extra_info("socket")
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+
+            # Request a pick, which the callback responds to
+            await protocol.write_and_drain(b"#n" + TERMINATOR)
+            async with asyncio.timeout(1):
+                await reply_event.wait()
+            assert replies == [b"1"]
+            assert len(server.mock_looms) == 1
+            mock_loom = server.mock_looms[0]
+            async with asyncio.timeout(1):
+                while mock_loom.shaft_word != 0x1234:
+                    await asyncio.sleep(0.01)
+
+            if hasattr(socket, "TCP_INFO"):
+                round_trip_time = protocol.round_trip_time
+                assert round_trip_time is not None
+                assert 0 <= round_trip_time < 1
+        finally:
+            protocol.close()
+
+
+async def test_threaded_serial_transport() -> None:
+    # pyserial's loop:// port echoes what is written to it
+    serial_instance = serial.serial_for_url("loop://", timeout=0.1)
+    protocol = RecordingProtocol()
+    transport = ThreadedSerialTransport(
+        loop=asyncio.get_running_loop(),
+        serial_instance=serial_instance,
+        protocol=protocol,
+    )
+    assert get_round_trip_time(transport) is None
+
+    transport.write(b"#n" + TERMINATOR)
+    # Writing pauses the protocol until the data is written
+    assert protocol.paused
+    async with asyncio.timeout(1):
+        while protocol.data != b"#n" + TERMINATOR:
+            protocol.data_event.clear()
+            await protocol.data_event.wait()
+    assert not protocol.paused
+    assert transport.get_write_buffer_size() == 0
+
+    transport.close()
+    assert transport.is_closing()
+    async with asyncio.timeout(1):
+        exc = await protocol.lost_future
+    assert exc is None
+    assert not serial_instance.is_open
+
+
+async def test_socket_write_timeout() -> None:
+    # A peer that accepts connections but never reads,
+    # with small socket buffers, so they fill up quickly.
+    with socket.socket() as listener:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+
+        lost: list[Exception | None] = []
+        protocol, _ = await open_loom_connection(
+            serial_port=f"socket://127.0.0.1:{port}",
+            protocol_factory=lambda: LoomProtocol(
+                reply_callback=lambda reply: None,
+                connection_lost_callback=lost.append,
+                write_timeout=0.1,
+            ),
+            verbose=False,
+        )
+        try:
+            assert protocol.transport is not None
+            sock = protocol.transport.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1)
+
+            # Write pick-sized commands until the link stalls;
+            # this must time out long before the transport
+            # has buffered 64 kB (its default high-water mark).
+            command = (0x1234).to_bytes(length=4, byteorder="big") + TERMINATOR
+            num_bytes_written = 0
+            with pytest.raises(TimeoutError):
+                while num_bytes_written < 64 * 1024:
+                    await protocol.write_and_drain(command)
+                    num_bytes_written += len(command)
+        finally:
+            protocol.close()
+
+        # A response to a loom reply times out in the same way
+        reply_protocol, _ = await open_loom_connection(
+            serial_port=f"socket://127.0.0.1:{port}",
+            protocol_factory=lambda: LoomProtocol(
+                reply_callback=lambda reply: b"x" * 16 * 1024 + TERMINATOR,
+                connection_lost_callback=lost.append,
+                write_timeout=0.1,
+            ),
+            verbose=False,
+        )
+        try:
+            assert reply_protocol.transport is not None
+            sock = reply_protocol.transport.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1)
+            reply_protocol.data_received(b"1" + TERMINATOR)
+            async with asyncio.timeout(1):
+                while not reply_protocol.lost:
+                    await asyncio.sleep(0.01)
+            assert isinstance(lost[-1], TimeoutError)
+        finally:
+            reply_protocol.close()
@@ -0,0 +1,72 @@
+import pathlib
+
+from toika_loom_server.pattern_cache import (
+    PatternCache,
+    PatternCacheStats,
+    approximate_pattern_size,
+)
+from toika_loom_server.reduced_pattern import (
+    ReducedPattern,
+    read_full_pattern,
+    reduced_pattern_from_pattern_data,
+)
+
+datadir = pathlib.Path(__file__).parent / "data"
+
+all_pattern_paths = list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx"))
+
+
+def read_reduced_pattern(path: pathlib.Path) -> ReducedPattern:
+    full_pattern = read_full_pattern(path)
+    return reduced_pattern_from_pattern_data(name=path.name, data=full_pattern)
+
+
+def test_pattern_cache() -> None:
+    patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:3]]
+    sizes = [approximate_pattern_size(pattern) for pattern in patterns]
+    assert all(size > 0 for size in sizes)
+
+    # Room for the first two patterns, but not all three
+    cache = PatternCache(max_size=sizes[0] + sizes[1])
+    keys = [f"hash{i}" for i in range(len(patterns))]
+    assert cache.get(keys[0]) is None
+    cache.put(keys[0], pattern=patterns[0])
+    cache.put(keys[1], pattern=patterns[1])
+    assert cache.stats == PatternCacheStats(
+        num_hits=0,
+        num_misses=1,
+        num_evictions=0,
+        num_patterns=2,
+        size=sizes[0] + sizes[1],
+    )
+
+    # A hit returns a copy, whose pick number can be changed
+    cached_pattern = cache.get(keys[0])
+    assert cached_pattern == patterns[0]
+    assert cached_pattern is not patterns[0]
+    assert cached_pattern.shaft_word_table == patterns[0].shaft_word_table
+    cached_pattern.pick_number = 5
+    cached_pattern.name = "new name"
+    cached_pattern = cache.get(keys[0])
+    assert cached_pattern is not None
+    assert cached_pattern.pick_number == 0
+    assert cached_pattern.name == patterns[0].name
+    assert cache.stats.num_hits == 2
+
+    # Adding a third pattern evicts the least recently used one
+    cache.put(keys[2], pattern=patterns[2])
+    assert cache.stats.num_evictions >= 1
+    assert cache.get(keys[1]) is None
+    assert cache.stats.size <= cache.max_size
+
+    cache.invalidate(keys[0])
+    assert cache.get(keys[0]) is None
+    cache.clear()
+    assert cache.stats.num_patterns == 0
+    assert cache.stats.size == 0
+
+    # A disabled cache stores nothing
+    cache = PatternCache(max_size=0)
+    cache.put(keys[0], pattern=patterns[0])
+    assert cache.get(keys[0]) is None
+    assert cache.stats.num_patterns == 0
@@ -0,0 +1,127 @@
+import dataclasses
+import json
+import pathlib
+
+import pytest
+
+from toika_loom_server.pattern_codec import (
+    FORMAT_VERSION,
+    MAGIC,
+    decode_pattern,
+    decode_warp,
+    encode_pattern,
+    encode_warp,
+    is_encoded_pattern,
+)
+from toika_loom_server.reduced_pattern import (
+    Pick,
+    ReducedPattern,
+    read_full_pattern,
+    reduced_pattern_from_pattern_data,
+)
+
+datadir = pathlib.Path(__file__).parent / "data"
+
+all_pattern_paths = list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx"))
+
+
+def read_reduced_pattern(path: pathlib.Path) -> ReducedPattern:
+    full_pattern = read_full_pattern(path)
+    return reduced_pattern_from_pattern_data(name=path.name, data=full_pattern)
+
+
+def test_round_trip() -> None:
+    for path in all_pattern_paths:
+        pattern = read_reduced_pattern(path)
+        pattern.pick_number = 3
+        pattern.repeat_number = -2
+        json_len = len(json.dumps(dataclasses.asdict(pattern)))
+        for compress in (False, True):
+            data = encode_pattern(pattern, compress=compress)
+            assert is_encoded_pattern(data)
+            assert data[len(MAGIC)] == FORMAT_VERSION
+            assert len(data) < json_len / 4
+            decoded_pattern = decode_pattern(data)
+            assert decoded_pattern == pattern
+            assert decoded_pattern.shaft_word_table == pattern.shaft_word_table
+            # Picks do not share lists
+            decoded_pattern.picks[0].are_shafts_up[0] ^= True
+            assert decoded_pattern.picks[1:] == pattern.picks[1:]
+
+
+def test_decode_memoryview() -> None:
+    pattern = read_reduced_pattern(all_pattern_paths[0])
+    for compress in (False, True):
+        data = encode_pattern(pattern, compress=compress)
+        # Decode from the middle of a larger buffer, as from a blob file
+        buffer = memoryview(b"prefix" + data + b"suffix")
+        view = buffer[6 : 6 + len(data)]
+        assert is_encoded_pattern(view)
+        assert decode_pattern(view) == pattern
+
+
+def test_warp() -> None:
+    for path in all_pattern_paths:
+        pattern = read_reduced_pattern(path)
+        data = encode_warp(pattern.threading, pattern.warp_colors)
+        assert decode_warp(data) == (pattern.threading, pattern.warp_colors)
+        with pytest.raises(ValueError):
+            decode_warp(data[:-1])
+    assert decode_warp(encode_warp([], [])) == ([], [])
+    assert encode_warp([0, 1], [2]) != encode_warp([0], [1, 2])
+
+
+def test_unusual_patterns() -> None:
+    # Ragged shaft lists, negative and large values, non-ASCII text,
+    # many shafts, and enough picks to compress well
+    pattern = ReducedPattern(
+        name="Überfall ✓",
+        color_table=["#ffffff", "red"],
+        warp_colors=[0, 1, 300],
+        threading=[-1, 0, 31],
+        picks=[
+            Pick(color=i % 3, are_shafts_up=[j == i % 32 for j in range(32)])
+            for i in range(1000)
+        ]
+        + [Pick(color=-5, are_shafts_up=[True, False, True])],
+        pick0=Pick(color=1, are_shafts_up=[False] * 4),
+        pick_number=1001,
+        repeat_number=-70000,
+    )
+    uncompressed_data = encode_pattern(pattern, compress=False)
+    data = encode_pattern(pattern)
+    assert len(data) < len(uncompressed_data)
+    for encoded in (uncompressed_data, data):
+        assert decode_pattern(encoded) == pattern
+
+    # A tiny pattern is not compressed
+    pattern = ReducedPattern(
+        name="",
+        color_table=[],
+        warp_colors=[],
+        threading=[],
+        picks=[],
+        pick0=Pick(color=0, are_shafts_up=[False]),
+    )
+    data = encode_pattern(pattern)
+    assert data == encode_pattern(pattern, compress=False)
+    assert decode_pattern(data) == pattern
+
+
+def test_invalid_data() -> None:
+    pattern = read_reduced_pattern(all_pattern_paths[0])
+    data = encode_pattern(pattern, compress=False)
+    compressed_data = encode_pattern(pattern)
+    assert compressed_data != data
+
+    for bad_data in (
+        b"",
+        json.dumps(dataclasses.asdict(pattern)).encode(),
+        MAGIC + bytes((FORMAT_VERSION + 1,)) + data[len(MAGIC) + 1 :],
+        data[:-1],
+        data[:20],
+        compressed_data[:-5],
+    ):
+        with pytest.raises(ValueError):
+            decode_pattern(bad_data)
+    assert not is_encoded_pattern(b"{}")
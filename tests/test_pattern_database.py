@@ -1,11 +1,32 @@
+import asyncio
+import copy
+import dataclasses
+import json
 import pathlib
+import sqlite3
 import tempfile
 import time
 
 import pytest
 
-from toika_loom_server.pattern_database import create_pattern_database
+from toika_loom_server.blob_file import BlobFile
+from toika_loom_server.pattern_codec import is_encoded_pattern
+from toika_loom_server.pattern_database import (
+    AUTO_VACUUM_INCREMENTAL,
+    BODY_STORES,
+    SCHEMA_VERSION,
+    PatternDatabase,
+    create_pattern_database,
+    delete_database_files,
+    encode_pattern_body,
+    get_blob_path,
+    get_compacted_blob_path,
+    get_upload_hash,
+    get_warp_hash,
+    quick_check_database,
+)
 from toika_loom_server.reduced_pattern import (
+    MAX_SHAFTS,
     ReducedPattern,
     read_full_pattern,
     reduced_pattern_from_pattern_data,
@@ -86,6 +107,7 @@ async def test_add_and_get_pattern() -> None:
         await db.add_pattern(pattern2, max_entries=1)
         pattern_names = await db.get_pattern_names()
         assert pattern_names == [pattern1.name, pattern2.name]
+        await db.close()
 
 
 async def test_clear_database() -> None:
@@ -107,6 +129,904 @@ async def test_clear_database() -> None:
         await db.clear_database()
         pattern_names_after_clear = await db.get_pattern_names()
         assert pattern_names_after_clear == []
+        await db.close()
+
+
+async def test_loom_isolation() -> None:
+    with tempfile.NamedTemporaryFile() as f:
+        dbpath = pathlib.Path(f.name)
+        db = await create_pattern_database(dbpath)
+        db_a = db.for_loom("a")
+        db_b = db.for_loom("b")
+        assert db.loom_id == ""
+        assert db_a.loom_id == "a"
+
+        pattern1 = read_reduced_pattern(all_pattern_paths[0])
+        pattern2 = read_reduced_pattern(all_pattern_paths[1])
+        await db_a.add_pattern(pattern1)
+        await db_a.add_pattern(pattern2)
+        await db_b.add_pattern(pattern2)
+        assert await db.get_pattern_names() == []
+        assert await db_a.get_pattern_names() == [pattern1.name, pattern2.name]
+        assert await db_b.get_pattern_names() == [pattern2.name]
+        with pytest.raises(LookupError):
+            await db_b.get_pattern(pattern1.name)
+
+        # Pick numbers and purging are per loom
+        await db_b.update_pick_number(
+            pattern_name=pattern2.name, pick_number=3, repeat_number=2
+        )
+        assert (await db_a.get_pattern(pattern2.name)).pick_number == 0
+        assert (await db_b.get_pattern(pattern2.name)).pick_number == 3
+        await db_b.add_pattern(pattern1, max_entries=1)
+        assert await db_a.get_pattern_names() == [pattern1.name, pattern2.name]
+
+        await db_b.clear_database()
+        assert await db_b.get_pattern_names() == []
+        assert await db_a.get_pattern_names() == [pattern1.name, pattern2.name]
+        await db.close()
+
+
+async def test_migrate_legacy_database() -> None:
+    with tempfile.NamedTemporaryFile() as f:
+        dbpath = pathlib.Path(f.name)
+        # Create a database as older versions did: patterns saved as JSON,
+        # and no loom_id column
+        legacy_pattern = read_reduced_pattern(all_pattern_paths[0])
+        legacy_pattern.pick_number = 3
+        conn = sqlite3.connect(dbpath)
+        try:
+            conn.execute(
+                "create table patterns (id integer primary key, pattern_name text, "
+                "pattern_json text, pick_number integer, repeat_number integer, "
+                "timestamp_sec real)"
+            )
+            conn.execute(
+                "insert into patterns (pattern_name, pattern_json, pick_number, "
+                "repeat_number, timestamp_sec) values (?, ?, ?, ?, ?)",
+                (
+                    legacy_pattern.name,
+                    json.dumps(dataclasses.asdict(legacy_pattern)),
+                    5,
+                    2,
+                    time.time(),
+                ),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        db = await create_pattern_database(dbpath)
+        assert await db.get_pattern_names() == [legacy_pattern.name]
+        returned_pattern = await db.get_pattern(legacy_pattern.name)
+        assert returned_pattern.pick_number == 5
+        assert returned_pattern.repeat_number == 2
+        returned_pattern.pick_number = legacy_pattern.pick_number
+        returned_pattern.repeat_number = legacy_pattern.repeat_number
+        assert returned_pattern == legacy_pattern
+
+        pattern = read_reduced_pattern(all_pattern_paths[1])
+        await db.add_pattern(pattern)
+        assert await db.get_pattern_names() == [legacy_pattern.name, pattern.name]
+        await db.close()
+
+        # The JSON has been replaced by content-addressed bodies
+        # in the binary format, and the schema is up to date
+        conn = sqlite3.connect(dbpath)
+        try:
+            rows = conn.execute(
+                "select pattern_json, p.pattern_data, b.pattern_data "
+                "from patterns p join pattern_bodies b using (content_hash)"
+            ).fetchall()
+            assert len(rows) == 2
+            for pattern_json, pattern_data, body_data in rows:
+                assert pattern_json is None
+                assert pattern_data is None
+                assert is_encoded_pattern(body_data)
+            assert conn.execute("pragma user_version").fetchone()[0] == SCHEMA_VERSION
+            assert (
+                conn.execute("pragma auto_vacuum").fetchone()[0]
+                == AUTO_VACUUM_INCREMENTAL
+            )
+            index_names = {
+                row[0]
+                for row in conn.execute(
+                    "select name from sqlite_master where type = 'index'"
+                )
+            }
+            assert {"patterns_by_name", "patterns_by_time"} <= index_names
+        finally:
+            conn.close()
+
+        # Metadata was computed for the migrated pattern
+        async with PatternDatabase(dbpath) as db:
+            metadata = await db.get_pattern_metadata()
+        assert [item.name for item in metadata] == [legacy_pattern.name, pattern.name]
+        assert metadata[0].num_picks == len(legacy_pattern.picks)
+        assert metadata[0].content_hash != metadata[1].content_hash
+
+
+async def test_content_addressed_storage() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+
+        def count_rows(table: str) -> int:
+            conn = sqlite3.connect(dbpath)
+            try:
+                return conn.execute(f"select count(*) from {table}").fetchone()[0]
+            finally:
+                conn.close()
+
+        async with PatternDatabase(dbpath) as db:
+            db_a = db.for_loom("a")
+            path = all_pattern_paths[0]
+            pattern = read_reduced_pattern(path)
+            upload_hash = get_upload_hash(path.name, path.read_text())
+            assert get_upload_hash("other.WIF", path.read_text()) == upload_hash
+            assert get_upload_hash("other.dtx", path.read_text()) != upload_hash
+            assert not await db.add_uploaded_pattern("copy", upload_hash=upload_hash)
+
+            # Patterns with the same content share one body
+            await db.add_pattern(pattern, upload_hash=upload_hash)
+            renamed_pattern = copy.copy(pattern)
+            renamed_pattern.name = "renamed"
+            await db.add_pattern(renamed_pattern)
+            assert await db_a.add_uploaded_pattern("copy", upload_hash=upload_hash)
+            assert count_rows("pattern_bodies") == 1
+            copied_pattern = await db_a.get_pattern("copy")
+            assert copied_pattern.name == "copy"
+            copied_pattern.name = pattern.name
+            assert copied_pattern == pattern
+            metadata = await db_a.get_pattern_metadata()
+            assert (
+                metadata[0].content_hash
+                == (await db.get_pattern_metadata())[0].content_hash
+            )
+
+            # add_uploaded_pattern prunes, like add_pattern
+            await db_a.add_pattern(read_reduced_pattern(all_pattern_paths[1]))
+            assert await db_a.add_uploaded_pattern(
+                "copy2", upload_hash=upload_hash, max_entries=2
+            )
+            assert await db_a.get_pattern_names() == [
+                all_pattern_paths[1].name,
+                "copy2",
+            ]
+
+            # A body (and its upload hash) is deleted with its last pattern
+            assert count_rows("pattern_bodies") == 2
+            await db_a.clear_database()
+            assert count_rows("pattern_bodies") == 1
+            await db.clear_database()
+            assert count_rows("pattern_bodies") == 0
+            assert count_rows("upload_hashes") == 0
+            assert not await db.add_uploaded_pattern("copy", upload_hash=upload_hash)
+
+
+def test_upload_hash_versions(monkeypatch: pytest.MonkeyPatch) -> None:
+    upload_hash = get_upload_hash("pattern.wif", "data")
+    # A change to the parser or the storage format invalidates the hash
+    for name in ("PARSER_VERSION", "FORMAT_VERSION"):
+        with monkeypatch.context() as patch:
+            patch.setattr(f"toika_loom_server.pattern_database.{name}", 1000)
+            assert get_upload_hash("pattern.wif", "data") != upload_hash
+    assert get_upload_hash("pattern.wif", "data") == upload_hash
+
+
+async def test_mmap_body_store() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        blob_path = get_blob_path(dbpath)
+        patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:3]]
+
+        with pytest.raises(ValueError):
+            PatternDatabase(dbpath, body_store="no_such_store")
+
+        # Store one pattern in the database, then two in the blob file
+        async with PatternDatabase(dbpath) as db:
+            await db.add_pattern(patterns[0])
+        assert not blob_path.exists()
+        async with PatternDatabase(dbpath, body_store="mmap", cache_size=0) as db:
+            await db.add_pattern(patterns[1])
+            blob_size = blob_path.stat().st_size
+            assert blob_size > 0
+            # Same content: the body is not appended again
+            renamed_pattern = copy.copy(patterns[1])
+            renamed_pattern.name = "renamed"
+            await db.add_pattern(renamed_pattern)
+            assert blob_path.stat().st_size == blob_size
+            await db.add_pattern(patterns[2])
+            assert blob_path.stat().st_size > blob_size
+            for pattern in patterns:
+                assert await db.get_pattern(pattern.name) == pattern
+            assert (await db.get_pattern("renamed")).picks == patterns[1].picks
+
+        # Bodies stored either way can be read with either store
+        for body_store in BODY_STORES:
+            async with PatternDatabase(
+                dbpath, body_store=body_store, cache_size=0
+            ) as db:
+                for pattern in patterns:
+                    assert await db.get_pattern(pattern.name) == pattern
+
+        conn = sqlite3.connect(dbpath)
+        try:
+            assert conn.execute(
+                "select count(*) from pattern_bodies where blob_offset is not null"
+            ).fetchone() == (2,)
+        finally:
+            conn.close()
+
+        delete_database_files(dbpath)
+        assert not blob_path.exists()
+
+
+async def test_compact_blob_file(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        blob_path = get_blob_path(dbpath)
+        compacted_path = get_compacted_blob_path(dbpath)
+        patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:6]]
+
+        def get_live_size() -> int:
+            conn = sqlite3.connect(dbpath)
+            try:
+                return conn.execute(
+                    "select sum(blob_length) from pattern_bodies "
+                    "where blob_offset is not null"
+                ).fetchone()[0]
+            finally:
+                conn.close()
+
+        async with PatternDatabase(dbpath, body_store="mmap", cache_size=0) as db:
+            assert await db.compact_blob_file() == 0
+            for pattern in patterns[0:4]:
+                await db.add_pattern(pattern, max_entries=2)
+            # The bodies of the pruned patterns are dead space
+            blob_size = blob_path.stat().st_size
+            live_size = get_live_size()
+            assert live_size < blob_size
+            assert await db.compact_blob_file(min_dead_fraction=1) == 0
+            assert blob_path.stat().st_size == blob_size
+
+            assert await db.compact_blob_file(min_dead_fraction=0) == (
+                blob_size - live_size
+            )
+            assert blob_path.stat().st_size == live_size
+            assert not compacted_path.exists()
+            for pattern in patterns[2:4]:
+                assert await db.get_pattern(pattern.name) == pattern
+            # Nothing left to reclaim
+            assert await db.compact_blob_file(min_dead_fraction=0) == 0
+
+            # If the server stops after the new offsets are saved,
+            # but before the blob file is replaced...
+            await db.add_pattern(patterns[4], max_entries=2)
+
+            def fail_to_replace(self: BlobFile, path: pathlib.Path) -> None:
+                raise OSError("Simulated failure")
+
+            with monkeypatch.context() as patch:
+                patch.setattr(BlobFile, "replace", fail_to_replace)
+                with pytest.raises(OSError):
+                    await db.compact_blob_file(min_dead_fraction=0)
+            assert compacted_path.exists()
+            assert blob_path.stat().st_size > get_live_size()
+
+        # ...the next init finishes the job
+        async with PatternDatabase(dbpath, body_store="mmap", cache_size=0) as db:
+            assert not compacted_path.exists()
+            assert blob_path.stat().st_size == get_live_size()
+            for pattern in patterns[3:5]:
+                assert await db.get_pattern(pattern.name) == pattern
+
+            # If the server stops before the new offsets are saved,
+            # the next init deletes the unused compacted file
+            await db.add_pattern(patterns[5], max_entries=2)
+        blob_size = blob_path.stat().st_size
+        compacted_path.write_bytes(blob_path.read_bytes()[:-1])
+        async with PatternDatabase(dbpath, cache_size=0) as db:
+            assert not compacted_path.exists()
+            assert blob_path.stat().st_size == blob_size
+            for pattern in patterns[4:6]:
+                assert await db.get_pattern(pattern.name) == pattern
+            # Compacting also works with the "sqlite" store
+            assert await db.compact_blob_file(min_dead_fraction=0) > 0
+            assert blob_path.stat().st_size == get_live_size()
+            for pattern in patterns[4:6]:
+                assert await db.get_pattern(pattern.name) == pattern
+
+
+@pytest.mark.parametrize("body_store", BODY_STORES)
+async def test_backup(body_store: str) -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        backup_path = pathlib.Path(tempdir) / "backup.sqlite"
+        patterns = [read_reduced_pattern(path) for path in all_pattern_paths]
+        async with PatternDatabase(dbpath, body_store=body_store) as db:
+            for pattern in patterns[0:-1]:
+                await db.add_pattern(pattern)
+                await db.for_loom("other").add_pattern(pattern)
+
+            # Keep writing while backing up, copying one page per step
+            async def write_picks() -> None:
+                for pick_number in range(100):
+                    await db.update_pick_number(
+                        pattern_name=patterns[0].name,
+                        pick_number=pick_number,
+                        repeat_number=1,
+                    )
+                    await asyncio.sleep(0)
+
+            await asyncio.gather(
+                db.backup(backup_path, pages_per_step=1), write_picks()
+            )
+            await db.add_pattern(patterns[-1])
+            assert not pathlib.Path(f"{backup_path}.tmp").exists()
+
+        # The backup is a single self-contained file,
+        # with the patterns for all looms when the backup started
+        delete_database_files(dbpath)
+        assert {path.name for path in pathlib.Path(tempdir).iterdir()} == {
+            backup_path.name
+        }
+        async with PatternDatabase(backup_path) as backup_db:
+            for loom_db in (backup_db, backup_db.for_loom("other")):
+                # Saving a pick number makes patterns[0] the most recent
+                # pattern for the main loom, if the backup saw it.
+                assert sorted(await loom_db.get_pattern_names()) == sorted(
+                    pattern.name for pattern in patterns[0:-1]
+                )
+                for pattern in patterns[1:-1]:
+                    assert await loom_db.get_pattern(pattern.name) == pattern
+
+            # Backing up to an existing file replaces it
+            await backup_db.clear_database()
+            await backup_db.backup(dbpath)
+        async with PatternDatabase(dbpath) as db:
+            assert await db.get_pattern_names() == []
+
+
+async def test_iter_patterns() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:3]]
+        async with PatternDatabase(dbpath, cache_size=0) as db:
+            for pattern in patterns:
+                await db.add_pattern(pattern)
+            # Updating the pick number makes the pattern the most recent
+            await db.update_pick_number(
+                pattern_name=patterns[2].name, pick_number=5, repeat_number=-1
+            )
+            patterns[2].pick_number = 5
+            patterns[2].repeat_number = -1
+            assert [pattern async for pattern in db.iter_patterns()] == patterns
+            assert [pattern async for pattern in db.for_loom("x").iter_patterns()] == []
+
+            # Patterns deleted during iteration are skipped
+            iterated_patterns = []
+            async for pattern in db.iter_patterns():
+                iterated_patterns.append(pattern)
+                await db.clear_database()
+            assert iterated_patterns == patterns[0:1]
+
+
+async def test_same_warp() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+
+        def count_rows(table: str) -> int:
+            conn = sqlite3.connect(dbpath)
+            try:
+                return conn.execute(f"select count(*) from {table}").fetchone()[0]
+            finally:
+                conn.close()
+
+        pattern = read_reduced_pattern(all_pattern_paths[0])
+        # Another treadling for the same warp
+        treadling = copy.deepcopy(pattern)
+        treadling.name = "treadling"
+        treadling.picks.reverse()
+        # The same threading with different warp colors
+        recolored = copy.deepcopy(pattern)
+        recolored.name = "recolored"
+        recolored.warp_colors = [0] * len(recolored.warp_colors)
+        other = read_reduced_pattern(all_pattern_paths[1])
+        patterns = [pattern, treadling, recolored, other]
+
+        for body_store in BODY_STORES:
+            delete_database_files(dbpath)
+            async with PatternDatabase(
+                dbpath, body_store=body_store, cache_size=0
+            ) as db:
+                for item in patterns:
+                    await db.add_pattern(item)
+                    await db.for_loom("x").add_pattern(item)
+
+                # Each distinct warp is stored once
+                assert count_rows("pattern_bodies") == 4
+                assert count_rows("warps") == 3
+                for item in patterns:
+                    assert await db.get_pattern(item.name) == item
+                    assert [pattern async for pattern in db.iter_patterns()] == patterns
+
+                metadata = await db.get_pattern_metadata()
+                assert [item.warp_hash for item in metadata] == [
+                    get_warp_hash(item.threading, item.warp_colors) for item in patterns
+                ]
+                assert metadata[0].warp_hash == metadata[1].warp_hash
+                assert len({item.warp_hash for item in metadata}) == 3
+
+                # Search for other patterns with the same warp
+                for item, compatible_items in (
+                    (pattern, [treadling]),
+                    (treadling, [pattern]),
+                    (recolored, []),
+                ):
+                    total, found = await db.search_patterns(same_warp_as=item.name)
+                    assert total == len(compatible_items)
+                    assert [item.name for item in found] == [
+                        item.name for item in compatible_items
+                    ]
+                total, found = await db.search_patterns(
+                    query="tread", same_warp_as=pattern.name
+                )
+                assert [item.name for item in found] == ["treadling"]
+                total, found = await db.search_patterns(
+                    query="bogus", same_warp_as=pattern.name
+                )
+                assert total == 0
+                assert await db.search_patterns(same_warp_as="no such pattern") == (
+                    0,
+                    [],
+                )
+
+                # A warp is deleted with the last body that uses it
+                await db.clear_database()
+                assert count_rows("warps") == 3
+                await db.for_loom("x").clear_database()
+                assert count_rows("warps") == 0
+
+
+async def test_migrate_warp_hashes() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:2]]
+        async with PatternDatabase(dbpath) as db:
+            await db.add_pattern(patterns[0])
+        async with PatternDatabase(dbpath, body_store="mmap") as db:
+            await db.add_pattern(patterns[1])
+
+        # Make a version 6 database: full bodies and no warps
+        blob_file = BlobFile(get_blob_path(dbpath))
+        conn = sqlite3.connect(dbpath)
+        try:
+            for row in conn.execute(
+                "select content_hash, blob_offset, blob_length from pattern_bodies"
+            ).fetchall():
+                content_hash, blob_offset, blob_length = row
+                pattern = patterns[0] if blob_offset is None else patterns[1]
+                pattern_data, _ = encode_pattern_body(pattern)
+                if blob_offset is not None:
+                    pattern_data, _ = encode_pattern_body(pattern, compress=False)
+                    blob_offset = blob_file.append(pattern_data)
+                    blob_length = len(pattern_data)
+                    pattern_data = b""
+                conn.execute(
+                    "update pattern_bodies set pattern_data = ?, blob_offset = ?, "
+                    "blob_length = ?, warp_hash = null where content_hash = ?",
+                    (pattern_data, blob_offset, blob_length, content_hash),
+                )
+            conn.execute("update patterns set warp_hash = null")
+            conn.execute("drop table warps")
+            conn.execute("pragma user_version = 6")
+            conn.commit()
+        finally:
+            conn.close()
+
+        async with PatternDatabase(dbpath, cache_size=0) as db:
+            metadata = await db.get_pattern_metadata()
+            assert [item.warp_hash for item in metadata] == [
+                get_warp_hash(pattern.threading, pattern.warp_colors)
+                for pattern in patterns
+            ]
+            for pattern in patterns:
+                assert await db.get_pattern(pattern.name) == pattern
+
+
+async def test_newer_schema() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath):
+            pass
+        conn = sqlite3.connect(dbpath)
+        try:
+            conn.execute(f"pragma user_version = {SCHEMA_VERSION + 1}")
+        finally:
+            conn.close()
+        db = PatternDatabase(dbpath)
+        with pytest.raises(RuntimeError):
+            await db.init()
+        assert not db.is_open
+
+
+async def test_pattern_metadata() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:2]]
+            # The pick number does not affect the saved data
+            patterns[0].pick_number = 2
+            for pattern in patterns:
+                await db.add_pattern(pattern)
+            assert patterns[0].pick_number == 2
+            metadata = await db.get_pattern_metadata()
+            assert [item.name for item in metadata] == await db.get_pattern_names()
+            for item, pattern in zip(metadata, patterns):
+                assert item.name == pattern.name
+                assert item.num_picks == len(pattern.picks)
+                assert item.num_shafts == len(pattern.pick0.are_shafts_up)
+                assert item.num_ends == len(pattern.threading)
+                assert item.data_size > 0
+                assert len(item.content_hash) == 64
+            assert await db.for_loom("a").get_pattern_metadata() == []
+
+            # Re-adding an unchanged pattern gives the same hash
+            patterns[0].pick_number = 4
+            await db.add_pattern(patterns[0])
+            new_metadata = await db.get_pattern_metadata()
+            assert new_metadata[-1].content_hash == metadata[0].content_hash
+
+
+async def test_migrate_too_many_shafts(caplog: pytest.LogCaptureFixture) -> None:
+    with tempfile.NamedTemporaryFile() as f:
+        dbpath = pathlib.Path(f.name)
+        # Older versions saved patterns with more shafts than the loom has
+        good_pattern = read_reduced_pattern(all_pattern_paths[0])
+        bad_pattern_dict = dataclasses.asdict(
+            read_reduced_pattern(all_pattern_paths[1])
+        )
+        bad_pattern_dict["name"] = "too many shafts"
+        for pick in bad_pattern_dict["picks"] + [bad_pattern_dict["pick0"]]:
+            pick["are_shafts_up"] = [True] * (MAX_SHAFTS + 8)
+        conn = sqlite3.connect(dbpath)
+        try:
+            conn.execute(
+                "create table patterns (id integer primary key, pattern_name text, "
+                "pattern_json text, pick_number integer, repeat_number integer, "
+                "timestamp_sec real)"
+            )
+            conn.executemany(
+                "insert into patterns (pattern_name, pattern_json, pick_number, "
+                "repeat_number, timestamp_sec) values (?, ?, 0, 1, ?)",
+                [
+                    (
+                        bad_pattern_dict["name"],
+                        json.dumps(bad_pattern_dict),
+                        time.time(),
+                    ),
+                    (
+                        good_pattern.name,
+                        json.dumps(dataclasses.asdict(good_pattern)),
+                        time.time() + 1,
+                    ),
+                ],
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        # The unusable pattern is dropped (and logged); the rest is migrated
+        async with PatternDatabase(dbpath) as db:
+            assert await db.get_pattern_names() == [good_pattern.name]
+            assert await db.get_pattern(good_pattern.name) == good_pattern
+        assert "cannot be converted" in caplog.text
+
+
+async def test_prune() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:5]]
+            for pattern in patterns:
+                await db.add_pattern(pattern)
+            assert await db.get_pattern_names(max_names=2) == [
+                pattern.name for pattern in patterns[3:5]
+            ]
+            sizes = {
+                item.name: item.data_size for item in await db.get_pattern_metadata()
+            }
+
+            # Prune by total size; the two most recent patterns are always kept
+            await db.add_pattern(
+                patterns[4],
+                max_bytes=sizes[patterns[3].name] + sizes[patterns[4].name],
+            )
+            assert await db.get_pattern_names() == [
+                pattern.name for pattern in patterns[3:5]
+            ]
+            await db.add_pattern(patterns[4], max_bytes=1)
+            assert await db.get_pattern_names() == [
+                pattern.name for pattern in patterns[3:5]
+            ]
+
+            # Prune by age
+            for pattern in patterns[0:2]:
+                await db.add_pattern(pattern)
+            for pattern in patterns[3:5]:
+                await db.set_timestamp(pattern.name, timestamp=time.time() - 100)
+            await db.add_pattern(patterns[2], max_age=50)
+            assert await db.get_pattern_names() == [
+                pattern.name for pattern in patterns[0:3]
+            ]
+            for i, pattern in enumerate(patterns[0:3]):
+                await db.set_timestamp(pattern.name, timestamp=time.time() - 200 + i)
+            await db.add_pattern(patterns[3], max_age=50)
+            assert await db.get_pattern_names() == [
+                pattern.name for pattern in patterns[2:4]
+            ]
+
+
+async def test_names_cache() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            db_a = db.for_loom("a")
+            patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:5]]
+            versions = [db.names_version]
+
+            async def check_names(
+                db: PatternDatabase, expected_names: list[str], changed: bool
+            ) -> None:
+                """Check cached names against the database,
+                and whether the version changed.
+                """
+                for max_names in (2, 3):
+                    names = await db.get_pattern_names(max_names=max_names)
+                    assert names == expected_names[-max_names:]
+                    # get_pattern_names(0) is not cached
+                    all_names = await db.get_pattern_names()
+                    assert names == all_names[-max_names:]
+                if db.loom_id == "":
+                    assert (db.names_version != versions[-1]) == changed
+                    versions.append(db.names_version)
+
+            await check_names(db, [], changed=False)
+            for pattern in patterns:
+                await db.add_pattern(pattern)
+            names = [pattern.name for pattern in patterns]
+            await check_names(db, names, changed=True)
+
+            # Using the most recent pattern does not change the names
+            await db.update_pick_number(names[-1], pick_number=1, repeat_number=1)
+            await check_names(db, names, changed=False)
+            await db.update_pick_number(names[2], pick_number=1, repeat_number=1)
+            names = names[0:2] + names[3:] + names[2:3]
+            await check_names(db, names, changed=True)
+            await db.add_uploaded_pattern("no such pattern", upload_hash="no such hash")
+            await check_names(db, names, changed=False)
+            await db.set_timestamp(names[-1], timestamp=time.time() - 100)
+            names = names[-1:] + names[:-1]
+            await check_names(db, names, changed=True)
+
+            # Changes to other looms do not change the names
+            await db_a.add_pattern(patterns[0])
+            await check_names(db_a, [patterns[0].name], changed=False)
+            await check_names(db, names, changed=False)
+
+            # Pruning discards the cached names
+            await db.add_pattern(patterns[0], max_entries=3)
+            names = names[-2:] + [patterns[0].name]
+            await check_names(db, names, changed=True)
+            assert await db.prune_to_size(max_bytes=1, max_patterns=1) == 1
+            await check_names(db, names[1:], changed=True)
+            await db.clear_database()
+            await check_names(db, [], changed=True)
+            await check_names(db_a, [patterns[0].name], changed=False)
+
+
+async def test_maintenance() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            db_a = db.for_loom("a")
+            base_pattern = read_reduced_pattern(all_pattern_paths[0])
+            for i in range(100):
+                # Give each pattern different content
+                pattern = copy.copy(base_pattern)
+                pattern.name = f"pattern {i}"
+                pattern.color_table = base_pattern.color_table + [f"color {i}"] * 100
+                await (db if i % 2 == 0 else db_a).add_pattern(pattern)
+            await db.checkpoint()
+            await db.optimize()
+            full_size = await db.get_size()
+            assert full_size > 0
+            assert await db.quick_check(should_stop=lambda: False) == "ok"
+            assert (
+                quick_check_database(dbpath, should_stop=lambda: True, progress_steps=1)
+                is None
+            )
+
+            # Prune to meet a size budget, least recently used first
+            # (of any loom), keeping the two most recent patterns per loom
+            assert await db.prune_to_size(max_bytes=full_size, max_patterns=5) == 0
+            # Find the smallest size pruning can reach, without pruning
+            min_size = await db.get_min_size()
+            assert 0 < min_size < full_size
+            assert await db.get_size() == full_size
+            assert len(await db.get_pattern_names()) == 50
+            max_bytes = (min_size + full_size) // 2
+            assert await db.prune_to_size(max_bytes=max_bytes, max_patterns=5) == 5
+            names = await db.get_pattern_names()
+            assert names == [f"pattern {i}" for i in range(6, 100, 2)]
+            while await db.prune_to_size(max_bytes=max_bytes, max_patterns=5) > 0:
+                pass
+            assert await db.get_size() <= max_bytes
+            for view, first_index in ((db, 0), (db_a, 1)):
+                view_names = await view.get_pattern_names()
+                assert 2 < len(view_names) < 45
+                all_names = [f"pattern {i}" for i in range(first_index, 100, 2)]
+                assert view_names == all_names[-len(view_names) :]
+            while await db.prune_to_size(max_bytes=1, max_patterns=5) > 0:
+                pass
+            assert await db.get_pattern_names() == ["pattern 96", "pattern 98"]
+            assert await db_a.get_pattern_names() == ["pattern 97", "pattern 99"]
+            assert await db.get_min_size() == await db.get_size() < max_bytes
+            assert db.get_disk_size() >= dbpath.stat().st_size
+
+            # Deleting patterns frees pages; vacuuming returns them
+            file_size = dbpath.stat().st_size
+            num_free_pages = await db.incremental_vacuum(max_pages=1)
+            assert num_free_pages > 0
+            assert await db.incremental_vacuum(max_pages=num_free_pages) == 0
+            await db.checkpoint()
+            assert dbpath.stat().st_size < file_size
+            assert await db.quick_check(should_stop=lambda: False) == "ok"
+
+
+@pytest.mark.parametrize("has_search_index", [True, False])
+async def test_search_patterns(has_search_index: bool) -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            # Without the full-text index, search falls back to substrings
+            assert db._shared.has_search_index
+            db._shared.has_search_index = has_search_index
+            patterns = [read_reduced_pattern(path) for path in all_pattern_paths]
+            for pattern in patterns:
+                await db.add_pattern(pattern)
+            newest_first = [pattern.name for pattern in reversed(patterns)]
+
+            total, items = await db.search_patterns()
+            assert total == len(patterns)
+            assert [item.name for item in items] == newest_first
+
+            total, items = await db.search_patterns(offset=2, limit=3)
+            assert total == len(patterns)
+            assert [item.name for item in items] == newest_first[2:5]
+
+            for query in ("Color LIFT", "two col", "wif"):
+                words = query.lower().split()
+                expected_names = [
+                    name
+                    for name in newest_first
+                    if all(word in name.lower() for word in words)
+                ]
+                assert expected_names
+                total, items = await db.search_patterns(query=query)
+                assert total == len(expected_names)
+                assert [item.name for item in items] == expected_names
+
+            num_shafts = items[0].num_shafts
+            total, items = await db.search_patterns(query=f"shafts:{num_shafts} wif")
+            assert total > 0
+            assert all(
+                item.num_shafts == num_shafts and item.name.endswith(".wif")
+                for item in items
+            )
+
+            # Punctuation, SQL wildcards and FTS operators are not special
+            for query in ('"', "%", "_", "or(", "NOT", "AND two"):
+                total, items = await db.search_patterns(query=query)
+                assert total == 0
+                assert items == []
+
+            # Other loom's patterns are not found
+            assert await db.for_loom("a").search_patterns() == (0, [])
+
+            for query in ("foo:1", "shafts:x", "picks:-1"):
+                with pytest.raises(ValueError):
+                    await db.search_patterns(query=query)
+
+
+async def test_shared_connection() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        db = PatternDatabase(dbpath)
+        db_a = db.for_loom("a")
+        with pytest.raises(RuntimeError):
+            await db.get_pattern_names()
+
+        # Views share one connection, which stays open until the last close
+        await db.init()
+        await db_a.init()
+        assert db.is_open and db_a.is_open
+        conn = sqlite3.connect(dbpath)
+        try:
+            assert conn.execute("pragma journal_mode").fetchone()[0] == "wal"
+        finally:
+            conn.close()
+        await db.close()
+        assert db_a.is_open
+        assert await db_a.get_pattern_names() == []
+
+        # Concurrent adds are each a single transaction
+        patterns = [read_reduced_pattern(path) for path in all_pattern_paths[0:4]]
+        await asyncio.gather(
+            *[db_a.add_pattern(pattern, max_entries=3) for pattern in patterns]
+        )
+        # (patterns are encoded in a thread, so they may finish in any order)
+        names = await db_a.get_pattern_names()
+        assert len(names) == 3
+        assert set(names) < {pattern.name for pattern in patterns}
+        await db_a.close()
+        assert not db.is_open
+        await db_a.close()
+
+        # Closing the last connection removes the write-ahead log
+        assert not pathlib.Path(f"{dbpath}-wal").exists()
+
+
+async def test_pattern_cache() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            db_a = db.for_loom("a")
+            assert db_a.cache is db.cache
+            pattern1 = read_reduced_pattern(all_pattern_paths[0])
+            pattern2 = read_reduced_pattern(all_pattern_paths[1])
+            await db.add_pattern(pattern1)
+            await db.add_pattern(pattern2)
+            await db_a.add_pattern(pattern1)
+
+            # Switching between patterns hits the cache
+            for _ in range(3):
+                for pattern in (pattern1, pattern2):
+                    returned_pattern = await db.get_pattern(pattern.name)
+                    assert returned_pattern == pattern
+            assert db.cache.stats.num_misses == 2
+            assert db.cache.stats.num_hits == 4
+
+            # Pick numbers come from the database
+            await db.update_pick_number(
+                pattern_name=pattern1.name, pick_number=4, repeat_number=3
+            )
+            returned_pattern = await db.get_pattern(pattern1.name)
+            assert returned_pattern.pick_number == 4
+            assert returned_pattern.repeat_number == 3
+            assert db.cache.stats.num_hits == 5
+
+            # Looms have separate pick numbers, but share cached content,
+            # even under a different name
+            assert (await db_a.get_pattern(pattern1.name)) == pattern1
+            renamed_pattern1 = copy.copy(pattern1)
+            renamed_pattern1.name = "renamed"
+            await db_a.add_pattern(renamed_pattern1)
+            assert (await db_a.get_pattern("renamed")) == renamed_pattern1
+            assert db.cache.stats.num_misses == 2
+            assert db.cache.stats.num_hits == 7
+
+            # Re-uploading changed content does not use the old cached pattern
+            changed_pattern1 = read_reduced_pattern(all_pattern_paths[0])
+            changed_pattern1.color_table = changed_pattern1.color_table[::-1]
+            await db.add_pattern(changed_pattern1)
+            assert await db.get_pattern(pattern1.name) == changed_pattern1
+            assert db.cache.stats.num_misses == 3
+
+            await db.clear_database()
+            with pytest.raises(LookupError):
+                await db.get_pattern(pattern2.name)
+            assert (await db_a.get_pattern(pattern1.name)) == pattern1
 
 
 async def test_create_database() -> None:
@@ -127,11 +1047,14 @@ async def test_create_database() -> None:
         ]
         assert pattern_names == expected_pattern_names
 
+        await db.close()
+
         # Test that a re-created database has the saved information
         dbpath = pathlib.Path(f.name)
         db = await create_pattern_database(dbpath)
         initial_pattern_names = await db.get_pattern_names()
         assert initial_pattern_names == expected_pattern_names
+        await db.close()
 
 
 async def test_update_pick() -> None:
@@ -167,3 +1090,4 @@ async def test_update_pick() -> None:
             assert pattern.name == pattern_name
             assert pattern.pick_number == pick_number
             assert pattern.repeat_number == repeat_number
+        await db.close()
@@ -0,0 +1,80 @@
+import io
+import pathlib
+import tempfile
+import zipfile
+
+import dtx_to_wif
+import pytest
+
+from toika_loom_server.pattern_codec import decode_pattern
+from toika_loom_server.pattern_database import PatternDatabase
+from toika_loom_server.pattern_export import (
+    EXPORT_FORMATS,
+    NATIVE_SUFFIX,
+    export_patterns,
+)
+from toika_loom_server.reduced_pattern import (
+    ReducedPattern,
+    read_full_pattern,
+    reduced_pattern_from_pattern_data,
+)
+
+datadir = pathlib.Path(__file__).parent / "data"
+
+all_pattern_paths = list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx"))
+
+
+def read_reduced_pattern(path: pathlib.Path) -> ReducedPattern:
+    full_pattern = read_full_pattern(path)
+    return reduced_pattern_from_pattern_data(name=path.name, data=full_pattern)
+
+
+async def test_export_patterns() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        dbpath = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with PatternDatabase(dbpath) as db:
+            patterns = [read_reduced_pattern(path) for path in all_pattern_paths]
+            for pattern in patterns:
+                await db.add_pattern(pattern)
+            await db.update_pick_number(
+                pattern_name=patterns[-1].name, pick_number=3, repeat_number=2
+            )
+            patterns[-1].pick_number = 3
+            patterns[-1].repeat_number = 2
+            # Another loom's patterns are not exported
+            await db.for_loom("other").add_pattern(patterns[0])
+
+            for format in EXPORT_FORMATS:
+                chunks = [chunk async for chunk in export_patterns(db, format=format)]
+                # One chunk per pattern, plus the central directory
+                assert len(chunks) == len(patterns) + 1
+                with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zip_file:
+                    assert zip_file.testzip() is None
+                    filenames = zip_file.namelist()
+                    # Pattern files with the same name but a different
+                    # suffix (e.g. foo.wif and foo.dtx) get unique names
+                    assert len(set(filenames)) == len(patterns)
+                    for filename, pattern in zip(filenames, patterns):
+                        data = zip_file.read(filename)
+                        if format == "wif":
+                            assert filename.endswith(".wif")
+                            exported_pattern = reduced_pattern_from_pattern_data(
+                                name=pattern.name,
+                                data=dtx_to_wif.read_wif(io.StringIO(data.decode())),
+                            )
+                            exported_pattern.pick_number = pattern.pick_number
+                            exported_pattern.repeat_number = pattern.repeat_number
+                        else:
+                            assert filename.endswith(NATIVE_SUFFIX)
+                            exported_pattern = decode_pattern(data)
+                        assert exported_pattern == pattern
+
+            with pytest.raises(ValueError):
+                async for chunk in export_patterns(db, format="bogus"):
+                    pass
+
+            # An empty library exports an empty zip file
+            await db.clear_database()
+            data = b"".join([chunk async for chunk in export_patterns(db)])
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                assert zip_file.namelist() == []
@@ -0,0 +1,100 @@
+import asyncio
+import pathlib
+
+import pytest
+
+from toika_loom_server.pattern_parser import PatternParser, parse_pattern_file
+
+datadir = pathlib.Path(__file__).parent / "data"
+
+all_pattern_paths = list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx"))
+
+# A pattern file that read_wif never finishes parsing
+# (it has no [WIF] section)
+hanging_data = "not a pattern"
+
+
+async def test_parse() -> None:
+    parser = PatternParser()
+    try:
+        for path in all_pattern_paths:
+            data = path.read_text()
+            pattern = await parser.parse(filename=path.name, data=data)
+            assert pattern == parse_pattern_file(filename=path.name, data=data)
+        # The worker is reused
+        assert parser.get_stats()["num_workers"] == 1
+        assert parser.parse_durations.num_values == len(all_pattern_paths)
+
+        # Parsing errors are raised, and the worker is still used
+        for filename, data in (
+            ("unsupported.txt", all_pattern_paths[0].read_text()),
+            ("invalid.wif", "[WIF]"),
+        ):
+            with pytest.raises(Exception) as exc_info:
+                parse_pattern_file(filename=filename, data=data)
+            with pytest.raises(exc_info.type):
+                await parser.parse(filename=filename, data=data)
+        assert parser.get_stats()["num_workers"] == 1
+    finally:
+        parser.close()
+    assert parser.get_stats()["num_workers"] == 0
+
+
+async def test_timeout_and_cancel() -> None:
+    path = all_pattern_paths[0]
+    parser = PatternParser(timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError):
+            await parser.parse(filename="hanging.wif", data=hanging_data)
+        # The worker was killed
+        assert parser.get_stats()["num_workers"] == 0
+        assert parser.num_timeouts == 1
+
+        parser.timeout = 0
+        parse_task = asyncio.create_task(
+            parser.parse(filename="hanging.wif", data=hanging_data)
+        )
+        await asyncio.sleep(0.5)
+        parse_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await parse_task
+        assert parser.get_stats()["num_workers"] == 0
+        assert parser.num_cancelled == 1
+
+        # A new worker is started as needed
+        pattern = await parser.parse(filename=path.name, data=path.read_text())
+        assert pattern.name == path.name
+        assert parser.get_stats()["num_workers"] == 1
+    finally:
+        parser.close()
+
+
+async def test_max_jobs() -> None:
+    parser = PatternParser(max_jobs=1)
+    max_jobs_running = 0
+
+    async def monitor_jobs() -> None:
+        nonlocal max_jobs_running
+        while True:
+            max_jobs_running = max(max_jobs_running, parser.num_jobs_running)
+            await asyncio.sleep(0.01)
+
+    monitor_task = asyncio.create_task(monitor_jobs())
+    try:
+        patterns = await asyncio.gather(
+            *[
+                parser.parse(filename=path.name, data=path.read_text())
+                for path in all_pattern_paths
+            ]
+        )
+        assert [pattern.name for pattern in patterns] == [
+            path.name for path in all_pattern_paths
+        ]
+        assert max_jobs_running == 1
+        assert parser.get_stats()["num_workers"] == 1
+    finally:
+        monitor_task.cancel()
+        parser.close()
+
+    with pytest.raises(ValueError):
+        PatternParser(max_jobs=0)
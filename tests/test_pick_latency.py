@@ -0,0 +1,65 @@
+import pytest
+
+from toika_loom_server.pick_latency import (
+    LATENCY_BUCKET_BOUNDS,
+    PICK_STAGES,
+    LatencyHistogram,
+    PickLatencyRecorder,
+)
+
+
+def test_latency_histogram() -> None:
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) is None
+    assert histogram.as_dict() == dict(
+        num_values=0, mean=None, p50=None, p95=None, p99=None, max=None
+    )
+    assert list(LATENCY_BUCKET_BOUNDS) == sorted(LATENCY_BUCKET_BOUNDS)
+
+    # 90 fast values, 9 medium, 1 slow
+    for _ in range(90):
+        histogram.record(15e-6)
+    for _ in range(9):
+        histogram.record(1.5e-3)
+    histogram.record(0.3)
+    summary = histogram.as_dict()
+    assert summary["num_values"] == 100
+    assert summary["mean"] == pytest.approx((90 * 15e-6 + 9 * 1.5e-3 + 0.3) / 100)
+    # Percentiles are the upper bound of the bucket
+    assert summary["p50"] == pytest.approx(20e-6)
+    assert summary["p95"] == pytest.approx(2e-3)
+    assert summary["p99"] == pytest.approx(2e-3)
+    assert histogram.percentile(100) == pytest.approx(0.3)
+    assert summary["max"] == pytest.approx(0.3)
+
+    # Values beyond the last bucket are reported as the max
+    histogram.record(100)
+    assert histogram.percentile(100) == 100
+    assert histogram.max == 100
+
+
+def test_pick_latency_recorder() -> None:
+    recorder = PickLatencyRecorder()
+    for stage in PICK_STAGES:
+        recorder.record(stage, 1e-4)
+    with pytest.raises(KeyError):
+        recorder.record("no such stage", 1e-4)
+    recorder.record_bytes_read(2)
+    recorder.record_bytes_written(5, is_pick=True)
+    recorder.record_bytes_written(3)
+    stats = recorder.as_dict()
+    assert set(stats["stages"]) == set(PICK_STAGES)
+    for stage in PICK_STAGES:
+        assert stats["stages"][stage]["num_values"] == 1
+        assert stats["stages"][stage]["max"] == pytest.approx(1e-4)
+    serial = stats["serial"]
+    assert serial["num_bytes_read"] == 2
+    assert serial["num_bytes_written"] == 8
+    assert serial["pick_wire_time"] == pytest.approx(5 * 10 / 9600)
+    assert 0 < serial["read_utilization"] < serial["write_utilization"]
+
+    recorder.reset()
+    stats = recorder.as_dict()
+    assert stats["stages"]["total"]["num_values"] == 0
+    assert stats["serial"]["num_bytes_written"] == 0
+    assert stats["serial"]["pick_wire_time"] is None
@@ -0,0 +1,99 @@
+import pathlib
+
+from toika_loom_server.client_replies import JumpPickNumber
+from toika_loom_server.loom_constants import TERMINATOR
+from toika_loom_server.pick_pipeline import PickPipeline
+from toika_loom_server.reduced_pattern import (
+    ReducedPattern,
+    read_full_pattern,
+    reduced_pattern_from_pattern_data,
+)
+
+datadir = pathlib.Path(__file__).parent / "data"
+
+
+def read_reduced_pattern(path: pathlib.Path) -> ReducedPattern:
+    full_pattern = read_full_pattern(path)
+    return reduced_pattern_from_pattern_data(name=path.name, data=full_pattern)
+
+
+def test_advance() -> None:
+    pattern = read_reduced_pattern(next(datadir.glob("*.wif")))
+    num_picks = len(pattern.picks)
+    pipeline = PickPipeline()
+    assert pipeline.advance(weave_forward=True) is None
+
+    assert not pipeline.set_pattern(pattern)
+    expected_pick_number = 0
+    expected_repeat_number = 1
+    for weave_forward in (True, False):
+        for _ in range(num_picks * 2 + 3):
+            # Compare to the simple pattern-based computation
+            expected_pick_number, expected_repeat_number = (
+                pattern.compute_next_pick_number(weave_forward=weave_forward)
+            )
+            prepared_pick = pipeline.advance(weave_forward=weave_forward)
+            assert prepared_pick is not None
+            assert prepared_pick.pattern_name == pattern.name
+            assert prepared_pick.pick_number == expected_pick_number
+            assert prepared_pick.repeat_number == expected_repeat_number
+            assert not prepared_pick.is_jump
+            assert (
+                prepared_pick.cmdbytes
+                == pattern.get_shaft_bytes(expected_pick_number) + TERMINATOR
+            )
+            assert pattern.pick_number == expected_pick_number
+            assert pattern.repeat_number == expected_repeat_number
+
+
+def test_jump() -> None:
+    pattern = read_reduced_pattern(next(datadir.glob("*.dtx")))
+    pipeline = PickPipeline()
+    pipeline.set_pattern(pattern)
+    assert not pipeline.clear_jump_pick()
+
+    for jump_pick_number, jump_repeat_number in (
+        (3, None),
+        (None, 5),
+        (2, -2),
+    ):
+        jump_pick = JumpPickNumber(
+            pick_number=jump_pick_number, repeat_number=jump_repeat_number
+        )
+        initial_pick_number = pattern.pick_number
+        initial_repeat_number = pattern.repeat_number
+        pipeline.set_jump_pick(jump_pick)
+        # Setting a jump does not change the current pick
+        assert pattern.pick_number == initial_pick_number
+        assert pattern.repeat_number == initial_repeat_number
+        for weave_forward in (True, False):
+            prepared_pick = pipeline.next_picks[weave_forward]
+            assert prepared_pick.is_jump
+            next_pick_number, next_repeat_number = pattern.compute_next_pick_number(
+                weave_forward=weave_forward
+            )
+            if jump_pick_number is None:
+                assert prepared_pick.pick_number == next_pick_number
+            else:
+                assert prepared_pick.pick_number == jump_pick_number
+            if jump_repeat_number is None:
+                assert prepared_pick.repeat_number == initial_repeat_number
+            else:
+                assert prepared_pick.repeat_number == jump_repeat_number
+
+        advanced_pick = pipeline.advance(weave_forward=True)
+        assert advanced_pick is not None
+        assert advanced_pick.is_jump
+        assert pipeline.jump_pick == JumpPickNumber(
+            pick_number=None, repeat_number=None
+        )
+        assert not pipeline.next_picks[True].is_jump
+
+    # Setting a new pattern clears the jump
+    pipeline.set_jump_pick(JumpPickNumber(pick_number=1, repeat_number=None))
+    assert pipeline.set_pattern(pattern)
+    assert pipeline.jump_pick == JumpPickNumber(pick_number=None, repeat_number=None)
+
+    pipeline.set_jump_pick(JumpPickNumber(pick_number=1, repeat_number=None))
+    assert pipeline.clear_jump_pick()
+    assert not pipeline.next_picks[True].is_jump
@@ -1,12 +1,18 @@
 import copy
 import dataclasses
+import io
 import pathlib
+import random
 
+import dtx_to_wif
 import pytest
 
 from toika_loom_server.reduced_pattern import (
+    HAVE_NUMPY,
+    MAX_SHAFTS,
     Pick,
     ReducedPattern,
+    pattern_data_from_reduced_pattern,
     read_full_pattern,
     reduced_pattern_from_pattern_data,
 )
@@ -26,6 +32,50 @@ def shaft_set_from_reduced(
     }
 
 
+def make_pattern_data(
+    num_picks: int, treadled: bool, num_shafts: int = 24, seed: int = 0
+) -> dtx_to_wif.PatternData:
+    """Make a random pattern, with a liftplan or a tieup and treadling.
+
+    Some picks have no shafts raised (or no treadles) or are missing.
+    """
+    rng = random.Random(seed)
+    num_treadles = 10
+
+    def random_set(max_value: int) -> set[int]:
+        return {value for value in range(1, max_value + 1) if rng.random() < 0.5}
+
+    liftplan: dict[int, set[int]] = {}
+    tieup: dict[int, set[int]] = {}
+    treadling: dict[int, set[int]] = {}
+    for pick in range(1, num_picks + 1):
+        if pick % 10 == 5:
+            continue
+        if treadled:
+            treadling[pick] = {
+                rng.randint(1, num_treadles),
+                rng.randint(0, num_treadles),
+            }
+        else:
+            liftplan[pick] = random_set(num_shafts) or {0}
+    if treadled:
+        tieup = {
+            treadle: random_set(num_shafts) for treadle in range(1, num_treadles + 1)
+        }
+    return dtx_to_wif.PatternData(
+        name="random",
+        threading={warp: {rng.randint(1, num_shafts)} for warp in range(1, 101)},
+        tieup=tieup,
+        treadling=treadling,
+        liftplan=liftplan,
+        color_table={1: (255, 255, 255), 2: (0, 0, 0), 3: (255, 0, 0)},
+        color_range=(0, 255),
+        warp=dtx_to_wif.WarpWeftData(color=1),
+        weft=dtx_to_wif.WarpWeftData(color=2),
+        weft_colors={pick: 3 for pick in range(1, num_picks + 1, 3)},
+    )
+
+
 def test_basics() -> None:
     for filepath in list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx")):
         full_pattern = read_full_pattern(filepath)
@@ -154,3 +204,139 @@ def test_color_table() -> None:
                 for rgbi in range(3)
             ]
             assert reduced_rgbvalues == expected_reduced_rgbvalues
+
+
+def test_pattern_data_from_reduced_pattern() -> None:
+    for filepath in list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx")):
+        reduced_pattern = reduced_pattern_from_pattern_data(
+            name=filepath.name, data=read_full_pattern(filepath)
+        )
+        pattern_data = pattern_data_from_reduced_pattern(reduced_pattern)
+        assert pattern_data.name == filepath.name
+
+        # Round trip through a WIF file
+        wif_file = io.StringIO()
+        dtx_to_wif.write_wif(wif_file, pattern_data)
+        wif_file.seek(0)
+        assert (
+            reduced_pattern_from_pattern_data(
+                name=filepath.name, data=dtx_to_wif.read_wif(wif_file)
+            )
+            == reduced_pattern
+        )
+
+    bad_color_pattern = ReducedPattern(
+        name="bad color",
+        color_table=["#ffffff", "red"],
+        warp_colors=[0, 1],
+        threading=[0, 1],
+        picks=[Pick(color=1, are_shafts_up=[True, False])],
+        pick0=Pick(color=2, are_shafts_up=[False, False]),
+    )
+    with pytest.raises(ValueError):
+        pattern_data_from_reduced_pattern(bad_color_pattern)
+
+
+def test_shaft_word_table() -> None:
+    for filepath in list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx")):
+        full_pattern = read_full_pattern(filepath)
+        reduced_pattern = reduced_pattern_from_pattern_data(
+            name=filepath.name, data=full_pattern
+        )
+        num_picks = len(reduced_pattern.picks)
+        assert len(reduced_pattern.shaft_word_table) == 4 * (num_picks + 1)
+        assert len(reduced_pattern.pick_colors) == num_picks + 1
+        for pick_number in range(num_picks + 1):
+            if pick_number == 0:
+                pick = reduced_pattern.pick0
+            else:
+                pick = reduced_pattern.picks[pick_number - 1]
+            shaft_bytes = reduced_pattern.get_shaft_bytes(pick_number)
+            assert shaft_bytes == pick.shaft_word.to_bytes(length=4, byteorder="big")
+            assert reduced_pattern.pick_colors[pick_number] == pick.color
+            for shaft_index, is_up in enumerate(pick.are_shafts_up):
+                assert bool(pick.shaft_word & (1 << shaft_index)) == is_up
+
+            reduced_pattern.set_current_pick_number(pick_number)
+            assert reduced_pattern.get_current_shaft_bytes() == shaft_bytes
+
+        for invalid_pick_number in (-1, num_picks + 1):
+            with pytest.raises(IndexError):
+                reduced_pattern.get_shaft_bytes(invalid_pick_number)
+
+        # The compiled tables survive a round trip through a dict
+        round_trip_pattern = ReducedPattern.from_dict(
+            dataclasses.asdict(reduced_pattern)
+        )
+        assert round_trip_pattern.shaft_word_table == reduced_pattern.shaft_word_table
+        assert round_trip_pattern.pick_colors == reduced_pattern.pick_colors
+
+
+def test_too_many_shafts() -> None:
+    filepath = next(datadir.glob("*.wif"))
+    reduced_pattern = reduced_pattern_from_pattern_data(
+        name=filepath.name, data=read_full_pattern(filepath)
+    )
+    patterndict = dataclasses.asdict(reduced_pattern)
+    patterndict["picks"][0]["are_shafts_up"] = [True] * (MAX_SHAFTS + 1)
+    with pytest.raises(ValueError):
+        ReducedPattern.from_dict(patterndict)
+
+
+def test_without_numpy(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("toika_loom_server.reduced_pattern.HAVE_NUMPY", False)
+    filepath = next(datadir.glob("*.wif"))
+    pattern_data = read_full_pattern(filepath)
+    with pytest.raises(ImportError):
+        reduced_pattern_from_pattern_data(
+            name=filepath.name, data=pattern_data, use_numpy=True
+        )
+    # By default, the pure Python conversion is used
+    assert reduced_pattern_from_pattern_data(
+        name=filepath.name, data=pattern_data
+    ) == reduced_pattern_from_pattern_data(
+        name=filepath.name, data=pattern_data, use_numpy=False
+    )
+
+
+@pytest.mark.skipif(not HAVE_NUMPY, reason="NumPy is not installed")
+def test_numpy() -> None:
+    pattern_datas = [
+        read_full_pattern(filepath)
+        for filepath in list(datadir.glob("*.wif")) + list(datadir.glob("*.dtx"))
+    ]
+    pattern_datas += [
+        make_pattern_data(num_picks=1000, treadled=treadled)
+        for treadled in (False, True)
+    ]
+    pattern_datas.append(make_pattern_data(num_picks=10, treadled=False, num_shafts=3))
+    # The NumPy conversion gives the same result as the pure Python one
+    for pattern_data in pattern_datas:
+        for is_rising_shed in (True, False):
+            pattern_data.is_rising_shed = is_rising_shed
+            python_pattern, numpy_pattern = (
+                reduced_pattern_from_pattern_data(
+                    name=pattern_data.name, data=pattern_data, use_numpy=use_numpy
+                )
+                for use_numpy in (False, True)
+            )
+            assert numpy_pattern == python_pattern
+            assert numpy_pattern.shaft_word_table == python_pattern.shaft_word_table
+            assert numpy_pattern.pick_colors == python_pattern.pick_colors
+
+    # And the same errors
+    too_many_shafts = make_pattern_data(
+        num_picks=10, treadled=False, num_shafts=MAX_SHAFTS + 1
+    )
+    too_many_shafts.liftplan[1] = {MAX_SHAFTS + 1}
+    no_shafts = make_pattern_data(num_picks=10, treadled=False)
+    no_shafts.liftplan = {pick: {0} for pick in no_shafts.liftplan}
+    for pattern_data, exception in (
+        (too_many_shafts, ValueError),
+        (no_shafts, RuntimeError),
+    ):
+        for use_numpy in (False, True):
+            with pytest.raises(exception):
+                reduced_pattern_from_pattern_data(
+                    name=pattern_data.name, data=pattern_data, use_numpy=use_numpy
+                )
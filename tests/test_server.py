@@ -1,17 +1,39 @@
+import asyncio
 import io
 import pathlib
 import random
+import socket
 import tempfile
+import time
+import zipfile
 from typing import Any
 
+import pytest
 from dtx_to_wif import read_dtx, read_wif
 
-from toika_loom_server import mock_loom
+from toika_loom_server import loom_server, main, mock_loom
+from toika_loom_server.client_replies import (
+    ConnectionStateEnum,
+    CurrentPickNumber,
+    JumpPickNumber,
+)
+from toika_loom_server.loom_driver import LoomDriver
+from toika_loom_server.loom_thread import LoomThread
+from toika_loom_server.mock_loom_server import MockLoomServer
+from toika_loom_server.pattern_database import PatternDatabase
 from toika_loom_server.reduced_pattern import (
     ReducedPattern,
+    read_full_pattern,
     reduced_pattern_from_pattern_data,
 )
-from toika_loom_server.testutils import WebSocketType, create_test_client, receive_dict
+from toika_loom_server.testutils import (
+    WebSocketType,
+    create_liftplan_wif,
+    create_test_client,
+    read_initial_replies,
+    receive_dict,
+    upload_pattern,
+)
 
 # Speed up tests
 mock_loom.SHAFT_MOTION_DURATION = 0.1
@@ -71,10 +93,13 @@ def test_jump_to_pick() -> None:
                 )
 
 
-def test_oobcommand() -> None:
+@pytest.mark.parametrize("loom_thread", [False, True])
+def test_oobcommand(loom_thread: bool) -> None:
     pattern_name = all_pattern_paths[2].name
 
-    with create_test_client(upload_patterns=all_pattern_paths[0:3]) as (
+    with create_test_client(
+        upload_patterns=all_pattern_paths[0:3], loom_thread=loom_thread
+    ) as (
         client,
         websocket,
     ):
@@ -175,6 +200,57 @@ def command_next_pick(
         assert reply == expected_reply
 
 
+def test_multiple_looms() -> None:
+    pattern_paths_a = all_pattern_paths[0:2]
+    pattern_path_b = all_pattern_paths[2]
+    with create_test_client(
+        serial_port="a=mock",
+        extra_serial_ports=["b=mock"],
+        loom_id="a",
+        upload_patterns=pattern_paths_a,
+    ) as (
+        client,
+        websocket_a,
+    ):
+        # Each loom has its own page and stats; unknown looms are rejected
+        for loom_id in ("a", "b"):
+            assert client.get(f"/loom/{loom_id}/").status_code == 200
+            stats = client.get(f"/loom/{loom_id}/stats").json()
+            assert stats["link_round_trip_time"] is None
+        assert client.get("/loom/c/").status_code == 404
+        assert client.get("/loom/c/stats").status_code == 404
+
+        with client.websocket_connect("/loom/b/ws") as websocket_b:
+            # Loom b does not see loom a's patterns
+            read_initial_replies(
+                websocket=websocket_b,
+                expected_pattern_names=[],
+                expected_current_pattern=None,
+            )
+            upload_pattern(websocket_b, pattern_path_b)
+            reply = receive_dict(websocket_b)
+            assert reply["type"] == "PatternNames"
+            assert reply["names"] == [pattern_path_b.name]
+
+            select_pattern(websocket=websocket_a, pattern_name=pattern_paths_a[1].name)
+            select_pattern(websocket=websocket_b, pattern_name=pattern_path_b.name)
+
+            # The looms weave independently
+            for expected_pick_number in (1, 2, 3):
+                command_next_pick(
+                    websocket=websocket_a,
+                    jump_pending=False,
+                    expected_pick_number=expected_pick_number,
+                    expected_repeat_number=1,
+                )
+            command_next_pick(
+                websocket=websocket_b,
+                jump_pending=False,
+                expected_pick_number=1,
+                expected_repeat_number=1,
+            )
+
+
 def test_pattern_persistence() -> None:
     rnd = random.Random(47)
     pattern_list = []
@@ -276,6 +352,303 @@ def test_select_pattern() -> None:
         assert returned_pattern == reduced_pattern
 
 
+async def test_write_behind_persistence() -> None:
+    path = all_pattern_paths[1]
+    pattern = reduced_pattern_from_pattern_data(
+        name=path.name, data=read_full_pattern(path)
+    )
+    with tempfile.TemporaryDirectory() as tempdir:
+        db_path = pathlib.Path(tempdir) / "patterns.sqlite"
+        async with loom_server.LoomServer(
+            serial_port="mock",
+            translation_dict={},
+            reset_db=True,
+            verbose=False,
+            db_path=db_path,
+            persist_interval=0.2,
+            persist_picks=3,
+        ) as server:
+            await server.add_pattern(pattern)
+            await server.select_pattern(pattern.name)
+
+            async def weave_picks(num_picks: int) -> None:
+                for _ in range(num_picks):
+                    server.handle_loom_reply(b"1")
+                await asyncio.sleep(0.05)
+
+            async def get_saved_pick_number() -> int:
+                return (await server.pattern_db.get_pattern(pattern.name)).pick_number
+
+            # Picks are saved once persist_picks are unsaved
+            await weave_picks(2)
+            assert await get_saved_pick_number() == 0
+            await weave_picks(1)
+            assert await get_saved_pick_number() == 3
+            assert server.get_stats()["pick_persistence"] == dict(
+                num_picks=3, num_writes=1, num_unsaved_picks=0
+            )
+
+            # ... or once persist_interval has passed
+            await weave_picks(1)
+            assert await get_saved_pick_number() == 3
+            await asyncio.sleep(0.2)
+            assert await get_saved_pick_number() == 4
+
+            # ... or when the server is closed
+            await weave_picks(1)
+
+        async with PatternDatabase(db_path) as pattern_db:
+            assert (await pattern_db.get_pattern(pattern.name)).pick_number == 5
+
+
+async def test_replace_pattern_with_unsaved_pick() -> None:
+    path = all_pattern_paths[1]
+    pattern = reduced_pattern_from_pattern_data(
+        name=path.name, data=read_full_pattern(path)
+    )
+    with tempfile.TemporaryDirectory() as tempdir:
+        async with loom_server.LoomServer(
+            serial_port="mock",
+            translation_dict={},
+            reset_db=True,
+            verbose=False,
+            db_path=pathlib.Path(tempdir) / "patterns.sqlite",
+            persist_interval=60,
+            persist_picks=100,
+        ) as server:
+            done_future: asyncio.Future = asyncio.Future()
+            done_future.set_result(None)
+            data = path.read_text()
+            await server.upload_pattern(path.name, data, done_future)
+            await server.select_pattern(pattern.name)
+
+            # Re-add or re-upload the pattern while its pick is unsaved;
+            # the pick must not be saved to the new pattern.
+            for replace in ("add", "upload"):
+                for _ in range(2):
+                    server.handle_loom_reply(b"1")
+                await asyncio.sleep(0.05)
+                assert server.picks_to_persist
+                if replace == "add":
+                    await server.add_pattern(pattern)
+                else:
+                    await server.upload_pattern(path.name, data, done_future)
+                    assert server.num_uploads_reused == 1
+                await server.persist_picks()
+                saved_pattern = await server.pattern_db.get_pattern(pattern.name)
+                assert saved_pattern.pick_number == 0
+
+
+async def test_no_stale_pick_reports() -> None:
+    patterns = [
+        reduced_pattern_from_pattern_data(name=path.name, data=read_full_pattern(path))
+        for path in all_pattern_paths[0:2]
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        async with loom_server.LoomServer(
+            serial_port="mock",
+            translation_dict={},
+            reset_db=True,
+            verbose=False,
+            db_path=pathlib.Path(tempdir) / "patterns.sqlite",
+        ) as server:
+            replies: list[Any] = []
+
+            async def record_reply(reply: Any) -> None:
+                replies.append(reply)
+
+            server.reply_to_client = record_reply  # type: ignore[method-assign]
+            for pattern in patterns:
+                await server.add_pattern(pattern)
+            await server.select_pattern(patterns[0].name)
+            for _ in range(3):
+                server.handle_loom_reply(b"1")
+            await asyncio.sleep(0.05)
+            assert [
+                reply.pick_number
+                for reply in replies
+                if isinstance(reply, CurrentPickNumber)
+            ] == [0, 1, 2, 3]
+
+            # A pick of the old pattern that is handled after a new pattern
+            # is selected (e.g. because the loom runs in its own thread)
+            # is not reported
+            prepared_pick = server.pick_pipeline.next_picks[True]
+            await server.select_pattern(patterns[1].name)
+            replies.clear()
+            server.handle_pick_sent(prepared_pick)
+            await asyncio.sleep(0.05)
+            assert replies == []
+
+
+def test_search_patterns() -> None:
+    with create_test_client(upload_patterns=all_pattern_paths) as (
+        client,
+        websocket,
+    ):
+        # Search terms match the start of words in pattern names,
+        # and the most recently used patterns are first
+        websocket.send_json(dict(type="search_patterns", query="two sing"))
+        reply = receive_dict(websocket)
+        assert reply["type"] == "PatternPage"
+        assert reply["query"] == "two sing"
+        assert reply["total"] == 2
+        assert [item["name"] for item in reply["patterns"]] == [
+            path.name
+            for path in reversed(all_pattern_paths)
+            if path.name.startswith("two color single")
+        ]
+        assert reply["patterns"][0]["num_shafts"] > 0
+
+        # Fetch one page at a time
+        num_patterns = len(all_pattern_paths)
+        websocket.send_json(
+            dict(type="search_patterns", query="", offset=num_patterns - 2, limit=5)
+        )
+        reply = receive_dict(websocket)
+        assert reply["total"] == num_patterns
+        assert reply["offset"] == num_patterns - 2
+        assert [item["name"] for item in reply["patterns"]] == [
+            path.name for path in reversed(all_pattern_paths[0:2])
+        ]
+
+        # Search for other patterns with the same warp as the current
+        # pattern: nothing matches if there is no current pattern
+        websocket.send_json(dict(type="search_patterns", query="", same_warp=True))
+        reply = receive_dict(websocket)
+        assert reply["same_warp"]
+        assert reply["total"] == 0
+
+        # In the test data, all "two color" patterns have the same warp
+        current_name = all_pattern_paths[-1].name
+        assert current_name.startswith("two color")
+        select_pattern(websocket, current_name)
+        websocket.send_json(
+            dict(type="search_patterns", query="", same_warp=True, limit=100)
+        )
+        reply = receive_dict(websocket)
+        assert reply["same_warp"]
+        assert [item["name"] for item in reply["patterns"]] == [
+            path.name
+            for path in reversed(all_pattern_paths)
+            if path.name.startswith("two color") and path.name != current_name
+        ]
+        assert reply["total"] == len(reply["patterns"])
+        websocket.send_json(
+            dict(type="search_patterns", query="liftplan", same_warp=True)
+        )
+        reply = receive_dict(websocket)
+        assert [item["name"] for item in reply["patterns"]] == [
+            path.name
+            for path in reversed(all_pattern_paths)
+            if path.name.startswith("two color liftplan")
+        ]
+
+        websocket.send_json(dict(type="search_patterns", query="bogus:3"))
+        reply = receive_dict(websocket)
+        assert reply["type"] == "CommandProblem"
+
+
+def test_backup_and_export() -> None:
+    with create_test_client(upload_patterns=all_pattern_paths[0:2]) as (
+        client,
+        websocket,
+    ):
+        response = client.get("/export")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/zip"
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
+            assert zip_file.namelist() == [
+                path.with_suffix(".wif").name for path in all_pattern_paths[0:2]
+            ]
+        response = client.get("/export", params=dict(format="native"))
+        assert response.status_code == 200
+        assert client.get("/export", params=dict(format="bogus")).status_code == 400
+
+        response = client.get("/backup")
+        assert response.status_code == 200
+        with tempfile.TemporaryDirectory() as tempdir:
+            backup_path = pathlib.Path(tempdir) / "backup.sqlite"
+            backup_path.write_bytes(response.content)
+
+            async def get_backup_names() -> list[str]:
+                async with PatternDatabase(backup_path) as db:
+                    return await db.get_pattern_names()
+
+            assert asyncio.run(get_backup_names()) == [
+                path.name for path in all_pattern_paths[0:2]
+            ]
+
+
+def test_stats() -> None:
+    with create_test_client() as (
+        client,
+        websocket,
+    ):
+        stats = client.get("/stats").json()
+        assert stats["client_sender"]["num_sent"] > 0
+        assert stats["client_sender"]["num_dropped"] == 0
+        # The mock loom is not a network connection
+        assert stats["link_round_trip_time"] is None
+        assert stats["pick_latency"]["stages"]["total"]["num_values"] == 0
+        # Database maintenance waits until the loom is idle
+        assert stats["db_maintenance"]["num_cycles"] == 0
+        assert stats["db_maintenance"]["max_db_bytes"] == 0
+
+        upload_pattern(websocket, all_pattern_paths[1])
+        receive_dict(websocket)
+        select_pattern(websocket=websocket, pattern_name=all_pattern_paths[1].name)
+        for expected_pick_number in (1, 2):
+            command_next_pick(
+                websocket=websocket,
+                jump_pending=False,
+                expected_pick_number=expected_pick_number,
+                expected_repeat_number=1,
+            )
+        pick_latency = client.get("/stats").json()["pick_latency"]
+        total_latency = pick_latency["stages"]["total"]
+        assert total_latency["num_values"] == 2
+        assert 0 <= total_latency["p50"] <= total_latency["max"] < 1
+        assert pick_latency["serial"]["pick_wire_time"] > 0
+        assert main.loom_server is not None
+        assert not main.loom_server.is_idle(idle_time=1)
+
+
+@pytest.mark.skipif(
+    not hasattr(socket, "TCP_INFO"), reason="round-trip time needs TCP_INFO"
+)
+def test_network_link_latency(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(loom_server, "LINK_LATENCY_INTERVAL", 0.05)
+
+    async def start_mock_loom_server() -> MockLoomServer:
+        server = MockLoomServer(port=0)
+        await server.start()
+        return server
+
+    server_thread = LoomThread(name="mock_loom_server")
+    server = asyncio.run_coroutine_threadsafe(
+        start_mock_loom_server(), server_thread.loop
+    ).result(timeout=2)
+    try:
+        with create_test_client(read_initial_state=False, serial_port=server.url) as (
+            client,
+            websocket,
+        ):
+            while True:
+                reply = receive_dict(websocket)
+                if reply["type"] == "LoomLinkLatency":
+                    break
+            assert 0 <= reply["round_trip_time"] < 1
+            stats = client.get("/stats").json()
+            assert stats["link_round_trip_time"]["num_measurements"] >= 1
+            assert 0 <= stats["link_round_trip_time"]["mean"] < 1
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), server_thread.loop).result(
+            timeout=2
+        )
+        server_thread.close()
+
+
 def test_upload() -> None:
     with create_test_client(upload_patterns=all_pattern_paths) as (
         client,
@@ -284,6 +657,109 @@ def test_upload() -> None:
         pass
 
 
+def test_upload_again() -> None:
+    path = all_pattern_paths[1]
+    pattern = reduced_pattern_from_pattern_data(
+        name=path.name, data=read_full_pattern(path)
+    )
+    with create_test_client() as (
+        client,
+        websocket,
+    ):
+        upload_pattern(websocket, path)
+        reply = receive_dict(websocket)
+        assert reply["names"] == [path.name]
+        version = reply["version"]
+
+        # Uploading the same file again, or under another name,
+        # does not parse it again
+        websocket.send_json(dict(type="file", name="copy.wif", data=path.read_text()))
+        assert receive_dict(websocket) == dict(
+            type="PatternNames", names=[path.name, "copy.wif"], version=version + 1
+        )
+        upload_pattern(websocket, path)
+        assert receive_dict(websocket) == dict(
+            type="PatternNames", names=["copy.wif", path.name], version=version + 2
+        )
+        assert client.get("/stats").json()["uploads"] == dict(
+            num_parsed=1, num_reused=2
+        )
+        returned_pattern = select_pattern(websocket=websocket, pattern_name="copy.wif")
+        pattern.name = "copy.wif"
+        assert returned_pattern == pattern
+
+        # A changed file is parsed
+        websocket.send_json(
+            dict(type="file", name="copy.wif", data=path.read_text() + "\n")
+        )
+        assert receive_dict(websocket)["names"] == [path.name, "copy.wif"]
+        assert client.get("/stats").json()["uploads"] == dict(
+            num_parsed=2, num_reused=2
+        )
+
+        # The names are not sent if they have not changed
+        websocket.send_json(
+            dict(type="file", name="copy.wif", data=path.read_text() + "\n")
+        )
+        select_pattern(websocket=websocket, pattern_name=path.name)
+        assert client.get("/stats").json()["uploads"] == dict(
+            num_parsed=2, num_reused=3
+        )
+
+
+@pytest.mark.slow
+def test_weave_while_parsing(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(mock_loom, "SHAFT_MOTION_DURATION", 0.05)
+    # A 3 MB liftplan, which takes a few seconds to parse
+    data = create_liftplan_wif(num_picks=80_000)
+    assert len(data) > 2_500_000
+    path = all_pattern_paths[1]
+    with create_test_client(upload_patterns=[path]) as (
+        client,
+        websocket,
+    ):
+        select_pattern(websocket=websocket, pattern_name=path.name)
+
+        def weave_pick() -> list[str] | None:
+            """Weave a pick; return the pattern names, if reported."""
+            pattern_names = None
+            websocket.send_json(dict(type="oobcommand", command="n"))
+            while True:
+                reply = receive_dict(websocket)
+                if reply["type"] == "CurrentPickNumber":
+                    return pattern_names
+                assert reply["type"] == "PatternNames"
+                pattern_names = reply["names"]
+
+        # Measure the time to weave each pick, first with nothing
+        # else to do, then until the large pattern has been added.
+        baseline_durations: list[float] = []
+        for _ in range(5):
+            start_time = time.monotonic()
+            assert weave_pick() is None
+            baseline_durations.append(time.monotonic() - start_time)
+
+        pick_durations: list[float] = []
+        pattern_names = None
+        parse_start_time = time.monotonic()
+        websocket.send_json(dict(type="file", name="large.wif", data=data))
+        while pattern_names is None:
+            start_time = time.monotonic()
+            pattern_names = weave_pick()
+            pick_durations.append(time.monotonic() - start_time)
+            time.sleep(0.05)
+        parse_duration = time.monotonic() - parse_start_time
+        assert pattern_names == [path.name, "large.wif"]
+        # Weaving continued while the pattern was parsed. Had parsing
+        # blocked the event loop, one pick would have taken about
+        # as long as the whole parse.
+        assert len(pick_durations) > 5
+        assert max(pick_durations) < max(baseline_durations) + parse_duration / 4
+        stats = client.get("/stats").json()
+        assert stats["uploads"]["num_parsed"] == 2
+        assert stats["pattern_parser"]["num_workers"] == 1
+
+
 def test_weave_direction() -> None:
     # TO DO: expand this test to test commanding the same direction
     # multiple times in a row, once I know what mock loom ought to do.
@@ -299,3 +775,156 @@ def test_weave_direction() -> None:
             websocket.send_json(dict(type="weave_direction", forward=forward))
             reply = receive_dict(websocket)
             assert reply == dict(type="WeaveDirection", forward=forward)
+
+
+def test_weave_with_driver() -> None:
+    pattern_name = all_pattern_paths[2].name
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        socket_path = pathlib.Path(tempdir) / "driver.sock"
+
+        async def start_driver() -> LoomDriver:
+            driver = LoomDriver(serial_port="mock", socket_path=socket_path)
+            await driver.start()
+            return driver
+
+        driver_thread = LoomThread(name="loom_driver")
+        driver = asyncio.run_coroutine_threadsafe(
+            start_driver(), driver_thread.loop
+        ).result(timeout=2)
+        try:
+            with create_test_client(
+                upload_patterns=all_pattern_paths[0:3],
+                serial_port=f"driver:{socket_path}",
+            ) as (
+                client,
+                websocket,
+            ):
+                select_pattern(websocket=websocket, pattern_name=pattern_name)
+                for expected_pick_number in (1, 2, 3):
+                    command_next_pick(
+                        websocket=websocket,
+                        jump_pending=False,
+                        expected_pick_number=expected_pick_number,
+                        expected_repeat_number=1,
+                    )
+
+                websocket.send_json(
+                    dict(type="jump_to_pick", pick_number=5, repeat_number=None)
+                )
+                reply = receive_dict(websocket)
+                assert reply == dict(
+                    type="JumpPickNumber", pick_number=5, repeat_number=None
+                )
+                command_next_pick(
+                    websocket=websocket,
+                    jump_pending=True,
+                    expected_pick_number=5,
+                    expected_repeat_number=1,
+                )
+
+                # The server adopts a jump that is pending in the driver
+                # when it reconnects to the driver.
+                def set_jump_and_disconnect() -> None:
+                    driver.pick_pipeline.set_jump_pick(
+                        JumpPickNumber(pick_number=2, repeat_number=None)
+                    )
+                    assert driver.client_writer is not None
+                    driver.client_writer.close()
+
+                driver_thread.loop.call_soon_threadsafe(set_jump_and_disconnect)
+                jump_replies = []
+                while True:
+                    reply = receive_dict(websocket)
+                    if reply["type"] == "JumpPickNumber":
+                        jump_replies.append(reply)
+                    elif (
+                        reply["type"] == "LoomConnectionState"
+                        and reply["state"] == ConnectionStateEnum.CONNECTED
+                    ):
+                        break
+                assert jump_replies[-1] == dict(
+                    type="JumpPickNumber", pick_number=2, repeat_number=None
+                )
+                command_next_pick(
+                    websocket=websocket,
+                    jump_pending=True,
+                    expected_pick_number=2,
+                    expected_repeat_number=1,
+                )
+
+            # The driver keeps its state after the web server disconnects
+            pattern = driver.pick_pipeline.pattern
+            assert pattern is not None
+            assert pattern.name == pattern_name
+            assert pattern.pick_number == 2
+            assert pattern.repeat_number == 1
+            assert driver.loom_connected
+        finally:
+            asyncio.run_coroutine_threadsafe(driver.close(), driver_thread.loop).result(
+                timeout=2
+            )
+            driver_thread.close()
+
+
+def test_loom_state() -> None:
+    with create_test_client(status_poll_interval=0.02) as (
+        client,
+        websocket,
+    ):
+        # Toggle the mock loom's error flag; the new state is reported
+        websocket.send_json(dict(type="oobcommand", command="e"))
+        while True:
+            reply = receive_dict(websocket)
+            if reply["type"] == "LoomState" and reply["error"]:
+                break
+        assert reply == dict(
+            type="LoomState", shed_fully_closed=True, pick_wanted=False, error=True
+        )
+
+
+def test_reconnect() -> None:
+    pattern_name = all_pattern_paths[1].name
+
+    with create_test_client(upload_patterns=all_pattern_paths[0:2]) as (
+        client,
+        websocket,
+    ):
+        select_pattern(websocket=websocket, pattern_name=pattern_name)
+        for expected_pick_number in (1, 2):
+            command_next_pick(
+                websocket=websocket,
+                jump_pending=False,
+                expected_pick_number=expected_pick_number,
+                expected_repeat_number=1,
+            )
+        websocket.send_json(dict(type="jump_to_pick", pick_number=4, repeat_number=2))
+        reply = receive_dict(websocket)
+        assert reply == dict(type="JumpPickNumber", pick_number=4, repeat_number=2)
+
+        # Tell the mock loom to close the connection;
+        # the server should reconnect on its own.
+        websocket.send_json(dict(type="oobcommand", command="c"))
+        seen_states: list[int] = []
+        while True:
+            reply = receive_dict(websocket)
+            if reply["type"] != "LoomConnectionState":
+                continue
+            seen_states.append(reply["state"])
+            if reply["state"] == ConnectionStateEnum.CONNECTED:
+                break
+        assert seen_states[0] == ConnectionStateEnum.DISCONNECTED
+        assert ConnectionStateEnum.CONNECTING in seen_states
+
+        # The pattern, pick and jump are unchanged
+        command_next_pick(
+            websocket=websocket,
+            jump_pending=True,
+            expected_pick_number=4,
+            expected_repeat_number=2,
+        )
+
+        stats = client.get("/stats").json()["loom_reconnect"]
+        assert stats["num_losses"] == 1
+        assert stats["num_recoveries"] == 1
+        assert 0 < stats["last_time_to_recover"] < 5
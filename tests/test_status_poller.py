@@ -0,0 +1,90 @@
+import asyncio
+
+from toika_loom_server.client_replies import LoomState
+from toika_loom_server.loom_constants import TERMINATOR
+from toika_loom_server.loom_protocol import LoomProtocol
+from toika_loom_server.mock_loom import MockLoom
+from toika_loom_server.status_poller import (
+    STATUS_QUERY,
+    StatusPoller,
+    parse_status_reply,
+)
+
+
+def test_parse_status_reply() -> None:
+    assert parse_status_reply(b"=s5") == 0x5
+    assert parse_status_reply(b"=sd") == 0xD
+    assert parse_status_reply(b"=s") is None
+    assert parse_status_reply(b"=sx") is None
+    assert parse_status_reply(b"1") is None
+
+
+async def test_adaptive_interval() -> None:
+    poll_times: list[float] = []
+    states: list[LoomState] = []
+    loop = asyncio.get_running_loop()
+
+    def write_query() -> bool:
+        poll_times.append(loop.time())
+        return True
+
+    poller = StatusPoller(
+        write_query=write_query,
+        state_callback=states.append,
+        min_interval=0.01,
+        max_interval=0.04,
+    )
+    poller.start()
+    try:
+        # The first poll is immediate
+        await asyncio.sleep(0.005)
+        assert poller.num_polls == 1
+
+        # With no activity the interval grows to max_interval
+        await asyncio.sleep(0.2)
+        assert poller.interval == 0.04
+        num_idle_polls = poller.num_polls
+
+        # Activity resets the interval
+        poller.note_activity()
+        assert poller.interval == 0.01
+        await asyncio.sleep(0.03)
+        assert poller.num_polls >= num_idle_polls + 2
+
+        # Only changes of state are reported
+        poller.handle_state_word(0x1)
+        poller.handle_state_word(0x1)
+        poller.handle_state_word(0x8)
+        assert states == [
+            LoomState(shed_fully_closed=True, pick_wanted=False, error=False),
+            LoomState(shed_fully_closed=False, pick_wanted=False, error=True),
+        ]
+    finally:
+        poller.stop()
+
+
+async def test_mock_loom_status() -> None:
+    async with MockLoom(verbose=False) as loom:
+        replies: asyncio.Queue[bytes] = asyncio.Queue()
+        _, protocol = await loom.open_client_transport(
+            lambda: LoomProtocol(
+                reply_callback=replies.put_nowait,
+                connection_lost_callback=lambda exc: None,
+            )
+        )
+        assert protocol.write_if_idle(STATUS_QUERY)
+        async with asyncio.timeout(1):
+            assert await replies.get() == b"=s1"
+
+        # Toggle the error flag and request a pick
+        protocol.write(b"#e" + TERMINATOR)
+        protocol.write(b"#n" + TERMINATOR)
+        async with asyncio.timeout(1):
+            assert await replies.get() == b"1"
+        protocol.write(STATUS_QUERY)
+        async with asyncio.timeout(1):
+            assert await replies.get() == b"=sd"
+
+        # Writing stays paused: low priority data is not written
+        protocol.pause_writing()
+        assert not protocol.write_if_idle(STATUS_QUERY)